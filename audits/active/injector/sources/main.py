@@ -530,14 +530,15 @@ class ConnectionsWindow(gtk.Dialog):
             conn_man = self.session.context.audit_dispatcher.\
                      get_connection_manager()
 
-            try:
-                idx = conn_man.conn_list.index(self.last_conn) + 1
-            except ValueError, exc:
-                idx = 0
-
-            while idx < len(conn_man.conn_list):
-                self.add_connection(conn_man.conn_list[idx])
-                idx += 1
+            # The last connection could be already expired so look for the
+            # connections created after it
+            if self.last_conn:
+                serial = self.last_conn.serial
+            else:
+                serial = 0
+
+            for conn in conn_man.get_new_connections(serial):
+                self.add_connection(conn)
 
         else:
             page = self.notebook.get_nth_page(page)
@@ -36,20 +36,61 @@ from umit.pm.gui.plugins.tree import *
 from umit.pm.gui.plugins.engine import *
 from umit.pm.manager.auditmanager import *
 from umit.pm.core.netconst import IL_TYPE_ETH
+from umit.pm.core.metrics import metrics, MetricsDumper
+from umit.pm.core.errors import PMErrorException
 from umit.pm.core.atoms import generate_traceback
 
+CAPTURE_EXTS = ('.pcap', '.pcap.gz', '.pcapng', '.pcapng.gz', '.cap')
+
+def get_captures(args):
+    """
+    @return the list of the files passed as arguments. The capture files
+            contained in directories are also included.
+    """
+    files = []
+
+    for arg in args:
+        if os.path.isdir(arg):
+            for name in sorted(os.listdir(arg)):
+                for ext in CAPTURE_EXTS:
+                    if name.endswith(ext):
+                        files.append(os.path.join(arg, name))
+                        break
+        elif os.path.exists(arg):
+            files.append(arg)
+        else:
+            print "Unable to find %s" % arg
+            sys.exit(-1)
+
+    return files
+
 class Tester(object):
     def __init__(self, options, args):
-        if not args or not os.path.exists(args[0]):
+        if options.batch:
+            files = get_captures(args)
+        else:
+            files = args[:1]
+
+        if not files or not os.path.exists(files[0]):
             print "I need a pcap file as input to work."
             sys.exit(-1)
 
-        if options.datalink is None:
+        if options.datalink is None and not options.batch:
             datalink = IL_TYPE_ETH
         else:
+            # In batch mode None means the linktype of every capture
             datalink = options.datalink
 
-        tester = AuditTester(args[0], datalink)
+        try:
+            if options.batch:
+                tester = BatchAuditTester(files, datalink, options.jobs,
+                                          options.split, options.dfilter)
+            else:
+                tester = AuditTester(files[0], datalink, options.workers,
+                                     options.dfilter)
+        except PMErrorException, err:
+            print "Invalid display filter: %s" % err
+            sys.exit(-1)
 
         modules = []
         filters = []
@@ -149,11 +190,29 @@ class Tester(object):
 
         AuditManager().global_conf['debug'] = True
 
-        tester.start()
-        tester.join()
+        dumper = None
+
+        if options.metrics:
+            metrics.enable()
+
+            dumper = MetricsDumper(metrics, options.metrics_out,
+                                   options.metrics, options.metrics_format)
+            dumper.start()
+
+        if options.batch:
+            tester.run()
+
+            for line in tester.get_report():
+                print line
+        else:
+            tester.start()
+            tester.join()
+
+        if dumper:
+            dumper.stop()
 
 if __name__ == "__main__":
-    parser = optparse.OptionParser(usage='%s [options] FILE' % sys.argv[0])
+    parser = optparse.OptionParser(usage='%s [options] FILE...' % sys.argv[0])
 
     parser.add_option('-q', '--quiet', action='store_true', dest='quiet',
                       help='If quiet suppress useless output messages')
@@ -167,6 +226,39 @@ if __name__ == "__main__":
                       help='Option to set. Ex: -sdecoder.ip.checksum_check=1')
     parser.add_option('-p', '--profile', action='store_true', dest='profile',
                       help='Profile the code')
+    parser.add_option('-w', '--workers', action='store', dest='workers',
+                      type='int', default=0,
+                      help='Number of processes used to decode packets. '
+                           'Packets are sharded by flow (0 to disable)')
+    parser.add_option('-F', '--display-filter', action='store',
+                      dest='dfilter', help='Only feed the packets matching '
+                      'the display filter. Ex: -F "tcp.port == 80"')
+    parser.add_option('-b', '--batch', action='store_true', dest='batch',
+                      help='Analyze all the capture files (or directories) '
+                           'passed with a pool of processes and print a '
+                           'merged report')
+    parser.add_option('-j', '--jobs', action='store', dest='jobs',
+                      type='int', default=0,
+                      help='Number of processes used in batch mode (0 to use '
+                           'the number of CPUs)')
+    parser.add_option('-S', '--split', action='store', dest='split',
+                      type='int', default=1,
+                      help='Split every capture in parts at flow boundaries '
+                           'in batch mode. The session counters are '
+                           'reported for every part')
+    parser.add_option('-m', '--metrics', action='store', dest='metrics',
+                      type='float', default=0,
+                      help='Collect metrics and dump them every METRICS '
+                           'seconds and at the end (not collected from the '
+                           'worker processes)')
+    parser.add_option('-M', '--metrics-format', action='store',
+                      dest='metrics_format', default='text',
+                      choices=('text', 'json'),
+                      help='Format of the metrics dump: text or json')
+    parser.add_option('-o', '--metrics-out', action='store',
+                      dest='metrics_out', default=None,
+                      help='Append the metrics dump to this file instead of '
+                           'stderr')
 
     options, args = parser.parse_args()
 
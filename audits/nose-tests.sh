@@ -12,9 +12,28 @@ export PYTHONPATH="$PYTHONPATH:$(dirname `pwd`)"
 echo "Masking pm-prefs.xml"
 mv ~/.PacketManipulator/pm-prefs.xml ~/.PacketManipulator/pm-prefs.xml.bak
 
+# Modules with doctests that can be imported without gtk
+MODULES="
+../benchmarks/suite.py
+../umit/pm/backend/scapy/displayfilter.py
+../umit/pm/backend/scapy/matcher.py
+../umit/pm/backend/scapy/packet.py
+../umit/pm/backend/scapy/pcapindex.py
+../umit/pm/backend/scapy/store.py
+../umit/pm/backend/scapy/utils.py
+../umit/pm/backend/scapy/wrapper.py
+../umit/pm/core/auditutils.py
+../umit/pm/core/metrics.py
+../umit/pm/core/tracing.py
+../umit/pm/gui/core/packetrows.py
+../umit/pm/gui/widgets/hexwindow.py
+"
+
 if [ "$1" = "" ]; then
     echo "Running tests"
     find . -name "main.py" | xargs nosetests --with-doctest
+    echo "Running module tests"
+    nosetests --with-doctest $MODULES
     echo "Restoring pm-prefs.xml"
 else
     echo "Running selected test ($1)"
@@ -24,6 +24,32 @@ FTP protocol dissector (Passive audit)
 >>> from umit.pm.core.auditutils import audit_unittest
 >>> audit_unittest('-f ethernet,ip,tcp,ftp', 'ftp-login.pcap')
 dissector.ftp.info FTP : 127.0.0.1:21 -> USER: anonymous PASS: guest@example.com
+
+In batch mode the dissector sessions are reported by name (for every part
+of a split capture):
+
+>>> audit_unittest('-f ethernet,ip,tcp,ftp -b -j2 -S2', 'ftp-login.pcap')
+== pcap-tests/ftp-login.pcap
+dissector.ftp.info FTP : 127.0.0.1:21 -> USER: anonymous PASS: guest@example.com
+== Summary
+  captures                      1
+  parts                         2
+  failed parts                  0
+  packets                      14
+  bytes                       843
+  decoding errors               0
+  info messages                 1
+== Sessions of part 0
+  live sessions                 2
+  expired sessions              0
+  evicted sessions              0
+  table 0x00000006              1
+  table 0x00000800              1
+  table dissector.ftp           0
+== Sessions of part 1
+  live sessions                 0
+  expired sessions              0
+  evicted sessions              0
 """
 
 from umit.pm.core.logger import log
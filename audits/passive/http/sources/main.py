@@ -79,6 +79,10 @@ class HTTPRequest(object):
         self.body = ''
         self.chunks = [(-1, '')]
 
+        # The body is collected in parts and joined once complete
+        self.body_parts = []
+        self.body_len = 0
+
         self.session = sess
         self.manager = manager
         self.http_type = HTTP_REQUEST
@@ -146,7 +150,7 @@ class HTTPRequest(object):
 
     def _check_finished(self):
         if self.content_length > 0:
-            return self.content_length == len(self.body)
+            return self.content_length == self.body_len
 
         if self.chunked:
             return False
@@ -427,15 +431,17 @@ class HTTPRequest(object):
                 raise Exception('This should not happen')
 
         elif self.content_length > 0:
-            missing = self.content_length - len(self.body)
+            missing = self.content_length - self.body_len
 
             if missing > 0:
                 captured = min(len(payload), missing)
-                self.body += payload[:captured]
+                self._add_body(payload[:captured])
 
-                if len(self.body) == self.content_length:
+                if self.body_len == self.content_length:
+                    self.body = ''.join(self.body_parts)
+                    self.body_parts = []
                     return True, captured + end_ptr
-                elif len(self.body) > self.content_length:
+                elif self.body_len > self.content_length:
                     raise Exception('This is impossible')
                 else:
                     return False, captured + end_ptr
@@ -446,9 +452,15 @@ class HTTPRequest(object):
                 raise Exception('This should not happen')
 
         else:
-            self.body += payload
+            self._add_body(payload)
+            self.body = ''.join(self.body_parts)
+            self.body_parts = []
             return True, len(payload) + end_ptr
 
+    def _add_body(self, data):
+        self.body_parts.append(data)
+        self.body_len += len(data)
+
     def report(self, mpkt, typ, username, password):
         if self.http_type == HTTP_RESPONSE:
             src = (mpkt.l3_src, mpkt.l4_src)
@@ -489,7 +501,7 @@ class HTTPSession(object):
                                          hlfstream.data[self.req_last_len:])
 
             if idx == 0:
-                return
+                break
 
             self.req_last_len += idx
 
@@ -497,13 +509,16 @@ class HTTPSession(object):
                 self.request = HTTPRequest(self, self.manager)
                 self.requests.append(self.request)
 
+        # Data already parsed is not needed anymore
+        hlfstream.data.discard(self.req_last_len)
+
     def feed_response(self, hlfstream, mpkt):
         while hlfstream.count > self.res_last_len:
             ret, idx = self.response.feed(mpkt,
                                           hlfstream.data[self.res_last_len:])
 
             if idx == 0:
-                return
+                break
 
             self.res_last_len += idx
 
@@ -511,6 +526,9 @@ class HTTPSession(object):
                 self.response = HTTPResponse(self, self.manager)
                 self.responses.append(self.response)
 
+        # Data already parsed is not needed anymore
+        hlfstream.data.discard(self.res_last_len)
+
 
 class HTTPDissector(Plugin, PassiveAudit):
     def start(self, reader):
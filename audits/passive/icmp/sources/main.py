@@ -43,17 +43,12 @@ def icmp_decoder():
         if not checksum_check:
             return None
 
-        if mpkt.get_field('ip.flags', 0) & 1:
-            # Only a fragment
-            return None
-
-        payload = mpkt.cfields.get('reassembled_payload', None)
+        # The IP decoder passes the reassembled datagram, never the
+        # fragments
+        payload = mpkt.get_field('icmp')
 
         if not payload:
-            payload = mpkt.get_field('icmp')
-
-            if not payload:
-                return None
+            return None
 
         cur_chksum = hex(unpack("!H", payload[2:4])[0])
         icmpraw = payload[0:2] + '\x00\x00' + payload[4:]
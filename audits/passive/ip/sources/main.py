@@ -43,139 +43,288 @@ decoder.ip.debug Dropping out the sequence with ID: 14300 due reassemble_max_fra
 decoder.ip.debug Dropping out the sequence with ID: 14301 due reassemble_max_fragments
 decoder.ip.debug Dropping out the sequence with ID: 14302 due reassemble_max_fragments
 decoder.ip.debug Dropping out the sequence with ID: 14303 due reassemble_max_fragments
+
+The echo requests of ip-fragments.pcap have a wrong ICMP checksum so the
+ICMP decoder reports every datagram reassembled. They are fragmented out of
+order, with the same ID from another host and for UDP interleaved, with
+overlapping fragments (the data received later wins), with a fragment with
+a wrong IP checksum (not used till the good copy is received) and with a
+fragment received after reassemble_timeout. Only the reassembled datagrams
+are passed to the L4 decoders: the UDP one has a good checksum.
+
+>>> audit_unittest('-f ethernet,ip,udp,icmp', 'ip-fragments.pcap')
+decoder.icmp.notice Invalid ICMP packet from 10.0.0.1 to 10.0.0.2 : wrong checksum 0x1234 instead of 0x5c62
+decoder.icmp.notice Invalid ICMP packet from 10.0.0.1 to 10.0.0.2 : wrong checksum 0x1234 instead of 0x484d
+decoder.icmp.notice Invalid ICMP packet from 10.0.0.3 to 10.0.0.2 : wrong checksum 0x1234 instead of 0x3439
+decoder.icmp.notice Invalid ICMP packet from 10.0.0.1 to 10.0.0.2 : wrong checksum 0x1234 instead of 0x7478
+decoder.ip.notice Invalid IP packet from 10.0.0.1 to 10.0.0.2 : wrong checksum 0xdead instead of 0x66c8
+decoder.icmp.notice Invalid ICMP packet from 10.0.0.1 to 10.0.0.2 : wrong checksum 0x1234 instead of 0xf7fa
+>>> audit_unittest('-f ethernet,ip,udp,icmp -sdecoder.ip.reassemble_timeout=0', 'ip-fragments.pcap')
+decoder.icmp.notice Invalid ICMP packet from 10.0.0.1 to 10.0.0.2 : wrong checksum 0x1234 instead of 0x5c62
+decoder.icmp.notice Invalid ICMP packet from 10.0.0.1 to 10.0.0.2 : wrong checksum 0x1234 instead of 0x484d
+decoder.icmp.notice Invalid ICMP packet from 10.0.0.3 to 10.0.0.2 : wrong checksum 0x1234 instead of 0x3439
+decoder.icmp.notice Invalid ICMP packet from 10.0.0.1 to 10.0.0.2 : wrong checksum 0x1234 instead of 0x7478
+decoder.ip.notice Invalid IP packet from 10.0.0.1 to 10.0.0.2 : wrong checksum 0xdead instead of 0x66c8
+decoder.icmp.notice Invalid ICMP packet from 10.0.0.1 to 10.0.0.2 : wrong checksum 0x1234 instead of 0xf7fa
+decoder.icmp.notice Invalid ICMP packet from 10.0.0.1 to 10.0.0.2 : wrong checksum 0x1234 instead of 0xe3e5
 """
 
+import sys
 import time
 
+from struct import pack
+
 from umit.pm.core.i18n import _
 from umit.pm.core.logger import log
 from umit.pm.gui.plugins.engine import Plugin
 from umit.pm.manager.auditmanager import AuditManager, PassiveAudit
 from umit.pm.manager.sessionmanager import *
 from umit.pm.core.netconst import PROTO_LAYER, NET_LAYER, LL_TYPE_IP
-from umit.pm.core.auditutils import checksum
+from umit.pm.core.auditutils import checksum_add
 
 from umit.pm.backend import MetaPacket
 
-def ip_decoder():
-    manager = AuditManager()
-
-    conf = manager.get_configuration('decoder.ip')
-    checksum_check, reassemble, max_len, max_frags = \
-        conf['checksum_check'], conf['reassemble'], \
-        conf['reassemble_max_fraglist'], conf['reassemble_max_fragments']
-
-    reas_dict = {}
-
-    def ip_reassemble(mpkt):
-        # Here we have to check for fragmentation
-        # by creating a dict to holds id of ip packets
-        # and set mpkt.lock() on it if mpkg is MF
-        # until the resegmentation is done.
-        # If it's a fragment we have to return None
-        # to break the chain.
-
-        # TODO: check ip.flags standard name in UMPA
-        ts = time.time()
-        mf = mpkt.get_field('ip.flags', 0) & 1
-        frag_off = mpkt.get_field('ip.frag', 0) * 8
-
-        if not mf and frag_off == 0:
-            return False
-
-        ipid = mpkt.get_field('ip.id')
-
-        if ipid in reas_dict:
-            plist = reas_dict[ipid]
+ip_log = log.category('ip')
+
+class Datagram(object):
+    "An IP datagram waiting for its fragments"
+
+    __slots__ = ('key', 'fragments', 'holes', 'length', 'size', 'expire_at',
+                 'prev', 'next')
+
+    def __init__(self, key, expire_at):
+        self.key = key
+        self.expire_at = expire_at
+
+        # (offset, data) tuples in arrival order
+        self.fragments = []
+
+        # (first, last) ranges of the payload still missing (RFC 815)
+        self.holes = [(0, sys.maxint)]
+
+        # Payload length, known once the last fragment (MF = 0) is seen
+        self.length = None
+        self.size = 0
+
+        self.prev = self.next = None
+
+    def add(self, offset, data, more):
+        """
+        Add a fragment updating the list of holes
+        @param offset the offset of the fragment in bytes
+        @param data the payload of the fragment
+        @param more True if the MF flag is set
+        @return True if the datagram is complete
+        """
+        first, last = offset, offset + len(data) - 1
+        holes = []
+
+        for hole_first, hole_last in self.holes:
+            if first > hole_last or last < hole_first:
+                holes.append((hole_first, hole_last))
+                continue
+
+            if first > hole_first:
+                holes.append((hole_first, first - 1))
+            if last < hole_last and more:
+                holes.append((last + 1, hole_last))
+
+        if not more:
+            self.length = offset + len(data)
+            holes = [(hole_first, min(hole_last, self.length - 1)) \
+                     for hole_first, hole_last in holes \
+                     if hole_first < self.length]
+
+        self.holes = holes
+        self.fragments.append((offset, data))
+        self.size += len(data)
+
+        return not holes
+
+    def assemble(self):
+        "@return the reassembled payload as str"
+        payload = bytearray(self.length)
+
+        # Overlapping data is overwritten by the fragments received later
+        for offset, data in self.fragments:
+            if offset + len(data) > self.length:
+                data = data[:max(0, self.length - offset)]
+
+            payload[offset:offset + len(data)] = data
+
+        return str(payload)
+
+class FragmentCache(object):
+    """
+    Fragments of the IP datagrams being reassembled. The datagrams are
+    indexed by the (source, dest, proto, id) tuple identifying them and are
+    linked in a list ordered by arrival time, so the oldest datagram is
+    always at the head and expiring or evicting it costs O(1).
+    """
+
+    def __init__(self, max_datagrams=30, max_fragments=10,
+                 max_memory=4 * 1024 * 1024, timeout=30):
+        """
+        @param max_datagrams the max number of datagrams tracked
+        @param max_fragments the max number of fragments of a datagram
+        @param max_memory the max number of bytes buffered (0 for no limit)
+        @param timeout seconds to wait for the missing fragments of a
+                       datagram (0 to disable)
+        """
+        self.max_datagrams = max_datagrams
+        self.max_fragments = max_fragments
+        self.mem_used, self.max_memory = 0, max_memory
+        self.timeout = timeout
+
+        self.datagrams = {}
+        self.oldest = self.latest = None
+
+        self.manager = AuditManager()
+
+    def add(self, key, offset, data, more, now):
+        """
+        Add a fragment to the cache
+        @param key the (source, dest, proto, id) tuple of the datagram
+        @param offset the offset of the fragment in bytes
+        @param data the payload of the fragment
+        @param more True if the MF flag is set
+        @param now the timestamp of the fragment
+        @return the reassembled payload as str or None
+        """
+        self.expire(now)
+
+        dgram = self.datagrams.get(key, None)
+
+        if dgram:
+            if len(dgram.fragments) >= self.max_fragments:
+                self.remove(dgram)
+                self.manager.user_msg(_('Dropping out the sequence with ID: '
+                                        '%s due reassemble_max_fragments') %
+                                      key[3], 7, 'decoder.ip')
+                return None
+        else:
+            if len(self.datagrams) >= self.max_datagrams:
+                oldest = self.oldest
+                self.remove(oldest)
 
-            if len(plist) >= max_frags:
-                del reas_dict[ipid]
-                manager.user_msg(_('Dropping out the sequence with ID: '
-                                   '%s due reassemble_max_fragments') %
-                                 ipid, 7, 'decoder.ip')
+                self.manager.user_msg(_('Dropping out the oldest sequence '
+                                        'with ID: %s') % oldest.key[3],
+                                      7, 'decoder.ip')
 
-                return False
+            ip_log.debug('First packet of the sequence with ID: %s', key[3])
 
-            ret = 0
-            idx = 0
-            inserted = False
+            dgram = Datagram(key, now + self.timeout)
+            self.link(dgram)
+            self.datagrams[key] = dgram
 
-            while idx < len(plist):
-                ts2, frag_off2, mpkt2 = plist[idx]
+        complete = dgram.add(offset, data, more)
+        self.mem_used += len(data)
 
-                if frag_off2 == frag_off:
-                    plist[idx] = (ts, frag_off, mpkt.copy())
-                    break
-                elif frag_off2 < frag_off:
-                    ret += frag_off2
-                    idx += 1
-                    continue
+        if complete:
+            ip_log.debug('Reassembling sequence with ID: %s', key[3])
 
-                inserted = True
-                plist.insert(idx, (ts, frag_off, mpkt.copy()))
-                break
+            self.remove(dgram)
+            return dgram.assemble()
 
-            if not inserted:
-                plist.append((ts, frag_off, mpkt.copy()))
+        if self.max_memory:
+            while self.mem_used > self.max_memory and self.oldest:
+                ip_log.debug('Dropping out the sequence with ID: %s due '
+                             'reassemble_max_memory', self.oldest.key[3])
+                self.remove(self.oldest)
 
-            # Now let's get the last packet and see if MF = 0
-            # EVASION!
-            if plist[-1][-1].get_field('ip.flags') & 1 == 0:
+        return None
 
-                if idx == len(plist) -1:
-                    ret = frag_off - ret
-                else:
-                    while idx < len(plist) - 1:
-                        ts2, frag_off2, mpkt2 = plist[idx]
-                        ret += frag_off2
-                        idx += 1
+    def expire(self, now):
+        "Drop the datagrams whose timeout elapsed"
+        if not self.timeout:
+            return
 
-                        ret = plist[-1][1] - ret
+        while self.oldest and self.oldest.expire_at <= now:
+            ip_log.debug('Sequence with ID: %s timed out', self.oldest.key[3])
+            self.remove(self.oldest)
 
-                if ret == 0:
-                    log.debug('Reassembling sequence with ID: %s' % \
-                              ipid)
+    def remove(self, dgram):
+        del self.datagrams[dgram.key]
 
-                    reas_payload = ''
+        self.unlink(dgram)
+        self.mem_used -= dgram.size
 
-                    for ts2, frag_off2, mpkt2 in plist:
-                        try:
-                            ihl = mpkt2.l3_len
-                            reas_payload += mpkt2.get_field('ip')[ihl:]
-                        except:
-                            pass
+    def link(self, dgram):
+        "Put the datagram at the tail (latest) of the list"
+        dgram.prev = self.latest
+        dgram.next = None
 
-                    # Ok check that we have a complete payload
-                    ihl = mpkt.l3_len
-                    p_len = frag_off + mpkt.get_field('ip.len') - ihl
+        if self.latest:
+            self.latest.next = dgram
+        else:
+            self.oldest = dgram
 
-                    if len(reas_payload) != p_len:
-                        mpkt.set_cfield('reassembled_payload', None)
-                        manager.user_msg(_('Reassemble of IP packet ' \
-                                           'from %s to %s failed') %  \
-                                         (mpkt.l3_src, mpkt.l3_dst),  \
-                                         4, 'decoder.ip')
+        self.latest = dgram
 
-                    # Nice drop out everythin!
-                    del reas_dict[ipid]
+    def unlink(self, dgram):
+        if dgram.prev:
+            dgram.prev.next = dgram.next
+        else:
+            self.oldest = dgram.next
 
-                    mpkt.set_cfield('reassembled_payload', reas_payload)
-                    return True
+        if dgram.next:
+            dgram.next.prev = dgram.prev
         else:
-            if len(reas_dict) >= max_len:
-                # Ok just drop the list with the minor ts (the oldest)
-                min_k = min([(v, k) for k, v in reas_dict.items()])[1]
-                del reas_dict[min_k]
+            self.latest = dgram.prev
 
-                # Debug
-                manager.user_msg(_('Dropping out the oldest sequence '
-                                   'with ID: %s') % min_k,
-                                 7, 'decoder.ip')
+        dgram.prev = dgram.next = None
 
-            log.debug('First packet of the sequence with ID: %s' % ipid)
-            reas_dict[ipid] = [(ts, frag_off, mpkt)]
+def ip_decoder():
+    manager = AuditManager()
 
-        return False
+    conf = manager.get_configuration('decoder.ip')
+    checksum_check, reassemble = conf['checksum_check'], conf['reassemble']
+
+    cache = FragmentCache(conf['reassemble_max_fraglist'],
+                          conf['reassemble_max_fragments'],
+                          conf['reassemble_max_memory'],
+                          conf['reassemble_timeout'])
+
+    def ip_reassemble(mpkt, ipraw, frag_off, mf):
+        # Fragments are collected in the cache. The payload of the datagram
+        # is set as cfield of the packet completing it and a new packet
+        # holding the whole datagram is returned to be passed to the L4
+        # decoders in place of the fragments.
+        key = (mpkt.l3_src, mpkt.l3_dst, mpkt.l4_proto,
+               mpkt.get_field('ip.id'))
+        data = ipraw[mpkt.l3_len:mpkt.l3_len + mpkt.payload_len]
+
+        payload = cache.add(key, frag_off, data, mf,
+                            mpkt.get_rawtime() or time.time())
+
+        if payload is None:
+            return None
+
+        mpkt.set_cfield('reassembled_payload', payload)
+
+        # The header of the completing fragment with the fragment fields
+        # cleared, the total length updated and the checksum recomputed
+        hdr = ipraw[:2] + pack('!H', mpkt.l3_len + len(payload)) + \
+              ipraw[4:6] + '\x00\x00' + ipraw[8:10] + '\x00\x00' + \
+              ipraw[12:mpkt.l3_len]
+        hdr = hdr[:10] + \
+              pack('!H', ~checksum_add(hdr, 0, mpkt.l3_len) & 0xffff) + \
+              hdr[12:]
+
+        dgram = MetaPacket.new_from_str('ip', hdr + payload,
+                                        mpkt.get_rawtime())
+
+        if not dgram:
+            return None
+
+        dgram.l2_proto, dgram.l2_src, dgram.l2_dst, dgram.l2_len = \
+            mpkt.l2_proto, mpkt.l2_src, mpkt.l2_dst, mpkt.l2_len
+        dgram.l3_src, dgram.l3_dst, dgram.l4_proto = \
+            mpkt.l3_src, mpkt.l3_dst, mpkt.l4_proto
+        dgram.l3_len = mpkt.l3_len
+        dgram.payload_len = len(payload)
+
+        return dgram
 
     def ip(mpkt):
         mpkt.l3_src, \
@@ -200,41 +349,52 @@ def ip_decoder():
 
             mpkt.context.set_forwardable(mpkt)
 
-        iplen = min(20, len(ipraw))
+        # Only the offset 0 fragment carries the L4 header and no fragment
+        # carries the whole L4 payload, so the fragments are never passed
+        # to the L4 decoders. The reassembled datagram is passed instead.
+        mf = mpkt.get_field('ip.flags', 0) & 1
+        frag_off = mpkt.get_field('ip.frag', 0) * 8
+        fragment = mf or frag_off
+        dgram = None
 
         if mpkt.get_field('ip.len') > len(ipraw):
             # Probably we are capturing with low snaplen
             # so the packets are not fully captured. Avoid
             # further calculation.
-            return PROTO_LAYER, mpkt.l4_proto
-
-        if checksum_check:
-            ihl = max(20, mpkt.l3_len)
-            pkt = ipraw[:10] + '\x00\x00' + ipraw[12:ihl]
-
-            chksum = checksum(pkt)
+            if fragment:
+                return None
 
-            # Probably here it's better to set also a cfield
-            # and to turn False the checksum_check default value
-            if mpkt.get_field('ip.chksum') != chksum:
-                mpkt.set_cfield('good_checksum', hex(chksum))
-                manager.user_msg(_("Invalid IP packet from %s to %s : " \
-                                   "wrong checksum %s instead of %s") %  \
-                                 (mpkt.l3_src, mpkt.l3_dst,          \
-                                  hex(mpkt.get_field('ip.chksum')),  \
-                                  hex(chksum)),
-                                 5, 'decoder.ip')
+            return PROTO_LAYER, mpkt.l4_proto
 
-            elif reassemble:
-                ip_reassemble(mpkt)
+        # Probably here it's better to set also a cfield
+        # and to turn False the checksum_check default value
+        # A correct header sums to 0xffff with the checksum included
+        if checksum_check and \
+           checksum_add(ipraw, 0, max(20, mpkt.l3_len)) != 0xffff:
+            # Skip the checksum field without copying the header
+            chksum = ~checksum_add(ipraw, 12, max(20, mpkt.l3_len),
+                                   checksum_add(ipraw, 0, 10)) & 0xffff
+
+            mpkt.set_cfield('good_checksum', hex(chksum))
+            manager.user_msg(_("Invalid IP packet from %s to %s : " \
+                               "wrong checksum %s instead of %s") %  \
+                             (mpkt.l3_src, mpkt.l3_dst,          \
+                              hex(mpkt.get_field('ip.chksum')),  \
+                              hex(chksum)),
+                             5, 'decoder.ip')
+
+        elif reassemble and fragment:
+            # A fragment with a wrong checksum is never used: it would
+            # corrupt the datagram and the good copy could still come
+            dgram = ip_reassemble(mpkt, ipraw, frag_off, mf)
 
         ident = IPIdent.create(mpkt)
-        sess = SessionManager().get_session(ident)
+        sess = SessionManager().get_session(ident, mpkt.get_rawtime())
 
         if not sess:
             sess = Session(ident)
             sess.data = IPStatus()
-            SessionManager().put_session(sess)
+            SessionManager().put_session(sess, mpkt.get_rawtime())
 
         sess.prev = mpkt.session
         mpkt.session = sess
@@ -242,7 +402,11 @@ def ip_decoder():
         status = sess.data
         status.last_id = mpkt.get_field('ip.id', 0)
 
-        manager.run_decoder(PROTO_LAYER, mpkt.l4_proto, mpkt)
+        if not fragment:
+            manager.run_decoder(PROTO_LAYER, mpkt.l4_proto, mpkt)
+        elif dgram:
+            dgram.session = sess
+            manager.run_decoder(PROTO_LAYER, dgram.l4_proto, dgram)
 
         if mpkt.flags & MPKT_DROPPED:
             status.id_adj -= 1
@@ -333,9 +497,15 @@ __audit_type__ = 0
 __protocols__ = (('ip', None), )
 __configurations__ = (('decoder.ip', {
     'checksum_check' : [True, 'Enable checksum check for IP packets'],
-    'reassemble' : [True, 'Enable IP fragments reassembling'],
+    'reassemble' : [True, 'Enable IP fragments reassembling. With '
+                    'checksum_check the fragments with a wrong checksum are '
+                    'not used'],
     'reassemble_max_fraglist' : [30, 'Max number of IP flows to follow'],
-    'reassemble_max_fragments' : [10, 'Max number of fragments in a flow']}),
+    'reassemble_max_fragments' : [10, 'Max number of fragments in a flow'],
+    'reassemble_max_memory' : [4 * 1024 * 1024, 'Max bytes of fragments '
+                               'buffered (0 for no limit)'],
+    'reassemble_timeout' : [30, 'Seconds to wait for the missing fragments '
+                            'of a datagram (0 to disable)']}),
 )
 __vulnerabilities__ = (('IP decoder', {
     'description' : 'The Internet Protocol (IP) is a protocol used for '
@@ -25,14 +25,29 @@ TCP protocol decoder
 >>> audit_unittest('-f ethernet,ip,tcp', 'wrong-checksum.pcap')
 decoder.ip.notice Invalid IP packet from 127.0.0.1 to 127.0.0.1 : wrong checksum 0xdead instead of 0x7bce
 decoder.tcp.notice Invalid TCP packet from 127.0.0.1 to 127.0.0.1 : wrong checksum 0x29a instead of 0xc86
+
+Reassembler tests. The streams followed by the http dissector are dropped
+when idle for reassemble_idle_timeout seconds (the last packet is 400
+seconds later) or, from the least recently used one, when
+reassemble_maxstreams is hit (the first stream is used again before the
+third one is opened). The streams dropped at once are reported with a
+single message.
+
+>>> audit_unittest('-f ethernet,ip,tcp,http', 'tcp-streams.pcap')
+decoder.tcp.debug Dropped 3 streams due reassemble_idle_timeout
+>>> audit_unittest('-f ethernet,ip,tcp,http -sdecoder.tcp.reassemble_maxstreams=2,decoder.tcp.reassemble_idle_timeout=0', 'tcp-streams.pcap')
+decoder.tcp.debug Dropped 1 stream due reassemble_maxstreams
+decoder.tcp.debug Dropped 1 stream due reassemble_maxstreams
 """
 
-from datetime import datetime
-from struct import pack, unpack
-from socket import inet_aton, ntohl, inet_ntoa
+from time import time
+from struct import unpack
+from collections import deque
+from socket import inet_aton
 
 from umit.pm.core.i18n import _
 from umit.pm.core.logger import log
+from umit.pm.core.metrics import metrics
 from umit.pm.core.tracing import trace
 from umit.pm.gui.plugins.core import Core
 from umit.pm.core.atoms import defaultdict
@@ -40,10 +55,12 @@ from umit.pm.gui.plugins.engine import Plugin
 from umit.pm.manager.sessionmanager import *
 from umit.pm.manager.auditmanager import AuditManager, PassiveAudit
 from umit.pm.core.netconst import *
-from umit.pm.core.auditutils import checksum
+from umit.pm.core.auditutils import checksum_add, checksum_pseudo
 
 from umit.pm.backend import MetaPacket
 
+tcp_log = log.category('tcp')
+
 TCP_ESTABLISHED = 1
 TCP_SYN_SENT    = 2
 TCP_SYN_RECV    = 3
@@ -92,12 +109,18 @@ def get_ts(mpkt, opt_type=8):
 
     return ret, out
 
+# Seconds a stream is kept once both sides sent a FIN (libnids workaround)
+CLOSING_TIMEOUT = 10
+
 class Buffer(object):
+    __slots__ = ('data', 'fin', 'urg', 'urg_ptr', 'seq', 'prev', 'next')
+
     def __init__(self):
         self.data = ''
 
         self.fin = 0
         self.urg = 0
+        self.urg_ptr = 0
         self.seq = 0
 
         self.prev, self.next = None, None
@@ -116,7 +139,153 @@ class Buffer(object):
         else:
             return repr(self) + ' ' + self.next.dump()
 
+class StreamBuffer(object):
+    """
+    Chunked buffer holding the data collected for a HalfStream. The data is
+    kept as a list of segments so appending never copies, and the offsets
+    used to read the buffer are absolute (counted from the start of the
+    stream, like HalfStream.count) so they stay valid after discard().
+
+    Slicing (buf[offset:]) is supported for compatibility and returns a str.
+    Use view() to get a zero copy buffer() of the data.
+    """
+    __slots__ = ('chunks', 'start', 'end', 'skip')
+
+    def __init__(self):
+        self.chunks = deque()
+
+        # Absolute offsets of the first byte buffered and of the end
+        self.start = 0
+        self.end = 0
+
+        # Bytes of chunks[0] already discarded
+        self.skip = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __nonzero__(self):
+        return self.end > self.start
+
+    def __str__(self):
+        return self.read(self.start)
+
+    def __getitem__(self, idx):
+        if not isinstance(idx, slice) or idx.step is not None:
+            raise TypeError('only slices are supported')
+
+        start = idx.start or 0
+        stop = idx.stop
+
+        if stop is None or stop > self.end:
+            stop = self.end
+
+        return self.read(start, max(0, stop - start))
+
+    def append(self, data):
+        if data:
+            self.chunks.append(data)
+            self.end += len(data)
+
+    def discard(self, offset):
+        """
+        Free the data before offset
+        @param offset an absolute offset
+        """
+        offset = min(offset, self.end)
+
+        while self.chunks and offset > self.start:
+            avail = len(self.chunks[0]) - self.skip
+
+            if offset - self.start >= avail:
+                self.chunks.popleft()
+                self.start += avail
+                self.skip = 0
+            else:
+                self.skip += offset - self.start
+                self.start = offset
+
+    def clear(self):
+        self.discard(self.end)
+
+    def iter_chunks(self, offset, size=-1):
+        """
+        Iterate over the segments holding the data starting from offset
+        @param offset an absolute offset
+        @param size the max number of bytes to return or -1 for all
+        @return a generator of (segment, offset in segment, length) tuples
+        """
+        offset = max(offset, self.start)
+
+        if size < 0 or offset + size > self.end:
+            size = self.end - offset
+
+        pos = self.start - self.skip
+
+        for chunk in self.chunks:
+            if size <= 0:
+                break
+
+            if offset < pos + len(chunk):
+                coff = offset - pos
+                clen = min(len(chunk) - coff, size)
+
+                yield chunk, coff, clen
+
+                offset += clen
+                size -= clen
+
+            pos += len(chunk)
+
+    def iter_views(self, offset, size=-1):
+        """
+        Iterate over the data starting from offset without copying it
+        @param offset an absolute offset
+        @param size the max number of bytes to return or -1 for all
+        @return a generator of buffer() objects
+        """
+        for chunk, coff, clen in self.iter_chunks(offset, size):
+            yield buffer(chunk, coff, clen)
+
+    def view(self, offset, size=-1):
+        """
+        @return a buffer() of the data if it lays in a single segment or a
+                str otherwise
+        """
+        chunks = list(self.iter_chunks(offset, size))
+
+        if len(chunks) == 1:
+            return buffer(*chunks[0])
+
+        return ''.join([chunk[coff:coff + clen] \
+                        for chunk, coff, clen in chunks])
+
+    def read(self, offset, size=-1):
+        """
+        @param offset an absolute offset
+        @param size the max number of bytes to read or -1 for all
+        @return a str
+        """
+        ret = []
+
+        for chunk, coff, clen in self.iter_chunks(offset, size):
+            if coff == 0 and clen == len(chunk):
+                ret.append(chunk)
+            else:
+                ret.append(chunk[coff:coff + clen])
+
+        if len(ret) == 1:
+            return ret[0]
+
+        return ''.join(ret)
+
 class HalfStream(object):
+    __slots__ = ('name', 'state', 'seq', 'first_data_seq', 'ack_seq', 'window',
+                 'ts_on', 'wscale_on', 'curr_ts', 'wscale', 'urg_ptr',
+                 'urg_seen', 'urg_count', 'count_new_urg', 'rmem_alloc',
+                 'count_new', 'count', 'data', 'urgdata', 'plist',
+                 'plist_tail')
+
     def __init__(self, name=None):
         self.name = name
 
@@ -133,25 +302,28 @@ class HalfStream(object):
         self.urg_ptr = 0
         self.urg_seen = 0
         self.urg_count = 0
+        self.count_new_urg = 0
 
         self.rmem_alloc = 0
         self.count_new = 0
         self.count = 0
-        self.data = ''
+        self.data = StreamBuffer()
         self.urgdata = ''
 
         self.plist = None
         self.plist_tail = None
 
     def __repr__(self):
-        return '<HalfStream(to=%s) seq=%d ack=%d data=%.10s>' \
-               % (self.name, self.seq, self.ack_seq, self.data)
+        return '<HalfStream(to=%s) seq=%d ack=%d data=%s>' \
+               % (self.name, self.seq, self.ack_seq,
+                  self.data.read(self.data.start, 10))
 
 class TCPStream(object):
-    def __init__(self, source, dest, sport, dport):
-        self.reset(source, dest, sport, dport)
+    __slots__ = ('source', 'dest', 'sport', 'dport', 'state', 'client',
+                 'server', 'listeners', 'next_time', 'prev_time', 'last_seen',
+                 'closing_at', 'timer')
 
-    def reset(self, source, dest, sport, dport):
+    def __init__(self, source, dest, sport, dport):
         self.source = source
         self.dest = dest
         self.sport = sport
@@ -159,28 +331,33 @@ class TCPStream(object):
 
         self.state = CONN_UNDEFINED
 
-        self.client = HalfStream(source and inet_ntoa(source) or None)
-        self.server = HalfStream(dest and inet_ntoa(dest) or None)
+        self.client = HalfStream(source)
+        self.server = HalfStream(dest)
 
-        self.next_node, self.prev_node = None, None
+        # Used by the Reassembler for the LRU list and the timeouts
         self.next_time, self.prev_time = None, None
-        self.next_free = None
+        self.last_seen = 0
+        self.closing_at = None
+        self.timer = None
 
         self.listeners = []
 
+    def get_key(self):
+        "@return the key used to index the stream (client side tuple)"
+        return (self.source, self.dest, self.sport, self.dport)
     def get_source(self):
         "@return the dotted decimal form of source IP"
-        return inet_ntoa(self.source)
+        return self.source
     def get_dest(self):
         "@return the dotted decimal form of destination IP"
-        return inet_ntoa(self.dest)
+        return self.dest
     def get_bytes(self):
         "@return the bytes collected of the session"
         return self.client.count + self.server.count
-
-    def mkhash(self):
-        return hash(self.source) ^ hash(self.dest) ^ \
-               hash(self.sport ^ self.dport)
+    def get_memory(self):
+        "@return the bytes actually buffered for the session"
+        return self.client.rmem_alloc + self.server.rmem_alloc + \
+               len(self.client.data) + len(self.server.data)
 
     def __repr__(self):
         return '%s:%d <-> %s:%d' % (
@@ -188,11 +365,76 @@ class TCPStream(object):
             self.get_dest(), self.dport
         )
 
-class TCPTimeout(object):
-    def __init__(self, stream, timeout):
-        self.stream = stream
-        self.timeout = timeout
-        self.next, self.prev = None, None
+class TimerWheel(object):
+    """
+    Hashed timer wheel. Every object has at most one pending timer stored in
+    its timer attribute, so scheduling and cancelling are O(1). A timer that
+    is more than a whole turn away stays in its slot until its round comes.
+    """
+
+    def __init__(self, slots=1024, resolution=1):
+        """
+        @param slots the number of slots of the wheel
+        @param resolution the seconds covered by a slot
+        """
+        self.slots = [{} for idx in xrange(slots)]
+        self.resolution = resolution
+        self.tick = None
+
+    def schedule(self, obj, when):
+        """
+        Schedule (or reschedule) the timer of obj
+        @param obj the object to schedule
+        @param when the expiration time in seconds
+        """
+        self.cancel(obj)
+
+        tick = int(when / self.resolution)
+
+        # Expired timers will fire at the next advance()
+        if self.tick is not None and tick <= self.tick:
+            tick = self.tick + 1
+
+        slot = self.slots[tick % len(self.slots)]
+        slot[obj] = tick
+        obj.timer = slot
+
+    def cancel(self, obj):
+        if obj.timer is not None:
+            del obj.timer[obj]
+            obj.timer = None
+
+    def advance(self, now):
+        """
+        Move the wheel forward
+        @param now the current time in seconds
+        @return a list of objects whose timer is expired
+        """
+        tick = int(now / self.resolution)
+
+        if self.tick is None or tick <= self.tick:
+            if self.tick is None:
+                self.tick = tick
+            return ()
+
+        nslots = len(self.slots)
+        start = max(self.tick + 1, tick - nslots + 1)
+        expired = []
+
+        for idx in xrange(start, tick + 1):
+            slot = self.slots[idx % nslots]
+
+            if not slot:
+                continue
+
+            for obj, when in slot.items():
+                if when <= tick:
+                    del slot[obj]
+                    obj.timer = None
+                    expired.append(obj)
+
+        self.tick = tick
+        return expired
 
 class Reassembler(object):
     """
@@ -204,26 +446,44 @@ class Reassembler(object):
     Copyright (c) 1999 Rafal Wojtczuk <nergal@avet.com.pl>. All rights reserved.
 
     The code is released as GPLv2 so no problem about integration.
+
+    Unlike libnids the streams are indexed by a dict keyed on the client side
+    (source, dest, sport, dport) tuple and they are also linked in a LRU list
+    used to drop the least recently used streams when maxstreams or maxmemory
+    are hit. Idle and closing timeouts are handled by a TimerWheel driven by
+    the timestamps of the packets.
     """
 
-    def __init__(self, workarounds=True, maxstreams=30):
+    def __init__(self, workarounds=True, maxstreams=100000,
+                 maxmemory=64 * 1024 * 1024, idle_timeout=300):
+        """
+        @param workarounds close a stream CLOSING_TIMEOUT seconds after the
+                           FIN segments
+        @param maxstreams the max number of streams tracked
+        @param maxmemory the max number of bytes buffered (0 for no limit)
+        @param idle_timeout seconds of inactivity after which a stream is
+                            dropped (0 to disable)
+        """
         self.tcp_workarounds = workarounds
         self.n_streams, self.max_streams = 0, maxstreams
+        self.mem_used, self.max_memory = 0, maxmemory
+        self.idle_timeout = idle_timeout
         self.oldest_stream, self.latest_stream = None, None
 
         self.tcp_streams = {}
-        self.free_streams = None
-        self.tcp_timeouts = None
+        self.timers = TimerWheel()
+        self.now = 0
 
-        for i in xrange(self.max_streams):
-            stream = TCPStream(None, None, None, None)
+        # reason -> number of streams dropped in the current pass
+        self.drops = defaultdict(int)
 
-            if self.free_streams:
-                stream.next_free = self.free_streams
+        self.analyzers = []
 
-            self.free_streams = stream
+        self.dropped = metrics.counter('tcp.streams.dropped')
+        self.expired = metrics.counter('tcp.streams.expired')
 
-        self.analyzers = []
+        metrics.gauge('tcp.streams', lambda: self.n_streams)
+        metrics.gauge('tcp.memory', lambda: self.mem_used)
 
     def add_analyzer(self, analyzer):
         self.analyzers.append(analyzer)
@@ -239,12 +499,10 @@ class Reassembler(object):
 
         if iplen < 20:
             return
-        ipsrc, ipdst = inet_aton(mpkt.l3_src), \
-                       inet_aton(mpkt.l3_dst)
 
         # Proto or port unreach
         if mpkt.get_field('ip.code') in (2, 3) and \
-           ipsrc != ipdst:
+           mpkt.l3_src != mpkt.l3_dst:
             return
 
         if mpkt.get_field('ip.proto') != NL_TYPE_TCP:
@@ -255,7 +513,7 @@ class Reassembler(object):
         if not stream:
             return
 
-        if stream.dest == ipdst:
+        if stream.dest == mpkt.l3_dst:
             hlf = stream.server
         else:
             hlf = stream.client
@@ -265,8 +523,7 @@ class Reassembler(object):
 
         stream.state = CONN_RESET
 
-        for listener in stream.listeners:
-            listener(stream, mpkt, None)
+        self.call_listeners(stream, mpkt, None)
 
         self.free_tcp_stream(stream)
 
@@ -276,18 +533,14 @@ class Reassembler(object):
         @param mpkt a MetaPacket object
         """
 
-        datalen = mpkt.get_field('ip.len') - \
-                  mpkt.l3_len - mpkt.l4_len
+        datalen = mpkt.payload_len - mpkt.l4_len
 
         if datalen < 0:
             log.warning('Bogus TCP/IP header (datalen < 0)')
             return
 
-        ipsrc, ipdst = inet_aton(mpkt.l3_src), \
-                       inet_aton(mpkt.l3_dst)
-
-        if ipsrc == '\x00\x00\x00\x00' and \
-           ipdst == '\x00\x00\x00\x00':
+        if mpkt.l3_src == '0.0.0.0' and \
+           mpkt.l3_dst == '0.0.0.0':
             log.warning('Bogus IP header (src or dst are NULL)')
             return
 
@@ -296,6 +549,8 @@ class Reassembler(object):
         if not tcpflags:
             return
 
+        self.update_time(mpkt)
+
         is_client, stream = self.find_stream(mpkt)
 
         if not stream:
@@ -306,6 +561,8 @@ class Reassembler(object):
 
             return
 
+        self.touch_stream(stream)
+
         if is_client:
             snd, rcv = stream.client, stream.server
         else:
@@ -357,8 +614,7 @@ class Reassembler(object):
             if stream.state == CONN_DATA:
                 stream.state = CONN_RESET
 
-                for listener in stream.listeners:
-                    listener(stream, mpkt, None)
+                self.call_listeners(stream, mpkt, None)
 
             self.free_tcp_stream(stream)
             return
@@ -394,23 +650,23 @@ class Reassembler(object):
             if rcv.state == FIN_CONFIRMED and snd.state == FIN_CONFIRMED:
                 stream.state = CONN_CLOSE
 
-                for listener in stream.listeners:
-                    listener(stream, mpkt, None)
+                self.call_listeners(stream, mpkt, None)
 
                 self.free_tcp_stream(stream)
                 return
 
         if (datalen + (tcpflags & TH_FIN)) > 0:
-            payload = mpkt.data
-
-            if payload:
-                self.tcp_queue(stream, mpkt, snd, rcv, payload, datalen)
+            # Empty FIN segments have to be queued too to close the stream
+            self.tcp_queue(stream, mpkt, snd, rcv, mpkt.data or '', datalen)
 
         snd.window = mpkt.get_field('tcp.window', 0)
 
         if rcv.rmem_alloc > 65535:
             self.prune_queue(rcv)
 
+        if self.max_memory and self.mem_used > self.max_memory:
+            self.check_memory(mpkt)
+
     #@trace
     def prune_queue(self, rcv):
         """
@@ -418,40 +674,62 @@ class Reassembler(object):
         @param rcv a HalfStream instance
         """
 
+        if not rcv.plist:
+            return
+
         log.warn('Pruning queue.')
 
         p = rcv.plist
 
         while p:
-            del p.data
             tmp = p.next
-            del p
+            p.prev = p.next = None
             p = tmp
 
+        self.mem_used -= rcv.rmem_alloc
+
         rcv.plist = rcv.plist_tail = None
         rcv.rmem_alloc = 0
 
     def add2buf(self, mpkt, rcv, data):
-        rcv.data += data
+        rcv.data.append(data)
         rcv.count_new = len(data)
         rcv.count += rcv.count_new
 
-    def notify(self, mpkt, stream, rcv):
+        self.mem_used += rcv.count_new
+
+    def call_listeners(self, stream, mpkt, rcv):
+        """
+        Call the listeners of the stream keeping track of the data they
+        discarded from the buffers.
+        @return the max value returned by the listeners
+        """
         ret = REAS_SKIP_PACKET
+        cdata, sdata = stream.client.data, stream.server.data
+        buffered = cdata.end - cdata.start + sdata.end - sdata.start
 
         for listener in stream.listeners:
             ret = max(ret,
                       listener(stream, mpkt, rcv))
 
+        self.mem_used -= buffered - \
+                         (cdata.end - cdata.start + sdata.end - sdata.start)
+        return ret
+
+    def notify(self, mpkt, stream, rcv):
+        ret = self.call_listeners(stream, mpkt, rcv)
+
         if ret == REAS_COLLECT_STATS:
-            log.debug('Collecting stats')
-            rcv.data = ''
+            tcp_log.debug('Collecting stats')
+            self.mem_used -= len(rcv.data)
+            rcv.data.clear()
         elif ret == REAS_SKIP_PACKET:
-            log.debug('Skipping packet')
+            tcp_log.debug('Skipping packet')
+            self.mem_used -= len(rcv.data)
             rcv.count_new = 0
-            rcv.data = ''
+            rcv.data.clear()
         else:
-            log.debug('Collecting data')
+            tcp_log.debug('Collecting data')
 
     #@trace
     def add_from_skb(self, stream, mpkt, rcv, snd, payload, datalen, tcpseq, \
@@ -472,7 +750,9 @@ class Reassembler(object):
         exp_seq = (snd.first_data_seq + rcv.count + rcv.urg_count)
         lost = exp_seq - tcpseq
 
-        log.debug('exp_seq: %d tcpseq: %d lost: %d' % (exp_seq, tcpseq, lost))
+        if tcp_log.debug_enabled:
+            tcp_log.debug('exp_seq: %d tcpseq: %d lost: %d', exp_seq, tcpseq,
+                          lost)
 
         if urg and urg_ptr - (exp_seq - 1) > 0 and \
            (not rcv.urg_seen or urg_ptr - rcv.urg_ptr > 0):
@@ -506,15 +786,16 @@ class Reassembler(object):
                 self.notify(mpkt, stream, rcv)
         else:
             if datalen - lost > 0:
-                log.debug('add2buf() %d:%d' % (lost, datalen))
+                tcp_log.debug('add2buf() %d:%d', lost, datalen)
                 self.add2buf(mpkt, rcv, payload[lost:datalen])
                 self.notify(mpkt, stream, rcv)
 
         if fin:
             snd.state = FIN_SENT
 
-            if rcv.state == TCP_CLOSE:
-                self.add_tcp_closing_timeout(stream)
+            # Both sides sent a FIN. Don't wait forever for the last ACK
+            if rcv.state in (TCP_CLOSING, FIN_SENT, FIN_CONFIRMED):
+                self.add_closing_timeout(stream)
 
     #@trace
     def tcp_queue(self, stream, mpkt, snd, rcv, payload, datalen):
@@ -537,7 +818,7 @@ class Reassembler(object):
             # This packet is old because seq < current
             if (tcpseq + datalen + (tcpflags & TH_FIN)) - exp_seq > 0:
 
-                log.debug('Last packet of the window')
+                tcp_log.debug('Last packet of the window')
 
                 cur_ts = get_ts(mpkt)[1]
                 self.add_from_skb(stream, mpkt, rcv, snd, payload, datalen,
@@ -547,6 +828,9 @@ class Reassembler(object):
                 packet = rcv.plist
 
                 while packet:
+                    # The expected sequence moves forward as data is added
+                    exp_seq = (snd.first_data_seq + rcv.count + rcv.urg_count)
+
                     if packet.seq - exp_seq > 0:
                         break
                     if (packet.seq + len(packet.data) + packet.fin) - \
@@ -557,11 +841,12 @@ class Reassembler(object):
                                           packet.urg_ptr + packet.seq - 1)
 
                     rcv.rmem_alloc -= len(packet.data)
+                    self.mem_used -= len(packet.data)
 
                     if packet.prev:
                         packet.prev.next = packet.next
                     else:
-                        packet.plist = packet.next
+                        rcv.plist = packet.next
 
                     if packet.next:
                         packet.next.prev = packet.prev
@@ -569,27 +854,27 @@ class Reassembler(object):
                         rcv.plist_tail = packet.prev
 
                     tmp = packet.next
-                    del packet.data
-                    del packet
+                    packet.prev = packet.next = None
                     packet = tmp
             else:
                 log.warning('Inconsistent packet (%.10s) ignored.' % payload)
                 return
         else:
-            log.debug('Standard packet. Looking for the right position')
+            tcp_log.debug('Standard packet. Looking for the right position')
 
             p = rcv.plist_tail
 
             packet = Buffer()
             packet.data = payload[:]
             rcv.rmem_alloc += len(packet.data)
+            self.mem_used += len(packet.data)
             packet.fin = tcpflags & TH_FIN
 
             if packet.fin:
                 snd.state = TCP_CLOSING
 
                 if rcv.state == FIN_SENT or rcv.state == FIN_CONFIRMED:
-                    self.add_closing_timeout(stream, mpkt)
+                    self.add_closing_timeout(stream)
 
             packet.seq = tcpseq
             packet.urg = tcpflags & TH_URG
@@ -612,13 +897,13 @@ class Reassembler(object):
                 if not rcv.plist_tail:
                     rcv.plist_tail = packet
 
-                log.debug('Prepending packet %s' % packet)
+                tcp_log.debug('Prepending packet %s', packet)
             else:
                 packet.next  = p.next
                 p.next = packet
                 packet.prev = p
 
-                log.debug('Appending %s after %s' % (packet, p))
+                tcp_log.debug('Appending %s after %s', packet, p)
 
                 if packet.next:
                     packet.next.prev = packet
@@ -631,35 +916,12 @@ class Reassembler(object):
         """
         @param mpkt a MetaPacket object
         """
-        ctup = (inet_aton(mpkt.l3_src),
-                inet_aton(mpkt.l3_dst),
-                mpkt.l4_src, mpkt.l4_dst)
-
-        hash_idx = hash(ctup[0]) ^ hash(ctup[1]) ^ hash(ctup[2] ^ ctup[3])
-
         if self.n_streams >= self.max_streams:
-            orig_client_state = self.oldest_stream.client.state
-            self.oldest_stream.state = CONN_TIMED_OUT
-
-            for listener in self.oldest_stream.listeners:
-                listener(self.oldest_stream, mpkt, None)
-
-            self.free_tcp_stream(self.oldest_stream)
-
-            if orig_client_state != TCP_SYN_SENT:
-                log.debug('Removing last stream. Limit hit.')
+            self.drop_oldest(mpkt)
+            self.report_drops()
 
-        new_stream = self.free_streams
-
-        if not new_stream:
-            raise Exception('No mem')
-
-        self.free_streams = new_stream.next_free
-
-        new_stream.reset(*ctup)
-
-        self.n_streams += 1
-        tolink = self.tcp_streams.get(hash_idx, None)
+        new_stream = TCPStream(mpkt.l3_src, mpkt.l3_dst,
+                               mpkt.l4_src, mpkt.l4_dst)
 
         new_stream.client.state = TCP_SYN_SENT
         new_stream.client.seq = \
@@ -670,163 +932,217 @@ class Reassembler(object):
         new_stream.client.wscale_on, new_stream.client.wscale = get_wscale(mpkt)
 
         new_stream.server.state = TCP_CLOSE
-        new_stream.next_node = tolink
-
-        if tolink:
-            tolink.prev_node = new_stream
 
-        self.tcp_streams[hash_idx] = new_stream
-
-        new_stream.next_time = self.latest_stream
+        self.tcp_streams[new_stream.get_key()] = new_stream
+        self.n_streams += 1
 
-        if not self.oldest_stream:
-            self.oldest_stream = new_stream
-        if self.latest_stream:
-            self.latest_stream.prev_time = new_stream
+        self.link_stream(new_stream)
+        new_stream.last_seen = self.now
 
-        self.latest_stream = new_stream
+        if self.idle_timeout:
+            self.timers.schedule(new_stream, self.now + self.idle_timeout)
 
     def find_stream(self, mpkt):
         """
         @param mpkt a MetaPacket object
-        @return a tuple (is_client:bool, TCPStream) or (True, None)
+        @return a tuple (is_client:bool, TCPStream) or (False, None)
         """
         # First look for client side streams
-
-        ctup = (inet_aton(mpkt.l3_src),
-                inet_aton(mpkt.l3_dst),
-                mpkt.l4_src, mpkt.l4_dst)
-
-        tcp_stream = self.find_tcp_stream(ctup)
+        tcp_stream = self.tcp_streams.get((mpkt.l3_src, mpkt.l3_dst,
+                                           mpkt.l4_src, mpkt.l4_dst), None)
 
         if tcp_stream:
             return (True, tcp_stream)
 
-        stup = (ctup[1], ctup[0], ctup[3], ctup[2])
-
-        tcp_stream = self.find_tcp_stream(stup)
+        tcp_stream = self.tcp_streams.get((mpkt.l3_dst, mpkt.l3_src,
+                                           mpkt.l4_dst, mpkt.l4_src), None)
 
         if tcp_stream:
             return (False, tcp_stream)
 
         return (False, None)
 
-    def find_tcp_stream(self, tup):
+    ############################################################################
+    # LRU list
+    ############################################################################
+
+    def link_stream(self, stream):
+        "Put the stream at the head (most recently used) of the LRU list"
+        stream.prev_time = None
+        stream.next_time = self.latest_stream
+
+        if self.latest_stream:
+            self.latest_stream.prev_time = stream
+
+        self.latest_stream = stream
+
+        if not self.oldest_stream:
+            self.oldest_stream = stream
+
+    def unlink_stream(self, stream):
+        "Remove the stream from the LRU list"
+        if stream.next_time:
+            stream.next_time.prev_time = stream.prev_time
+        else:
+            self.oldest_stream = stream.prev_time
+
+        if stream.prev_time:
+            stream.prev_time.next_time = stream.next_time
+        else:
+            self.latest_stream = stream.next_time
+
+        stream.next_time = stream.prev_time = None
+
+    def touch_stream(self, stream):
+        stream.last_seen = self.now
+
+        if stream is not self.latest_stream:
+            self.unlink_stream(stream)
+            self.link_stream(stream)
+
+    def drop_oldest(self, mpkt, reason='reassemble_maxstreams'):
         """
-        @param tup a tuple (srcip, dstip, srport, dport)
-        @return a TCPStream or None
+        Drop the least recently used stream
+        @param mpkt the MetaPacket object passed to the listeners
+        @param reason the option whose limit was hit
         """
-        hash_idx = hash(tup[0]) ^ hash(tup[1]) ^ \
-                   hash(tup[2] ^ tup[3])
+        stream = self.oldest_stream
+        orig_client_state = stream.client.state
 
-        it = self.tcp_streams.get(hash_idx, None)
+        if metrics.enabled:
+            self.dropped.inc()
 
-        while it:
-            if it.sport == tup[2] and it.dport == tup[3]:
-                return it
-            it = it.next_node
+        self.expire_stream(stream, mpkt, reason)
 
-    def add_tcp_closing_timeout(self, stream, mpkt):
+        if orig_client_state != TCP_SYN_SENT:
+            tcp_log.debug('Removing last stream. Limit hit.')
+
+    def check_memory(self, mpkt):
         """
-        @param stream a TCPStream instance
+        Drop the least recently used streams until the memory used is under
+        max_memory.
+        @param mpkt the MetaPacket object passed to the listeners
+        """
+        while self.mem_used > self.max_memory and self.oldest_stream:
+            self.drop_oldest(mpkt, 'reassemble_maxmemory')
+
+        self.report_drops()
+
+    ############################################################################
+    # Timeouts
+    ############################################################################
+
+    def update_time(self, mpkt):
+        """
+        Advance the timers with the timestamp of mpkt expiring the streams
         @param mpkt a MetaPacket object
         """
-        if not self.tcp_workarounds:
-            return
+        now = mpkt.get_rawtime() or time()
 
-        newto = TCPTimeout(stream, datetime.timedelta())
-        newto.timeout.seconds = mpkt.get_datetime().seconds + 10
+        if now > self.now:
+            self.now = now
 
-        to = self.tcp_timeouts
-        newto.next = self.tcp_timeouts
+        for stream in self.timers.advance(self.now):
+            self.check_timeout(stream, mpkt)
 
-        while to:
-            if to.stream is stream:
-                del newto
+        if self.drops:
+            self.report_drops()
 
-            if to.timeout.seconds > to.timeout.seconds:
-                break
+    def check_timeout(self, stream, mpkt):
+        """
+        Called when the timer of the stream fires. Since the idle timer is not
+        rescheduled on every packet, last_seen is used to compute the real
+        deadline of the stream.
+        """
+        deadline = reason = None
+
+        if self.idle_timeout:
+            deadline = stream.last_seen + self.idle_timeout
+            reason = 'reassemble_idle_timeout'
+
+        if stream.closing_at is not None and \
+           (deadline is None or stream.closing_at < deadline):
+            # Closed streams are dropped silently
+            deadline, reason = stream.closing_at, None
 
-            newto.prev = to
-            newto.next = to = to.next
+        if deadline is None:
+            return
 
-        if not newto.prev:
-            self.tcp_timeouts = newto
+        if deadline > self.now:
+            self.timers.schedule(stream, deadline)
         else:
-            newto.prev.next = newto
+            if metrics.enabled:
+                self.expired.inc()
 
-        if newto.next:
-            newto.next.prev = newto
+            self.expire_stream(stream, mpkt, reason)
 
-    def del_tcp_closing_timeout(self, stream):
+    def expire_stream(self, stream, mpkt, reason=None):
         """
-        @param stream a TCPStream instance
+        Drop the stream notifying the listeners with CONN_TIMED_OUT
+        @param reason the option that caused the drop reported to the user
+                      or None
         """
-        if not self.tcp_workarounds:
-            return
+        if reason:
+            tcp_log.debug('Dropping stream %s due %s', stream, reason)
+            self.drops[reason] += 1
 
-        to = self.tcp_timeouts
+        stream.state = CONN_TIMED_OUT
 
-        while to:
-            if to.stream is stream:
-                break
+        self.call_listeners(stream, mpkt, None)
 
-            to = to.next
+        self.free_tcp_stream(stream)
 
-        if not to:
-            return
+    def report_drops(self):
+        """
+        Report to the user the number of streams dropped for every reason
+        with a single message per pass (a pass could drop thousands of
+        streams on a big capture).
+        """
+        for reason in sorted(self.drops):
+            count = self.drops[reason]
 
-        if not to.prev:
-            self.tcp_timeouts = to.next
-        else:
-            to.prev.next = to.next
+            if count == 1:
+                msg = _('Dropped %d stream due %s')
+            else:
+                msg = _('Dropped %d streams due %s')
 
-        if to.next:
-            to.next.prev = to.prev
+            AuditManager().user_msg(msg % (count, reason), 7, 'decoder.tcp')
 
-        del to
+        self.drops.clear()
 
-    def free_tcp_stream(self, stream):
+    def add_closing_timeout(self, stream):
         """
-        @param stream TCPStream instance
+        @param stream a TCPStream instance
         """
-        hash_idx = stream.mkhash()
+        if not self.tcp_workarounds:
+            return
 
-        self.del_tcp_closing_timeout(stream)
+        stream.closing_at = self.now + CLOSING_TIMEOUT
+        self.timers.schedule(stream, stream.closing_at)
 
-        self.prune_queue(stream.server)
-        self.prune_queue(stream.client)
+    def free_tcp_stream(self, stream):
+        """
+        @param stream TCPStream instance
+        """
+        key = stream.get_key()
 
-        if stream.next_node:
-            stream.next_node.prev_node = stream.prev_node
-        if stream.prev_node:
-            stream.prev_node.next_node = stream.next_node
-        else:
-            self.tcp_streams[hash_idx] = stream.next_node
+        if self.tcp_streams.get(key, None) is not stream:
+            return
 
-        if self.tcp_streams[hash_idx] is None:
-            del self.tcp_streams[hash_idx]
+        del self.tcp_streams[key]
 
-        if stream.client.data:
-            del stream.client.data
-        if stream.server.data:
-            del stream.server.data
+        self.timers.cancel(stream)
+        self.unlink_stream(stream)
 
-        if stream.next_time:
-            stream.next_time.prev_time = stream.prev_time
-        if stream.prev_time:
-            stream.prev_time.next_time = stream.next_time
+        self.prune_queue(stream.server)
+        self.prune_queue(stream.client)
 
-        if stream is self.oldest_stream:
-            self.oldest_stream = stream.prev_time
-        if stream is self.latest_stream:
-            self.latest_stream = stream.next_time
+        self.mem_used -= len(stream.client.data) + len(stream.server.data)
+        stream.client.data.clear()
+        stream.server.data.clear()
 
         stream.listeners = []
 
-        stream.next_free = self.free_streams
-        self.free_streams = stream
-
         self.n_streams -= 1
 
 class TCPDecoder(Plugin, PassiveAudit):
@@ -852,12 +1168,18 @@ class TCPDecoder(Plugin, PassiveAudit):
 
         self.checksum_check = conf['checksum_check']
 
+        # TCP sessions live as long as the streams
+        SessionManager().set_timeout(NL_TYPE_TCP,
+                                     conf['reassemble_idle_timeout'])
+
         self.manager.add_decoder(PROTO_LAYER, NL_TYPE_TCP, self._process_tcp)
         self.manager.add_injector(1, NL_TYPE_TCP, self._inject_tcp)
 
         if conf['enable_reassemble']:
             self.reassembler = Reassembler(conf['reassemble_workarounds'],
-                                           conf['reassemble_maxstreams'])
+                                           conf['reassemble_maxstreams'],
+                                           conf['reassemble_maxmemory'],
+                                           conf['reassemble_idle_timeout'])
             self.manager.add_decoder_hook(PROTO_LAYER, NL_TYPE_ICMP,
                                           self.reassembler.process_icmp, 1)
 
@@ -951,16 +1273,16 @@ class TCPDecoder(Plugin, PassiveAudit):
                 ip_src = mpkt.l3_src
                 ip_dst = mpkt.l3_dst
 
-                psdhdr = pack("!4s4sHH",
-                              inet_aton(ip_src),
-                              inet_aton(ip_dst),
-                              mpkt.l4_proto,
-                              mpkt.payload_len)
+                psdsum = checksum_pseudo(inet_aton(ip_src),
+                                         inet_aton(ip_dst),
+                                         mpkt.l4_proto,
+                                         mpkt.payload_len)
 
-                chksum = checksum(psdhdr + tcpraw[:16] + \
-                                  "\x00\x00" + tcpraw[18:])
+                # A correct segment sums to 0xffff with the checksum included
+                if checksum_add(tcpraw, 0, None, psdsum) != 0xffff:
+                    chksum = checksum_add(tcpraw, 0, 16, psdsum)
+                    chksum = ~checksum_add(tcpraw, 18, None, chksum) & 0xffff
 
-                if mpkt.get_field('tcp.chksum', 0) != chksum:
                     wrong = True
                     mpkt.set_cfield('good_checksum', hex(chksum))
                     self.manager.user_msg(
@@ -979,12 +1301,12 @@ class TCPDecoder(Plugin, PassiveAudit):
             self.reassembler.process_tcp(mpkt)
 
         ident = TCPIdent.create(mpkt)
-        sess = SessionManager().get_session(ident)
+        sess = SessionManager().get_session(ident, mpkt.get_rawtime())
 
         if not sess:
             sess = Session(ident)
             sess.data = (TCPStatus(), TCPStatus())
-            SessionManager().put_session(sess)
+            SessionManager().put_session(sess, mpkt.get_rawtime())
 
         sess.prev = mpkt.session
         mpkt.session = sess
@@ -1048,7 +1370,13 @@ __configurations__ = (
         'reassemble_workarounds' : [True, 'Close a TCP connection after a ' \
                                     'timeout. Not RFC compliant but used in ' \
                                     'many implementations'],
-        'reassemble_maxstreams' : [30, 'Max number of streams to follow']
+        'reassemble_maxstreams' : [100000, 'Max number of streams to follow'],
+        'reassemble_maxmemory' : [64 * 1024 * 1024, 'Max bytes buffered by '
+                                  'the reassembler. The least recently used '
+                                  'streams are dropped once exceeded (0 to '
+                                  'disable)'],
+        'reassemble_idle_timeout' : [300, 'Drop a stream after this number of '
+                                     'seconds without traffic (0 to disable)'],
     }),
 )
 __vulnerabilities__ = (('TCP decoder', {
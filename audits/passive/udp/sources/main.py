@@ -27,7 +27,6 @@ decoder.udp.notice Invalid UDP packet from 127.0.0.1 to 127.0.0.1 : wrong checks
 """
 
 from time import time
-from struct import pack
 from socket import inet_aton
 
 from umit.pm.core.i18n import _
@@ -36,7 +35,7 @@ from umit.pm.gui.plugins.engine import Plugin
 from umit.pm.manager.auditmanager import AuditManager, PassiveAudit
 from umit.pm.manager.sessionmanager import STATELESS_IP_MAGIC
 from umit.pm.core.netconst import *
-from umit.pm.core.auditutils import checksum
+from umit.pm.core.auditutils import checksum_add, checksum_pseudo
 
 from umit.pm.backend import MetaPacket
 
@@ -64,16 +63,18 @@ def udp_decoder():
 
             if udpraw:
                 if mpkt.payload_len == len(udpraw):
-                    psdhdr = pack("!4s4sHH",
-                                  inet_aton(mpkt.l3_src),
-                                  inet_aton(mpkt.l3_dst),
-                                  mpkt.l4_proto,
-                                  mpkt.payload_len)
+                    psdsum = checksum_pseudo(inet_aton(mpkt.l3_src),
+                                             inet_aton(mpkt.l3_dst),
+                                             mpkt.l4_proto,
+                                             mpkt.payload_len)
+
+                    # A correct datagram sums to 0xffff with the checksum
+                    # included
+                    if checksum_add(udpraw, 0, None, psdsum) != 0xffff:
+                        chksum = checksum_add(udpraw, 0, 6, psdsum)
+                        chksum = ~checksum_add(udpraw, 8, None, chksum) & \
+                                 0xffff
 
-                    chksum = checksum(psdhdr + udpraw[:6] + \
-                                      '\x00\x00' + udpraw[8:])
-
-                    if mpkt.get_field('udp.chksum') != chksum:
                         mpkt.set_cfield('good_checksum', hex(chksum))
                         manager.user_msg(
                             _("Invalid UDP packet from %s to %s : " \
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Benchmark of the batch mode of audittester.py.
+
+The audits/pcap-tests corpus is replicated many times in a temporary
+directory and analyzed in batch mode with an increasing number of
+processes. The reports must be the same whatever the number of processes.
+"""
+
+import os
+import sys
+import time
+import shutil
+import optparse
+import tempfile
+import multiprocessing
+
+from subprocess import Popen, PIPE
+
+AUDITS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                          'audits')
+PCAP_DIR = os.path.join(AUDITS_DIR, 'pcap-tests')
+
+def replicate(dest, replicas):
+    "Copy the corpus replicas times in dest"
+    names = sorted([name for name in os.listdir(PCAP_DIR) \
+                    if name.endswith('.pcap')])
+
+    for idx in xrange(replicas):
+        for name in names:
+            shutil.copy(os.path.join(PCAP_DIR, name),
+                        os.path.join(dest, '%04d-%s' % (idx, name)))
+
+    return len(names) * replicas
+
+def run(dest, plugins, jobs, split):
+    "@return a tuple (elapsed, output)"
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.abspath(os.path.join(
+        AUDITS_DIR, '..'))] + filter(None, [env.get('PYTHONPATH')]))
+
+    cmd = [sys.executable, 'audittester.py', '-q', '-b', '-j', str(jobs),
+           '-S', str(split), '-f', plugins, dest]
+
+    start = time.time()
+    process = Popen(cmd, stdout=PIPE, cwd=AUDITS_DIR, env=env)
+    out, err = process.communicate()
+
+    return time.time() - start, out
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-r', '--replicas', dest='replicas', type='int',
+                      default=20, help='times the corpus is replicated')
+    parser.add_option('-j', '--jobs', dest='jobs',
+                      default='1,%d' % multiprocessing.cpu_count(),
+                      help='comma separated list of process counts')
+    parser.add_option('-S', '--split', dest='split', type='int', default=1,
+                      help='parts every capture is split into')
+    parser.add_option('-f', '--plugins', dest='plugins',
+                      default='ethernet,ip,tcp,udp,icmp,http,ftp,mysql,smb,'
+                              'vnc',
+                      help='comma separated list of passive plugins')
+
+    options, args = parser.parse_args()
+
+    dest = tempfile.mkdtemp(prefix='pm-batch-')
+
+    try:
+        count = replicate(dest, options.replicas)
+
+        print "Analyzing %d captures (times in secs)" % count
+        print "  %10s %10s %10s %10s" % ('processes', 'elapsed', 'speedup',
+                                         'same')
+
+        serial = report = None
+
+        for jobs in map(int, options.jobs.split(',')):
+            elapsed, out = run(dest, options.plugins, jobs, options.split)
+
+            if serial is None:
+                serial, report = elapsed, out
+
+            print "  %10d %10.2f %10.2f %10s" % (jobs, elapsed,
+                                                 serial / elapsed,
+                                                 out == report)
+    finally:
+        shutil.rmtree(dest)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Benchmark of the startup cost of the scapy backend.
+
+Every run is done in a new interpreter that imports umit.pm.backend, then
+builds the protocol registry with an empty cache (cold) or with the cache
+saved by the previous run (warm), looks up some protocols and finally
+parses the documentation, like the first time a field description is
+shown. The time and the resident memory added by every step are reported.
+"""
+
+import os
+import sys
+import optparse
+import tempfile
+
+from subprocess import Popen, PIPE
+
+STEPS = ('backend import', 'registry', 'get_proto', 'documentation')
+
+def get_rss():
+    "@return the resident set size of the process in KB"
+    try:
+        f = open('/proc/self/status')
+
+        try:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+        finally:
+            f.close()
+    except IOError:
+        pass
+
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def child(fname):
+    import time
+
+    marks = [(time.time(), get_rss())]
+
+    # Only the cost of the import is measured
+    __import__('umit.pm.backend')
+    marks.append((time.time(), get_rss()))
+
+    from umit.pm.backend.scapy import wrapper, doc
+
+    wrapper.registry = wrapper.ProtocolRegistry(fname)
+    marks.append((time.time(), get_rss()))
+
+    for name in ('Ether', 'IP', 'TCP', 'UDP', 'ICMP', 'ARP', 'DNS'):
+        wrapper.get_proto(name)
+
+    marks.append((time.time(), get_rss()))
+
+    doc.apply_doc()
+    marks.append((time.time(), get_rss()))
+
+    print repr([(end[0] - start[0], end[1] - start[1]) \
+                for start, end in zip(marks, marks[1:])])
+
+def run(fname):
+    proc = Popen([sys.executable, os.path.abspath(__file__), '--child',
+                  fname], stdout=PIPE)
+    out = proc.communicate()[0]
+
+    if proc.returncode:
+        raise Exception('Child process failed (%d)' % proc.returncode)
+
+    return eval(out.strip().splitlines()[-1])
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int',
+                      default=5, help='runs for every startup kind')
+    parser.add_option('--child', dest='child', default=None,
+                      help=optparse.SUPPRESS_HELP)
+
+    options, args = parser.parse_args()
+
+    if options.child:
+        child(options.child)
+        return
+
+    fd, fname = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+
+    print "Scapy backend startup (best of %d runs)" % options.repeat
+    print "  %-6s %-16s %10s %10s" % ('', '', 'msecs', 'RSS KB')
+
+    try:
+        for kind in ('cold', 'warm'):
+            best = None
+
+            for idx in xrange(options.repeat):
+                if kind == 'cold' and os.path.exists(fname):
+                    os.remove(fname)
+
+                steps = run(fname)
+
+                if best is None:
+                    best = steps
+                else:
+                    best = [(min(a[0], b[0]), min(a[1], b[1])) \
+                            for a, b in zip(best, steps)]
+
+            for name, (secs, rss) in zip(STEPS, best):
+                print "  %-6s %-16s %10.2f %10d" % (kind, name, secs * 1000,
+                                                    rss)
+    finally:
+        if os.path.exists(fname):
+            os.remove(fname)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Benchmark of the internet checksum routines used by the IP, TCP and UDP
+decoders over the captures contained in audits/pcap-tests.
+"""
+
+import os
+import sys
+import glob
+import gzip
+import time
+import optparse
+
+from array import array
+from struct import pack, unpack
+
+from umit.pm.core import auditutils
+from umit.pm.core.auditutils import checksum_pseudo, _checksum_add
+
+PCAP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'audits', 'pcap-tests')
+CAPTURES = ('wrong-checksum*.pcap', 'http_with_jpegs.pcap')
+
+def read_pcap(fname):
+    "@return a list of the raw frames contained in the ethernet capture"
+    f = open(fname, 'rb')
+
+    if f.read(2) == '\x1f\x8b':
+        f.close()
+        f = gzip.open(fname, 'rb')
+    else:
+        f.seek(0)
+
+    hdr = f.read(24)
+    endian = (unpack('<I', hdr[:4])[0] == 0xa1b2c3d4) and '<' or '>'
+    frames = []
+
+    while True:
+        rec = f.read(16)
+
+        if len(rec) < 16:
+            break
+
+        caplen = unpack(endian + 'IIII', rec)[2]
+        frames.append(f.read(caplen))
+
+    f.close()
+    return frames
+
+def split_ipv4(frames):
+    "@return a list of (ip header, l4 proto, l4 segment) tuples"
+    ret = []
+
+    for frame in frames:
+        if frame[12:14] != '\x08\x00':
+            continue
+
+        ihl = (ord(frame[14]) & 0x0f) * 4
+        iplen = unpack('!H', frame[16:18])[0]
+        ip = frame[14:14 + iplen]
+
+        if len(ip) < iplen:
+            continue
+
+        ret.append((ip[:ihl], ord(ip[9]), ip[ihl:]))
+
+    return ret
+
+def legacy_checksum(pkt):
+    "The implementation used before the chained checksum API"
+    if len(pkt) % 2 == 1:
+        pkt += "\0"
+    s = sum(array("H", pkt))
+    s = (s >> 16) + (s & 0xffff)
+    s += s >> 16
+    s = ~s
+    if auditutils.BIG_ENDIAN:
+        return s & 0xffff
+    return (((s>>8)&0xff)|s<<8) & 0xffff
+
+def run_legacy(packets):
+    ret = []
+
+    for iphdr, proto, seg in packets:
+        ret.append(legacy_checksum(iphdr[:10] + '\x00\x00' + iphdr[12:]))
+
+        if proto in (6, 17):
+            off = (proto == 6) and 16 or 6
+            psdhdr = pack("!4s4sHH", iphdr[12:16], iphdr[16:20], proto,
+                          len(seg))
+            ret.append(legacy_checksum(psdhdr + seg[:off] + '\x00\x00' + \
+                                       seg[off + 2:]))
+    return ret
+
+def make_chained(add):
+    def run_chained(packets):
+        ret = []
+
+        for iphdr, proto, seg in packets:
+            ret.append(~add(iphdr, 12, None, add(iphdr, 0, 10)) & 0xffff)
+
+            if proto in (6, 17):
+                off = (proto == 6) and 16 or 6
+                s = add(iphdr[12:20], 0, None, proto + len(seg))
+                s = add(seg, 0, off, s)
+                ret.append(~add(seg, off + 2, None, s) & 0xffff)
+        return ret
+
+    return run_chained
+
+def make_verify(add):
+    def run_verify(packets):
+        # What the decoders do: checksum fields are kept so a correct packet
+        # sums to 0xffff
+        ret = []
+
+        for iphdr, proto, seg in packets:
+            ret.append(add(iphdr) == 0xffff)
+
+            if proto in (6, 17):
+                s = add(iphdr[12:20], 0, None, proto + len(seg))
+                ret.append(add(seg, 0, None, s) == 0xffff)
+        return ret
+
+    return run_verify
+
+def run_batch(packets):
+    # Checksum fields are kept: a correct packet sums to zero
+    bufs = []
+
+    for iphdr, proto, seg in packets:
+        bufs.append(iphdr)
+
+        if proto in (6, 17):
+            bufs.append((seg, checksum_pseudo(iphdr[12:16], iphdr[16:20],
+                                              proto, len(seg))))
+
+    return auditutils.checksum_batch(bufs)
+
+def measure(func, packets, rounds):
+    start = time.time()
+
+    for idx in xrange(rounds):
+        func(packets)
+
+    return (time.time() - start) * 1e6 / (rounds * len(packets))
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-r', '--rounds', dest='rounds', type='int', default=50,
+                      help='times the whole corpus is checksummed')
+
+    options, args = parser.parse_args()
+
+    packets = []
+
+    for pattern in CAPTURES:
+        for fname in sorted(glob.glob(os.path.join(PCAP_DIR, pattern))):
+            packets.extend(split_ipv4(read_pcap(fname)))
+
+    if not packets:
+        print "No packets found in %s" % PCAP_DIR
+        sys.exit(-1)
+
+    native = auditutils.checksum_add is not _checksum_add
+
+    tests = [('legacy', run_legacy),
+             ('chained (python)', make_chained(_checksum_add)),
+             ('verify (python)', make_verify(_checksum_add))]
+
+    if native:
+        tests.append(('chained (native)', make_chained(auditutils.checksum_add)))
+        tests.append(('verify (native)', make_verify(auditutils.checksum_add)))
+
+    tests.append(('batch', run_batch))
+
+    expected = run_legacy(packets)
+
+    for name, func in tests[1:-1]:
+        if name.startswith('chained'):
+            assert func(packets) == expected, name
+
+    print "Checksumming %d IPv4 packets (%d rounds, native extension: %s)" % \
+          (len(packets), options.rounds, native and 'yes' or 'no')
+
+    for name, func in tests:
+        print "  %-17s %8.3f usec/packet" % (name, measure(func, packets,
+                                                           options.rounds))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Benchmark of the grouping of packets by connection used by the reflow of
+the sniff perspective, against the number of packets.
+
+The packets are lazy MetaPackets of synthetic TCP flows. For every size
+the time to group the whole list with the ConnectionIndex is compared
+with the old hashret() based scan (only up to --legacy packets since it's
+quadratic) and with the time needed to update the index after 1% more
+packets are captured.
+"""
+
+import time
+import optparse
+
+from struct import pack
+
+from umit.pm.backend.scapy.packet import MetaPacket
+from umit.pm.backend.scapy.utils import ConnectionIndex
+from umit.pm.backend.scapy.wrapper import Ether
+
+def legacy_analyze_connections(pktlist):
+    "The implementation used before the ConnectionIndex"
+    tree = {}
+
+    for packet in pktlist:
+        hashret = packet.root.hashret()
+        append = False
+        last = 0
+
+        for (idx, hash, pkt) in tree:
+            last = max(last, idx)
+
+            if hash == hashret:
+                tree[(idx, hash, pkt)].append(packet)
+                append = True
+                break
+
+        if not append:
+            tree[(last + 1, hashret, packet)] = []
+
+    return [(packet, lst) for (idx, hash, packet), lst in tree.items()]
+
+def generate(count, flows):
+    "@return a list of lazy MetaPackets of flows interleaved"
+    packets = []
+    ts = 1000000000.0
+
+    for idx in xrange(count):
+        flow = idx % flows
+        client = (idx / flows) % 2 == 0
+
+        src = pack('!BBBB', 10, flow >> 16 & 0xff, flow >> 8 & 0xff,
+                   flow & 0xff)
+        dst = '\xc0\xa8\x00\x01'
+        sport, dport = 1024 + flow % 60000, 80
+
+        if not client:
+            src, dst, sport, dport = dst, src, dport, sport
+
+        tcp = pack('!HHIIBBHHH', sport, dport, idx, 0, 5 << 4, 0x18, 65535,
+                   0, 0)
+        ip = pack('!BBHHHBBH4s4s', 0x45, 0, 40, idx & 0xffff, 0, 64, 6, 0,
+                  src, dst)
+        frame = '\x00\x01\x02\x03\x04\x05\x00\x01\x02\x03\x04\x06\x08\x00' + \
+                ip + tcp
+
+        ts += 0.0001
+        packets.append(MetaPacket.new_lazy(frame, Ether, ts))
+
+    return packets
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--sizes', dest='sizes',
+                      default='1000,10000,50000,100000',
+                      help='comma separated list of packet counts')
+    parser.add_option('-f', '--flows', dest='flows', type='int', default=500,
+                      help='number of flows')
+    parser.add_option('-l', '--legacy', dest='legacy', type='int',
+                      default=10000, help='max packets for the old scan')
+
+    options, args = parser.parse_args()
+
+    print "Grouping packets of %d flows (times in secs)" % options.flows
+    print "  %10s %10s %10s %10s" % ('packets', 'legacy', 'index',
+                                     'update 1%')
+
+    for size in map(int, options.sizes.split(',')):
+        packets = generate(size + size / 100, options.flows)
+        pktlist = packets[:size]
+
+        if size <= options.legacy:
+            start = time.time()
+            legacy = legacy_analyze_connections(pktlist)
+            legacy_time = '%10.3f' % (time.time() - start)
+
+            # The old scan dissected the packets. Start again from raw ones.
+            packets = generate(size + size / 100, options.flows)
+            pktlist = packets[:size]
+        else:
+            legacy = None
+            legacy_time = '%10s' % '-'
+
+        index = ConnectionIndex()
+
+        start = time.time()
+        groups = index.update(pktlist)
+        index_time = time.time() - start
+
+        if legacy is not None:
+            assert len(groups) == len(legacy), (len(groups), len(legacy))
+
+        pktlist.extend(packets[size:])
+
+        start = time.time()
+        index.update(pktlist)
+        update_time = time.time() - start
+
+        print "  %10d %s %10.3f %10.3f" % (size, legacy_time, index_time,
+                                           update_time)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Microbenchmark of the AuditManager dispatch machinery.
+
+No-op decoders are registered on a fake datalink so that the numbers only
+show the overhead of walking the decoders chain and the hook points for
+every packet. With --metrics the dispatching is measured again with the
+metrics enabled (the decoders and the hooks timed) and the collected
+metrics are printed.
+"""
+
+import time
+import optparse
+
+from umit.pm.core.metrics import metrics
+from umit.pm.manager.auditmanager import AuditManager, AuditDispatcher
+from umit.pm.core.netconst import LINK_LAYER, NET_LAYER, PROTO_LAYER
+
+# Not used by any real decoder
+FAKE_TYPE = 0xfff0
+
+class FakePacket(object):
+    flags = 0
+
+    def get_rawtime(self):
+        return 1000000000.0
+
+def noop_hook(mpkt):
+    pass
+
+def link_decoder(mpkt):
+    return NET_LAYER, FAKE_TYPE
+
+def net_decoder(mpkt):
+    return PROTO_LAYER, FAKE_TYPE
+
+def proto_decoder(mpkt):
+    return None
+
+def setup(hooks):
+    manager = AuditManager()
+
+    manager.add_decoder(LINK_LAYER, FAKE_TYPE, link_decoder)
+    manager.add_decoder(NET_LAYER, FAKE_TYPE, net_decoder)
+    manager.add_decoder(PROTO_LAYER, FAKE_TYPE, proto_decoder)
+
+    for idx in xrange(hooks):
+        manager.add_decoder_hook(NET_LAYER, FAKE_TYPE, noop_hook, 0)
+        manager.add_decoder_hook(PROTO_LAYER, FAKE_TYPE, noop_hook, 1)
+        manager.add_to_hook_point('pm::received', noop_hook)
+
+    return manager
+
+def measure(func, count):
+    start = time.time()
+
+    for idx in xrange(count):
+        func()
+
+    return (time.time() - start) * 1e6 / count
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--packets', dest='packets', type='int',
+                      default=200000, help='number of packets to dispatch')
+    parser.add_option('-k', '--hooks', dest='hooks', type='int', default=1,
+                      help='no-op hooks registered for each hook point')
+    parser.add_option('-m', '--metrics', dest='metrics', action='store_true',
+                      default=False, help='measure also with the metrics '
+                                          'enabled')
+
+    options, args = parser.parse_args()
+
+    manager = setup(options.hooks)
+    dispatcher = AuditDispatcher(FAKE_TYPE)
+    mpkt = FakePacket()
+
+    def run():
+        return (
+            ('run_decoder', measure(
+                lambda: manager.run_decoder(LINK_LAYER, FAKE_TYPE, mpkt),
+                options.packets)),
+            ('run_hook_point', measure(
+                lambda: manager.run_hook_point('pm::received', mpkt),
+                options.packets)),
+            ('feed', measure(lambda: dispatcher.feed(mpkt), options.packets)),
+        )
+
+    results = [run()]
+
+    if options.metrics:
+        metrics.enable()
+        results.append(run())
+        metrics.disable()
+
+    print "Dispatching %d packets (%d hooks per point)" % (options.packets,
+                                                           options.hooks)
+
+    if options.metrics:
+        print "  %-16s %10s %10s" % ('usec/packet', 'disabled', 'enabled')
+
+        for (name, usecs), (name, timed) in zip(*results):
+            print "  %-16s %10.3f %10.3f" % (name, usecs, timed)
+
+        print
+        print metrics.dump()
+    else:
+        for name, usecs in results[0]:
+            print "  %-16s %8.3f usec/packet" % (name, usecs)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+"""
+Benchmark of the display filters used by the sniff perspective and by
+audittester.py against the number of packets.
+
+The packets are lazy MetaPackets of synthetic TCP and UDP flows. For every
+size each filter is compiled once and matched against the whole list. The
+old substring search of the sniff perspective is timed too (only up to
+--legacy packets since it dissects every packet).
+"""
+
+import time
+import optparse
+
+from struct import pack
+
+from umit.pm.backend.scapy.packet import MetaPacket
+from umit.pm.backend.scapy.wrapper import Ether
+from umit.pm.backend.scapy.displayfilter import DisplayFilter
+
+FILTERS = (
+    'tcp',
+    'tcp.dport == 80 and ip.src in 10.0.0.0/8',
+    'udp.port in {53 67 68} || tcp.flags.syn == 1',
+    'not ip.addr == 192.168.0.1',
+    'tcp.payload contains "GET"',
+)
+
+def generate(count, flows=500):
+    "@return a list of lazy MetaPackets of flows interleaved"
+    packets = []
+    ts = 1000000000.0
+
+    for idx in xrange(count):
+        flow = idx % flows
+        src = pack('!BBBB', (flow % 2) and 10 or 172, 0, flow >> 8 & 0xff,
+                   flow & 0xff)
+
+        if flow % 3:
+            data = (idx % 7) and 'x' * 16 or 'GET / HTTP/1.0\r\n\r\n'
+            l4 = pack('!HHIIBBHHH', 1024 + flow, 80, idx, 0, 5 << 4,
+                      (idx % 10) and 0x18 or 0x02, 65535, 0, 0) + data
+            proto = 6
+        else:
+            l4 = pack('!HHHH', 1024 + flow, 53, 8 + 32, 0) + 'x' * 32
+            proto = 17
+
+        ip = pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(l4), idx & 0xffff, 0,
+                  64, proto, 0, src, '\xc0\xa8\x00\x01')
+        frame = '\x00\x01\x02\x03\x04\x05\x00\x01\x02\x03\x04\x06\x08\x00' + \
+                ip + l4
+
+        ts += 0.0001
+        packets.append(MetaPacket.new_lazy(frame, Ether, ts))
+
+    return packets
+
+def legacy_filter(packets, text):
+    "The substring search used by the sniff perspective before"
+    ret = []
+
+    for idx, packet in enumerate(packets):
+        strs = (
+            str(idx + 1),
+            packet.get_time(),
+            packet.get_source(),
+            packet.get_dest(),
+            packet.get_protocol_str(),
+            packet.summary()
+        )
+
+        for pattern in strs:
+            if text in pattern:
+                ret.append(idx)
+                break
+
+    return ret
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--sizes', dest='sizes',
+                      default='10000,100000,1000000',
+                      help='comma separated list of packet counts')
+    parser.add_option('-l', '--legacy', dest='legacy', type='int',
+                      default=10000, help='max packets for the old search')
+
+    options, args = parser.parse_args()
+
+    for size in map(int, options.sizes.split(',')):
+        packets = generate(size)
+
+        print "Filtering %d packets (times in secs)" % size
+        print "  %-50s %10s %10s" % ('filter', 'matches', 'time')
+
+        for expression in FILTERS:
+            dfilter = DisplayFilter(expression)
+
+            start = time.time()
+            matches = len(dfilter.filter(packets))
+            elapsed = time.time() - start
+
+            print "  %-50s %10d %10.3f" % (expression, matches, elapsed)
+
+        if size <= options.legacy:
+            start = time.time()
+            matches = len(legacy_filter(packets, 'TCP'))
+            elapsed = time.time() - start
+
+            print "  %-50s %10d %10.3f" % ('(old substring search)', matches,
+                                           elapsed)
+
+if __name__ == "__main__":
+    main()
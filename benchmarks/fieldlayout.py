@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Benchmark of the offsets and sizes of the fields asked by the GUI.
+
+A packet with many layers (IP in IP tunnels) is selected several times:
+every selection asks the offset and the size of all the fields of all the
+layers like the PropertyTab and the plotter do. The offsets are computed
+walking the fields_desc of the previous layers, like before the layout
+tables, and through the layout memoized on the MetaPacket. The packet is
+invalidated before every selection, so the layout is rebuilt each time.
+"""
+
+import time
+import optparse
+
+from umit.pm.backend.scapy.packet import MetaPacket
+from umit.pm.backend.scapy.wrapper import Ether, IP, TCP, Raw, NoPayload, \
+                                          StrField, get_field_offset, \
+                                          get_field_size
+
+def legacy_field_size(proto, field):
+    if isinstance(field, StrField):
+        try:
+            return field.i2len(proto, getattr(proto, field.name)) * 8
+        except TypeError:
+            return len(field.i2m(proto, getattr(proto, field.name)))
+
+    if hasattr(field, 'size'):
+        return field.size
+    else:
+        return field.sz * 8
+
+def legacy_field_offset(packet, proto, field):
+    bits = 0
+
+    child = packet.root
+
+    while not isinstance(child, NoPayload) and proto is not child:
+        for f in child.fields_desc:
+            bits += legacy_field_size(child, f)
+
+        child = child.payload
+
+    for f in child.fields_desc:
+        if field == f:
+            return bits
+
+        bits += legacy_field_size(child, f)
+
+def select(mpkt, offset, size):
+    "Ask offset and size of every field of the packet"
+    mpkt.invalidate()
+
+    for proto in mpkt.get_protocols():
+        for field in proto.fields_desc:
+            offset(mpkt, proto, field)
+            size(proto, field)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-l', '--layers', dest='layers', type='int',
+                      default=20, help='number of IP layers')
+    parser.add_option('-n', '--selections', dest='selections', type='int',
+                      default=100, help='number of selections')
+
+    options, args = parser.parse_args()
+
+    pkt = Ether()
+
+    for idx in xrange(options.layers):
+        pkt = pkt / IP(dst='10.0.0.%d' % (idx + 1))
+
+    mpkt = MetaPacket(pkt / TCP() / Raw('x' * 64))
+    fields = sum([len(proto.fields_desc) for proto in mpkt.get_protocols()])
+
+    print "%d selections of a packet with %d layers and %d fields" % \
+          (options.selections, len(mpkt.get_protocols()), fields)
+    print "  %-10s %10s %12s" % ('', 'msecs', 'usecs/field')
+
+    for name, offset, size in (
+        ('legacy', legacy_field_offset, legacy_field_size),
+        ('layout', get_field_offset, get_field_size)):
+
+        start = time.time()
+
+        for idx in xrange(options.selections):
+            select(mpkt, offset, size)
+
+        elapsed = time.time() - start
+
+        print "  %-10s %10.2f %12.2f" % (name, elapsed * 1000, elapsed * 1e6 /
+                                         (options.selections * fields))
+
+if __name__ == "__main__":
+    main()
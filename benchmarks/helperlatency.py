@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Capture to callback latency of the helper based capture methods.
+
+A fake helper (this script with --helper) replays a capture at a fixed
+rate stamping every packet with the time it is written, so no capture
+privileges are needed. The packets are read back:
+
+  file   like the old code: the helper writes a dump file and reports the
+         number of packets captured on stderr ("Got %u" every --report
+         seconds like tcpdump). The reader waits for the report and then
+         reads the reported packets from the file.
+  pipe   like SniffContext now: the helper writes the pcap stream on its
+         stdout which is parsed with bind_reader().
+
+The latency is the time between the write of the helper and the moment the
+MetaPacket is available to the callback.
+"""
+
+import os
+import sys
+import gzip
+import time
+import optparse
+import tempfile
+
+from select import select
+from struct import pack, unpack
+from subprocess import Popen, PIPE
+
+PCAP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'audits', 'pcap-tests')
+
+###############################################################################
+# Fake helper
+###############################################################################
+
+def read_frames(fname):
+    "@return the linktype and the list of the frames of the capture fname"
+    f = open(fname, 'rb')
+
+    if f.read(2) == '\x1f\x8b':
+        f.close()
+        f = gzip.open(fname, 'rb')
+    else:
+        f.seek(0)
+
+    hdr = f.read(24)
+    endian = hdr[:4] == '\xa1\xb2\xc3\xd4' and '>' or '<'
+    linktype = unpack(endian + 'I', hdr[20:24])[0]
+
+    frames = []
+
+    while True:
+        rec = f.read(16)
+
+        if len(rec) < 16:
+            break
+
+        caplen = unpack(endian + 'IIII', rec)[2]
+        frames.append(f.read(caplen))
+
+    f.close()
+    return linktype, frames
+
+def helper(fname, output, count, rate, report):
+    """
+    Write count packets of fname at rate packets per second on output (a
+    path or - for stdout). With a path the number of packets written is
+    printed on stderr every report seconds.
+    """
+    linktype, frames = read_frames(fname)
+
+    if output == '-':
+        out = os.fdopen(sys.stdout.fileno(), 'wb', 0)
+    else:
+        out = open(output, 'wb')
+
+    out.write(pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, linktype))
+    out.flush()
+
+    start = last_report = time.time()
+
+    for idx in xrange(count):
+        delay = start + float(idx) / rate - time.time()
+
+        if delay > 0:
+            time.sleep(delay)
+
+        frame = frames[idx % len(frames)]
+        now = time.time()
+        sec = int(now)
+
+        out.write(pack('<IIII', sec, int((now - sec) * 1000000), len(frame),
+                       len(frame)) + frame)
+        out.flush()
+
+        if output != '-' and now - last_report >= report:
+            sys.stderr.write('Got %u\r' % (idx + 1))
+            sys.stderr.flush()
+            last_report = now
+
+    if output != '-':
+        sys.stderr.write('Got %u\r' % count)
+        sys.stderr.flush()
+
+    out.close()
+
+def spawn(fname, output, options, stderr):
+    return Popen([sys.executable, os.path.abspath(__file__), '--helper',
+                  output, '-n', str(options.count), '-r', str(options.rate),
+                  '-R', str(options.report), fname],
+                 stdout=PIPE, stderr=stderr)
+
+###############################################################################
+# Readers
+###############################################################################
+
+def read_file(fname, options, hist):
+    "The old method: dump file polled after the packets reported on stderr"
+    from scapy.utils import PcapReader
+    from umit.pm.backend.scapy.packet import MetaPacket
+
+    outfile = tempfile.mktemp(prefix='pm-latency-', suffix='.pcap')
+    process = spawn(fname, outfile, options, PIPE)
+
+    try:
+        while not os.path.exists(outfile) or os.stat(outfile).st_size < 24:
+            time.sleep(0.5)
+
+        reader = PcapReader(outfile)
+        fd = process.stderr.fileno()
+        read = 0
+
+        while read < options.count:
+            if not select([fd], [], [], 1.0)[0]:
+                continue
+
+            data = os.read(fd, 1024)
+
+            if not data:
+                break
+
+            reported = int(data.strip('\r').split('\r')[-1].split(' ')[1])
+
+            while read < reported:
+                mpkt = MetaPacket.new_from_pcap(reader)
+
+                if not mpkt:
+                    break
+
+                hist.record((time.time() - mpkt.get_rawtime()) * 1000000)
+                read += 1
+
+        process.wait()
+    finally:
+        if os.path.exists(outfile):
+            os.unlink(outfile)
+
+def read_pipe(fname, options, hist):
+    "The new method: pcap stream read from the helper stdout"
+    from umit.pm.backend.scapy.utils import bind_reader
+    from umit.pm.backend.scapy.packet import MetaPacket
+
+    errfile = tempfile.TemporaryFile(prefix='pm-latency-')
+    process = spawn(fname, '-', options, errfile)
+
+    for reader in bind_reader(process):
+        if reader:
+            reader = reader[0]
+
+    while True:
+        mpkt = MetaPacket.new_from_pcap(reader)
+
+        if not mpkt:
+            if reader.eof:
+                break
+
+            continue
+
+        hist.record((time.time() - mpkt.get_rawtime()) * 1000000)
+
+    process.wait()
+    errfile.close()
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [capture]')
+    parser.add_option('-n', '--count', dest='count', type='int',
+                      default=2000, help='packets written by the helper')
+    parser.add_option('-r', '--rate', dest='rate', type='float',
+                      default=1000.0, help='packets per second')
+    parser.add_option('-R', '--report', dest='report', type='float',
+                      default=1.0, help='seconds between the reports of '
+                                        'the file method')
+    parser.add_option('--helper', dest='helper', default=None,
+                      help=optparse.SUPPRESS_HELP)
+
+    options, args = parser.parse_args()
+    fname = args and args[0] or os.path.join(PCAP_DIR, 'http_with_jpegs.pcap')
+
+    if options.helper:
+        helper(fname, options.helper, options.count, options.rate,
+               options.report)
+        return
+
+    from umit.pm.core.metrics import Histogram
+
+    print "Replaying %d packets of %s at %.0f pps (latency in usecs)" % \
+          (options.count, os.path.basename(fname), options.rate)
+    print "  %-6s %8s %10s %10s %10s %10s" % ('', 'packets', 'mean', 'p50',
+                                              'p99', 'max')
+
+    for name, func in (('file', read_file), ('pipe', read_pipe)):
+        hist = Histogram(name)
+        func(fname, options, hist)
+
+        print "  %-6s %8d %10d %10d %10d %10d" % (name, hist.count,
+                                                  hist.get_mean() or 0,
+                                                  hist.percentile(50) or 0,
+                                                  hist.percentile(99) or 0,
+                                                  hist.max or 0)
+
+if __name__ == "__main__":
+    main()
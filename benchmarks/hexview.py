@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Benchmark of the read only HexView against the size of the payload.
+
+For every size the time needed to show a new payload is compared with the
+old rendering of the whole payload (only up to --legacy bytes), then the
+time to show the payload again with a byte changed (like after a field is
+edited) and to scroll to its end are printed.
+
+It needs a display, use xvfb-run to run it headless.
+"""
+
+import time
+import optparse
+
+import gtk
+
+from umit.pm.gui.widgets.hexview import HexView
+
+def flush():
+    while gtk.events_pending():
+        gtk.main_iteration(False)
+
+def legacy_render(view, txt):
+    "The rendering of the whole payload used before the windowed one"
+    bpl = view.bpl
+    tot_lines = int(len(txt) / bpl)
+
+    if len(txt) % bpl != 0:
+        tot_lines += 1
+
+    off_len = len(str(tot_lines)) + 1
+    printable = view.ascii_text._printable
+
+    buffers = [(view.offset_text.buffer, view.tag_offset),
+               (view.hex_text.buffer, view.tag_hex),
+               (view.ascii_text.buffer, view.tag_ascii)]
+
+    for buffer, tag in buffers:
+        buffer.set_text('')
+
+    offsets = [("%0" + str(off_len) + "d") % i for i in xrange(tot_lines)]
+    hexs, asciis = [], []
+
+    for i in xrange(tot_lines):
+        chunk = txt[i * bpl:(i * bpl) + bpl]
+        hexs.append(" ".join(map(lambda x: str(hex(ord(x)))[2:].zfill(2),
+                                 chunk)).upper())
+        asciis.append("".join(map(lambda x: (x in printable) and x or '.',
+                                  chunk)))
+
+    for (buffer, tag), output in zip(buffers, (offsets, hexs, asciis)):
+        buffer.insert_with_tags(buffer.get_end_iter(), "\n".join(output), tag)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--sizes', dest='sizes',
+                      default='64,1500,65536,1048576,10485760',
+                      help='comma separated list of payload sizes in bytes')
+    parser.add_option('-l', '--legacy', dest='legacy', type='int',
+                      default=1048576, help='max bytes for the old rendering')
+
+    options, args = parser.parse_args()
+
+    view = HexView()
+
+    w = gtk.Window()
+    w.set_default_size(700, 400)
+    w.add(view)
+    w.show_all()
+    flush()
+
+    print "Showing payloads in the HexView (times in secs)"
+    print "  %10s %10s %10s %10s %10s" % ('bytes', 'legacy', 'payload',
+                                          'edit', 'scroll')
+
+    for size in map(int, options.sizes.split(',')):
+        payload = ''.join([chr(i % 256) for i in xrange(256)]) * \
+                  (size / 256 + 1)
+        payload = payload[:size]
+
+        if size <= options.legacy:
+            start = time.time()
+            legacy_render(view, payload)
+            flush()
+            legacy_time = '%10.4f' % (time.time() - start)
+        else:
+            legacy_time = '%10s' % '-'
+
+        # Start from an empty view every time
+        view.payload = ''
+        flush()
+
+        start = time.time()
+        view.payload = payload
+        flush()
+        payload_time = time.time() - start
+
+        view.select_block(0, min(size, 20))
+        edited = payload[:10] + chr((ord(payload[10]) + 1) % 256) + \
+                 payload[11:]
+
+        start = time.time()
+        view.payload = edited
+        view.select_block(0, min(size, 20))
+        flush()
+        edit_time = time.time() - start
+
+        start = time.time()
+        view.vadj.set_value(view.vadj.upper - view.vadj.page_size)
+        flush()
+        scroll_time = time.time() - start
+
+        print "  %10d %s %10.4f %10.4f %10.4f" % (size, legacy_time,
+                                                  payload_time, edit_time,
+                                                  scroll_time)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Benchmark of the IP fragments reassembly of the ip decoder.
+
+Thousands of synthetic datagrams are fragmented and their fragments are
+shuffled and interleaved with the ones of the other datagrams in flight.
+The datagrams share a small set of IP ids so that only the (source, dest,
+proto, id) key keeps them apart. Every reassembled payload is checked.
+
+audits/pcap-tests/fragmented-ping.pcap is used as regression case before
+running the benchmark.
+"""
+
+import os
+import imp
+import gzip
+import time
+import random
+import optparse
+
+from struct import pack, unpack
+from socket import inet_ntoa
+
+from umit.pm.core.auditutils import checksum_add
+
+IP_SOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                          'audits', 'passive', 'ip', 'sources', 'main.py')
+PCAP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'audits', 'pcap-tests')
+
+def read_pcap(fname):
+    "@return a list of (timestamp, frame) tuples of the ethernet capture"
+    f = open(fname, 'rb')
+
+    if f.read(2) == '\x1f\x8b':
+        f.close()
+        f = gzip.open(fname, 'rb')
+    else:
+        f.seek(0)
+
+    hdr = f.read(24)
+    endian = (unpack('<I', hdr[:4])[0] == 0xa1b2c3d4) and '<' or '>'
+    frames = []
+
+    while True:
+        rec = f.read(16)
+
+        if len(rec) < 16:
+            break
+
+        sec, usec, caplen = unpack(endian + 'III', rec[:12])
+        frames.append((sec + usec / 1000000.0, f.read(caplen)))
+
+    f.close()
+    return frames
+
+def regression(ip):
+    "Reassemble the pings in fragmented-ping.pcap"
+    cache = ip.FragmentCache()
+    payloads = []
+
+    for ts, frame in read_pcap(os.path.join(PCAP_DIR,
+                                            'fragmented-ping.pcap')):
+        if frame[12:14] != '\x08\x00':
+            continue
+
+        iphdr = frame[14:34]
+        ihl = (ord(iphdr[0]) & 0x0f) * 4
+        iplen, ipid, frag = unpack('!HHH', iphdr[2:8])
+
+        key = (inet_ntoa(iphdr[12:16]), inet_ntoa(iphdr[16:20]),
+               ord(iphdr[9]), ipid)
+        payload = cache.add(key, (frag & 0x1fff) * 8,
+                            frame[14 + ihl:14 + iplen], frag & 0x2000, ts)
+
+        if payload is not None:
+            payloads.append(payload)
+
+    # Echo requests of 65507 bytes with a valid ICMP checksum
+    assert len(payloads) == 4, len(payloads)
+
+    for payload in payloads:
+        assert len(payload) == 65515, len(payload)
+        assert checksum_add(payload) == 0xffff
+
+    assert not cache.datagrams and cache.mem_used == 0
+
+    print "fragmented-ping.pcap: %d datagrams reassembled" % len(payloads)
+
+def generate(datagrams, window, size, mtu, seed=0):
+    """
+    @return a tuple (fragments, payloads) where fragments is the list of the
+            (key, offset, data, more, ts) tuples to feed and payloads maps
+            the key of the datagrams to their payload
+    """
+    rnd = random.Random(seed)
+    fraglen = (mtu - 20) & ~7
+    fragments, payloads = [], {}
+    ts = 1000000000.0
+
+    for base in xrange(0, datagrams, window):
+        inflight = []
+
+        for idx in xrange(base, min(base + window, datagrams)):
+            key = ('10.0.%d.%d' % (idx >> 8 & 0xff, idx & 0xff),
+                   '192.168.0.1', 17, idx % 16)
+            payload = pack('!I', idx) * (size / 4)
+            payloads[key] = payload
+
+            frags = [(key, off, payload[off:off + fraglen],
+                      off + fraglen < len(payload)) \
+                     for off in xrange(0, len(payload), fraglen)]
+            rnd.shuffle(frags)
+            inflight.append(frags)
+
+        while inflight:
+            frags = inflight[rnd.randrange(len(inflight))]
+            ts += 0.0001
+            fragments.append(frags.pop() + (ts, ))
+
+            if not frags:
+                inflight.remove(frags)
+
+    return fragments, payloads
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--datagrams', dest='datagrams', type='int',
+                      default=5000, help='number of fragmented datagrams')
+    parser.add_option('-w', '--window', dest='window', type='int',
+                      default=100, help='datagrams reassembled at same time')
+    parser.add_option('-s', '--size', dest='size', type='int', default=8000,
+                      help='payload size of the datagrams')
+    parser.add_option('-m', '--mtu', dest='mtu', type='int', default=1500,
+                      help='MTU used to fragment the datagrams')
+
+    options, args = parser.parse_args()
+
+    ip = imp.load_source('ip_decoder', IP_SOURCES)
+
+    regression(ip)
+
+    fragments, payloads = generate(options.datagrams, options.window,
+                                   options.size, options.mtu)
+    cache = ip.FragmentCache(options.window,
+                             options.size / ((options.mtu - 20) & ~7) + 1,
+                             0, 30)
+    add = cache.add
+    done = 0
+
+    start = time.time()
+
+    for key, offset, data, more, ts in fragments:
+        payload = add(key, offset, data, more, ts)
+
+        if payload is not None:
+            assert payload == payloads[key], key
+            done += 1
+
+    elapsed = time.time() - start
+
+    assert done == options.datagrams, done
+
+    print "Reassembled %d datagrams (%d fragments, %d in flight) in " \
+          "%.2f secs" % (done, len(fragments), options.window, elapsed)
+    print "  %-20s %10.0f" % ('fragments/sec', len(fragments) / elapsed)
+    print "  %-20s %10.0f" % ('datagrams/sec', done / elapsed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Benchmark of the cost of a debug record on the packet path.
+
+The message is formatted with % before the call like the old call sites
+did, passed with lazy arguments to a disabled level (no-op method) and
+skipped through the debug_enabled check of a category. With debug enabled
+the records are written to /dev/null directly or through the asynchronous
+handler, measuring only the time spent by the thread logging.
+"""
+
+import os
+import time
+import optparse
+
+from umit.pm.core.logger import log
+
+class Connection(object):
+    "Object with a __str__ like the ones logged by the audits"
+
+    def __str__(self):
+        return '%s:%d -> %s:%d' % ('10.0.0.1', 1024, '192.168.0.1', 80)
+
+def measure(func, count):
+    "@return usecs per call of func"
+    start = time.time()
+
+    for idx in xrange(count):
+        func(idx)
+
+    return (time.time() - start) * 1000000.0 / count
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--records', dest='records', type='int',
+                      default=100000, help='number of records')
+
+    options, args = parser.parse_args()
+
+    cat = log.category('benchmark')
+    conn = Connection()
+
+    def eager(idx):
+        cat.debug('Updating connection %s (%d)' % (conn, idx))
+
+    def lazy(idx):
+        cat.debug('Updating connection %s (%d)', conn, idx)
+
+    def guarded(idx):
+        if cat.debug_enabled:
+            cat.debug('Updating connection %s (%d)', conn, idx)
+
+    calls = (('eager %', eager), ('lazy args', lazy), ('guarded', guarded))
+
+    print "Logging %d debug records (usecs/record)" % options.records
+    print "  %-12s %10s %10s %10s" % ('', 'disabled', 'enabled', 'async')
+
+    null = open(os.devnull, 'w')
+    stream = log.handler.stream
+    log.handler.stream = null
+
+    try:
+        results = []
+        dropped = 0
+
+        for level, threaded in ((30, False), (10, False), (10, True)):
+            log.setLevel(level)
+            log.set_async(threaded)
+
+            results.append([measure(func, options.records) \
+                            for name, func in calls])
+
+            if log.async_handler:
+                dropped = log.async_handler.dropped
+
+            log.set_async(False)
+    finally:
+        log.handler.stream = stream
+        null.close()
+
+    for idx, (name, func) in enumerate(calls):
+        print "  %-12s %10.3f %10.3f %10.3f" % (name, results[0][idx],
+                                                results[1][idx],
+                                                results[2][idx])
+
+    if dropped:
+        print "  %d records dropped by the asynchronous handler" % dropped
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Benchmark of the matching of the replies against the outstanding requests.
+
+A discovery scan is simulated: all the probes are written on one end of a
+socket pair, a part of them is answered in random order from the other end
+and the rest expires. The replies are matched with the recv_list used by
+the SequenceConsumer before the ReplyMatcher (only up to --legacy probes in
+non strict mode, since it sorts all the requests for every reply) and with
+the ReplyMatcher, also expiring the unanswered probes through the deadlines.
+"""
+
+import time
+import random
+import socket
+import optparse
+
+from threading import Thread
+
+from umit.pm.core.atoms import defaultdict
+from umit.pm.backend.scapy.matcher import ReplyMatcher
+
+class Probe(object):
+    "A probe identified by host and sequence number like an ICMP echo"
+
+    def __init__(self, kind, host, seq):
+        self.kind = kind
+        self.host = host
+        self.seq = seq
+
+    def hashret(self):
+        return '%d:%d' % (self.host, self.seq)
+
+    def answers(self, other):
+        return self.kind == 'ans' and other.kind == 'req' and \
+               self.host == other.host and self.seq == other.seq
+
+def exchange(count, answered):
+    """
+    Send count probes and read back the answers.
+    @return the list of the replies received
+    """
+    local, remote = socket.socketpair()
+    rnd = random.Random(0)
+
+    def responder():
+        data = []
+
+        while len(data) < count:
+            data.extend(remote.recv(65536).split())
+
+        data = data[:answered]
+        rnd.shuffle(data)
+        remote.sendall(' '.join(data) + ' ')
+        remote.close()
+
+    thread = Thread(target=responder)
+    thread.start()
+
+    for idx in xrange(count):
+        local.sendall('%d ' % idx)
+
+    data = []
+
+    while True:
+        chunk = local.recv(65536)
+
+        if not chunk:
+            break
+
+        data.append(chunk)
+
+    thread.join()
+    local.close()
+
+    return [Probe('ans', int(idx) % 254, int(idx)) \
+            for idx in ''.join(data).split()]
+
+def legacy_match(probes, replies, strict):
+    recv_list = defaultdict(list)
+
+    for probe in probes:
+        recv_list[probe.hashret()].append((len(recv_list), None, probe))
+
+    matched = 0
+
+    for reply in replies:
+        if strict:
+            for (idx, sock, probe) in recv_list.get(reply.hashret(), ()):
+                if reply.answers(probe):
+                    matched += 1
+                    break
+        else:
+            lst = [(v, k) for k, v in recv_list.items()]
+            lst.sort()
+            lst[0][0][0][2]
+            matched += 1
+
+    return matched
+
+def matcher_match(probes, replies, strict, timeout=None):
+    matcher = ReplyMatcher()
+    now = time.time()
+
+    for probe in probes:
+        matcher.add(probe, timeout=timeout, now=now)
+
+    matched = 0
+
+    for reply in replies:
+        if matcher.match(reply, strict) is not None:
+            matched += 1
+
+    if timeout is not None:
+        expired = len(matcher.expire(now + timeout))
+        assert matched + expired == len(probes)
+
+    return matched
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--probes', dest='probes', type='int',
+                      default=50000, help='number of probes in flight')
+    parser.add_option('-a', '--answered', dest='answered', type='float',
+                      default=0.3, help='fraction of answered probes')
+    parser.add_option('-l', '--legacy', dest='legacy', type='int',
+                      default=2000, help='max probes for the old non strict '
+                                         'matching')
+
+    options, args = parser.parse_args()
+
+    probes = [Probe('req', idx % 254, idx) for idx in xrange(options.probes)]
+    replies = exchange(options.probes,
+                       int(options.probes * options.answered))
+
+    print "Matching %d replies to %d probes (times in secs)" % \
+          (len(replies), len(probes))
+    print "  %-10s %10s %10s" % ('', 'legacy', 'matcher')
+
+    for name, strict, timeout in (('strict', True, None),
+                                  ('non strict', False, None),
+                                  ('deadlines', True, 5)):
+        if timeout is not None:
+            legacy = '%10s' % '-'
+        elif strict or len(probes) <= options.legacy:
+            start = time.time()
+            legacy_match(probes, replies, strict)
+            legacy = '%10.2f' % (time.time() - start)
+        else:
+            legacy = '%10s' % '-'
+
+        start = time.time()
+        matcher_match(probes, replies, strict, timeout)
+
+        print "  %-10s %s %10.2f" % (name, legacy, time.time() - start)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Benchmark of the opening of capture files used by the StaticContext.
+
+A synthetic capture is written (optionally gzipped) and then opened with
+the old sequential load (only up to --legacy packets), by scanning it to
+build the index and by loading the index back from the sidecar file. The
+time of random accesses to the packets and the memory used are printed.
+"""
+
+import os
+import gzip
+import time
+import random
+import optparse
+import resource
+import tempfile
+
+from struct import pack
+
+from umit.pm.backend.scapy.packet import MetaPacket
+from umit.pm.backend.scapy.pcapindex import PcapIndex, PcapPacketList, \
+                                           SIDECAR_EXT
+from umit.pm.backend.scapy.wrapper import PcapReader
+
+def write_capture(fname, count, compress):
+    "Write a pcap of count TCP packets of random length"
+    rnd = random.Random(0)
+
+    if compress:
+        f = gzip.open(fname, 'wb')
+    else:
+        f = open(fname, 'wb')
+
+    f.write(pack('IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+
+    payload = 'x' * 1500
+    ts = 1000000000
+
+    for idx in xrange(count):
+        ip = pack('!BBHHHBBH4s4s', 0x45, 0, 40, idx & 0xffff, 0, 64, 6, 0,
+                  '\x0a\x00\x00\x01', '\xc0\xa8\x00\x01')
+        tcp = pack('!HHIIBBHHH', 1024, 80, idx, 0, 5 << 4, 0x18, 65535, 0, 0)
+        frame = '\x00\x01\x02\x03\x04\x05\x00\x01\x02\x03\x04\x06\x08\x00' + \
+                ip + tcp + payload[:rnd.randrange(0, 1400)]
+
+        f.write(pack('IIII', ts + idx / 1000, (idx % 1000) * 1000,
+                     len(frame), len(frame)))
+        f.write(frame)
+
+    f.close()
+
+def legacy_load(fname):
+    "The sequential load used before the index"
+    data = []
+    reader = PcapReader(fname)
+
+    while True:
+        mpkt = MetaPacket.new_from_pcap(reader)
+
+        if mpkt is None:
+            break
+
+        data.append(mpkt)
+
+    return data
+
+def rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--packets', dest='packets', type='int',
+                      default=1000000, help='number of packets')
+    parser.add_option('-z', '--gzip', dest='gzip', action='store_true',
+                      default=False, help='gzip the capture')
+    parser.add_option('-l', '--legacy', dest='legacy', type='int',
+                      default=200000, help='max packets for the old load')
+    parser.add_option('-r', '--random', dest='random', type='int',
+                      default=1000, help='number of random accesses')
+
+    options, args = parser.parse_args()
+
+    fd, fname = tempfile.mkstemp(prefix='pm-bench-',
+                                 suffix=options.gzip and '.pcap.gz' or '.pcap')
+    os.close(fd)
+
+    try:
+        write_capture(fname, options.packets, options.gzip)
+
+        print "Opening %d packets (%.1f MB%s)" % (
+            options.packets, os.stat(fname).st_size / (1024.0 ** 2),
+            options.gzip and ', gzipped' or '')
+        print "  %-20s %10s %10s" % ('', 'secs', 'max rss MB')
+
+        if options.packets <= options.legacy:
+            start = time.time()
+            legacy_load(fname)
+            print "  %-20s %10.2f %10.1f" % ('legacy load', time.time() - start,
+                                            rss())
+
+        start = time.time()
+        index = PcapIndex.open(fname)
+        print "  %-20s %10.2f %10.1f" % ('index scan', time.time() - start,
+                                        rss())
+
+        start = time.time()
+        index = PcapIndex.open(fname)
+        print "  %-20s %10.2f %10.1f" % ('sidecar load', time.time() - start,
+                                        rss())
+
+        data = PcapPacketList(fname, index)
+        rnd = random.Random(1)
+
+        start = time.time()
+
+        for idx in xrange(options.random):
+            data[rnd.randrange(len(data))].root
+
+        print "  %-20s %10.2f %10.1f" % ('%d random' % options.random,
+                                        time.time() - start, rss())
+
+        start = time.time()
+
+        for mpkt in data.stream():
+            pass
+
+        print "  %-20s %10.2f %10.1f" % ('sequential read',
+                                        time.time() - start, rss())
+        data.close()
+    finally:
+        for name in (fname, fname + SIDECAR_EXT):
+            if os.path.exists(name):
+                os.unlink(name)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Benchmark of the scan of the plugins done by the PluginEngine at startup.
+
+The .ump files in the given directories (the bundled plugins and audits
+and the ones in the plugins.paths preference by default) are read without
+cache, like before the ManifestCache, with an empty cache (cold startup)
+and with the cache saved by the previous pass (warm startup). The time
+spent building the dependency graph and sorting the plugins is reported
+too. The plugins could be built with audits/setup-autogen.py.
+"""
+
+import os
+import sys
+import time
+import optparse
+import tempfile
+
+from umit.pm.core.const import PLUGINS_DIR, AUDITS_DIR
+from umit.pm.gui.plugins.tree import DepGraph
+from umit.pm.gui.plugins.containers import PluginReader, ManifestCache, \
+                                          BadPlugin
+
+def find_plugins(dirs):
+    plugins = []
+
+    for path in dirs:
+        if not os.path.isdir(path):
+            continue
+
+        for file in os.listdir(path):
+            fname = os.path.join(path, file)
+
+            if file.endswith('.ump') and os.path.isfile(fname):
+                plugins.append(fname)
+
+    return plugins
+
+def scan(plugins, cache=None):
+    readers = []
+
+    for path in plugins:
+        try:
+            if cache is not None:
+                readers.append(cache.get_reader(path))
+            else:
+                readers.append(PluginReader(path))
+        except BadPlugin:
+            pass
+
+    if cache is not None:
+        cache.save()
+
+    return readers
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [dir ...]')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int',
+                      default=5, help='repetitions of every pass')
+
+    options, args = parser.parse_args()
+
+    if not args:
+        args = [PLUGINS_DIR, AUDITS_DIR]
+
+        try:
+            from umit.pm.manager.preferencemanager import Prefs
+            args += filter(None,
+                           Prefs()['plugins.paths'].value.split(os.pathsep))
+        except Exception:
+            pass
+
+    plugins = find_plugins(args)
+
+    if not plugins:
+        print "No .ump files found in %s" % ', '.join(args)
+        print "Build them with audits/setup-autogen.py and make"
+        sys.exit(1)
+
+    fd, fname = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+
+    def no_cache():
+        return scan(plugins)
+
+    def cold():
+        os.remove(fname)
+        return scan(plugins, ManifestCache(fname))
+
+    def warm():
+        return scan(plugins, ManifestCache(fname))
+
+    print "Scanning %d plugins (best of %d, times in msecs)" % \
+          (len(plugins), options.repeat)
+    print "  %-12s %10s" % ('', 'msecs')
+
+    try:
+        for name, func in (('no cache', no_cache),
+                           ('cold cache', cold),
+                           ('warm cache', warm)):
+            best = None
+
+            for idx in xrange(options.repeat):
+                start = time.time()
+                readers = func()
+                elapsed = time.time() - start
+
+                if best is None or elapsed < best:
+                    best = elapsed
+
+            print "  %-12s %10.2f" % (name, best * 1000)
+
+        start = time.time()
+        DepGraph(readers).sort(readers)
+
+        print "  %-12s %10.2f" % ('dep graph', (time.time() - start) * 1000)
+    finally:
+        os.remove(fname)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Soak test of the sessions and connections expiration.
+
+Millions of packets of short synthetic TCP flows, each one from a different
+host, are replayed through the SessionManager and a ConnectionManager in
+the same way the IP and TCP decoders and the AuditDispatcher do, and the
+number of objects tracked and the memory used are printed while the test
+goes on. With the expiration enabled they must stay bounded.
+"""
+
+import sys
+import time
+import optparse
+import resource
+
+from umit.pm.core.netconst import TH_SYN, TH_ACK, TH_FIN, TH_PSH
+from umit.pm.manager.sessionmanager import SessionManager, Session, \
+                                         ConnectionManager, ExpiryScheduler, \
+                                         IPIdent, IPStatus, TCPIdent, \
+                                         TCPStatus
+
+FLOW = (
+    # (client side, flags, payload)
+    (True, TH_SYN, ''),
+    (False, TH_SYN | TH_ACK, ''),
+    (True, TH_ACK, ''),
+    (True, TH_ACK | TH_PSH, 'x' * 64),
+    (False, TH_ACK | TH_PSH, 'x' * 512),
+    (True, TH_ACK, ''),
+    (False, TH_ACK | TH_PSH, 'x' * 512),
+    (True, TH_ACK | TH_FIN, ''),
+    (False, TH_ACK | TH_FIN, ''),
+    (True, TH_ACK, ''),
+)
+
+class SyntheticPacket(object):
+    "Minimal MetaPacket look-alike with the fields used by the managers"
+
+    l2_src, l2_dst = '00:01:02:03:04:05', '00:01:02:03:04:06'
+    l4_proto = 6
+    flags = 0
+
+    def get_rawtime(self):
+        return self.time
+
+def generate(packets, concurrent, pps):
+    """
+    Generate packets of flows going on concurrently. A single packet
+    object is modified and returned every time.
+    """
+    mpkt = SyntheticPacket()
+    flows = [None] * concurrent
+    ts = 1000000000.0
+    hosts = 0
+
+    for idx in xrange(packets):
+        slot = idx % concurrent
+        flow = flows[slot]
+
+        if flow is None or flow[1] == len(FLOW):
+            hosts += 1
+            flow = flows[slot] = [('10.%d.%d.%d' % (hosts >> 16 & 0xff,
+                                                    hosts >> 8 & 0xff,
+                                                    hosts & 0xff),
+                                   1024 + hosts % 60000), 0]
+
+        (src, sport), step = flow
+        client, flags, data = FLOW[step]
+        flow[1] += 1
+
+        if client:
+            mpkt.l3_src, mpkt.l3_dst = src, '192.168.0.1'
+            mpkt.l4_src, mpkt.l4_dst = sport, 80
+        else:
+            mpkt.l3_src, mpkt.l3_dst = '192.168.0.1', src
+            mpkt.l4_src, mpkt.l4_dst = 80, sport
+
+        ts += 1.0 / pps
+        mpkt.time = ts
+        mpkt.l4_flags, mpkt.data = flags, data
+
+        yield mpkt
+
+def track(sessions, ident, factory):
+    "What the IP and TCP decoders do for every packet"
+    sess = sessions.get_session(ident)
+
+    if not sess:
+        sess = Session(ident)
+        sess.data = factory()
+        sessions.put_session(sess)
+
+    return sess
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--packets', dest='packets', type='int',
+                      default=2000000, help='number of packets to replay')
+    parser.add_option('-c', '--concurrent', dest='concurrent', type='int',
+                      default=1000, help='flows going on at the same time')
+    parser.add_option('-p', '--pps', dest='pps', type='int', default=5000,
+                      help='packets per second of capture time')
+    parser.add_option('-t', '--timeout', dest='timeout', type='int',
+                      default=300, help='idle timeout of sessions and '
+                      'connections in seconds')
+    parser.add_option('-m', '--max', dest='max', type='int', default=65536,
+                      help='max number of sessions and connections')
+    parser.add_option('-d', '--disable', dest='disable', action='store_true',
+                      default=False, help='disable the expiration')
+
+    options, args = parser.parse_args()
+
+    if options.disable:
+        options.timeout = options.max = 0
+
+    sessions = SessionManager()
+    sessions.configure(options.timeout, options.max)
+
+    # A connection without timeout is never deleted by expire()
+    connections = ConnectionManager(5, options.timeout or sys.maxint,
+                                    options.max)
+
+    expiry = ExpiryScheduler((sessions, connections))
+
+    print "Replaying %d packets (%d concurrent flows, %d pps, timeout %d, " \
+          "max %d)" % (options.packets, options.concurrent, options.pps,
+                       options.timeout, options.max)
+    print "  %10s %10s %10s %10s %10s %10s" % ('packets', 'sessions',
+                                              'conns', 'expired', 'evicted',
+                                              'rss (MB)')
+
+    report = max(1, options.packets / 10)
+    start = time.time()
+
+    for idx, mpkt in enumerate(generate(options.packets, options.concurrent,
+                                        options.pps)):
+        expiry.tick(mpkt.time)
+
+        track(sessions, IPIdent.create(mpkt), IPStatus)
+        track(sessions, TCPIdent.create(mpkt), TCPStatus)
+        connections.parse(mpkt)
+
+        if (idx + 1) % report == 0:
+            stats = sessions.get_stats()
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+            print "  %10d %10d %10d %10d %10d %10.1f" % (
+                idx + 1, stats['sessions'], len(connections.conn_list),
+                stats['expired'] + connections.stats['expired'],
+                stats['evicted'] + connections.stats['evicted'],
+                rss / 1024.0)
+
+    elapsed = time.time() - start
+
+    print "  %-20s %10.0f" % ('packets/sec', options.packets / elapsed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+"""
+Latency of the packet list of the sniff perspective against the number of
+packets. It needs a display so run it headless with:
+
+  xvfb-run python benchmarks/sniffview.py
+
+A SniffPage showing a static context of lazy MetaPackets is created and for
+every size the time needed to load the whole list and paint it is compared
+with the old gtk.ListStore filling (only up to --legacy packets). Then the
+time to paint the view after jumping to random positions of the list and
+the time to show 1% more packets are measured.
+"""
+
+import time
+import random
+import optparse
+
+from struct import pack
+
+import gtk
+
+from umit.pm import backend
+from umit.pm.backend.scapy.packet import MetaPacket
+from umit.pm.backend.scapy.wrapper import Ether
+from umit.pm.gui.pages.sniffpage import SniffPage
+
+class BenchSession(object):
+    "The bits of a SniffSession used by the SniffPage"
+
+    def __init__(self, context):
+        self.context = context
+
+    def set_active_packet(self, packet):
+        pass
+
+def generate(count, flows=500):
+    "@return a list of lazy MetaPackets of TCP flows interleaved"
+    packets = []
+    ts = 1000000000.0
+
+    for idx in xrange(count):
+        flow = idx % flows
+        src = pack('!BBBB', 10, 0, flow >> 8 & 0xff, flow & 0xff)
+        tcp = pack('!HHIIBBHHH', 1024 + flow, 80, idx, 0, 5 << 4, 0x18,
+                   65535, 0, 0)
+        ip = pack('!BBHHHBBH4s4s', 0x45, 0, 40, idx & 0xffff, 0, 64, 6, 0,
+                  src, '\xc0\xa8\x00\x01')
+        frame = '\x00\x01\x02\x03\x04\x05\x00\x01\x02\x03\x04\x06\x08\x00' + \
+                ip + tcp
+
+        ts += 0.0001
+        packets.append(MetaPacket.new_lazy(frame, Ether, ts))
+
+    return packets
+
+def flush(widget):
+    "Paint the widget and process all the pending events"
+    widget.window.process_updates(True)
+
+    while gtk.events_pending():
+        gtk.main_iteration(False)
+
+def legacy_reload(page, packets):
+    "What SniffPage.reload() did before the PacketListModel"
+    store = gtk.ListStore(object)
+    page.tree.set_model(store)
+
+    for packet in packets:
+        store.append([packet])
+
+        while gtk.events_pending():
+            gtk.main_iteration_do()
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--sizes', dest='sizes',
+                      default='100,1000,10000,100000',
+                      help='comma separated list of packet counts')
+    parser.add_option('-j', '--jumps', dest='jumps', type='int', default=50,
+                      help='number of random scrolls for every size')
+    parser.add_option('-l', '--legacy', dest='legacy', type='int',
+                      default=10000, help='max packets for the old filling')
+
+    options, args = parser.parse_args()
+
+    rnd = random.Random(0)
+
+    print "Packet list latency (times in msecs)"
+    print "  %10s %10s %10s %10s %10s" % ('packets', 'legacy', 'reload',
+                                          'scroll', 'append 1%')
+
+    for size in map(int, options.sizes.split(',')):
+        packets = generate(size + size / 100)
+
+        context = backend.StaticContext('bench')
+        context.data = packets[:size]
+
+        page = SniffPage(BenchSession(context))
+
+        window = gtk.Window()
+        window.set_default_size(800, 600)
+        window.add(page)
+        window.show_all()
+        flush(window)
+
+        if size <= options.legacy:
+            start = time.time()
+            legacy_reload(page, context.data)
+            flush(window)
+            legacy_time = '%10.1f' % ((time.time() - start) * 1000)
+        else:
+            legacy_time = '%10s' % '-'
+
+        page.clear()
+        flush(window)
+
+        start = time.time()
+        page.reload()
+        flush(window)
+        reload_time = time.time() - start
+
+        assert len(page.tree.get_model()) == size
+
+        vadj = page.tree.get_vadjustment()
+        start = time.time()
+
+        for idx in xrange(options.jumps):
+            vadj.set_value(rnd.uniform(vadj.lower,
+                                       max(vadj.lower,
+                                           vadj.upper - vadj.page_size)))
+            flush(window)
+
+        scroll_time = (time.time() - start) / options.jumps
+
+        context.data.extend(packets[size:])
+
+        start = time.time()
+        page.reload()
+        flush(window)
+        append_time = time.time() - start
+
+        assert len(page.tree.get_model()) == len(packets)
+
+        print "  %10d %s %10.1f %10.1f %10.1f" % (size, legacy_time,
+                                                  reload_time * 1000,
+                                                  scroll_time * 1000,
+                                                  append_time * 1000)
+
+        window.destroy()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Benchmark of the socket pool used to send packets.
+
+A sequence of small UDP packets is sent on an interface (the loopback by
+default, or one end of a veth pair) opening a socket for every packet like
+the SequenceConsumer did before the pool, through a pooled socket and
+finally executing a flat sequence (shorter by default, since walking the
+siblings of a sequence is quadratic). It needs root privileges.
+"""
+
+import time
+import optparse
+
+from threading import Event
+
+from umit.pm.core.atoms import Node
+from umit.pm.backend import SequencePacket
+from umit.pm.backend.scapy.packet import MetaPacket
+from umit.pm.backend.scapy.wrapper import Ether, IP, UDP
+from umit.pm.backend.scapy.utils import get_socket_for, acquire_socket_for, \
+                                        execute_sequence, socket_pool
+
+def create_packets(count, layer):
+    pkts = []
+
+    for idx in xrange(count):
+        pkt = IP(dst='127.0.0.1') / UDP(sport=1024, dport=9 + idx % 2) / \
+              ('x' * 18)
+
+        if layer == 2:
+            pkt = Ether() / pkt
+
+        pkts.append(MetaPacket(pkt))
+
+    return pkts
+
+def legacy_send(pkts, iface):
+    "A new socket for every packet"
+    for mpkt in pkts:
+        sock = get_socket_for(mpkt, iff=iface)
+        sock.send(mpkt.root)
+        sock.close()
+
+def pooled_send(pkts, iface):
+    "A single socket of the pool"
+    sock = acquire_socket_for(pkts[0], iff=iface)
+
+    for mpkt in pkts:
+        sock.send(mpkt.root)
+
+    sock.close()
+
+def sequence_send(pkts, iface):
+    "The SequenceConsumer sending the packets as a flat sequence"
+    tree = Node()
+
+    for mpkt in pkts:
+        tree.append_node(Node(SequencePacket(mpkt)))
+
+    done = Event()
+
+    def scallback(packet, parent, udata):
+        return False
+
+    def rcallback(packet, reply, is_reply, udata):
+        # Called with no reply once the last packet is sent
+        if reply is None:
+            done.set()
+
+        return False
+
+    def excback(exc):
+        print "Error: %s" % exc
+        done.set()
+
+    consumer = execute_sequence(tree, 1, 0, iface, False, 0, scallback,
+                                rcallback, None, None, excback)
+    done.wait()
+    consumer.stop()
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--packets', dest='packets', type='int',
+                      default=10000, help='number of packets')
+    parser.add_option('-i', '--iface', dest='iface', default='lo',
+                      help='interface to send on (lo or a veth end)')
+    parser.add_option('-l', '--layer', dest='layer', type='int', default=3,
+                      help='send at layer 2 or 3')
+    parser.add_option('-s', '--sequence', dest='sequence', type='int',
+                      default=1000, help='packets in the sequence')
+
+    options, args = parser.parse_args()
+
+    pkts = create_packets(options.packets, options.layer)
+
+    print "Sending %d packets at layer %d on %s" % (options.packets,
+                                                   options.layer,
+                                                   options.iface)
+    print "  %-20s %10s %10s" % ('', 'secs', 'pps')
+
+    for name, func, count in (
+        ('socket per packet', legacy_send, options.packets),
+        ('pooled socket', pooled_send, options.packets),
+        ('sequence of %d' % options.sequence, sequence_send,
+         min(options.sequence, options.packets))):
+
+        start = time.time()
+        func(pkts[:count], options.iface)
+        elapsed = time.time() - start
+
+        print "  %-20s %10.2f %10d" % (name, elapsed, count / elapsed)
+
+    assert not len(socket_pool), 'Pooled sockets not released'
+
+if __name__ == "__main__":
+    main()
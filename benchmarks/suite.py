@@ -0,0 +1,692 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Reproducible benchmark suite replaying captures through the main paths.
+
+The captures of audits/pcap-tests and synthetic ones generated with a
+fixed seed (many TCP flows, IP fragments, large HTTP bodies and a high
+packet rate) are replayed through these stages:
+
+  load          StaticContext.load() without the sidecar index
+  dispatch      AuditDispatcher.feed() with the passive audits loaded
+  accessors     the MetaPacket accessors used by the packet list
+  connections   analyze_connections() on the whole capture
+  sequence      SequenceLoader parsing a sequence of the first packets
+
+Every stage runs in a new interpreter, so the peak RSS is the one of the
+stage, and the best of --repeat runs is kept. For the per packet stages
+the latency percentiles (usecs) are reported too.
+
+The results could be saved as JSON with --output and compared with a
+previous run with --baseline: the exit status is 1 if the throughput, the
+p99 latency or the peak RSS of a stage got worse than --threshold. Only
+capture files are read, so no capture privileges are needed.
+
+Every stage works with the default plugins on a small synthetic capture:
+
+>>> dest = tempfile.mkdtemp(prefix='pm-bench-')
+>>> fname = generate(dest, 0.01, 0)[0]
+>>> options = get_parser().parse_args(['-r', '1'])[0]
+>>> [measure(stage, fname, options)['packets'] > 0 for stage in STAGES]
+[True, True, True, True, True]
+>>> shutil.rmtree(dest)
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import optparse
+import tempfile
+
+from struct import pack
+from subprocess import Popen, PIPE
+
+from umit.pm.core.auditutils import checksum, checksum_add, checksum_pseudo
+
+AUDITS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                          'audits')
+PCAP_DIR = os.path.join(AUDITS_DIR, 'pcap-tests')
+
+STAGES = ('load', 'dispatch', 'accessors', 'connections', 'sequence')
+
+ETH_HDR = '\x00\x01\x02\x03\x04\x05\x00\x01\x02\x03\x04\x06\x08\x00'
+
+TH_FIN, TH_SYN, TH_PUSH, TH_ACK = 0x01, 0x02, 0x08, 0x10
+
+###############################################################################
+# Synthetic captures
+###############################################################################
+
+class CaptureWriter(object):
+    "Minimal pcap writer for ethernet frames"
+
+    def __init__(self, fname):
+        self.f = open(fname, 'wb')
+        self.f.write(pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        self.ts = 1000000000.0
+
+    def write(self, frame, gap=0.0001):
+        self.ts += gap
+
+        sec = int(self.ts)
+        usec = int((self.ts - sec) * 1000000)
+
+        self.f.write(pack('<IIII', sec, usec, len(frame), len(frame)))
+        self.f.write(frame)
+
+    def close(self):
+        self.f.close()
+
+def ip_frame(src, dst, proto, payload, ipid=0, frag=0):
+    "@return an ethernet frame carrying the IP datagram"
+    hdr = pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), ipid, frag, 64,
+               proto, 0, src, dst)
+
+    return ETH_HDR + hdr[:10] + pack('!H', checksum(hdr)) + hdr[12:] + \
+           payload
+
+def transport(src, dst, proto, hdr, data, offset):
+    "@return hdr + data with the checksum at offset filled"
+    segment = hdr + data
+    csum = ~checksum_add(segment, 0, None,
+                         checksum_pseudo(src, dst, proto, len(segment)))
+    csum &= 0xffff
+
+    if proto == 17 and not csum:
+        csum = 0xffff
+
+    return segment[:offset] + pack('!H', csum) + segment[offset + 2:]
+
+def tcp_frame(src, dst, sport, dport, seq, ack, flags, data=''):
+    hdr = pack('!HHIIBBHHH', sport, dport, seq, ack, 5 << 4, flags, 65535,
+               0, 0)
+    return ip_frame(src, dst, 6, transport(src, dst, 6, hdr, data, 16))
+
+def udp_payload(src, dst, sport, dport, data):
+    hdr = pack('!HHHH', sport, dport, 8 + len(data), 0)
+    return transport(src, dst, 17, hdr, data, 6)
+
+def host(idx):
+    return pack('!BBBB', 10, idx >> 16 & 0xff, idx >> 8 & 0xff, idx & 0xff)
+
+SERVER = '\xc0\xa8\x00\x01'
+
+def tcp_flow(client, sport, dport, request, response, mss=1460):
+    "@return the frames of a whole TCP connection"
+    cseq, sseq = 1000, 5000
+    frames = [tcp_frame(client, SERVER, sport, dport, cseq, 0, TH_SYN),
+              tcp_frame(SERVER, client, dport, sport, sseq, cseq + 1,
+                        TH_SYN | TH_ACK),
+              tcp_frame(client, SERVER, sport, dport, cseq + 1, sseq + 1,
+                        TH_ACK)]
+    cseq, sseq = cseq + 1, sseq + 1
+
+    frames.append(tcp_frame(client, SERVER, sport, dport, cseq, sseq,
+                            TH_PUSH | TH_ACK, request))
+    cseq += len(request)
+
+    for off in xrange(0, len(response), mss):
+        data = response[off:off + mss]
+        frames.append(tcp_frame(SERVER, client, dport, sport, sseq, cseq,
+                                TH_ACK, data))
+        sseq += len(data)
+
+    frames.append(tcp_frame(client, SERVER, sport, dport, cseq, sseq,
+                            TH_FIN | TH_ACK))
+    frames.append(tcp_frame(SERVER, client, dport, sport, sseq, cseq + 1,
+                            TH_FIN | TH_ACK))
+    frames.append(tcp_frame(client, SERVER, sport, dport, cseq + 1, sseq + 1,
+                            TH_ACK))
+
+    return frames
+
+def interleave(writer, flows, rnd, gap=0.0001):
+    "Write the frames of the flows (lists of frames) randomly interleaved"
+    flows = [flow[::-1] for flow in flows]
+
+    while flows:
+        idx = rnd.randrange(len(flows))
+        writer.write(flows[idx].pop(), gap)
+
+        if not flows[idx]:
+            flows[idx] = flows[-1]
+            flows.pop()
+
+def gen_flows(writer, scale, rnd):
+    "Many short TCP connections with up to 200 of them open at once"
+    count = int(2000 * scale)
+
+    for base in xrange(0, count, 200):
+        flows = []
+
+        for idx in xrange(base, min(base + 200, count)):
+            request = 'REQ %08d\r\n' % idx
+            flows.append(tcp_flow(host(idx), 1024 + idx % 60000, 5000,
+                                  request, request * 20))
+
+        interleave(writer, flows, rnd)
+
+def gen_fragments(writer, scale, rnd):
+    "UDP datagrams of 4000 bytes fragmented on a 1500 bytes MTU"
+    count = int(1000 * scale)
+
+    for base in xrange(0, count, 50):
+        flows = []
+
+        for idx in xrange(base, min(base + 50, count)):
+            src = host(idx)
+            payload = udp_payload(src, SERVER, 1024 + idx, 7000,
+                                  pack('!I', idx) * 998)
+            flows.append([ip_frame(src, SERVER, 17, payload[off:off + 1480],
+                                   idx % 16, off / 8 |
+                                   (off + 1480 < len(payload) and 0x2000))
+                          for off in xrange(0, len(payload), 1480)])
+
+        interleave(writer, flows, rnd)
+
+def gen_http(writer, scale, rnd):
+    "HTTP transfers of 1 MB bodies"
+    count = max(1, int(10 * scale))
+    flows = []
+
+    for idx in xrange(count):
+        body = ''.join([chr(rnd.randrange(256)) for i in xrange(4096)]) * 256
+        request = 'GET /file%d HTTP/1.1\r\nHost: 192.168.0.1\r\n\r\n' % idx
+        response = 'HTTP/1.1 200 OK\r\nContent-Type: application/' \
+                   'octet-stream\r\nContent-Length: %d\r\n\r\n%s' % \
+                   (len(body), body)
+        flows.append(tcp_flow(host(idx), 1024 + idx, 80, request, response))
+
+    interleave(writer, flows, rnd, 0.00002)
+
+def gen_rate(writer, scale, rnd):
+    "Small UDP packets at 100k packets per second"
+    count = int(100000 * scale)
+
+    for idx in xrange(count):
+        src = host(rnd.randrange(1000))
+        writer.write(ip_frame(src, SERVER, 17,
+                              udp_payload(src, SERVER, 1024 + idx % 60000,
+                                          9999, pack('!I', idx) * 8),
+                              idx & 0xffff), 0.00001)
+
+GENERATORS = (('synthetic-flows.pcap', gen_flows),
+              ('synthetic-fragments.pcap', gen_fragments),
+              ('synthetic-http.pcap', gen_http),
+              ('synthetic-rate.pcap', gen_rate))
+
+def generate(dest, scale, seed):
+    "@return the list of the synthetic captures written in dest"
+    files = []
+
+    for name, func in GENERATORS:
+        fname = os.path.join(dest, name)
+        writer = CaptureWriter(fname)
+
+        try:
+            func(writer, scale, random.Random(seed))
+        finally:
+            writer.close()
+
+        files.append(fname)
+
+    return files
+
+###############################################################################
+# Stages (run in the child process)
+###############################################################################
+
+def read_packets(fname):
+    "@return a tuple (linktype, list of lazy MetaPackets)"
+    import umit.pm.backend
+
+    index = umit.pm.backend.PcapIndex.open(fname, sidecar=False)
+    data = umit.pm.backend.PcapPacketList(fname, index)
+
+    try:
+        return data.get_linktype(), list(data.stream())
+    finally:
+        data.close()
+
+# The plugin modules are removed from sys.modules after the load, so a
+# reference is kept here to not let their globals be cleared
+loaded_modules = []
+
+def load_audits(names):
+    "Load and start the passive audits like audittester.py"
+    from umit.pm.gui.plugins.tree import Package
+    from umit.pm.gui.plugins.engine import PluginEngine
+    from umit.pm.manager.auditmanager import AuditManager, AuditPlugin
+
+    instances = []
+
+    for name in names:
+        path = os.path.abspath(os.path.join(AUDITS_DIR, 'passive', name,
+                                            'sources'))
+        sys.path.insert(0, path)
+
+        try:
+            mod = __import__('main')
+            loaded_modules.append(mod)
+
+            pkg = None
+
+            for pname, needs, provides, conflicts in \
+                getattr(mod, '__plugins_deps__', []):
+
+                pkg = Package(pname, needs, provides, conflicts)
+                PluginEngine().tree.add_plugin_to_cache(pkg)
+
+            for conf_name, conf_dict in getattr(mod, '__configurations__', []):
+                AuditManager().register_configuration(conf_name, conf_dict)
+
+            ret = [kplug() for kplug in getattr(mod, '__plugins__', [])]
+            instances.extend(ret)
+
+            if pkg:
+                PluginEngine().tree.modules[pkg] = mod
+                PluginEngine().tree.instances[pkg] = ret
+        finally:
+            sys.path.remove(path)
+            del sys.modules['main']
+
+    for plug_inst in instances:
+        plug_inst.start(None)
+
+        if isinstance(plug_inst, AuditPlugin):
+            plug_inst.register_decoders()
+            plug_inst.register_hooks()
+
+    AuditManager().redirect_messages(lambda msg, severity, facility: None)
+
+def stage_load(fname, hist, options):
+    import umit.pm.backend
+    from umit.pm.backend.scapy.pcapindex import SIDECAR_EXT
+
+    if os.path.exists(fname + SIDECAR_EXT):
+        os.remove(fname + SIDECAR_EXT)
+
+    ctx = umit.pm.backend.StaticContext('benchmark', fname)
+
+    start = time.time()
+
+    if not ctx.load():
+        raise Exception('Unable to load %s: %s' % (fname, ctx.summary))
+
+    elapsed = time.time() - start
+
+    return elapsed, len(ctx.data), sum(ctx.data.index.lengths)
+
+def stage_dispatch(fname, hist, options):
+    from umit.pm.core.netconst import IL_TYPE_ETH
+    from umit.pm.manager.auditmanager import AuditDispatcher
+
+    load_audits(filter(None, options.plugins.split(',')))
+
+    linktype, packets = read_packets(fname)
+    feed = AuditDispatcher(linktype or IL_TYPE_ETH).feed
+    clock, record = time.time, hist.record
+
+    start = clock()
+
+    for mpkt in packets:
+        pstart = clock()
+        feed(mpkt)
+        record((clock() - pstart) * 1000000)
+
+    return clock() - start, len(packets), \
+           sum([mpkt.get_size() for mpkt in packets])
+
+def stage_accessors(fname, hist, options):
+    linktype, packets = read_packets(fname)
+    clock, record = time.time, hist.record
+
+    start = clock()
+
+    for mpkt in packets:
+        pstart = clock()
+
+        mpkt.get_protocols()
+        mpkt.summary()
+        mpkt.get_time()
+        mpkt.get_source()
+        mpkt.get_dest()
+        mpkt.get_protocol_str()
+
+        record((clock() - pstart) * 1000000)
+
+    return clock() - start, len(packets), \
+           sum([mpkt.get_size() for mpkt in packets])
+
+def stage_connections(fname, hist, options):
+    from umit.pm.backend.scapy.utils import analyze_connections
+
+    linktype, packets = read_packets(fname)
+
+    start = time.time()
+    analyze_connections(packets)
+    elapsed = time.time() - start
+
+    return elapsed, len(packets), sum([mpkt.get_size() for mpkt in packets])
+
+def stage_sequence(fname, hist, options):
+    from umit.pm.core.atoms import Node
+    from umit.pm.backend import SequencePacket
+    from umit.pm.backend.scapy.serialize import SequenceLoader, save_sequence
+
+    linktype, packets = read_packets(fname)
+    packets = packets[:options.sequence]
+
+    tree = Node()
+
+    for mpkt in packets:
+        tree.append_node(Node(SequencePacket(mpkt)))
+
+    fd, xml = tempfile.mkstemp(suffix='.pms')
+    os.close(fd)
+
+    try:
+        for idx in save_sequence(xml, tree):
+            pass
+
+        start = time.time()
+        SequenceLoader(xml).parse()
+        elapsed = time.time() - start
+    finally:
+        os.remove(xml)
+
+    return elapsed, len(packets), sum([mpkt.get_size() for mpkt in packets])
+
+def get_peak_rss():
+    "@return the peak resident set size of the process in KB or None"
+    try:
+        f = open('/proc/self/status')
+
+        try:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+        finally:
+            f.close()
+    except IOError:
+        pass
+
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        return None
+
+def child(stage, fname, options):
+    from umit.pm.core.metrics import Histogram
+
+    hist = Histogram(stage)
+    elapsed, packets, size = globals()['stage_' + stage](fname, hist, options)
+
+    latency = None
+
+    if hist.count:
+        latency = hist.snapshot()
+        del latency['type']
+
+    print json.dumps({'secs' : elapsed, 'packets' : packets, 'bytes' : size,
+                      'latency' : latency, 'rss' : get_peak_rss()})
+
+###############################################################################
+# Runs and baseline
+###############################################################################
+
+def run(stage, fname, options):
+    "Run the stage on fname in a new interpreter and return the result"
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.abspath(os.path.join(
+        AUDITS_DIR, '..'))] + filter(None, [env.get('PYTHONPATH')]))
+
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', stage,
+           '-f', options.plugins, '-n', str(options.sequence), fname]
+
+    process = Popen(cmd, stdout=PIPE, env=env)
+    out = process.communicate()[0]
+
+    if process.returncode:
+        raise Exception('Stage %s on %s failed (%d)' % (stage, fname,
+                                                        process.returncode))
+
+    return json.loads(out.strip().splitlines()[-1])
+
+def measure(stage, fname, options):
+    "@return the best of options.repeat runs with the highest peak RSS"
+    best = None
+    rss = None
+
+    for idx in xrange(options.repeat):
+        result = run(stage, fname, options)
+
+        if best is None or result['secs'] < best['secs']:
+            best = result
+
+        if result['rss'] is not None:
+            rss = max(rss, result['rss'])
+
+    secs = best['secs'] or 1e-9
+
+    best.update({'capture' : os.path.basename(fname), 'stage' : stage,
+                 'rss' : rss, 'pps' : best['packets'] / secs,
+                 'mbps' : best['bytes'] / secs / (1024.0 ** 2)})
+    return best
+
+def compare(baseline, results, threshold):
+    """
+    @return a list of (result, base, list of the worse metrics) tuples for
+            the results having the same packets in baseline
+    """
+    index = dict([((base['capture'], base['stage']), base) \
+                  for base in baseline['results']])
+    ret = []
+
+    for result in results:
+        base = index.get((result['capture'], result['stage']), None)
+
+        if base is None or base['packets'] != result['packets']:
+            continue
+
+        worse = []
+
+        if result['pps'] < base['pps'] * (1 - threshold):
+            worse.append('pps')
+
+        if result['latency'] and base['latency'] and \
+           result['latency']['p99'] > \
+           max(base['latency']['p99'], 1) * (1 + threshold):
+            worse.append('p99')
+
+        if result['rss'] and base['rss'] and \
+           result['rss'] > base['rss'] * (1 + threshold):
+            worse.append('rss')
+
+        ret.append((result, base, worse))
+
+    return ret
+
+def format_latency(result, key):
+    if not result['latency']:
+        return '-'
+
+    return str(result['latency'][key])
+
+def get_parser():
+    parser = optparse.OptionParser(usage='%prog [options] [capture ...]')
+    parser.add_option('-s', '--stages', dest='stages', default=','.join(STAGES),
+                      help='comma separated list of stages')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int',
+                      default=3, help='runs of every stage')
+    parser.add_option('-S', '--scale', dest='scale', type='float',
+                      default=1.0, help='size factor of the synthetic '
+                                        'captures')
+    parser.add_option('-G', '--no-synthetic', dest='synthetic',
+                      action='store_false', default=True,
+                      help='do not generate the synthetic captures')
+    parser.add_option('-C', '--no-corpus', dest='corpus',
+                      action='store_false', default=True,
+                      help='do not replay audits/pcap-tests')
+    parser.add_option('-f', '--plugins', dest='plugins',
+                      default='ethernet,ip,tcp,udp,icmp,http,ftp,mysql,smb,'
+                              'vnc',
+                      help='comma separated list of passive plugins')
+    parser.add_option('-n', '--sequence', dest='sequence', type='int',
+                      default=1000, help='packets of the sequence stage')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='save the results as JSON in the file')
+    parser.add_option('-b', '--baseline', dest='baseline', default=None,
+                      help='JSON results of a previous run to compare with')
+    parser.add_option('-t', '--threshold', dest='threshold', type='float',
+                      default=0.1, help='relative change considered a '
+                                        'regression')
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+                      help='seed of the synthetic captures')
+    parser.add_option('--child', dest='child', default=None,
+                      help=optparse.SUPPRESS_HELP)
+
+    return parser
+
+def main():
+    parser = get_parser()
+    options, args = parser.parse_args()
+
+    if options.child:
+        child(options.child, args[0], options)
+        return
+
+    stages = filter(None, options.stages.split(','))
+
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error('Unknown stage %s' % stage)
+
+    baseline = None
+
+    if options.baseline:
+        f = open(options.baseline)
+
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+
+    # The captures are linked in a temporary directory so the sidecar
+    # indexes are not written next to the originals
+    dest = tempfile.mkdtemp(prefix='pm-bench-')
+
+    try:
+        sources = list(args)
+
+        if options.corpus and not args:
+            sources += [os.path.join(PCAP_DIR, name) \
+                        for name in sorted(os.listdir(PCAP_DIR)) \
+                        if name.endswith('.pcap')]
+
+        captures = []
+
+        for fname in sources:
+            link = os.path.join(dest, os.path.basename(fname))
+
+            if hasattr(os, 'symlink'):
+                os.symlink(os.path.abspath(fname), link)
+            else:
+                shutil.copy(fname, link)
+
+            captures.append(link)
+
+        if options.synthetic:
+            captures += generate(dest, options.scale, options.seed)
+
+        print "Replaying %d captures (best of %d, latencies in usecs)" % \
+              (len(captures), options.repeat)
+        print "  %-28s %-12s %8s %10s %8s %6s %6s %7s %9s" % \
+              ('capture', 'stage', 'packets', 'pkts/s', 'MB/s', 'p50', 'p90',
+               'p99', 'RSS KB')
+
+        results = []
+
+        for fname in captures:
+            for stage in stages:
+                result = measure(stage, fname, options)
+                results.append(result)
+
+                print "  %-28s %-12s %8d %10.0f %8.2f %6s %6s %7s %9s" % \
+                      (result['capture'][:28], stage, result['packets'],
+                       result['pps'], result['mbps'],
+                       format_latency(result, 'p50'),
+                       format_latency(result, 'p90'),
+                       format_latency(result, 'p99'), result['rss'])
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(dest)
+
+    if options.output:
+        f = open(options.output, 'w')
+
+        try:
+            json.dump({'date' : time.time(),
+                       'python' : sys.version.split()[0],
+                       'platform' : sys.platform,
+                       'scale' : options.scale, 'seed' : options.seed,
+                       'plugins' : options.plugins,
+                       'results' : results}, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+    if baseline is None:
+        return
+
+    regressions = 0
+
+    print
+    print "Compared with %s (threshold %d%%)" % (options.baseline,
+                                                 options.threshold * 100)
+    print "  %-28s %-12s %8s %8s %8s  %s" % ('capture', 'stage', 'pkts/s',
+                                            'p99', 'RSS', 'worse')
+
+    def change(new, old):
+        if not new or not old:
+            return '-'
+
+        return '%+.1f%%' % ((new - old) * 100.0 / old)
+
+    for result, base, worse in compare(baseline, results, options.threshold):
+        regressions += len(worse)
+
+        print "  %-28s %-12s %8s %8s %8s  %s" % \
+              (result['capture'][:28], result['stage'],
+               change(result['pps'], base['pps']),
+               change(result['latency'] and result['latency']['p99'],
+                      base['latency'] and base['latency']['p99']),
+               change(result['rss'], base['rss']), ','.join(worse))
+
+    if regressions:
+        print "%d regressions found" % regressions
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
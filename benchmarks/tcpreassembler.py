@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Throughput and memory benchmark of the TCP reassembler of the tcp decoder
+over a synthetic capture with many concurrent flows.
+
+All the flows are opened first, then they exchange a request and a response
+and finally they are closed, so the stream table holds every flow at the
+same time. With -o the synthetic capture is also saved as pcap file so it
+could be used with audittester.py.
+
+With -t a single flow transferring the given number of megabytes is used
+instead, to check that the throughput doesn't depend on the transfer size.
+"""
+
+import os
+import imp
+import time
+import optparse
+import resource
+
+from struct import pack
+from socket import inet_aton
+
+from umit.pm.core.auditutils import checksum
+from umit.pm.core.netconst import TH_SYN, TH_ACK, TH_FIN, TH_PSH, \
+                                  REAS_COLLECT_STATS, REAS_COLLECT_DATA
+
+TCP_SOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                           'audits', 'passive', 'tcp', 'sources', 'main.py')
+
+REQUEST = 'GET / HTTP/1.0\r\n\r\n'
+RESPONSE = 'HTTP/1.0 200 OK\r\nContent-Length: 0\r\n\r\n'
+
+class SyntheticPacket(object):
+    "Minimal MetaPacket look-alike with the fields set by the decoders"
+
+    def __init__(self, ts, src, dst, sport, dport, seq, ack, flags, data):
+        self.time = ts
+        self.l3_src, self.l3_dst = src, dst
+        self.l4_src, self.l4_dst = sport, dport
+        self.l4_seq, self.l4_ack, self.l4_flags = seq, ack, flags
+        self.l3_len, self.l4_len = 20, 20
+        self.data, self.data_len = data, len(data)
+        self.payload_len = self.l4_len + self.data_len
+
+    def get_rawtime(self):
+        return self.time
+
+    def get_field(self, name, default=None):
+        if name == 'tcp':
+            return self.to_tcp() + self.data
+        elif name == 'tcp.window':
+            return 65535
+        elif name == 'tcp.dataofs':
+            return 5
+
+        return default
+
+    def to_tcp(self, csum=0):
+        return pack('!HHIIBBHHH', self.l4_src, self.l4_dst, self.l4_seq,
+                    self.l4_ack, 5 << 4, self.l4_flags, 65535, csum, 0)
+
+    def to_frame(self):
+        "@return the ethernet frame of the packet with valid checksums"
+        src, dst = inet_aton(self.l3_src), inet_aton(self.l3_dst)
+        seg = self.to_tcp() + self.data
+        seg = self.to_tcp(checksum(pack('!4s4sHH', src, dst, 6, len(seg)) + \
+                                   seg)) + self.data
+
+        ip = pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(seg), 0, 0, 64, 6, 0,
+                  src, dst)
+        ip = ip[:10] + pack('!H', checksum(ip)) + ip[12:]
+
+        return '\x00\x01\x02\x03\x04\x05\x00\x01\x02\x03\x04\x06\x08\x00' + \
+               ip + seg
+
+def generate(flows):
+    "@return a list of SyntheticPacket for the given number of flows"
+    ts = 1000000000.0
+    step = 60.0 / (flows * 10)
+
+    def endpoints(idx):
+        return ('10.%d.%d.%d' % (idx >> 16 & 0xff, idx >> 8 & 0xff,
+                                  idx & 0xff),
+                '192.168.0.1', 1024 + idx % 60000, 80)
+
+    phases = (
+        # (client side, seq delta, ack delta, flags, payload)
+        (True, 0, 0, TH_SYN, ''),
+        (False, 0, 1, TH_SYN | TH_ACK, ''),
+        (True, 1, 1, TH_ACK, ''),
+        (True, 1, 1, TH_ACK | TH_PSH, REQUEST),
+        (False, 1, 1 + len(REQUEST), TH_ACK | TH_PSH, RESPONSE),
+        (True, 1 + len(REQUEST), 1 + len(RESPONSE), TH_ACK | TH_FIN, ''),
+        (False, 1 + len(RESPONSE), 2 + len(REQUEST), TH_ACK | TH_FIN, ''),
+        (True, 2 + len(REQUEST), 2 + len(RESPONSE), TH_ACK, ''),
+    )
+
+    packets = []
+    cseq, sseq = 1000, 5000
+
+    for client, seqd, ackd, flags, data in phases:
+        for idx in xrange(flows):
+            src, dst, sport, dport = endpoints(idx)
+            ts += step
+
+            if client:
+                pkt = SyntheticPacket(ts, src, dst, sport, dport,
+                                      cseq + seqd, ackd and sseq + ackd or 0,
+                                      flags, data)
+            else:
+                pkt = SyntheticPacket(ts, dst, src, dport, sport,
+                                      sseq + seqd, cseq + ackd, flags, data)
+            packets.append(pkt)
+
+    return packets
+
+def transfer(size, mss=1460):
+    """
+    @param size the bytes sent by the server
+    @return a generator of SyntheticPacket for a single flow
+    """
+    src, dst, sport, dport = '10.0.0.1', '10.0.0.2', 1024, 80
+    cseq, sseq = 1000, 5000
+    ts = 1000000000.0
+
+    yield SyntheticPacket(ts, src, dst, sport, dport, cseq, 0, TH_SYN, '')
+    yield SyntheticPacket(ts, dst, src, dport, sport, sseq, cseq + 1,
+                          TH_SYN | TH_ACK, '')
+    yield SyntheticPacket(ts, src, dst, sport, dport, cseq + 1, sseq + 1,
+                          TH_ACK, '')
+
+    segment = 'x' * mss
+    seq, sent = sseq + 1, 0
+
+    while sent < size:
+        data = segment[:min(mss, size - sent)]
+        ts += 0.0001
+
+        yield SyntheticPacket(ts, dst, src, dport, sport, seq, cseq + 1,
+                              TH_ACK | TH_PSH, data)
+
+        seq += len(data)
+        sent += len(data)
+
+def run_transfer(tcp, sizes):
+    print "Single flow transfer (reading and discarding like the HTTP " \
+          "dissector)"
+
+    for size in sizes:
+        consumed = [0]
+
+        def consumer(stream, mpkt, rcv):
+            if rcv is not None:
+                data = rcv.data[consumed[0]:]
+                consumed[0] += len(data)
+                rcv.data.discard(consumed[0])
+
+            return REAS_COLLECT_DATA
+
+        reassembler = tcp.Reassembler(True, 10, 0)
+        reassembler.add_analyzer(
+            lambda stream, mpkt: stream.listeners.append(consumer))
+
+        start = time.time()
+
+        for pkt in transfer(size * 1024 * 1024):
+            reassembler.process_tcp(pkt)
+
+        elapsed = time.time() - start
+
+        print "  %6d MB %8.2f MB/sec (%d bytes buffered)" % (
+            size, size / elapsed, reassembler.mem_used)
+
+def write_pcap(fname, packets):
+    f = open(fname, 'wb')
+    f.write(pack('IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+
+    for pkt in packets:
+        frame = pkt.to_frame()
+        f.write(pack('IIII', int(pkt.time), int((pkt.time % 1) * 1000000),
+                     len(frame), len(frame)))
+        f.write(frame)
+
+    f.close()
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--flows', dest='flows', type='int',
+                      default=100000, help='number of concurrent flows')
+    parser.add_option('-m', '--maxmemory', dest='maxmemory', type='int',
+                      default=64 * 1024 * 1024,
+                      help='memory budget of the reassembler in bytes')
+    parser.add_option('-o', '--output', dest='output',
+                      help='also save the synthetic capture to this file')
+    parser.add_option('-t', '--transfer', dest='transfer',
+                      help='comma separated list of transfer sizes in MB')
+
+    options, args = parser.parse_args()
+
+    if options.transfer:
+        run_transfer(imp.load_source('tcp_decoder', TCP_SOURCES),
+                     map(int, options.transfer.split(',')))
+        return
+
+    packets = generate(options.flows)
+
+    if options.output:
+        write_pcap(options.output, packets)
+
+    tcp = imp.load_source('tcp_decoder', TCP_SOURCES)
+
+    collected = [0, 0]
+
+    def listener(stream, mpkt, rcv):
+        if rcv is not None:
+            collected[0] += rcv.count_new
+        return REAS_COLLECT_STATS
+
+    def analyzer(stream, mpkt):
+        stream.listeners.append(listener)
+
+    reassembler = tcp.Reassembler(True, options.flows, options.maxmemory)
+    reassembler.add_analyzer(analyzer)
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+
+    for pkt in packets:
+        reassembler.process_tcp(pkt)
+        collected[1] = max(collected[1], reassembler.n_streams)
+
+    elapsed = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+
+    print "Reassembled %d flows (%d packets) in %.2f secs" % (
+        options.flows, len(packets), elapsed)
+    print "  %-20s %10.0f" % ('packets/sec', len(packets) / elapsed)
+    print "  %-20s %10d" % ('max streams', collected[1])
+    print "  %-20s %10d" % ('streams left', reassembler.n_streams)
+    print "  %-20s %10d" % ('bytes collected', collected[0])
+    print "  %-20s %10d" % ('max rss delta (KB)', rss)
+
+if __name__ == "__main__":
+    main()
@@ -29,6 +29,9 @@ import shutil
 from distutils.core import setup, Extension
 from distutils.command.install import install
 from distutils.command.build import build
+from distutils.command.build_ext import build_ext
+from distutils.errors import CCompilerError, DistutilsExecError, \
+                             DistutilsPlatformError
 from umit.pm.core.const import PM_VERSION, PM_SITE
 
 ROOT_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -99,7 +102,12 @@ def pkc_get_library_dirs(names):
         retval.extend(output.replace('-L', '').split())
     return retval
 
-modules = []
+# The native checksum is optional. auditutils falls back to the pure python
+# implementation if the extension is not available.
+modules = [
+    Extension('umit.pm.core._checksum',
+              [os.path.join(ROOT_DIR, 'umit/pm/core/checksum.c')]),
+]
 
 if os.getenv('PM_DOCKING', False):
     print "OMG you're brave enough to give a try :O"
@@ -124,7 +132,7 @@ if os.getenv('PM_DOCKING', False):
         library_dirs=pkc_get_library_dirs('gtk+-2.0 pygtk-2.0'),
     )
 
-    modules = [moo]
+    modules.append(moo)
 
 mo_files = []
 
@@ -168,6 +176,23 @@ class pm_build(build):
         self.build_html_doc()
         build.run(self)
 
+class pm_build_ext(build_ext):
+    def run(self):
+        try:
+            build_ext.run(self)
+        except DistutilsPlatformError, err:
+            print "Skipping native extensions (%s)" % err
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except (CCompilerError, DistutilsExecError), err:
+            if ext.name != 'umit.pm.core._checksum':
+                raise
+
+            print "Unable to build %s (%s). Using the pure python " \
+                  "fallback" % (ext.name, err)
+
 class pm_install(install):
     def run(self):
         print
@@ -329,5 +354,6 @@ setup(name         = 'PacketManipulator',
                                    'PacketManipulator')],
       ext_modules  = modules,
       cmdclass     = {'install' : pm_install,
-                      'build' : pm_build}
+                      'build' : pm_build,
+                      'build_ext' : pm_build_ext}
 )
@@ -27,7 +27,9 @@ class BaseStaticContext(object):
     """
 
     file_types = [(_('Pcap files'), '*.pcap'),
-                  (_('Pcap gz files'), '*.pcap.gz')]
+                  (_('Pcap gz files'), '*.pcap.gz'),
+                  (_('Pcapng files'), '*.pcapng'),
+                  (_('Pcapng gz files'), '*.pcapng.gz')]
 
     NOT_SAVED, SAVED = range(2)
 
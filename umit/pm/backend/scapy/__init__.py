@@ -21,9 +21,13 @@
 from umit.pm.backend.scapy.packet import *
 from umit.pm.backend.scapy.wrapper import *
 from umit.pm.backend.scapy.utils import *
-from umit.pm.backend.scapy.doc import apply_doc
+from umit.pm.backend.scapy.store import *
+from umit.pm.backend.scapy.pcapindex import *
+from umit.pm.backend.scapy.matcher import *
+from umit.pm.backend.scapy.displayfilter import *
+from umit.pm.backend.scapy.doc import apply_layers
 
-apply_doc()
+apply_layers()
 
 PMField             = Field
 PMFlagsField        = FlagsField
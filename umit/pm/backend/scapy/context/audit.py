@@ -23,12 +23,12 @@ import sys
 import time
 import socket
 
-from threading import Thread
+from threading import Thread, Event
 
 from umit.pm.core.i18n import _
 from umit.pm.core.netconst import *
 from umit.pm.core.logger import log
-from umit.pm.core.atoms import ThreadPool, defaultdict
+from umit.pm.core.atoms import ThreadPool
 from umit.pm.manager.auditmanager import AuditDispatcher, AuditManager, \
                                          IL_TYPE_ETH
 from umit.pm.backend.scapy import *
@@ -101,6 +101,12 @@ class SendWorker(object):
         # Num of answers excepted
         self.ans_left = len(mpkts)
 
+        # id(mpkt) -> PendingRequest in the ReplyMatcher of the context
+        self.requests = {}
+
+        # Set when all the answers are received
+        self.done = Event()
+
 def register_audit_context(BaseAuditContext):
     class AuditContext(BaseAuditContext):
         """
@@ -144,7 +150,7 @@ def register_audit_context(BaseAuditContext):
             self.thread_pool = ThreadPool()
             self.audit_dispatcher = None
 
-            self.ans_dict = defaultdict(list)
+            self.matcher = ReplyMatcher()
             self.receivers = [] # A list of callable
 
             self.iface_origin_table = []
@@ -158,9 +164,10 @@ def register_audit_context(BaseAuditContext):
             log.debug('Creating send sockets')
 
             try:
-                # Here we create L2 and L3 sockets used to send packets
-                self._l2_socket = conf.L2socket(iface=dev1)
-                self._l3_socket = conf.L3socket(iface=dev1)
+                # Here we get the L2 and L3 sockets used to send packets from
+                # the pool. They are shared with the other send paths.
+                self._l2_socket = socket_pool.acquire(dev1, 2)
+                self._l3_socket = socket_pool.acquire(dev1, 3)
 
                 self._ip1 = get_if_addr(dev1)
                 self._mac1 = get_if_hwaddr(dev1)
@@ -171,7 +178,7 @@ def register_audit_context(BaseAuditContext):
                     self._mac2 = get_if_hwaddr(dev2)
                     self._mtu2 = get_mtu(dev2)
 
-                    self._lb_socket = conf.L2socket(iface=dev2)
+                    self._lb_socket = socket_pool.acquire(dev2, 2)
 
                     self.check_forwarded = self.__check_forwarded_multi
                     self.set_forwardable = self.__set_forwardable_multi
@@ -295,11 +302,11 @@ def register_audit_context(BaseAuditContext):
                     return self.skip_forwarded
 
             if mpkt.flags & MPKT_FROMIFACE:
-                log.info('Adding %s MAC to the IFACE table' % mpkt.l2_src)
+                log.info('Adding %s MAC to the IFACE table', mpkt.l2_src)
                 self.iface_origin_table.insert(0, mpkt.l2_src)
 
             elif mpkt.flags & MPKT_FROMBRIDGE:
-                log.info('Adding %s MAC to the BRIDGE table' % mpkt.l2_src)
+                log.info('Adding %s MAC to the BRIDGE table', mpkt.l2_src)
                 self.bridge_origin_table.insert(0, mpkt.l2_src)
 
             return False
@@ -380,6 +387,13 @@ def register_audit_context(BaseAuditContext):
             log.debug('Stopping thread pool')
             self.thread_pool.stop()
 
+            if self.capmethod != 0:
+                log.debug('Killing helper processes')
+
+                for process in (self._listen_dev1, self._listen_dev2):
+                    if process:
+                        kill_helper(process)
+
             log.debug('Joining threads')
 
             if self.thread1:
@@ -388,6 +402,14 @@ def register_audit_context(BaseAuditContext):
             if self.thread2:
                 self.thread2.join()
 
+            log.debug('Releasing send sockets')
+
+            for sock in (self._l2_socket, self._l3_socket, self._lb_socket):
+                if sock:
+                    sock.close()
+
+            self._l2_socket = self._l3_socket = self._lb_socket = None
+
             self.state = self.NOT_RUNNING
 
             log.debug('AuditContext succesfully stopped')
@@ -429,10 +451,10 @@ def register_audit_context(BaseAuditContext):
             return True
 
         def __helper_thread(self, obj):
-            errstr = None
+            errstr = reader = None
 
             try:
-                for reader in bind_reader(obj[0], obj[1]):
+                for reader in bind_reader(obj):
                     if not self.internal:
                         break
 
@@ -447,31 +469,26 @@ def register_audit_context(BaseAuditContext):
                 self.internal = False
                 log.error(generate_traceback())
 
-            self.audit_dispatcher = AuditDispatcher(reader.linktype, self)
+            if reader:
+                self.audit_dispatcher = AuditDispatcher(reader.linktype, self)
 
             log.debug('Entering in the helper mainloop')
 
-            reported_packets = 0
             mflags = (obj is self._listen_dev1) and \
                    MPKT_FROMIFACE and MPKT_FROMBRIDGE
 
-            while self.internal:
-                report_idx = get_n_packets(obj[0])
-
-                if report_idx < reported_packets:
-                    continue
-
-                while reported_packets < report_idx:
-                    r = reader.read_packet()
+            while self.internal and reader:
+                # This waits at most the reader timeout
+                r = reader.read_packet()
 
-                    if not r:
+                if not r:
+                    if reader.eof:
+                        errstr = errstr or _('Helper process terminated')
                         break
 
-                    self.__manage_mpkt(obj, MetaPacket(r, flags=mflags))
-
-                    reported_packets += 1
+                    continue
 
-                report_idx = reported_packets
+                self.__manage_mpkt(obj, MetaPacket(r, flags=mflags))
 
             if errstr:
                 self.internal = False
@@ -520,10 +537,10 @@ def register_audit_context(BaseAuditContext):
                 self.summary = self.title + ' (' + errstr + ')'
 
         def __manage_mpkt(self, obj, mpkt):
-            found = False
+            req = None
             layer = 2
 
-            while not found and layer <= 3:
+            while req is None and layer <= 3:
                 if layer == 2:
                     cpkt = mpkt.root
                 elif is_proto(mpkt.root.payload):
@@ -531,36 +548,22 @@ def register_audit_context(BaseAuditContext):
                 else:
                     break
 
-                idx = 0
-                hashret = cpkt.hashret()
-                lst = self.ans_dict[hashret]
-
-                if hashret in self.ans_dict:
-                    for ans, send, cnt in lst:
-                        if cpkt.answers(ans.root):
-                            send.ans_left -= 1
-                            lst[idx][2] -= 1
-
-                            if lst[idx][2] < 1:
-                                del lst[idx]
-
-                                if not lst:
-                                    del self.ans_dict[hashret]
-
-                            send.onreply(send, mpkt, ans, send.udata)
-
-                            if send.ans_left == 0 and not send.timeout:
-                                log.debug('Stopping SendWorker')
-                                self.cancel_send(send)
+                req = self.matcher.match(cpkt)
+                layer += 1
 
-                            found = True
-                            break
+            if req is not None:
+                ans, send = req.udata
+                send.ans_left -= 1
 
-                        idx += 1
-                layer += 1
+                send.onreply(send, mpkt, ans, send.udata)
 
+                if send.ans_left == 0:
+                    send.done.set()
 
-            if not found:
+                    if not send.timeout:
+                        log.debug('Stopping SendWorker')
+                        self.cancel_send(send)
+            else:
                 for rcv in self.receivers:
                     if isinstance(rcv, SendWorker):
                         if callable(rcv.onrecv):
@@ -584,24 +587,18 @@ def register_audit_context(BaseAuditContext):
         def __worker_thread(self, send):
             while send.repeat != 0 and self.internal:
                 send.ans_left = len(send.mpkts)
+                send.done.clear()
 
                 for mpkt in send.mpkts:
 
                     if callable(send.onreply):
-                        idx = 0
-                        found = False
-                        lst = self.ans_dict[mpkt.hashret()]
-
-                        for pmpkt, psend, pcnt in lst:
-                            if psend is send and pmpkt is mpkt:
-                                found = True
-                                break
-                            idx += 1
-
-                        if found:
-                            lst[idx][2] += 1
+                        req = send.requests.get(id(mpkt))
+
+                        if req is None:
+                            send.requests[id(mpkt)] = \
+                                self.matcher.add(mpkt.root, (mpkt, send))
                         else:
-                            lst.append([mpkt, send, 1])
+                            self.matcher.renew(req)
 
                     mpkt.root.time = time.time()
 
@@ -632,15 +629,8 @@ def register_audit_context(BaseAuditContext):
                 log.debug('Send complete for %s. Waiting for timeout' % send)
 
                 if send.ans_left > 0 and self.internal:
-                    time_left = send.timeout * 1000
-                    delay = max(100, send.delay)
-
-                    while time_left > send.delay:
-                        if send.ans_left == 0:
-                            break
-
-                        time_left -= delay
-                        time.sleep(delay / 1000.0)
+                    # Woken up by __manage_mpkt() on the last answer
+                    send.done.wait(send.timeout)
 
                 if send.ans_left == 0:
                     log.debug('Send process complete')
@@ -676,27 +666,12 @@ def register_audit_context(BaseAuditContext):
             if not callable(send.onreply):
                 return
 
-            removed = 0
-
-            for mpkt in send.mpkts:
-                try:
-                    idx = 0
-                    lst = self.ans_dict[mpkt.hashret()]
-                    for pmpkt, psend, pcnt in lst:
-                        if pmpkt is mpkt and psend is send:
-                            del lst[idx]
-                            break
-                        idx = 0
-                    removed += 1
-                except ValueError:
-                    continue
+            for req in send.requests.values():
+                self.matcher.remove(req)
 
-            if removed == len(send.mpkts):
-                log.debug('SendWorker object succesfully removed')
-            else:
-                log.error('It seems that we\'ve leaved it dirty')
+            send.requests.clear()
 
-            del send
+            log.debug('SendWorker object succesfully removed')
 
         ########################################################################
         # Pure send functions
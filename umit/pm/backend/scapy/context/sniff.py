@@ -25,6 +25,7 @@ import gobject
 
 from umit.pm.core.i18n import _
 from umit.pm.core.logger import log
+from umit.pm.core.metrics import metrics
 from umit.pm.core.atoms import with_decorator
 from umit.pm.manager.preferencemanager import Prefs
 from umit.pm.manager.auditmanager import AuditDispatcher
@@ -34,6 +35,11 @@ from umit.pm.backend.scapy import *
 import select
 
 def register_sniff_context(BaseSniffContext):
+    sniff_packets = metrics.counter('sniff.packets')
+    sniff_bytes = metrics.counter('sniff.bytes')
+    sniff_skipped = metrics.counter('sniff.skipped')
+    sniff_backlog = metrics.histogram('sniff.backlog')
+
     class SniffContext(BaseSniffContext):
         """
         A sniff context for controlling various options.
@@ -121,7 +127,7 @@ def register_sniff_context(BaseSniffContext):
 
             self.state = self.RUNNING
             self.internal = True
-            self.data = []
+            self.data = PacketStore()
 
             if self.capmethod == 0:
                 self.thread = Thread(target=self.run)
@@ -180,13 +186,14 @@ def register_sniff_context(BaseSniffContext):
                     log.debug("I'm using virtual interface method")
                     outfile = self.cap_file
                 else:
-                    # Run tcpdump or dumpcap
-                    self.process, outfile = run_helper(self.capmethod - 2,
-                                                       self.iface,
-                                                       self.filter,
-                                                       self.stop_count,
-                                                       self.stop_time,
-                                                       self.stop_size)
+                    # Run tcpdump or dumpcap and read from their stdout
+                    outfile = None
+                    self.process = run_helper(self.capmethod - 2,
+                                              self.iface,
+                                              self.filter,
+                                              self.stop_count,
+                                              self.stop_time,
+                                              self.stop_size)
 
                 for reader in bind_reader(self.process, outfile):
                     if not self.internal:
@@ -202,29 +209,28 @@ def register_sniff_context(BaseSniffContext):
                 errstr = str(err)
                 self.internal = False
 
-            reported_packets = 0
-
             log.debug("Entering in the main loop")
 
-            if self.audits:
+            if self.audits and reader:
                 self.audit_dispatcher = AuditDispatcher(reader.linktype)
 
-            while self.internal:
-
-                if self.capmethod != 1:
-                    report_idx = get_n_packets(self.process)
+            while self.internal and reader:
 
-                    if report_idx < reported_packets:
-                        continue
-
-                while self.capmethod == 1 or reported_packets < report_idx:
+                # Read all the packets available. For helpers the read waits
+                # at most the reader timeout so we could check self.internal
+                while self.internal:
 
-                    pkt = reader.read_packet()
+                    # The packet will be dissected only if needed
+                    pkt = MetaPacket.new_from_pcap(reader)
 
                     if not pkt:
+                        if self.capmethod == 1 or reader.eof:
+                            # End of the capture file or the helper has
+                            # terminated (stop conditions)
+                            self.internal = False
+
                         break
 
-                    pkt = MetaPacket(pkt)
                     packet_size = pkt.get_size()
 
                     if not pkt:
@@ -234,17 +240,29 @@ def register_sniff_context(BaseSniffContext):
                        packet_size - self.max_packet_size > 0:
 
                         log.debug("Skipping current packet (max_packet_size)")
+
+                        if metrics.enabled:
+                            sniff_skipped.inc()
+
                         continue
 
                     if self.min_packet_size and \
                        packet_size - self.min_packet_size < 0:
 
                         log.debug("Skipping current packet (min_packet_size)")
+
+                        if metrics.enabled:
+                            sniff_skipped.inc()
+
                         continue
 
                     self.tot_count += 1
                     self.tot_size += packet_size
 
+                    if metrics.enabled:
+                        sniff_packets.inc()
+                        sniff_bytes.inc(packet_size)
+
                     now = datetime.now()
                     delta = now - self.prevtime
                     self.prevtime = now
@@ -253,7 +271,6 @@ def register_sniff_context(BaseSniffContext):
                         self.tot_time += delta.seconds
 
                     self.data.append(pkt)
-                    reported_packets += 1
 
                     if self.audit_dispatcher:
                         self.audit_dispatcher.feed(pkt)
@@ -275,22 +292,23 @@ def register_sniff_context(BaseSniffContext):
                         lst.append(float(float(self.tot_size) /
                                          float(self.stop_size)))
 
+                    if lst and sum(lst) / len(lst) >= 1.0:
+                        self.internal = False
+
+                    # The file position is only used to report the progress.
+                    # With gzip files it is the compressed one so the file is
+                    # read till new_from_pcap() returns None.
                     if self.capmethod == 1:
-                        lst.append(position() / outfile_size)
+                        lst.append(min(position() / outfile_size, 1.0))
 
                     if lst:
                         self.percentage = float(float(sum(lst)) /
                                                 float(len(lst))) * 100.0
-
-                        if self.percentage >= 100:
-                            self.internal = False
                     else:
                         # ((goject.G_MAXINT / 4) % gobject.G_MAXINT)
                         self.percentage = (self.percentage + 536870911) % \
                                           gobject.G_MAXINT
 
-                report_idx = reported_packets
-
             log.debug("Exiting from thread")
 
             if self.process:
@@ -374,6 +392,10 @@ def register_sniff_context(BaseSniffContext):
             priv = self.priv
             self.priv = []
 
+            # Packets received by run() and waiting to be processed here
+            if metrics.enabled:
+                sniff_backlog.record(len(priv))
+
             for r in priv:
                 # This code should not be in the thread and called in the
                 # main thread of the GUI so we can avoid packet loss.
@@ -388,17 +410,29 @@ def register_sniff_context(BaseSniffContext):
                    packet_size - self.max_packet_size > 0:
 
                     log.debug("Skipping current packet (max_packet_size)")
+
+                    if metrics.enabled:
+                        sniff_skipped.inc()
+
                     continue
 
                 if self.min_packet_size and \
                    packet_size - self.min_packet_size < 0:
 
                     log.debug("Skipping current packet (min_packet_size)")
+
+                    if metrics.enabled:
+                        sniff_skipped.inc()
+
                     continue
 
                 self.tot_count += 1
                 self.tot_size += packet.get_size()
 
+                if metrics.enabled:
+                    sniff_packets.inc()
+                    sniff_bytes.inc(packet_size)
+
                 now = datetime.now()
                 delta = now - self.prevtime
                 self.prevtime = now
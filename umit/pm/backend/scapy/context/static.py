@@ -21,11 +21,14 @@
 import os
 import os.path
 
-from umit.pm.backend.scapy.packet import MetaPacket
-from umit.pm.backend.scapy.wrapper import PcapWriter, PcapReader, wrpcap, PacketList
+from threading import Thread
+
+from umit.pm.backend.scapy.pcapindex import PcapIndex, PcapPacketList
+from umit.pm.backend.scapy.wrapper import PcapWriter, wrpcap
 from umit.pm.manager.auditmanager import AuditDispatcher, IL_TYPE_ETH
 
 from umit.pm.core.i18n import _
+from umit.pm.core.logger import log
 
 class CustomPcapWriter(PcapWriter):
     def __init__(self, operation, plen, filename, *args, **kargs):
@@ -68,21 +71,19 @@ def register_static_context(BaseStaticContext):
             BaseStaticContext.__init__(self, title, fname, audits)
 
             self.audit_dispatcher = None
+            self.audit_thread = None
 
         def load(self, operation=None):
+            """
+            Index the capture file. Packets are read from the file only when
+            requested and the audits are fed in a separate thread.
+            """
             if not self.cap_file:
                 return False
 
-            self.data = []
-
             try:
-                pktcount = 0
-                reader = PcapReader(self.cap_file)
                 size = os.stat(self.cap_file).st_size
 
-                if self.audits:
-                    self.audit_dispatcher = AuditDispatcher(reader.linktype)
-
                 if size >= 1024 ** 3:
                     fsize = "%.1f GB" % (size / (1024.0 ** 3))
                 elif size >= 1024 ** 2:
@@ -90,43 +91,23 @@ def register_static_context(BaseStaticContext):
                 else:
                     fsize = "%.1f KB" % (size / 1024.0)
 
-                while True:
-                    p = reader.read_packet()
-
-                    if p is None:
-                        break
-                    else:
-                        pktcount += 1
-
-                        if pktcount % 10 == 0 and operation:
-                            operation.summary = \
-                                _('Loading %s - %d packets (%s)') % \
-                                 (self.cap_file, pktcount, fsize)
-
-                            # FIXME: we are accessing to a private field (f)
-
-                            if getattr(reader.f, 'fileobj', None):
-                                # If fileobj is present we are gzip file and we
-                                # need to get the absolute position not the
-                                # relative to the gzip file.
-                                pos = reader.f.fileobj.tell()
-                            else:
-                                pos = reader.f.tell()
+                def callback(pos, pktcount):
+                    operation.summary = \
+                        _('Indexing %s - %d packets (%s)') % \
+                         (self.cap_file, pktcount, fsize)
+                    operation.percentage = (pos / float(size or 1)) * 100.0
 
-                            operation.percentage = \
-                                (pos / float(size)) * 100.0
+                index = PcapIndex.open(self.cap_file,
+                                       operation and callback or None)
 
-                        lst = PacketList([p], os.path.basename(self.cap_file))
-                        mpkt = MetaPacket(lst[0])
-                        self.data.append(mpkt)
+                if isinstance(self.data, PcapPacketList):
+                    self.data.close()
 
-                        # TODO: overhead
-                        if self.audit_dispatcher:
-                            self.audit_dispatcher.feed(mpkt)
+                self.data = PcapPacketList(self.cap_file, index)
 
                 if operation:
                     operation.summary = _('Loaded %s - %d packets (%s)') % \
-                                         (self.cap_file, pktcount, fsize)
+                                         (self.cap_file, len(index), fsize)
                     operation.percentage = 100.0
 
             except IOError, (errno, err):
@@ -138,11 +119,45 @@ def register_static_context(BaseStaticContext):
 
                 return False
 
+            if self.audits:
+                linktype = self.data.get_linktype()
+
+                if linktype is None:
+                    linktype = IL_TYPE_ETH
+
+                self.audit_dispatcher = AuditDispatcher(linktype)
+
+                self.audit_thread = Thread(target=self.__feed_audits,
+                                           name='StaticAudits',
+                                           args=(self.data, ))
+                self.audit_thread.setDaemon(True)
+                self.audit_thread.start()
+
             self.status = self.SAVED
             self.title = self.cap_file
             self.summary = _('%d packets loaded.') % len(self.data)
             return True
 
+        def __feed_audits(self, data):
+            """
+            Feed the audits with the packets read sequentially. The cfields
+            set by the audits are saved by the PcapPacketList and shown on
+            the packets of the list.
+            """
+
+            dispatcher = self.audit_dispatcher
+
+            try:
+                for mpkt in data.stream():
+                    # A new load() started
+                    if self.audit_dispatcher is not dispatcher:
+                        break
+
+                    dispatcher.feed(mpkt)
+            except IOError, err:
+                log.error('Error while feeding the audits with %s (%s)' % \
+                          (self.cap_file, str(err)))
+
         def save(self, operation=None):
             if getattr(self, 'get_all_data', False):
                 data = self.get_all_data()
@@ -166,6 +181,13 @@ def register_static_context(BaseStaticContext):
 
                 writer.update_operation()
 
+                # The file we are reading from has been rewritten
+                if isinstance(self.data, PcapPacketList) and \
+                   self.data.fname == self.cap_file:
+                    self.data.close()
+                    self.data = PcapPacketList(self.cap_file,
+                                               PcapIndex.open(self.cap_file))
+
             except IOError, (errno, err):
                 self.summary = str(err)
 
@@ -0,0 +1,964 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Wireshark like display filters.
+
+An expression is compiled once to a tree of closures and then evaluated
+against MetaPackets. Some examples:
+
+  tcp.dport == 80 and ip.src in 10.0.0.0/8
+  udp.port in {53 67 68} || icmp
+  not arp and eth.src != 00:11:22:33:44:55
+  tcp.flags.syn == 1 && !(tcp.flags & 0x10)
+  tcp.payload contains "GET" or dns
+
+The fields of ethernet, vlan, arp, ip, ipv6, icmp, icmpv6, tcp and udp are
+read directly from the raw bytes of the packet at offsets computed once per
+packet, so lazy packets are never dissected by scapy. The other protocols
+of global_trans could be used as well (dns, dns.qdcount) but they need the
+scapy tree of the packet.
+"""
+
+import re
+import operator
+
+from struct import Struct, error
+from binascii import hexlify
+from socket import inet_aton, error as socket_error
+
+from umit.pm.core.errors import PMErrorException
+from umit.pm.backend.scapy.wrapper import *
+from umit.pm.backend.scapy.translator import global_trans
+
+__all__ = ['DisplayFilter', 'FilterSyntaxError', 'get_filter_fields']
+
+class FilterSyntaxError(PMErrorException):
+    def __init__(self, msg, pos=None):
+        PMErrorException.__init__(self, msg)
+        self.pos = pos
+
+###############################################################################
+# Headers
+###############################################################################
+
+# Indexes of the tuple returned by get_headers()
+H_ETH, H_L3TYPE, H_L3, H_L4PROTO, H_L4, H_END = range(6)
+
+NO_HEADERS = (None, None, None, None, None, None)
+
+IP6_EXTENSIONS = (0, 43, 60)
+
+def get_headers(mpkt, raw):
+    """
+    Locate the headers of the packet
+
+    @param mpkt a MetaPacket
+    @param raw the bytes of the packet
+    @return a tuple (ethernet offset, ethertype, l3 offset, l4 protocol,
+            l4 offset, end of the l3 datagram). Missing items are None.
+    """
+    eth = None
+
+    try:
+        llcls = mpkt.get_llclass()
+
+        if llcls is Ether:
+            eth, l3, l3type = 0, 14, ord(raw[12]) << 8 | ord(raw[13])
+
+            if l3type == 0x8100:
+                l3, l3type = 18, ord(raw[16]) << 8 | ord(raw[17])
+        elif llcls is CookedLinux:
+            l3, l3type = 16, ord(raw[14]) << 8 | ord(raw[15])
+        elif llcls is IP:
+            l3 = 0
+            l3type = (ord(raw[0]) >> 4 == 6) and 0x86dd or 0x0800
+        else:
+            # Let scapy find the IP layer for the other link types
+            layer = mpkt.getlayer(IP)
+
+            if layer is None:
+                return NO_HEADERS
+
+            l3, l3type = len(raw) - len(mpkt.get_raw_layer(IP)), 0x0800
+
+        if l3type == 0x0800:
+            proto = ord(raw[l3 + 9])
+            end = l3 + (ord(raw[l3 + 2]) << 8 | ord(raw[l3 + 3]))
+
+            # Segmentation offload captures have no total length
+            if end == l3:
+                end = len(raw)
+
+            # Non first fragments have no l4 header
+            if (ord(raw[l3 + 6]) & 0x1f) or ord(raw[l3 + 7]):
+                l4 = None
+            else:
+                l4 = l3 + (ord(raw[l3]) & 0x0f) * 4
+        elif l3type == 0x86dd:
+            proto = ord(raw[l3 + 6])
+            end = l3 + 40 + (ord(raw[l3 + 4]) << 8 | ord(raw[l3 + 5]))
+            l4 = l3 + 40
+
+            while proto in IP6_EXTENSIONS:
+                proto = ord(raw[l4])
+                l4 += (ord(raw[l4 + 1]) + 1) * 8
+
+            if proto == 44:
+                proto = ord(raw[l4])
+
+                if ord(raw[l4 + 2]) or ord(raw[l4 + 3]) & 0xf8:
+                    l4 = None
+                else:
+                    l4 += 8
+        else:
+            return (eth, l3type, l3, None, None, len(raw))
+
+    except IndexError:
+        return (eth, None, None, None, None, None)
+
+    return (eth, l3type, l3, proto, l4, min(end, len(raw)))
+
+###############################################################################
+# Fields
+###############################################################################
+
+# Field types
+T_INT, T_FLOAT, T_BYTES, T_MAC, T_IPV4, T_IPV6, T_ANY = range(7)
+
+def layer_eth(raw, hdrs):
+    return hdrs[H_ETH]
+
+def layer_vlan(raw, hdrs):
+    if hdrs[H_ETH] is not None and raw[12:14] == '\x81\x00':
+        return 14
+
+def layer_l3(l3type):
+    def base(raw, hdrs):
+        if hdrs[H_L3TYPE] == l3type:
+            return hdrs[H_L3]
+    return base
+
+def layer_l4(*protos):
+    def base(raw, hdrs):
+        if hdrs[H_L4PROTO] in protos:
+            return hdrs[H_L4]
+    return base
+
+LAYERS = {
+    'eth'    : layer_eth,
+    'vlan'   : layer_vlan,
+    'arp'    : layer_l3(0x0806),
+    'ip'     : layer_l3(0x0800),
+    'ipv6'   : layer_l3(0x86dd),
+    'icmp'   : layer_l4(1),
+    'icmpv6' : layer_l4(58),
+    'tcp'    : layer_l4(6),
+    'udp'    : layer_l4(17),
+}
+
+def number(layer, offset, fmt, mask=0, shift=0):
+    "@return a getter for an integer field of the layer"
+    base_of = LAYERS[layer]
+    unpack = Struct(fmt).unpack_from
+
+    def get(mpkt, raw, hdrs):
+        base = base_of(raw, hdrs)
+
+        if base is None:
+            return None
+
+        try:
+            value = unpack(raw, base + offset)[0]
+        except error:
+            return None
+
+        if mask:
+            value = (value & mask) >> shift
+
+        return value
+
+    return get
+
+def string(layer, offset, size):
+    "@return a getter for a fixed size bytes field of the layer"
+    base_of = LAYERS[layer]
+
+    def get(mpkt, raw, hdrs):
+        base = base_of(raw, hdrs)
+
+        if base is None or len(raw) < base + offset + size:
+            return None
+
+        return raw[base + offset:base + offset + size]
+
+    return get
+
+def ipv6_address(offset):
+    unpack = Struct('!QQ').unpack_from
+
+    def get(mpkt, raw, hdrs):
+        if hdrs[H_L3TYPE] != 0x86dd:
+            return None
+
+        try:
+            high, low = unpack(raw, hdrs[H_L3] + offset)
+        except error:
+            return None
+
+        return high << 64 | low
+
+    return get
+
+def payload(layer, header_len):
+    "@return a getter for the payload of a l4 layer"
+    base_of = LAYERS[layer]
+
+    def get(mpkt, raw, hdrs):
+        base = base_of(raw, hdrs)
+
+        if base is None:
+            return None
+
+        try:
+            return raw[base + header_len(raw, base):hdrs[H_END]]
+        except IndexError:
+            return None
+
+    return get
+
+def both(*getters):
+    "@return a getter returning the values of getters as a tuple"
+    def get(mpkt, raw, hdrs):
+        values = tuple([value for value in [getter(mpkt, raw, hdrs) \
+                                            for getter in getters] \
+                        if value is not None])
+        return values or None
+
+    return get
+
+def tcp_header_len(raw, base):
+    return (ord(raw[base + 12]) >> 4) * 4
+
+def udp_header_len(raw, base):
+    return 8
+
+def get_frame_len(mpkt, raw, hdrs):
+    return len(raw)
+
+def get_frame_time(mpkt, raw, hdrs):
+    return mpkt.get_rawtime()
+
+def get_frame(mpkt, raw, hdrs):
+    return raw
+
+def get_eth_type(mpkt, raw, hdrs):
+    if hdrs[H_ETH] is not None:
+        return hdrs[H_L3TYPE]
+
+def get_data(mpkt, raw, hdrs):
+    for layer in ('tcp', 'udp'):
+        value = FIELDS[layer + '.payload'][1](mpkt, raw, hdrs)
+
+        if value is not None:
+            return value
+
+def get_tcp_len(mpkt, raw, hdrs):
+    value = FIELDS['tcp.payload'][1](mpkt, raw, hdrs)
+
+    if value is not None:
+        return len(value)
+
+# name -> (type, getter, multiple values)
+FIELDS = {
+    'frame'          : (T_BYTES, get_frame, False),
+    'frame.len'      : (T_INT, get_frame_len, False),
+    'frame.time'     : (T_FLOAT, get_frame_time, False),
+
+    'eth.dst'        : (T_MAC, string('eth', 0, 6), False),
+    'eth.src'        : (T_MAC, string('eth', 6, 6), False),
+    'eth.type'       : (T_INT, get_eth_type, False),
+
+    'vlan.prio'      : (T_INT, number('vlan', 0, '!H', 0xe000, 13), False),
+    'vlan.id'        : (T_INT, number('vlan', 0, '!H', 0x0fff), False),
+
+    'arp.op'         : (T_INT, number('arp', 6, '!H'), False),
+    'arp.hwsrc'      : (T_MAC, string('arp', 8, 6), False),
+    'arp.psrc'       : (T_IPV4, number('arp', 14, '!I'), False),
+    'arp.hwdst'      : (T_MAC, string('arp', 18, 6), False),
+    'arp.pdst'       : (T_IPV4, number('arp', 24, '!I'), False),
+
+    'ip.version'     : (T_INT, number('ip', 0, '!B', 0xf0, 4), False),
+    'ip.ihl'         : (T_INT, number('ip', 0, '!B', 0x0f), False),
+    'ip.tos'         : (T_INT, number('ip', 1, '!B'), False),
+    'ip.len'         : (T_INT, number('ip', 2, '!H'), False),
+    'ip.id'          : (T_INT, number('ip', 4, '!H'), False),
+    'ip.flags'       : (T_INT, number('ip', 6, '!B', 0xe0, 5), False),
+    'ip.frag'        : (T_INT, number('ip', 6, '!H', 0x1fff), False),
+    'ip.ttl'         : (T_INT, number('ip', 8, '!B'), False),
+    'ip.proto'       : (T_INT, number('ip', 9, '!B'), False),
+    'ip.chksum'      : (T_INT, number('ip', 10, '!H'), False),
+    'ip.src'         : (T_IPV4, number('ip', 12, '!I'), False),
+    'ip.dst'         : (T_IPV4, number('ip', 16, '!I'), False),
+
+    'ipv6.tc'        : (T_INT, number('ipv6', 0, '!H', 0x0ff0, 4), False),
+    'ipv6.fl'        : (T_INT, number('ipv6', 0, '!I', 0x000fffff), False),
+    'ipv6.plen'      : (T_INT, number('ipv6', 4, '!H'), False),
+    'ipv6.nh'        : (T_INT, number('ipv6', 6, '!B'), False),
+    'ipv6.hlim'      : (T_INT, number('ipv6', 7, '!B'), False),
+    'ipv6.src'       : (T_IPV6, ipv6_address(8), False),
+    'ipv6.dst'       : (T_IPV6, ipv6_address(24), False),
+
+    'icmp.type'      : (T_INT, number('icmp', 0, '!B'), False),
+    'icmp.code'      : (T_INT, number('icmp', 1, '!B'), False),
+    'icmp.chksum'    : (T_INT, number('icmp', 2, '!H'), False),
+    'icmp.id'        : (T_INT, number('icmp', 4, '!H'), False),
+    'icmp.seq'       : (T_INT, number('icmp', 6, '!H'), False),
+
+    'icmpv6.type'    : (T_INT, number('icmpv6', 0, '!B'), False),
+    'icmpv6.code'    : (T_INT, number('icmpv6', 1, '!B'), False),
+
+    'tcp.sport'      : (T_INT, number('tcp', 0, '!H'), False),
+    'tcp.dport'      : (T_INT, number('tcp', 2, '!H'), False),
+    'tcp.seq'        : (T_INT, number('tcp', 4, '!I'), False),
+    'tcp.ack'        : (T_INT, number('tcp', 8, '!I'), False),
+    'tcp.dataofs'    : (T_INT, number('tcp', 12, '!B', 0xf0, 4), False),
+    'tcp.flags'      : (T_INT, number('tcp', 12, '!H', 0x01ff), False),
+    'tcp.window'     : (T_INT, number('tcp', 14, '!H'), False),
+    'tcp.chksum'     : (T_INT, number('tcp', 16, '!H'), False),
+    'tcp.urgptr'     : (T_INT, number('tcp', 18, '!H'), False),
+    'tcp.payload'    : (T_BYTES, payload('tcp', tcp_header_len), False),
+    'tcp.len'        : (T_INT, get_tcp_len, False),
+
+    'udp.sport'      : (T_INT, number('udp', 0, '!H'), False),
+    'udp.dport'      : (T_INT, number('udp', 2, '!H'), False),
+    'udp.len'        : (T_INT, number('udp', 4, '!H'), False),
+    'udp.chksum'     : (T_INT, number('udp', 6, '!H'), False),
+    'udp.payload'    : (T_BYTES, payload('udp', udp_header_len), False),
+
+    'data'           : (T_BYTES, get_data, False),
+}
+
+for idx, flag in enumerate(('fin', 'syn', 'rst', 'psh', 'ack', 'urg', 'ece',
+                            'cwr', 'ns')):
+    FIELDS['tcp.flags.' + flag] = \
+          (T_INT, number('tcp', 12, '!H', 1 << idx, idx), False)
+
+for name, src, dst in (('eth.addr', 'eth.src', 'eth.dst'),
+                       ('ip.addr', 'ip.src', 'ip.dst'),
+                       ('ipv6.addr', 'ipv6.src', 'ipv6.dst'),
+                       ('tcp.port', 'tcp.sport', 'tcp.dport'),
+                       ('udp.port', 'udp.sport', 'udp.dport')):
+    FIELDS[name] = (FIELDS[src][0], both(FIELDS[src][1], FIELDS[dst][1]),
+                    True)
+
+# Wireshark names
+ALIASES = {
+    'ip.hdr_len'       : 'ip.ihl',
+    'ip.dsfield'       : 'ip.tos',
+    'ip.frag_offset'   : 'ip.frag',
+    'ip.checksum'      : 'ip.chksum',
+    'ipv6.nxt'         : 'ipv6.nh',
+    'ipv6.hop_limit'   : 'ipv6.hlim',
+    'tcp.srcport'      : 'tcp.sport',
+    'tcp.dstport'      : 'tcp.dport',
+    'tcp.window_size'  : 'tcp.window',
+    'tcp.checksum'     : 'tcp.chksum',
+    'udp.srcport'      : 'udp.sport',
+    'udp.dstport'      : 'udp.dport',
+    'udp.length'       : 'udp.len',
+    'udp.checksum'     : 'udp.chksum',
+    'icmp.checksum'    : 'icmp.chksum',
+    'arp.opcode'       : 'arp.op',
+    'arp.src.hw_mac'   : 'arp.hwsrc',
+    'arp.src.proto_ipv4' : 'arp.psrc',
+    'arp.dst.hw_mac'   : 'arp.hwdst',
+    'arp.dst.proto_ipv4' : 'arp.pdst',
+}
+
+def get_filter_fields():
+    "@return a sorted list of the field names with a fast accessor"
+    names = FIELDS.keys() + LAYERS.keys() + ALIASES.keys()
+    names.sort()
+    return names
+
+def scapy_field(fieldname):
+    "@return a getter using MetaPacket.get_field()"
+    def get(mpkt, raw, hdrs):
+        return mpkt.get_field(fieldname)
+
+    return get
+
+def scapy_layer(klass):
+    def get(mpkt, raw, hdrs):
+        if mpkt.getlayer(klass) is not None:
+            return True
+
+    return get
+
+###############################################################################
+# Values
+###############################################################################
+
+def parse_int(txt):
+    try:
+        return int(txt, 0)
+    except ValueError:
+        return None
+
+def parse_mac(txt):
+    if len(txt) != 17:
+        return None
+
+    try:
+        return ''.join([chr(int(byte, 16)) for byte in re.split('[:-]', txt)])
+    except ValueError:
+        return None
+
+def parse_ipv4(txt):
+    "@return a (network, mask) tuple"
+    addr, sep, bits = txt.partition('/')
+
+    if addr.count('.') != 3:
+        return None
+
+    try:
+        value = Struct('!I').unpack(inet_aton(addr))[0]
+        bits = sep and int(bits) or 32
+    except (socket_error, ValueError):
+        return None
+
+    if bits < 0 or bits > 32:
+        return None
+
+    mask = (0xffffffff << (32 - bits)) & 0xffffffff
+
+    return (value & mask, mask)
+
+def parse_ipv6(txt):
+    "@return a (network, mask) tuple"
+    from socket import inet_pton, AF_INET6
+
+    addr, sep, bits = txt.partition('/')
+
+    try:
+        value = long(hexlify(inet_pton(AF_INET6, addr)), 16)
+        bits = sep and int(bits) or 128
+    except (socket_error, ValueError):
+        return None
+
+    if bits < 0 or bits > 128:
+        return None
+
+    mask = ((1 << 128) - 1) ^ ((1 << (128 - bits)) - 1)
+
+    return (value & mask, mask)
+
+def parse_value(ftype, token):
+    """
+    @param ftype the T_* type of the field
+    @param token a (kind, text) token
+    @return the value to compare with the field
+    """
+    kind, txt = token
+
+    if kind == 'string':
+        if ftype in (T_BYTES, T_ANY):
+            return txt
+        value = None
+    elif ftype == T_INT:
+        value = parse_int(txt)
+    elif ftype == T_FLOAT:
+        try:
+            value = float(txt)
+        except ValueError:
+            value = None
+    elif ftype == T_MAC:
+        value = parse_mac(txt)
+    elif ftype == T_IPV4:
+        value = parse_ipv4(txt)
+    elif ftype == T_IPV6:
+        value = parse_ipv6(txt)
+    else:
+        # Bytes written as aa:bb:cc or a generic scapy field
+        value = txt
+
+        if ftype == T_BYTES and ':' in txt:
+            try:
+                value = ''.join([chr(int(byte, 16)) \
+                                 for byte in txt.split(':')])
+            except ValueError:
+                pass
+
+    if value is None:
+        raise FilterSyntaxError('Invalid value %r' % txt)
+
+    return value
+
+def coerce(value, literal):
+    "Convert literal to the type of value of a generic scapy field"
+    if isinstance(value, (int, long)):
+        return parse_int(literal)
+
+    return literal
+
+###############################################################################
+# Compiler
+###############################################################################
+
+TOKENS = re.compile(r'''\s*(?:
+    (?P<string>"(?:[^"\\]|\\.)*")|
+    (?P<op>==|!=|<=|>=|&&|\|\||[<>!&(){},~])|
+    (?P<word>[\w.:/-]+)
+)''', re.VERBOSE)
+
+KEYWORDS = {
+    'and' : '&&', 'or' : '||', 'not' : '!',
+    'eq' : '==', 'ne' : '!=', 'lt' : '<', 'le' : '<=', 'gt' : '>',
+    'ge' : '>=',
+}
+
+RELATIONS = {
+    '==' : operator.eq,
+    '!=' : operator.eq,
+    '<'  : operator.lt,
+    '<=' : operator.le,
+    '>'  : operator.gt,
+    '>=' : operator.ge,
+}
+
+def tokenize(expression):
+    "@return a list of (kind, text, position) tuples"
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+
+    while pos < len(expression):
+        match = TOKENS.match(expression, pos)
+
+        if not match:
+            pos = len(expression) - len(expression[pos:].lstrip())
+            raise FilterSyntaxError('Unexpected character %r' % \
+                                    expression[pos], pos)
+
+        kind = match.lastgroup
+        txt, start = match.group(kind), match.start(kind)
+
+        if kind == 'string':
+            txt = txt[1:-1].decode('string_escape')
+        elif kind == 'word' and txt.lower() in KEYWORDS:
+            kind, txt = 'op', KEYWORDS[txt.lower()]
+        elif kind == 'word' and txt.lower() in ('in', 'contains', 'matches'):
+            kind, txt = 'op', txt.lower()
+        elif kind == 'op' and txt == '~':
+            txt = 'matches'
+
+        tokens.append((kind, txt, start))
+        pos = match.end()
+
+    return tokens
+
+class Compiler(object):
+    """
+    Recursive descent parser building the closures. Every closure takes
+    (mpkt, raw, hdrs) and returns a boolean.
+
+    expr    := and ('||' and)*
+    and     := not ('&&' not)*
+    not     := '!' not | '(' expr ')' | test
+    test    := field [relation value | 'in' set | 'contains' value |
+                      'matches' string | '&' value]
+    set     := '{' value (','? value)* '}' | value
+    """
+
+    def __init__(self, expression):
+        self.tokens = tokenize(expression)
+        self.pos = 0
+        self.needs_headers = False
+
+    def compile(self):
+        if not self.tokens:
+            raise FilterSyntaxError('Empty filter')
+
+        func = self.parse_or()
+
+        if self.pos < len(self.tokens):
+            self.fail('Unexpected %r' % self.tokens[self.pos][1])
+
+        return func
+
+    def fail(self, msg):
+        if self.pos < len(self.tokens):
+            raise FilterSyntaxError(msg, self.tokens[self.pos][2])
+
+        raise FilterSyntaxError(msg)
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][:2]
+
+        return (None, None)
+
+    def next(self):
+        if self.pos >= len(self.tokens):
+            self.fail('Unexpected end of the filter')
+
+        self.pos += 1
+        return self.tokens[self.pos - 1][:2]
+
+    def accept(self, op):
+        if self.peek() == ('op', op):
+            self.pos += 1
+            return True
+
+        return False
+
+    def parse_or(self):
+        funcs = [self.parse_and()]
+
+        while self.accept('||'):
+            funcs.append(self.parse_and())
+
+        if len(funcs) == 1:
+            return funcs[0]
+
+        def any_of(mpkt, raw, hdrs):
+            for func in funcs:
+                if func(mpkt, raw, hdrs):
+                    return True
+            return False
+
+        return any_of
+
+    def parse_and(self):
+        funcs = [self.parse_not()]
+
+        while self.accept('&&'):
+            funcs.append(self.parse_not())
+
+        if len(funcs) == 1:
+            return funcs[0]
+
+        def all_of(mpkt, raw, hdrs):
+            for func in funcs:
+                if not func(mpkt, raw, hdrs):
+                    return False
+            return True
+
+        return all_of
+
+    def parse_not(self):
+        if self.accept('!'):
+            func = self.parse_not()
+            return lambda mpkt, raw, hdrs: not func(mpkt, raw, hdrs)
+
+        if self.accept('('):
+            func = self.parse_or()
+
+            if not self.accept(')'):
+                self.fail('Missing )')
+
+            return func
+
+        return self.parse_test()
+
+    def parse_field(self):
+        kind, name = self.next()
+
+        if kind != 'word':
+            self.fail('Field name expected instead of %r' % name)
+
+        name = ALIASES.get(name, name)
+
+        if name in FIELDS:
+            self.needs_headers = True
+            return FIELDS[name]
+
+        if name in LAYERS:
+            self.needs_headers = True
+            base_of = LAYERS[name]
+
+            def get(mpkt, raw, hdrs):
+                if base_of(raw, hdrs) is not None:
+                    return True
+
+            return (None, get, False)
+
+        proto, sep, field = name.partition('.')
+
+        if proto in global_trans and '.' not in field:
+            klass = global_trans[proto][0]
+
+            if not field:
+                return (None, scapy_layer(klass), False)
+
+            if field in [fld.name for fld in klass.fields_desc]:
+                return (T_ANY, scapy_field(name), False)
+
+        self.pos -= 1
+        self.fail('Unknown field %r' % name)
+
+    def parse_test(self):
+        ftype, get, multi = self.parse_field()
+        kind, op = self.peek()
+
+        if kind != 'op' or op not in RELATIONS and \
+           op not in ('in', 'contains', 'matches', '&'):
+            return self.presence(get, multi)
+
+        if ftype is None:
+            self.fail('A protocol could be only tested for presence')
+
+        self.pos += 1
+
+        if op == 'in':
+            pred = self.parse_set(ftype)
+        elif op in ('contains', 'matches'):
+            if ftype not in (T_BYTES, T_ANY):
+                self.pos -= 1
+                self.fail('%r works only with strings' % op)
+
+            if op == 'contains':
+                # Bytes could be written as aa:bb:cc like with ==
+                value = self.parse_literal(T_BYTES)
+                pred = lambda field: value in str(field)
+            else:
+                value = self.parse_literal(T_ANY)
+
+                try:
+                    search = re.compile(value).search
+                except re.error, err:
+                    self.pos -= 1
+                    self.fail('Invalid regular expression (%s)' % err)
+
+                pred = lambda field: search(str(field)) is not None
+        elif op == '&':
+            if ftype not in (T_INT, T_ANY):
+                self.pos -= 1
+                self.fail('& works only with integers')
+
+            value = self.parse_literal(T_INT)
+            pred = lambda field: bool(field & value)
+        else:
+            pred = self.parse_relation(ftype, op)
+
+        if multi:
+            def test(mpkt, raw, hdrs):
+                values = get(mpkt, raw, hdrs)
+
+                if values:
+                    for value in values:
+                        if pred(value):
+                            return True
+                return False
+        else:
+            def test(mpkt, raw, hdrs):
+                value = get(mpkt, raw, hdrs)
+                return value is not None and pred(value)
+
+        if op == '!=':
+            # True if the field is present and no value is equal
+            present = self.presence(get, multi)
+            return lambda mpkt, raw, hdrs: present(mpkt, raw, hdrs) and \
+                                           not test(mpkt, raw, hdrs)
+
+        return test
+
+    def presence(self, get, multi):
+        if multi:
+            return lambda mpkt, raw, hdrs: bool(get(mpkt, raw, hdrs))
+
+        return lambda mpkt, raw, hdrs: get(mpkt, raw, hdrs) is not None
+
+    def parse_literal(self, ftype):
+        kind, txt = self.next()
+
+        if kind not in ('word', 'string'):
+            self.pos -= 1
+            self.fail('Value expected instead of %r' % txt)
+
+        try:
+            return parse_value(ftype, (kind, txt))
+        except FilterSyntaxError, err:
+            self.pos -= 1
+            self.fail(str(err))
+
+    def parse_relation(self, ftype, op):
+        relation = RELATIONS[op]
+        value = self.parse_literal(ftype)
+
+        if ftype in (T_IPV4, T_IPV6):
+            net, mask = value
+
+            if op in ('==', '!='):
+                return lambda field: field & mask == net
+
+            if ftype == T_IPV4 and mask != 0xffffffff or \
+               ftype == T_IPV6 and mask != (1 << 128) - 1:
+                self.pos -= 1
+                self.fail('Networks could be only compared for equality')
+
+            return lambda field: relation(field, net)
+
+        if ftype == T_ANY:
+            return lambda field: relation(field, coerce(field, value))
+
+        return lambda field: relation(field, value)
+
+    def parse_set(self, ftype):
+        if not self.accept('{'):
+            values = [self.parse_literal(ftype)]
+        else:
+            values = []
+
+            while not self.accept('}'):
+                values.append(self.parse_literal(ftype))
+                self.accept(',')
+
+            if not values:
+                self.fail('Empty set')
+
+        if ftype in (T_IPV4, T_IPV6):
+            def pred(field):
+                for net, mask in values:
+                    if field & mask == net:
+                        return True
+                return False
+
+            return pred
+
+        if ftype == T_ANY:
+            return lambda field: field in [coerce(field, value) \
+                                           for value in values]
+
+        values = frozenset(values)
+        return lambda field: field in values
+
+class DisplayFilter(object):
+    """
+    A compiled display filter. Use match() to test a packet.
+
+    >>> DisplayFilter('tcp.port == 80 and ip.src in 10.0.0.0/8').expression
+    'tcp.port == 80 and ip.src in 10.0.0.0/8'
+    >>> DisplayFilter('tcp.port == ')
+    Traceback (most recent call last):
+    ...
+    FilterSyntaxError: Unexpected end of the filter
+
+    filter() returns the indexes of the matching packets:
+
+    >>> from umit.pm.backend.scapy.packet import MetaPacket
+    >>> packets = [MetaPacket(pkt) for pkt in (
+    ...   Ether(src='00:11:22:33:44:55') / IP(src='10.0.0.1', dst='10.0.0.2') /
+    ...       TCP(sport=1025, dport=80, flags='PA') / 'GET / HTTP/1.0\\r\\n',
+    ...   Ether() / IP(src='10.0.0.2', dst='10.0.0.1') /
+    ...       TCP(sport=80, dport=1025, flags='SA'),
+    ...   Ether() / IP(src='192.168.1.5', dst='8.8.8.8') /
+    ...       UDP(sport=5353, dport=53) / 'query',
+    ...   Ether() / IP(src='192.168.1.5', dst='10.0.0.1') / ICMP(),
+    ...   Ether() / ARP(op=1, psrc='192.168.1.5', pdst='192.168.1.1'),
+    ...   Ether() / IPv6(src='fe80::1', dst='2001:db8::2') /
+    ...       TCP(dport=443, flags='S'),
+    ...   Ether() / Dot1Q(vlan=10, prio=3) /
+    ...       IP(src='10.0.0.3', dst='10.0.0.4') / UDP(dport=67))]
+    >>> def test(expression):
+    ...     return DisplayFilter(expression).filter(packets)
+    >>> test('tcp'), test('arp || icmp'), test('frame.len > 60')
+    ([0, 1, 5], [3, 4], [0, 5])
+    >>> test('tcp.dport == 80'), test('tcp.port == 80'), test('tcp.port != 80')
+    ([0], [0, 1], [5])
+    >>> test('udp.dport in {53 67 68}'), test('ip.addr in 10.0.0.0/8')
+    ([2, 6], [0, 1, 3, 6])
+    >>> test('ip.src == 192.168.1.0/24 && !icmp'), test('ip.dst > 10.0.0.1')
+    ([2], [0, 6])
+    >>> test('tcp.flags.syn == 1'), test('tcp.flags & 0x10')
+    ([1, 5], [0, 1])
+    >>> test('tcp.payload contains "GET"')
+    [0]
+    >>> test('tcp.payload contains 47:45:54')
+    [0]
+    >>> test('data matches "^q.*y$"'), test('eth.src == 00:11:22:33:44:55')
+    ([2], [0])
+    >>> test('ipv6.dst == 2001:db8::/32'), test('ipv6 && tcp.dport == 443')
+    ([5], [5])
+    >>> test('vlan.id == 10 and vlan.prio == 3')
+    [6]
+    >>> test('arp.op == 1 && arp.pdst == 192.168.1.1')
+    [4]
+
+    The position of the error is saved in the pos attribute:
+
+    >>> def error(expression):
+    ...     try:
+    ...         DisplayFilter(expression)
+    ...     except FilterSyntaxError, err:
+    ...         return str(err), err.pos
+    >>> error('tcp.port == http')
+    ("Invalid value 'http'", 12)
+    >>> error('tcp.payload contains &&')
+    ("Value expected instead of '&&'", 21)
+    >>> error('tcp.dport contains "x"')
+    ("'contains' works only with strings", 10)
+    >>> error('ip.src > 10.0.0.0/8')
+    ('Networks could be only compared for equality', 9)
+    >>> error('foo.bar == 1'), error('tcp $ 1')
+    (("Unknown field 'foo.bar'", 0), ("Unexpected character '$'", 4))
+    >>> error('(tcp'), error('tcp.port eq')
+    (('Missing )', None), ('Unexpected end of the filter', None))
+    """
+
+    def __init__(self, expression):
+        """
+        @param expression the filter string
+        @raise FilterSyntaxError if the expression is not valid
+        """
+        compiler = Compiler(expression)
+
+        self.expression = expression
+        self.func = compiler.compile()
+        self.needs_headers = compiler.needs_headers
+
+    def match(self, mpkt):
+        """
+        @param mpkt a MetaPacket
+        @return True if the packet matches the filter
+        """
+        raw = mpkt.get_raw()
+
+        if self.needs_headers:
+            return self.func(mpkt, raw, get_headers(mpkt, raw))
+
+        return self.func(mpkt, raw, NO_HEADERS)
+
+    def filter(self, packets, start=0, end=None):
+        """
+        @param packets a list of MetaPacket (or a PacketStore)
+        @param start the index of the first packet to test
+        @param end the index after the last packet to test or None
+        @return the list of the indexes of the packets matching the filter
+        """
+        if end is None:
+            end = len(packets)
+
+        match = self.match
+        return [idx for idx in xrange(start, end) if match(packets[idx])]
+
+    def __str__(self):
+        return self.expression
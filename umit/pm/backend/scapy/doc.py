@@ -199,6 +199,7 @@
 </scapydoc>
 """
 
+import re
 import sys
 from xml.sax import handler, make_parser, parseString
 
@@ -282,6 +283,28 @@ class DocLoader(handler.ContentHandler):
         data = [part.lstrip(" ") for part in txt.split("\n")]
         return "\n".join(filter(None, data))
 
+LAYER_RE = re.compile(r'<proto id="(\w+)" layer="(\d+)"')
+
+def apply_layers():
+    """
+    Set only the layer of the documented protocols. This is cheap and done
+    on import while the documentation is parsed the first time it is shown.
+    """
+    all = wrapper.__dict__
+
+    for name, layer in LAYER_RE.findall(__doc__):
+        if name in all:
+            setattr(all[name], '_pm_layer', int(layer))
+
+doc_applied = False
+
 def apply_doc():
+    global doc_applied
+
+    if doc_applied:
+        return
+
+    doc_applied = True
+
     handler = DocLoader(sys.stdout)
     parseString(__doc__, handler)
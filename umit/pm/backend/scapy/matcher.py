@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Matching of the received packets against the outstanding requests.
+
+The requests are kept in a multimap indexed by their hashret() so a reply
+is checked with answers() only against the requests sharing its hash.
+Deadlines are kept in a heap and the requests are also queued in sending
+order for the non strict matching (every packet answers the oldest
+request). Removed entries are dropped lazily from the heap and the queue.
+
+Requests and replies only need the hashret() and answers() methods:
+
+>>> class Probe(object):
+...     def __init__(self, kind, seq):
+...         self.kind, self.seq = kind, seq
+...     def hashret(self):
+...         return str(self.seq)
+...     def answers(self, other):
+...         return self.kind == 'ans' and other.kind == 'req'
+>>> matcher = ReplyMatcher()
+>>> reqs = [matcher.add(Probe('req', seq), udata=seq, timeout=10, now=0)
+...         for seq in xrange(3)]
+>>> matcher.match(Probe('ans', 1)).udata, matcher.match(Probe('ans', 1))
+(1, None)
+>>> matcher.match(Probe('req', 2)) is None
+True
+>>> matcher.match(Probe('ans', 2), strict=False).udata
+0
+>>> len(matcher), matcher.next_timeout(now=4)
+(1, 6)
+>>> [req.udata for req in matcher.expire(now=10)], len(matcher)
+([2], 0)
+
+renew() adds back a removed request or waits for more replies:
+
+>>> matcher.renew(reqs[1], count=2, timeout=5, now=10)
+>>> len(matcher), matcher.next_timeout(now=12)
+(1, 3)
+>>> [matcher.match(Probe('ans', 1)).left for idx in xrange(2)], len(matcher)
+([1, 0], 0)
+>>> req = matcher.add(Probe('req', 5))
+>>> matcher.renew(req); req.left
+2
+
+With count=None a request answers every reply till it expires:
+
+>>> req = matcher.add(Probe('req', 7), udata=7, timeout=1, count=None, now=0)
+>>> [matcher.match(Probe('ans', 7)) is req for idx in xrange(3)], req.left
+([True, True, True], None)
+>>> matcher.renew(req); req.left, len(matcher)
+(None, 2)
+>>> [req.udata for req in matcher.expire(now=1)], matcher.remove(req)
+([7], False)
+>>> len(matcher), matcher.next_timeout()
+(1, None)
+"""
+
+import time
+
+from heapq import heappush, heappop, heapify
+from threading import Lock
+from collections import deque
+
+from umit.pm.core.atoms import with_decorator
+
+__all__ = ['ReplyMatcher', 'PendingRequest']
+
+class PendingRequest(object):
+    "A request waiting for its replies"
+
+    __slots__ = ('packet', 'key', 'udata', 'left', 'deadline', 'alive')
+
+    def __init__(self, packet, key, udata, left, deadline):
+        self.packet = packet
+        self.key = key
+        self.udata = udata
+
+        # Replies still expected (None for unlimited)
+        self.left = left
+        self.deadline = deadline
+        self.alive = True
+
+    def __repr__(self):
+        return '<PendingRequest %r left=%s deadline=%s>' % \
+               (self.key, self.left, self.deadline)
+
+class ReplyMatcher(object):
+    """
+    Multimap of the outstanding requests indexed by hashret(). All the
+    methods are thread safe.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+
+        self.requests = {}     # hashret -> [PendingRequest, ...]
+        self.order = deque()   # PendingRequest in sending order
+        self.deadlines = []    # heap of (deadline, seqno, PendingRequest)
+
+        self.pending = 0
+        self.seqno = 0
+
+    @with_decorator
+    def add(self, packet, udata=None, timeout=None, count=1, now=None):
+        """
+        Add a request.
+
+        @param packet the request (with hashret() and answers() methods)
+        @param udata user data kept in the returned object
+        @param timeout seconds after which the request expires or None
+        @param count number of replies expected (None for unlimited)
+        @param now the current time (defaults to time.time())
+        @return a PendingRequest
+        """
+        key = packet.hashret()
+        req = PendingRequest(packet, key, udata, count, None)
+
+        self.requests.setdefault(key, []).append(req)
+        self.order.append(req)
+        self.pending += 1
+
+        if timeout is not None:
+            self.__set_deadline(req, timeout, now)
+
+        return req
+
+    @with_decorator
+    def renew(self, req, count=1, timeout=None, now=None):
+        """
+        Wait for count more replies to req (for example when the same packet
+        is sent again). Removed requests are added back.
+
+        @param timeout the new timeout or None to leave the deadline as is
+        """
+        if not req.alive:
+            req.alive = True
+            req.left = count
+
+            self.requests.setdefault(req.key, []).append(req)
+            self.order.append(req)
+            self.pending += 1
+
+        elif req.left is not None:
+            req.left += count
+
+        if timeout is not None:
+            self.__set_deadline(req, timeout, now)
+
+    def __set_deadline(self, req, timeout, now):
+        # Stale heap entries are detected comparing the deadline
+        req.deadline = (now is None and time.time() or now) + timeout
+
+        self.seqno += 1
+        heappush(self.deadlines, (req.deadline, self.seqno, req))
+
+    @with_decorator
+    def match(self, reply, strict=True):
+        """
+        Look up the request answered by reply. In strict mode the request
+        must have the same hashret() and reply.answers() must hold while in
+        non strict mode the oldest request is returned.
+
+        @return the PendingRequest answered (its left attribute is already
+                decremented) or None
+        """
+        if strict:
+            lst = self.requests.get(reply.hashret())
+
+            if not lst:
+                return None
+
+            for req in lst:
+                if reply.answers(req.packet):
+                    break
+            else:
+                return None
+        else:
+            order = self.order
+
+            while order and not order[0].alive:
+                order.popleft()
+
+            if not order:
+                return None
+
+            req = order[0]
+
+        if req.left is not None:
+            req.left -= 1
+
+            if req.left <= 0:
+                self.__remove(req)
+
+        return req
+
+    def __remove(self, req):
+        req.alive = False
+        self.pending -= 1
+
+        lst = self.requests[req.key]
+        lst.remove(req)
+
+        if not lst:
+            del self.requests[req.key]
+
+        # Compact the lazily cleaned containers when mostly dead
+        if len(self.order) > 2 * self.pending + 1024:
+            self.order = deque([r for r in self.order if r.alive])
+
+        if len(self.deadlines) > 2 * self.pending + 1024:
+            self.deadlines = [item for item in self.deadlines \
+                              if item[2].alive and item[2].deadline == item[0]]
+            heapify(self.deadlines)
+
+    @with_decorator
+    def remove(self, req):
+        "Remove a request. @return False if it was already removed"
+        if not req.alive:
+            return False
+
+        self.__remove(req)
+        return True
+
+    @with_decorator
+    def expire(self, now=None):
+        """
+        Remove the requests whose deadline is passed.
+        @return the list of expired PendingRequest
+        """
+        if now is None:
+            now = time.time()
+
+        expired = []
+        heap = self.deadlines
+
+        while heap and heap[0][0] <= now:
+            deadline, seqno, req = heappop(heap)
+
+            if req.alive and req.deadline == deadline:
+                self.__remove(req)
+                expired.append(req)
+
+                # __remove() could have rebuilt the heap
+                heap = self.deadlines
+
+        return expired
+
+    @with_decorator
+    def next_timeout(self, now=None):
+        "@return the seconds till the next deadline or None"
+        heap = self.deadlines
+
+        while heap and (not heap[0][2].alive or \
+                        heap[0][2].deadline != heap[0][0]):
+            heappop(heap)
+
+        if not heap:
+            return None
+
+        if now is None:
+            now = time.time()
+
+        return max(0, heap[0][0] - now)
+
+    @with_decorator
+    def clear(self):
+        for req in self.order:
+            req.alive = False
+
+        self.requests.clear()
+        self.order.clear()
+        self.deadlines = []
+        self.pending = 0
+
+    def __len__(self):
+        return self.pending
@@ -18,7 +18,28 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
+"""
+MetaPacket caches the serialized bytes and the layers of the packet. The
+cache is dropped by the methods modifying the packet:
+
+>>> mpkt = MetaPacket(Ether() / IP(dst='10.0.0.1', ttl=64) / TCP())
+>>> ord(mpkt.get_raw()[22]), mpkt.getlayer(IP) is mpkt.getlayer(IP)
+(64, True)
+>>> mpkt.set_field('ip.ttl', 5)
+>>> ord(mpkt.get_raw()[22]), ord(mpkt.get_raw_layer(IP)[8])
+(5, 5)
+
+The layers returned by getlayer() and get_protocols() are the ones of the
+packet. After modifying them directly invalidate() must be called:
+
+>>> mpkt.getlayer(IP).ttl = 7
+>>> mpkt.invalidate()
+>>> ord(mpkt.get_raw()[22]), ord(mpkt.get_raw_layer(IP)[8])
+(7, 7)
+"""
+
 from datetime import datetime
+from time import localtime, strftime
 
 from umit.pm.core.logger import log
 from umit.pm.core.atoms import generate_traceback
@@ -32,9 +53,41 @@ from umit.pm.backend.scapy.wrapper import *
 
 
 class MetaPacket(object):
+    # Captures could easily contain millions of packets so we avoid the
+    # per instance __dict__ to keep the memory footprint low.
+    __slots__ = ('_root', '_raw', '_llcls', '_time', '_cache', '_cfields',
+                 '_edited', 'flags',
+                 'l2_proto', 'l2_src', 'l2_dst', 'l2_len',
+                 'l3_src', 'l3_dst', 'l3_proto', 'l3_len',
+                 'l4_src', 'l4_dst', 'l4_ack', 'l4_seq', 'l4_flags',
+                 'l4_proto', 'l4_len',
+                 'payload_len',
+                 'inject', 'inject_len', 'inj_delta',
+                 'data', 'data_len',
+                 'session', 'context')
+
     def __init__(self, proto=None, cfields=None, flags=0):
-        self.root = proto
-        self.cfields = cfields or {}
+        # A packet created with new_lazy() holds only the raw bytes, the link
+        # layer class and the timestamp (_raw, _llcls, _time). The scapy tree
+        # is created the first time root is accessed.
+        self._raw = None
+        self._llcls = None
+        self._time = None
+
+        # The cache is lazily created by __get_cache() and holds the
+        # serialized bytes of the packet and of its layers together with the
+        # layers resolved through global_trans. It's dropped every time the
+        # packet is modified with the methods of this class (set_field,
+        # reset_field & co.). If you modify the scapy tree directly remember
+        # to call invalidate().
+        self._cache = None
+        self._root = proto
+
+        # Set by invalidate(). Containers paging packets in and out (like
+        # PacketStore) use it to keep the packets modified after loading.
+        self._edited = False
+
+        self._cfields = cfields or None
         self.flags = flags
 
         self.l2_proto = None
@@ -67,11 +120,115 @@ class MetaPacket(object):
         self.session = None
         self.context = None
 
+    def get_root(self):
+        if self._root is None and self._raw is not None:
+            self.__dissect()
+
+        return self._root
+
+    def set_root(self, proto):
+        self._root = proto
+        self._raw = None
+        self.invalidate()
+
+    def get_cfields(self):
+        if self._cfields is None:
+            self._cfields = {}
+
+        return self._cfields
+
+    def set_cfields(self, cfields):
+        self._cfields = cfields
+
+    root = property(get_root, set_root)
+    cfields = property(get_cfields, set_cfields)
+
+    def is_edited(self):
+        """
+        @return True if the packet was modified after its creation
+        """
+        return self._edited
+
+    def is_dissected(self):
+        """
+        @return False if the packet is still waiting to be dissected
+        """
+        return self._raw is None
+
+    def get_llclass(self):
+        """
+        @return the scapy class of the link layer
+        """
+        if self._raw is not None:
+            return self._llcls
+
+        return self.root.__class__
+
+    def __dissect(self):
+        try:
+            proto = self._llcls(self._raw)
+        except Exception, err:
+            log.debug('Dissection failed (%s). Falling back to Raw' % str(err))
+            proto = Raw(self._raw)
+
+        proto.time = self._time
+
+        # The captured bytes are still valid till the first modification
+        self._root = proto
+        self.__get_cache()['raw'] = self._raw
+        self._raw = None
+
+    def invalidate(self):
+        """
+        Drop the cached raw bytes and the resolved layers. This is called
+        automatically by the methods that modify the packet and should be
+        called manually only after modifying the scapy tree directly.
+        The packet is also marked as edited (@see is_edited).
+        """
+        self._cache = None
+        self._edited = True
+
+    def __get_cache(self):
+        if self._cache is None:
+            self._cache = {}
+
+        return self._cache
+
+    def __resolve_layer(self, proto_name):
+        """
+        @param proto_name a protocol name registered in global_trans
+        @return the layer instance or None if not present
+        """
+        cache = self.__get_cache()
+        key = ('proto', proto_name)
+
+        try:
+            return cache[key]
+        except KeyError:
+            layer = self.root.getlayer(global_trans[proto_name][0])
+            cache[key] = layer
+            return layer
+
+    def __get_raw_of(self, layer):
+        if layer is self.root:
+            return self.get_raw()
+
+        cache = self.__get_cache()
+        key = ('raw', id(layer))
+
+        try:
+            return cache[key]
+        except KeyError:
+            raw = str(layer)
+            cache[key] = raw
+            return raw
+
     def set_data_len(self, length):
         """
         This is used from the injection engine to set the correct payload
         string to transport protocols like TCP or UDP
         """
+        self.invalidate()
         value = self.data[:length]
 
         if self.l4_proto == NL_TYPE_TCP:
@@ -103,9 +260,53 @@ class MetaPacket(object):
             return None
 
     @classmethod
-    def new_from_str(cls, proto_name, raw):
+    def new_lazy(cls, raw, llcls, timestamp, flags=0):
+        """
+        Create a MetaPacket that will be dissected only on demand
+
+        @param raw the captured bytes
+        @param llcls the scapy class of the link layer
+        @param timestamp the capture timestamp
+        @param flags the MPKT_* flags
+        @return a MetaPacket
+        """
+        mpkt = MetaPacket(flags=flags)
+        mpkt._raw = raw
+        mpkt._llcls = llcls
+        mpkt._time = timestamp
+
+        return mpkt
+
+    @classmethod
+    def new_from_pcap(cls, reader, flags=0):
+        """
+        Read the next packet from a PcapReader object without dissecting it
+
+        @param reader a PcapReader or PcapStreamReader instance
+        @param flags the MPKT_* flags
+        @return a MetaPacket or None on EOF (or if no packet is available)
+        """
+        if isinstance(reader, RawPcapReader):
+            ret = RawPcapReader.read_packet(reader)
+        else:
+            ret = reader.read_raw_packet()
+
+        if ret is None:
+            return None
+
+        raw, (sec, usec, wirelen) = ret
+
+        return MetaPacket.new_lazy(raw, reader.LLcls, sec + 0.000001 * usec,
+                                   flags)
+
+    @classmethod
+    def new_from_str(cls, proto_name, raw, timestamp=None):
         try:
             klass = global_trans[proto_name][0]
+
+            if timestamp is not None:
+                return MetaPacket.new_lazy(raw, klass, timestamp)
+
             return MetaPacket(klass(raw))
         except:
             log.error('Could not create %s MetaPacket from %s' % \
@@ -122,6 +323,8 @@ class MetaPacket(object):
             return None
 
     def insert(self, proto, layer):
+        self.invalidate()
+
         if layer == -1:
             # Append
             packet = self.root / proto.root
@@ -162,6 +365,8 @@ class MetaPacket(object):
         return False
 
     def remove(self, rproto):
+        self.invalidate()
+
         first = None
         last = self.root
 
@@ -184,44 +389,47 @@ class MetaPacket(object):
         return False
 
     def get_size(self):
-        return len(str(self.root))
+        return len(self.get_raw())
 
     def summary(self):
         return self.root.summary()
 
     def get_datetime(self):
-        return datetime.fromtimestamp(self.root.time)
+        return datetime.fromtimestamp(self.get_rawtime())
 
     def get_rawtime(self):
+        if self._raw is not None:
+            return self._time
+
         return self.root.time
 
     def get_time(self):
-        #self.root.time
-        return self.root.sprintf("%.time%")
+        # Same format of sprintf("%.time%") without dissecting the packet
+        ts = self.get_rawtime()
+        return strftime("%H:%M:%S.%%06i", localtime(ts)) % \
+               int((ts - int(ts)) * 1000000)
 
     def get_source(self):
-        ip = self.root.sprintf("{IP:%IP.src%}")
-        hw = self.root.sprintf("{Ether:%Ether.src%}")
-
-        if ip:
-            return ip
-
-        if hw:
-            return hw
+        cache = self.__get_cache()
 
-        return "N/A"
+        try:
+            return cache['src']
+        except KeyError:
+            ret = self.root.sprintf("{IP:%IP.src%}") or \
+                  self.root.sprintf("{Ether:%Ether.src%}") or "N/A"
+            cache['src'] = ret
+            return ret
 
     def get_dest(self):
-        ip = self.root.sprintf("{IP:%IP.dst%}")
-        hw = self.root.sprintf("{Ether:%Ether.dst%}")
-
-        if ip:
-            return ip
-
-        if hw:
-            return hw
+        cache = self.__get_cache()
 
-        return "N/A"
+        try:
+            return cache['dst']
+        except KeyError:
+            ret = self.root.sprintf("{IP:%IP.dst%}") or \
+                  self.root.sprintf("{Ether:%Ether.dst%}") or "N/A"
+            cache['dst'] = ret
+            return ret
 
     def get_protocol_str(self):
         proto = self.root
@@ -252,17 +460,79 @@ class MetaPacket(object):
     def get_protocol_bounds(self, proto_inst):
         "@return a tuple (start, len)"
 
-        start = 0
-        proto = self.root
+        layout = self.get_layer_layout(proto_inst)
 
-        while isinstance(proto, Packet):
-            if isinstance(proto, NoPayload):
-                return None
-            elif proto_inst is proto:
-                return start, start + get_proto_size(proto_inst) / 8
+        if layout is None:
+            return None
 
-            start += get_proto_size(proto) / 8
-            proto = proto.payload
+        return layout[:2]
+
+    def get_layer_layout(self, proto_inst):
+        """
+        @param proto_inst a layer of this packet
+        @return a tuple (start, end, offsets) where start and end are the
+                bounds of the layer in bytes and offsets maps the id() of
+                its fields to their offset in bits from the start of the
+                packet, or None if proto_inst is not a layer of the packet
+
+        >>> mpkt = MetaPacket(Ether() / IP() / TCP() / Raw('hello'))
+        >>> layers = [mpkt.root]
+        >>> while not isinstance(layers[-1].payload, NoPayload):
+        ...     layers.append(layers[-1].payload)
+        >>> [mpkt.get_protocol_bounds(proto) for proto in layers]
+        [(0, 14), (14, 34), (34, 54), (54, 59)]
+        >>> offsets = mpkt.get_layer_layout(layers[2])[2]
+        >>> [offsets[id(field)] for field in layers[2].fields_desc[:3]]
+        [272, 288, 304]
+        >>> mpkt.get_layer_layout(Raw('hello')) is None
+        True
+
+        The layout is computed again once the packet is modified:
+
+        >>> mpkt.set_field('ip.options', [IPOption('\\x01\\x01\\x01\\x01')])
+        >>> [mpkt.get_protocol_bounds(proto) for proto in layers]
+        [(0, 14), (14, 38), (38, 58), (58, 63)]
+        >>> get_field_offset(mpkt, layers[2], layers[2].fields_desc[0])
+        304
+        """
+        cache = self.__get_cache()
+
+        try:
+            layouts = cache['layouts']
+        except KeyError:
+            # The layout of all the layers is calculated at once. Only the
+            # variable fields are measured, the others come from the
+            # layout table of the protocol class.
+            layouts = {}
+            start = 0
+            bits = 0
+            proto = self.root
+
+            while isinstance(proto, Packet) and \
+                  not isinstance(proto, NoPayload):
+                sizes = get_proto_layout(proto)[0]
+                offsets = {}
+                size = 0
+
+                for field in proto.fields_desc:
+                    offsets[id(field)] = bits + size
+                    fsize = sizes.get(id(field), None)
+
+                    if fsize is None:
+                        fsize = get_field_size(proto, field)
+
+                    size += fsize
+
+                end = start + size / 8
+                layouts[id(proto)] = (start, end, offsets)
+
+                start = end
+                bits += size
+                proto = proto.payload
+
+            cache['layouts'] = layouts
+
+        return layouts.get(id(proto_inst), None)
 
     def reset(self, protocol=None, startproto=None, field=None):
         """
@@ -274,6 +544,8 @@ class MetaPacket(object):
         @return True if reset is ok or False
         """
 
+        self.invalidate()
+
         protocol_found = False
         current = (startproto is not None) and (startproto) or (self.root)
 
@@ -324,13 +596,36 @@ class MetaPacket(object):
         return bool(self.root.haslayer(layer))
 
     def getlayer(self, layer):
-        return self.root.getlayer(layer)
+        """
+        @param layer a scapy class
+        @return the layer of the packet (not a copy). Call invalidate()
+                after modifying it directly.
+        """
+        cache = self.__get_cache()
+        key = ('layer', layer)
+
+        try:
+            return cache[key]
+        except KeyError:
+            ret = self.root.getlayer(layer)
+            cache[key] = ret
+            return ret
 
     def get_raw(self):
-        return str(self.root)
+        if self._raw is not None:
+            return self._raw
+
+        cache = self.__get_cache()
+
+        try:
+            return cache['raw']
+        except KeyError:
+            raw = str(self.root)
+            cache['raw'] = raw
+            return raw
 
     def get_raw_layer(self, layer):
-        return str(self.getlayer(layer))
+        return self.__get_raw_of(self.getlayer(layer))
 
     def rebuild_from_raw_payload(self, newpayload):
         log.debug('Rebuilding packet starting from %s' % \
@@ -355,7 +650,8 @@ class MetaPacket(object):
     def reset_field(self, fieldname):
         try:
             ret = fieldname.split('.')
-            layer = self.root.getlayer(global_trans[ret[0]][0])
+            layer = self.__resolve_layer(ret[0])
+            self.invalidate()
 
             if not layer:
                 return None
@@ -372,7 +668,8 @@ class MetaPacket(object):
 
     def set_fields(self, proto, dict):
         try:
-            layer = self.root.getlayer(global_trans[proto][0])
+            layer = self.__resolve_layer(proto)
+            self.invalidate()
 
             if not layer:
                 return None
@@ -394,7 +691,8 @@ class MetaPacket(object):
 
         try:
             ret = fieldname.split('.')
-            layer = self.root.getlayer(global_trans[ret[0]][0])
+            layer = self.__resolve_layer(ret[0])
+            self.invalidate()
 
             if not layer:
                 return None
@@ -418,7 +716,7 @@ class MetaPacket(object):
 
     def get_fields(self, proto, tup):
         try:
-            layer = self.root.getlayer(global_trans[proto][0])
+            layer = self.__resolve_layer(proto)
 
             if not layer:
                 return (None, ) * len(tup)
@@ -443,7 +741,7 @@ class MetaPacket(object):
     def get_field(self, fieldname, default=None):
         try:
             ret = fieldname.split('.')
-            layer = self.root.getlayer(global_trans[ret[0]][0])
+            layer = self.__resolve_layer(ret[0])
 
             if not layer:
                 return default
@@ -462,14 +760,17 @@ class MetaPacket(object):
 
                 return val
             else:
-                return str(layer)
+                return self.__get_raw_of(layer)
         except Exception, err:
             log.error('Error while getting %s field. Traceback:' % fieldname)
             log.error(generate_traceback())
             return default
 
     def copy(self, full=False):
-        if self.root:
+        if self._raw is not None:
+            cpy = MetaPacket.new_lazy(self._raw, self._llcls, self._time)
+            cpy.cfields = self.cfields.copy()
+        elif self.root:
             cpy = MetaPacket(self.root.copy(),
                              self.cfields.copy())
         if full:
@@ -503,6 +804,7 @@ class MetaPacket(object):
         return cpy
 
     def add_to(self, aft_proto, mpkt):
+        self.invalidate()
         self.root[global_trans[aft_proto][0]].payload = mpkt.root
 
     # Custom fields
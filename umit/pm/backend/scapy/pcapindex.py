@@ -0,0 +1,874 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Random access to pcap and pcapng files (also gzipped).
+
+The file is scanned once to build an index with the position, the length
+and the timestamp of every record. The index is saved in a sidecar file
+(capture name plus .pmidx) and loaded back the next time the capture is
+opened if the capture is not changed. Packets are then read and dissected
+only when they are requested.
+
+>>> import os, gzip, shutil, tempfile
+>>> from struct import pack
+>>> tmpdir = tempfile.mkdtemp(prefix='pm-test-')
+>>> frames = ['\\x00' * 12 + '\\x08\\x06' + chr(idx) * (idx * 10)
+...           for idx in xrange(5)]
+
+A little endian pcap with microsecond timestamps and its gzipped copy:
+
+>>> fname = os.path.join(tmpdir, 'test.pcap')
+>>> f = open(fname, 'wb')
+>>> f.write(pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+>>> for idx, frame in enumerate(frames):
+...     f.write(pack('<IIII', 1000 + idx, 500000, len(frame), len(frame)))
+...     f.write(frame)
+>>> f.close()
+>>> def gzip_write(fname, data):
+...     f = gzip.open(fname, 'wb')
+...     f.write(data)
+...     f.close()
+>>> gzip_write(fname + '.gz', open(fname, 'rb').read())
+>>> index = PcapIndex.open(fname)
+>>> len(index), index.linktypes, list(index.timestamps[:2])
+(5, [1], [1000.5, 1001.5])
+>>> os.path.exists(fname + SIDECAR_EXT), len(PcapIndex.load(fname))
+(True, 5)
+>>> for name in (fname, fname + '.gz'):
+...     pktlist = PcapPacketList(name, PcapIndex.open(name, sidecar=False))
+...     print [mpkt.get_raw() == frames[idx]
+...            for idx, mpkt in [(3, pktlist[3]), (1, pktlist[1]),
+...                              (4, pktlist[-1])]], pktlist[2] is pktlist[2]
+...     print [len(mpkt.get_raw()) for mpkt in pktlist.stream(2)]
+...     pktlist.close()
+[True, True, True] True
+[34, 44, 54]
+[True, True, True] True
+[34, 44, 54]
+
+The sidecar is not used once the capture is changed. A truncated last
+record is dropped:
+
+>>> f = open(fname, 'r+b'); f.truncate(os.path.getsize(fname) - 1); f.close()
+>>> PcapIndex.load(fname) is None, len(PcapIndex.open(fname))
+(True, 4)
+
+Seeks in a gzip file restart from the nearest checkpoint:
+
+>>> import random
+>>> rnd = random.Random(1)
+>>> data = ''.join([chr(rnd.randrange(256)) for idx in xrange(300000)])
+>>> gzip_write(fname + '.gz', data)
+>>> gzf = GzipSeekableFile(fname + '.gz', spacing=65536)
+>>> gzf.seek(250000); gzf.read(10) == data[250000:250010]
+True
+>>> gzf.seek(70000); gzf.read(10) == data[70000:70010], len(gzf.points) > 1
+(True, True)
+>>> gzf.seek(299995); gzf.read(10) == data[299995:], gzf.read()
+(True, '')
+>>> gzf.close()
+
+A pcapng with two interfaces, the second one with nanosecond timestamps,
+an enhanced and a simple packet block:
+
+>>> def block(btype, body):
+...     body += '\\x00' * (-len(body) % 4)
+...     return pack('<II', btype, len(body) + 12) + body + \\
+...            pack('<I', len(body) + 12)
+>>> fname = os.path.join(tmpdir, 'test.pcapng')
+>>> f = open(fname, 'wb')
+>>> f.write(block(NG_SHB, pack('<IHHq', 0x1a2b3c4d, 1, 0, -1)))
+>>> f.write(block(NG_IDB, pack('<HHI', 1, 0, 65535)))
+>>> f.write(block(NG_IDB, pack('<HHIHHB3xI', 101, 0, 65535, 9, 1, 9, 0)))
+>>> f.write(block(NG_EPB, pack('<IIIII', 1, 0, 2500000000, 5, 5) + 'abcde'))
+>>> f.write(block(NG_SPB, pack('<I', 14) + frames[0][:14]))
+>>> f.close()
+>>> index = PcapIndex.open(fname, sidecar=False)
+>>> index.linktypes, list(index.ifaces), list(index.timestamps)
+([1, 101], [1, 0], [2.5, 2.5])
+>>> pktlist = PcapPacketList(fname, index)
+>>> pktlist[0].get_raw(), pktlist[1].get_raw() == frames[0][:14]
+('abcde', True)
+>>> pktlist.close()
+
+A packet block too short to hold its header is a corrupted capture:
+
+>>> f = open(fname, 'wb')
+>>> f.write(block(NG_SHB, pack('<IHHq', 0x1a2b3c4d, 1, 0, -1)))
+>>> f.write(block(NG_IDB, pack('<HHI', 1, 0, 65535)))
+>>> f.write(pack('<IIIIIII', NG_EPB, 28, 0, 0, 0, 5, 5)); f.close()
+>>> PcapIndex.open(fname, sidecar=False)
+Traceback (most recent call last):
+  ...
+IOError: [Errno 0] Bad pcapng block length
+
+The cfields set on the streamed packets (by the audits) are kept. Viewing
+the whole capture doesn't pin the packets, only the edited ones are:
+
+>>> from umit.pm.backend.scapy.wrapper import Ether, IP
+>>> fname = os.path.join(tmpdir, 'big.pcap')
+>>> f = open(fname, 'wb')
+>>> f.write(pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+>>> for idx in xrange(PAGE_CACHE_SIZE + 100):
+...     frame = str(Ether() / IP(id=idx))
+...     f.write(pack('<IIII', idx, 0, len(frame), len(frame)) + frame)
+>>> f.close()
+>>> pktlist = PcapPacketList(fname, PcapIndex.open(fname, sidecar=False))
+>>> first = pktlist[0]
+>>> for mpkt in pktlist.stream():
+...     if mpkt.get_field('ip.id') % 500 == 0:
+...         mpkt.cfields['username'] = 'guest'
+>>> sorted(pktlist.annotations), first.cfields
+([0, 500, 1000], {'username': 'guest'})
+>>> def dissect_all(pktlist):
+...     return len([mpkt for mpkt in pktlist if mpkt.get_field('ip.id') > -1])
+>>> dissect_all(pktlist), len(pktlist.pinned)
+(1124, 0)
+>>> pktlist[3].set_field('ip.ttl', 5)
+>>> dissect_all(pktlist), pktlist.pinned.keys(), pktlist[3].get_field('ip.ttl')
+(1124, [3], 5)
+>>> pktlist[500] is not pktlist[1000], pktlist[500].cfields
+(True, {'username': 'guest'})
+>>> pktlist.close()
+>>> shutil.rmtree(tmpdir)
+"""
+
+import os
+import sys
+import zlib
+import struct
+
+from bisect import bisect
+
+from array import array
+from threading import Lock
+from collections import deque
+
+from umit.pm.core.logger import log
+from umit.pm.backend.scapy.packet import MetaPacket
+from umit.pm.backend.scapy.wrapper import conf, Raw
+
+__all__ = ['PcapIndex', 'PcapPacketList', 'GzipSeekableFile']
+
+# How many bytes are read at once while scanning
+SCAN_CHUNK = 1024 * 1024
+
+# Uncompressed bytes between two checkpoints of a gzip file
+GZIP_SPACING = 4 * 1024 * 1024
+
+# How many packets not dissected are kept alive
+PAGE_CACHE_SIZE = 1024
+
+SIDECAR_EXT = '.pmidx'
+SIDECAR_MAGIC = 'PMPCAPIX'
+SIDECAR_VERSION = 1
+
+# magic, version, little endian, capture size, capture mtime, records,
+# interfaces
+SIDECAR_HEADER = struct.Struct('!8sHBQdII')
+
+PCAP_MAGICS = {
+    '\xa1\xb2\xc3\xd4' : ('>', False),
+    '\xd4\xc3\xb2\xa1' : ('<', False),
+    '\xa1\xb2\x3c\x4d' : ('>', True),
+    '\x4d\x3c\xb2\xa1' : ('<', True),
+}
+
+# pcapng block types
+NG_SHB, NG_IDB, NG_PB, NG_SPB, NG_EPB = 0x0A0D0D0A, 1, 2, 3, 6
+
+class GzipSeekableFile(object):
+    """
+    Read only file object over a gzip file supporting fast seeks.
+
+    The state of the decompressor is saved every GZIP_SPACING bytes of
+    output the first time they are read so a seek restarts decompressing
+    from the nearest checkpoint instead of the start of the file.
+    Concatenated gzip members are supported.
+    """
+
+    def __init__(self, fname, spacing=None, points=None):
+        """
+        @param fname the gzip file
+        @param spacing the bytes between two checkpoints
+        @param points the checkpoints of another GzipSeekableFile on fname
+        """
+        self.f = open(fname, 'rb')
+        self.spacing = spacing or GZIP_SPACING
+
+        # (uncompressed offset, compressed offset, decompressor)
+        self.points = points or [(0, 0, self.__new_decompressor())]
+
+        self.pos = 0
+        self.eof = False
+        self.__restart(self.points[0])
+
+    def __new_decompressor(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def __restart(self, point):
+        uoff, coff, dobj = point
+
+        self.uoff = uoff
+        self.coff = coff
+        self.dobj = dobj.copy()
+        self.buffer = ''
+        self.finished = False
+
+    def __advance(self):
+        "Decompress the next chunk. @return False at the end of the file"
+
+        if self.finished:
+            return False
+
+        self.f.seek(self.coff)
+        data = self.f.read(65536)
+
+        if not data:
+            self.finished = self.eof = True
+            return False
+
+        self.coff += len(data)
+        output = []
+
+        while data:
+            try:
+                output.append(self.dobj.decompress(data))
+            except zlib.error:
+                # Trailing garbage after the last member
+                self.finished = self.eof = True
+                break
+
+            data = self.dobj.unused_data
+
+            if data:
+                self.dobj = self.__new_decompressor()
+
+        self.uoff += len(self.buffer)
+        self.buffer = ''.join(output)
+
+        end = self.uoff + len(self.buffer)
+
+        if not self.finished and end - self.points[-1][0] >= self.spacing:
+            self.points.append((end, self.coff, self.dobj.copy()))
+
+        return True
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            raise IOError('Seek from the end not supported on gzip files')
+
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def compressed_tell(self):
+        "@return the position in the compressed file"
+        return self.coff
+
+    def read(self, size=-1):
+        pos = self.pos
+
+        # Nearest checkpoint before pos
+        point = self.points[bisect(self.points, (pos, sys.maxint)) - 1]
+
+        # Go back or jump forward skipping what is already indexed
+        if pos < self.uoff or point[0] > self.uoff + len(self.buffer):
+            self.__restart(point)
+
+        output = []
+
+        while size < 0 or size > 0:
+            start = pos - self.uoff
+
+            if start < len(self.buffer):
+                if size < 0:
+                    chunk = self.buffer[start:]
+                else:
+                    chunk = self.buffer[start:start + size]
+                    size -= len(chunk)
+
+                output.append(chunk)
+                pos += len(chunk)
+
+                if size == 0:
+                    break
+
+            if not self.__advance():
+                break
+
+        self.pos = pos
+        return ''.join(output)
+
+    def close(self):
+        self.f.close()
+        self.points = []
+        self.buffer = ''
+
+def open_capture(fname, points=None):
+    """
+    @param points the checkpoints to use if fname is a gzip file
+    @return a seekable file object for the uncompressed capture
+    """
+
+    f = open(fname, 'rb')
+
+    if f.read(2) == '\x1f\x8b':
+        f.close()
+        # Every file object extends its own list of checkpoints
+        return GzipSeekableFile(fname, points=points and list(points))
+
+    f.seek(0)
+    return f
+
+class Scanner(object):
+    "Sequential reader used to build the index"
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ''
+        self.base = 0
+        self.pos = 0
+
+    def peek(self, size):
+        "@return size bytes at the current position or less at the end"
+        start = self.pos - self.base
+
+        if start + size > len(self.buffer):
+            self.buffer = self.buffer[start:] + \
+                          self.f.read(max(SCAN_CHUNK, size))
+            self.base = self.pos
+            start = 0
+
+        return self.buffer[start:start + size]
+
+    def skip(self, size):
+        self.pos += size
+
+        if self.pos - self.base > len(self.buffer):
+            self.buffer = ''
+            self.base = self.pos
+            self.f.seek(self.pos)
+
+class PcapIndex(object):
+    """
+    Index of the records of a pcap or pcapng capture. For every packet the
+    position and the length of the captured bytes, the timestamp and the
+    interface are stored in arrays.
+    """
+
+    def __init__(self):
+        self.offsets = array('d')
+        self.lengths = array('I')
+        self.timestamps = array('d')
+        self.ifaces = array('H')
+
+        # The linktype of every interface (only one for pcap)
+        self.linktypes = []
+
+        # Checkpoints of the gzip file created while scanning
+        self.points = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def open(cls, fname, callback=None, sidecar=True):
+        """
+        Load the index from the sidecar file or build it scanning the
+        capture.
+
+        @param fname the capture file
+        @param callback a callable called while scanning with the number of
+                        bytes of the capture read and the number of packets
+        @param sidecar False to not use the sidecar file
+        @return a PcapIndex
+        """
+        index = None
+
+        if sidecar:
+            index = cls.load(fname)
+
+        if index is None:
+            index = cls.build(fname, callback)
+
+            if sidecar:
+                index.save(fname)
+
+        return index
+
+    @classmethod
+    def build(cls, fname, callback=None):
+        """
+        Scan the capture
+        @return a PcapIndex
+        @raise IOError if the file is not in pcap or pcapng format
+        """
+        index = cls()
+        f = open_capture(fname)
+
+        try:
+            scanner = Scanner(f)
+            magic = scanner.peek(4)
+
+            try:
+                if magic in PCAP_MAGICS:
+                    index.__scan_pcap(scanner, callback)
+                elif magic == '\x0a\x0d\x0d\x0a':
+                    index.__scan_pcapng(scanner, callback)
+                else:
+                    raise IOError(0, 'Unknown file format')
+            except (IndexError, struct.error):
+                # Packets of interfaces not described or truncated blocks
+                raise IOError(0, 'Corrupted capture file')
+
+            # Drop a truncated last record
+            if index.offsets:
+                f.seek(int(index.offsets[-1]))
+
+                if len(f.read(index.lengths[-1])) < index.lengths[-1]:
+                    for arr in (index.offsets, index.lengths,
+                                index.timestamps, index.ifaces):
+                        arr.pop()
+
+            if isinstance(f, GzipSeekableFile):
+                index.points = f.points
+        finally:
+            f.close()
+
+        return index
+
+    def __progress(self, scanner, callback):
+        getpos = getattr(scanner.f, 'compressed_tell', scanner.f.tell)
+        callback(getpos(), len(self.offsets))
+
+    def __scan_pcap(self, scanner, callback):
+        hdr = scanner.peek(24)
+
+        if len(hdr) < 24:
+            raise IOError(0, 'Truncated pcap header')
+
+        endian, nsec = PCAP_MAGICS[hdr[:4]]
+        self.linktypes.append(struct.unpack(endian + 'I', hdr[20:24])[0])
+
+        scanner.skip(24)
+
+        record = struct.Struct(endian + 'IIII')
+        divisor = nsec and 1000000000.0 or 1000000.0
+
+        peek, skip = scanner.peek, scanner.skip
+        offsets, lengths = self.offsets.append, self.lengths.append
+        timestamps, ifaces = self.timestamps.append, self.ifaces.append
+
+        while True:
+            data = peek(16)
+
+            if len(data) < 16:
+                break
+
+            sec, frac, caplen, wirelen = record.unpack(data)
+
+            offsets(scanner.pos + 16)
+            lengths(caplen)
+            timestamps(sec + frac / divisor)
+            ifaces(0)
+
+            skip(16 + caplen)
+
+            if callback and len(self.offsets) % 10000 == 0:
+                self.__progress(scanner, callback)
+
+    def __scan_pcapng(self, scanner, callback):
+        peek, skip = scanner.peek, scanner.skip
+
+        endian = '<'
+        section = []       # interfaces of the current section
+        resolutions = []   # timestamp units per second of every interface
+
+        while True:
+            data = peek(12)
+
+            if len(data) < 12:
+                break
+
+            if data[:4] == '\x0a\x0d\x0d\x0a':
+                if data[8:12] == '\x1a\x2b\x3c\x4d':
+                    endian = '>'
+                elif data[8:12] == '\x4d\x3c\x2b\x1a':
+                    endian = '<'
+                else:
+                    raise IOError(0, 'Bad pcapng byte order magic')
+
+                section = []
+
+            btype, blen = struct.unpack(endian + 'II', data[:8])
+
+            if blen < 12:
+                raise IOError(0, 'Bad pcapng block length')
+
+            if btype == NG_EPB or btype == NG_PB:
+                if blen < 32:
+                    raise IOError(0, 'Bad pcapng block length')
+
+                data = peek(28)
+
+                if len(data) < 28:
+                    break
+
+                if btype == NG_EPB:
+                    iface, high, low, caplen = \
+                         struct.unpack(endian + 'IIII', data[8:24])
+                else:
+                    iface, drops, high, low, caplen = \
+                         struct.unpack(endian + 'HHIII', data[8:24])
+
+                iface = section[iface]
+
+                self.offsets.append(scanner.pos + 28)
+                self.lengths.append(min(caplen, blen - 32))
+                self.timestamps.append(((high << 32) | low) /
+                                       float(resolutions[iface]))
+                self.ifaces.append(iface)
+
+            elif btype == NG_SPB:
+                if blen < 16:
+                    raise IOError(0, 'Bad pcapng block length')
+
+                wirelen = struct.unpack(endian + 'I', peek(12)[8:12])[0]
+
+                iface = section[0]
+
+                self.offsets.append(scanner.pos + 12)
+                self.lengths.append(min(wirelen, blen - 16))
+                self.timestamps.append(self.timestamps and \
+                                       self.timestamps[-1] or 0)
+                self.ifaces.append(iface)
+
+            elif btype == NG_IDB:
+                body = peek(blen)[8:blen - 4]
+
+                if len(body) < 8:
+                    break
+
+                linktype = struct.unpack(endian + 'H', body[:2])[0]
+                resolution = 1000000
+
+                # Look for the if_tsresol option
+                opts = body[8:]
+
+                while len(opts) >= 4:
+                    code, length = struct.unpack(endian + 'HH', opts[:4])
+
+                    if code == 0:
+                        break
+
+                    if code == 9 and length == 1:
+                        value = ord(opts[4])
+
+                        if value & 0x80:
+                            resolution = 2 ** (value & 0x7f)
+                        else:
+                            resolution = 10 ** value
+
+                    opts = opts[4 + ((length + 3) & ~3):]
+
+                section.append(len(self.linktypes))
+                self.linktypes.append(linktype)
+                resolutions.append(resolution)
+
+            skip(blen)
+
+            if callback and len(self.offsets) % 10000 == 0:
+                self.__progress(scanner, callback)
+
+    ############################################################################
+    # Sidecar file
+    ############################################################################
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Load the index from the sidecar file of fname
+        @return a PcapIndex or None if the sidecar is missing or outdated
+        """
+        try:
+            st = os.stat(fname)
+            f = open(fname + SIDECAR_EXT, 'rb')
+        except (IOError, OSError):
+            return None
+
+        try:
+            try:
+                magic, version, little, size, mtime, count, nifaces = \
+                    SIDECAR_HEADER.unpack(f.read(SIDECAR_HEADER.size))
+
+                if magic != SIDECAR_MAGIC or version != SIDECAR_VERSION or \
+                   size != st.st_size or mtime != st.st_mtime:
+                    log.debug('Sidecar index of %s is outdated' % fname)
+                    return None
+
+                index = cls()
+
+                linktypes = array('I')
+                arrays = (linktypes, index.offsets, index.lengths,
+                          index.timestamps, index.ifaces)
+
+                for arr, length in zip(arrays, (nifaces, ) + (count, ) * 4):
+                    arr.fromfile(f, length)
+
+                    # Written on a machine with a different byte order
+                    if bool(little) != (sys.byteorder == 'little'):
+                        arr.byteswap()
+
+                index.linktypes = linktypes.tolist()
+
+                log.debug('Index of %s loaded from the sidecar file (%d '
+                          'packets)' % (fname, count))
+
+                return index
+            except (EOFError, struct.error):
+                log.debug('Corrupted sidecar index for %s' % fname)
+                return None
+        finally:
+            f.close()
+
+    def save(self, fname):
+        """
+        Save the index in the sidecar file of fname. Errors are only logged
+        since the directory of the capture could be read only.
+        """
+        tmpname = fname + SIDECAR_EXT + '.tmp'
+
+        try:
+            st = os.stat(fname)
+            f = open(tmpname, 'wb')
+
+            try:
+                f.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, SIDECAR_VERSION,
+                                            sys.byteorder == 'little',
+                                            st.st_size, st.st_mtime,
+                                            len(self.offsets),
+                                            len(self.linktypes)))
+
+                array('I', self.linktypes).tofile(f)
+
+                for arr in (self.offsets, self.lengths, self.timestamps,
+                            self.ifaces):
+                    arr.tofile(f)
+            finally:
+                f.close()
+
+            os.rename(tmpname, fname + SIDECAR_EXT)
+        except (IOError, OSError), err:
+            log.debug('Unable to save the sidecar index of %s (%s)' % \
+                      (fname, str(err)))
+
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+
+class PcapPacketList(object):
+    """
+    Container for the packets of a capture file supporting len(), iteration,
+    random access by index (also with slices) and append() like
+    PacketStore. Packets are read from the file and returned as lazy
+    MetaPackets only when accessed.
+
+    The last PAGE_CACHE_SIZE packets accessed are kept so the same object is
+    returned for repeated accesses. Only the packets edited (@see
+    MetaPacket.is_edited) are kept for the whole life of the list, so the
+    memory used doesn't depend on how many packets are viewed.
+
+    The cfields set on the packets returned by stream() (the annotations of
+    the audits) are saved by index and set on the packets returned by
+    __getitem__.
+    """
+
+    def __init__(self, fname, index):
+        """
+        @param fname the capture file
+        @param index the PcapIndex of fname
+        """
+        self.fname = fname
+        self.index = index
+        self.f = open_capture(fname, index.points)
+
+        self.classes = []
+
+        for linktype in index.linktypes:
+            try:
+                self.classes.append(conf.l2types[linktype])
+            except KeyError:
+                log.warning('Unknown linktype %d. Using Raw' % linktype)
+                self.classes.append(Raw)
+
+        # Packets appended after the load
+        self.memory = []
+
+        # index -> cfields of the packets streamed
+        self.annotations = {}
+
+        # Packets edited, never dropped from the cache
+        self.pinned = {}
+        self.pages = {}
+        self.pages_order = deque()
+
+        self.lock = Lock()
+
+    def get_linktype(self):
+        "@return the linktype of the first interface or None"
+        if self.index.linktypes:
+            return self.index.linktypes[0]
+
+        return None
+
+    def __len__(self):
+        return len(self.index) + len(self.memory)
+
+    def __iter__(self):
+        idx = 0
+
+        while idx < len(self):
+            yield self[idx]
+            idx += 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in xrange(*idx.indices(len(self)))]
+
+        if idx < 0:
+            idx += len(self)
+
+        if idx < 0 or idx >= len(self):
+            raise IndexError('packet index out of range')
+
+        if idx >= len(self.index):
+            return self.memory[idx - len(self.index)]
+
+        self.lock.acquire()
+
+        try:
+            if idx in self.pinned:
+                return self.pinned[idx]
+
+            if idx in self.pages:
+                return self.pages[idx]
+
+            mpkt = self.__read(idx)
+
+            if len(self.pages_order) >= PAGE_CACHE_SIZE:
+                old = self.pages_order.popleft()
+                oldpkt = self.pages.pop(old)
+
+                # Edits can't be read back from the file
+                if oldpkt.is_edited():
+                    self.pinned[old] = oldpkt
+
+            self.pages[idx] = mpkt
+            self.pages_order.append(idx)
+
+            return mpkt
+        finally:
+            self.lock.release()
+
+    def __read(self, idx):
+        index = self.index
+
+        self.f.seek(int(index.offsets[idx]))
+        raw = self.f.read(index.lengths[idx])
+
+        mpkt = MetaPacket.new_lazy(raw, self.classes[index.ifaces[idx]],
+                                   index.timestamps[idx])
+
+        if idx in self.annotations:
+            mpkt.cfields = self.annotations[idx]
+
+        return mpkt
+
+    def __annotate(self, idx, cfields):
+        "Save the cfields of the packet idx and set them on the loaded one"
+        self.lock.acquire()
+
+        try:
+            self.annotations[idx] = cfields
+
+            mpkt = self.pinned.get(idx, None)
+
+            if mpkt is None:
+                mpkt = self.pages.get(idx, None)
+
+            if mpkt is not None:
+                mpkt.cfields.update(cfields)
+                self.annotations[idx] = mpkt.cfields
+        finally:
+            self.lock.release()
+
+    def stream(self, start=0):
+        """
+        Iterate sequentially over the packets of the capture using another
+        file object. The packets returned are not kept in the list but the
+        cfields set on them before the next one is requested are.
+
+        @param start the index of the first packet
+        @return a generator of MetaPackets
+        """
+        index = self.index
+        f = open_capture(self.fname, self.index.points)
+        scanner = Scanner(f)
+
+        try:
+            for idx in xrange(start, len(index)):
+                scanner.skip(int(index.offsets[idx]) - scanner.pos)
+                raw = scanner.peek(index.lengths[idx])
+
+                mpkt = MetaPacket.new_lazy(raw,
+                                           self.classes[index.ifaces[idx]],
+                                           index.timestamps[idx])
+                yield mpkt
+
+                if mpkt.cfields:
+                    self.__annotate(idx, mpkt.cfields)
+        finally:
+            f.close()
+
+    def append(self, mpkt):
+        self.memory.append(mpkt)
+
+    def extend(self, mpkts):
+        self.memory.extend(mpkts)
+
+    def close(self):
+        "Close the capture file"
+
+        self.lock.acquire()
+
+        try:
+            self.f.close()
+            self.annotations.clear()
+            self.pinned.clear()
+            self.pages.clear()
+            self.pages_order.clear()
+        finally:
+            self.lock.release()
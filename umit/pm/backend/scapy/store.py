@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2008, 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+A list like container for captured packets that keeps in memory only the
+most recent packets and moves the older ones to a temporary segment file.
+
+>>> from umit.pm.backend.scapy.wrapper import Ether, IP
+>>> store = PacketStore(window=8)
+>>> for idx in xrange(20):
+...     store.append(MetaPacket(Ether() / IP(id=idx)))
+>>> len(store), store.spilled, len(store.memory)
+(20, 12, 8)
+>>> [mpkt.get_field('ip.id') for mpkt in store[10:14]]
+[10, 11, 12, 13]
+>>> store[0] is store[0], store[0].is_dissected()
+(True, False)
+
+The cfields survive to the spill and the packets edited after being loaded
+back are kept:
+
+>>> store = PacketStore(window=4)
+>>> for idx in xrange(PAGE_CACHE_SIZE + 100):
+...     mpkt = MetaPacket(Ether() / IP(id=idx))
+...     if idx == 1:
+...         mpkt.cfields['username'] = 'guest'
+...     store.append(mpkt)
+>>> store[1].cfields, store[2].cfields
+({'username': 'guest'}, {})
+>>> store[3].set_field('ip.ttl', 5)
+>>> len([mpkt for mpkt in store if mpkt.get_field('ip.id') is not None])
+1124
+>>> store.pinned.keys(), store[3].get_field('ip.ttl'), store[1].cfields
+([3], 5, {'username': 'guest'})
+>>> store.close(); len(store)
+0
+"""
+
+import tempfile
+
+from struct import Struct
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from threading import Lock
+from collections import deque
+
+from umit.pm.core.logger import log
+from umit.pm.manager.preferencemanager import Prefs
+from umit.pm.backend.scapy.packet import MetaPacket
+
+__all__ = ['PacketStore']
+
+# offset in the segment, length, timestamp, flags, link layer class index,
+# length of the pickled cfields following the raw bytes (0 if none)
+INDEX_RECORD = Struct('!QIdIHI')
+
+# How many packets loaded back from the disk are kept alive
+PAGE_CACHE_SIZE = 1024
+
+class PacketStore(object):
+    """
+    Container for MetaPackets supporting append(), len(), iteration and
+    random access by index (also with slices). Only the last window packets
+    are kept in memory. Once the window is exceeded the oldest packets are
+    written to a segment file with a fixed size index so the access stays
+    O(1) whatever is the length of the capture.
+
+    Packets loaded back from the disk are lazy MetaPackets with the raw
+    bytes, the timestamp, the flags and the cfields of the packet spilled.
+    Decoder fields (l3_src & co.) are lost. The packets edited after being
+    loaded back, and the ones with cfields that can't be pickled, are kept
+    in memory.
+    """
+
+    def __init__(self, window=None):
+        """
+        @param window the number of packets kept in memory or None to use
+                      backend.system.store.window preference. 0 means no
+                      limit.
+        """
+        if window is None:
+            window = Prefs()['backend.system.store.window'].value
+
+        self.window = max(0, int(window))
+
+        self.memory = []
+        self.spilled = 0
+
+        self.segment = None
+        self.segment_size = 0
+        self.index = None
+
+        self.classes = []
+        self.pages = {}
+        self.pages_order = deque()
+
+        # Packets that can't be loaded back from the segment
+        self.pinned = {}
+
+        self.lock = Lock()
+
+    def __len__(self):
+        # Packets are moved from memory to spilled by the capture thread
+        self.lock.acquire()
+
+        try:
+            return self.spilled + len(self.memory)
+        finally:
+            self.lock.release()
+
+    def __iter__(self):
+        idx = 0
+
+        while idx < len(self):
+            yield self[idx]
+            idx += 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in xrange(*idx.indices(len(self)))]
+
+        # The capture thread could be spilling packets meanwhile
+        self.lock.acquire()
+
+        try:
+            length = self.spilled + len(self.memory)
+
+            if idx < 0:
+                idx += length
+
+            if idx < 0 or idx >= length:
+                raise IndexError('packet index out of range')
+
+            if idx >= self.spilled:
+                return self.memory[idx - self.spilled]
+        finally:
+            self.lock.release()
+
+        return self.__page_in(idx)
+
+    def append(self, mpkt):
+        self.memory.append(mpkt)
+
+        if self.window and len(self.memory) > self.window:
+            # Spill a quarter of the window at once to amortize the cost of
+            # shrinking the list.
+            self.__spill(max(1, self.window / 4))
+
+    def extend(self, mpkts):
+        for mpkt in mpkts:
+            self.append(mpkt)
+
+    def close(self):
+        "Remove the segment files"
+
+        self.lock.acquire()
+
+        try:
+            if self.segment:
+                self.segment.close()
+                self.index.close()
+
+            self.segment = self.index = None
+            self.segment_size = 0
+            self.spilled = 0
+            self.memory = []
+            self.pages.clear()
+            self.pages_order.clear()
+            self.pinned.clear()
+        finally:
+            self.lock.release()
+
+    ############################################################################
+    # Disk functions
+    ############################################################################
+
+    def __spill(self, count):
+        self.lock.acquire()
+
+        try:
+            if not self.segment:
+                log.debug('Creating segment files for the packet store')
+
+                self.segment = tempfile.TemporaryFile(prefix='pm-store-')
+                self.index = tempfile.TemporaryFile(prefix='pm-index-')
+
+            self.segment.seek(0, 2)
+            self.index.seek(0, 2)
+
+            records = []
+
+            for idx, mpkt in enumerate(self.memory[:count]):
+                raw = mpkt.get_raw()
+                llcls = mpkt.get_llclass()
+                cfields = ''
+
+                if mpkt.cfields:
+                    try:
+                        cfields = dumps(mpkt.cfields, HIGHEST_PROTOCOL)
+                    except Exception:
+                        log.debug('Keeping packet %d in memory since its '
+                                  'cfields can\'t be pickled',
+                                  self.spilled + idx)
+                        self.pinned[self.spilled + idx] = mpkt
+
+                try:
+                    clsidx = self.classes.index(llcls)
+                except ValueError:
+                    clsidx = len(self.classes)
+                    self.classes.append(llcls)
+
+                self.segment.write(raw + cfields)
+                records.append(INDEX_RECORD.pack(self.segment_size, len(raw),
+                                                 mpkt.get_rawtime() or 0,
+                                                 mpkt.flags, clsidx,
+                                                 len(cfields)))
+                self.segment_size += len(raw) + len(cfields)
+
+            self.index.write(''.join(records))
+
+            del self.memory[:count]
+            self.spilled += count
+        finally:
+            self.lock.release()
+
+    def __page_in(self, idx):
+        self.lock.acquire()
+
+        try:
+            if idx in self.pinned:
+                return self.pinned[idx]
+
+            if idx in self.pages:
+                return self.pages[idx]
+
+            self.index.seek(idx * INDEX_RECORD.size)
+            offset, length, ts, flags, clsidx, clen = \
+                  INDEX_RECORD.unpack(self.index.read(INDEX_RECORD.size))
+
+            self.segment.seek(offset)
+            raw = self.segment.read(length)
+
+            mpkt = MetaPacket.new_lazy(raw, self.classes[clsidx], ts, flags)
+
+            if clen:
+                mpkt.cfields = loads(self.segment.read(clen))
+
+            # Return the same object for repeated accesses (GUI views)
+            if len(self.pages_order) >= PAGE_CACHE_SIZE:
+                old = self.pages_order.popleft()
+                oldpkt = self.pages.pop(old)
+
+                # Edits are not written back to the segment
+                if oldpkt is not None and oldpkt.is_edited():
+                    self.pinned[old] = oldpkt
+
+            self.pages[idx] = mpkt
+            self.pages_order.append(idx)
+
+            return mpkt
+        finally:
+            self.lock.release()
@@ -20,35 +20,34 @@
 
 import os
 import sys
+import atexit
+import tempfile
 import traceback
 
-import tempfile
 import subprocess
 
+from errno import EAGAIN, EINTR, EBADF, ENODEV, ENXIO, ENETDOWN
+
+from array import array
 from datetime import datetime
 from threading import Thread, Lock, Condition
 from select import select
 from umit.pm.core.logger import log
+from umit.pm.core.metrics import metrics
 from umit.pm.core.atoms import Node, ThreadPool, Interruptable, \
-                          with_decorator, defaultdict
+                          with_decorator
 
 from umit.pm.manager.preferencemanager import Prefs
 
 from umit.pm.backend import VirtualIFace
 from umit.pm.backend.scapy.wrapper import *
 from umit.pm.backend.scapy.packet import MetaPacket
-
-from select import select
+from umit.pm.backend.scapy.matcher import ReplyMatcher
 
 if not WINDOWS:
     import fcntl
 else:
     import ctypes
-    import msvcrt
-
-    # Function to get stderr async
-    from win32file import ReadFile
-    from win32pipe import PeekNamedPipe
 
 ###############################################################################
 # Helper functions
@@ -57,14 +56,17 @@ else:
 def run_helper(helper_type, iface, filter=None, stop_count=0, stop_time=0, \
                stop_size=0):
     """
-    Start an helper process for capturing
+    Start an helper process for capturing. The helper writes the captured
+    packets in pcap format on its stdout (use bind_reader to read them).
+
     @param helper is integer (0 to use tcpdump, 1 to use pcapdump)
     @param iface the interface to sniff on
     @param filter the tcpdump filter to use
     @param stop_count stop process after n packets (tcpdump/dumpcap)
     @param stop_time stop process after n secs (dumpcap only)
     @param stop_size stop process after n bytes (dumpcap only)
-    @return a tuple (Popen object, outfile path)
+    @return a Popen object. Its stderr is collected in the errfile
+            attribute (see get_helper_error)
     @see subprocess module for more information
     """
 
@@ -78,56 +80,58 @@ def run_helper(helper_type, iface, filter=None, stop_count=0, stop_time=0, \
         iface = iface[0]
 
     if helper_type == 0:
-        helper = Prefs()['backend.tcpdump'].value
+        args = [Prefs()['backend.tcpdump'].value, '-U', '-i', iface, '-w', '-']
 
         if stop_count:
-            helper += "-c %d " % stop_count
-
-        helper += " -vU -i%s -w%s"
+            args += ['-c', str(stop_count)]
 
         if filter:
-            helper += " " + filter
+            args.append(filter)
 
         log.debug("I'm using tcpdump helper to capture packets")
 
     else:
-        helper = Prefs()['backend.dumpcap'].value
+        # -P is needed to get pcap instead of pcapng
+        args = [Prefs()['backend.dumpcap'].value, '-q', '-P', '-i', iface,
+                '-w', '-']
 
         if stop_count:
-            helper += "-c %d " % stop_count
+            args += ['-c', str(stop_count)]
 
         if stop_time:
-            helper += "-a duration:%d " % stop_time
+            args += ['-a', 'duration:%d' % stop_time]
 
         if stop_size:
-            helper += "-a filesize:%d " % stop_size / 1024
-
-        helper += " -i%s -w%s"
+            args += ['-a', 'filesize:%d' % (stop_size / 1024)]
 
         if filter:
-            helper += " " + filter
+            args += ['-f', filter]
 
         log.debug("I'm using dumpcap helper to capture packets")
 
-    outfile = tempfile.mktemp('.pcap', 'PM-')
+    # stderr goes to a temporary file: a pipe never drained would block the
+    # helper once it is full
+    errfile = tempfile.TemporaryFile(prefix='pm-helper-')
 
-    process = subprocess.Popen(helper % (iface, outfile), shell=(not WINDOWS),
-                               close_fds=(not WINDOWS), stderr=subprocess.PIPE)
+    process = subprocess.Popen(args, close_fds=(not WINDOWS),
+                               stdout=subprocess.PIPE, stderr=errfile)
+    process.errfile = errfile
 
-    if not WINDOWS:
-        log.debug("Setting O_NONBLOCK stderr file descriptor")
+    log.debug("Process spawned as `%s` with pid %d" % \
+              (' '.join(args), process.pid))
+    log.debug("Helper started on interface %s" % iface)
 
-        flags = fcntl.fcntl(process.stderr, fcntl.F_GETFL)
+    return process
 
-        if not process.stderr.closed:
-            fcntl.fcntl(process.stderr, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+def get_helper_error(process):
+    "@return the stderr output of the helper process created by run_helper"
+    errfile = getattr(process, 'errfile', None)
 
-    log.debug("Process spawned as `%s` with pid %d" % \
-              ((helper % (iface, outfile), process.pid)))
-    log.debug("Helper started on interface %s. Dumping to %s" % \
-              (iface, outfile))
+    if errfile is None or errfile.closed:
+        return ''
 
-    return process, outfile
+    errfile.seek(0)
+    return errfile.read().strip()
 
 def kill_helper(process):
     """
@@ -160,18 +164,191 @@ def kill_helper(process):
             import signal
             os.kill(process.pid, signal.SIGKILL)
 
-def bind_reader(process, outfile, ts=0.5):
+    if getattr(process, 'errfile', None):
+        process.errfile.close()
+
+class PcapStreamReader(object):
+    """
+    Incremental pcap parser reading from a pipe (the stdout of the helper
+    process). It exposes the linktype, LLcls attributes and the read_packet()
+    method like scapy PcapReader but a read never blocks more than timeout
+    seconds. When None is returned check the eof attribute to know if the
+    stream is finished.
+    """
+
+    def __init__(self, fileobj, timeout=0.5):
+        """
+        @param fileobj a file object (like Popen.stdout)
+        @param timeout the max seconds to wait for new data
+        """
+        self.f = fileobj
+        self.fd = fileobj.fileno()
+        self.timeout = timeout
+
+        self.buffer = ''
+        self.offset = 0
+        self.position = 0
+        self.eof = False
+
+        self.endian = None
+        self.nsec = False
+        self.linktype = None
+        self.LLcls = None
+
+        if not WINDOWS:
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def tell(self):
+        "@return the number of bytes parsed till now"
+        return self.position
+
+    def __fill(self, size):
+        """
+        Read from the pipe till size bytes are available in the buffer
+        @return True if size bytes are available or False
+        """
+
+        while len(self.buffer) - self.offset < size:
+            if self.eof:
+                return False
+
+            if not WINDOWS:
+                inp, out, err = select([self.fd], [], [], self.timeout)
+
+                if not inp:
+                    return False
+
+                try:
+                    data = os.read(self.fd, 65536)
+                except OSError, err:
+                    if err.errno in (EAGAIN, EINTR):
+                        continue
+                    raise
+            else:
+                # No select on pipes here
+                data = os.read(self.fd, 65536)
+
+            if not data:
+                self.eof = True
+                return False
+
+            self.buffer = self.buffer[self.offset:] + data
+            self.offset = 0
+
+        return True
+
+    def read_header(self):
+        """
+        Parse the pcap global header
+        @return True if the header is parsed or False if more data is needed
+        """
+
+        if self.linktype is not None:
+            return True
+
+        if not self.__fill(24):
+            return False
+
+        hdr = self.buffer[self.offset:self.offset + 24]
+
+        if hdr[:4] in ('\xa1\xb2\xc3\xd4', '\xa1\xb2\x3c\x4d'):
+            self.endian = '>'
+        elif hdr[:4] in ('\xd4\xc3\xb2\xa1', '\x4d\x3c\xb2\xa1'):
+            self.endian = '<'
+        else:
+            raise Exception('The helper output is not in pcap format')
+
+        self.nsec = hdr[:4] in ('\xa1\xb2\x3c\x4d', '\x4d\x3c\xb2\xa1')
+        self.linktype = struct.unpack(self.endian + 'I', hdr[20:24])[0]
+
+        try:
+            self.LLcls = conf.l2types[self.linktype]
+        except KeyError:
+            log.warning('Unknown linktype %d. Using Raw' % self.linktype)
+            self.LLcls = Raw
+
+        self.offset += 24
+        self.position += 24
+
+        return True
+
+    def read_raw_packet(self):
+        """
+        @return a tuple (raw, (sec, usec, wirelen)) or None if no complete
+                packet is available
+        """
+
+        if not self.read_header() or not self.__fill(16):
+            return None
+
+        sec, usec, caplen, wirelen = \
+            struct.unpack(self.endian + 'IIII',
+                          self.buffer[self.offset:self.offset + 16])
+
+        if not self.__fill(16 + caplen):
+            return None
+
+        start = self.offset + 16
+        raw = self.buffer[start:start + caplen]
+
+        self.offset = start + caplen
+        self.position += 16 + caplen
+
+        if self.nsec:
+            usec /= 1000
+
+        return raw, (sec, usec, wirelen)
+
+    def read_packet(self):
+        "@return a scapy packet or None"
+
+        ret = self.read_raw_packet()
+
+        if ret is None:
+            return None
+
+        raw, (sec, usec, wirelen) = ret
+
+        try:
+            pkt = self.LLcls(raw)
+        except Exception:
+            pkt = Raw(raw)
+
+        pkt.time = sec + 0.000001 * usec
+        return pkt
+
+def bind_reader(process, outfile=None, ts=0.5):
     """
-    Create a PcapReader to handle outfile created by run_helper.
-    This is generator returning None if the file is not ready, and a tuple
-    (reader, file_size, position_callable) when it is.
+    Create a reader to handle the packets captured by process or the pcap
+    file outfile. This is generator returning None if the reader is not ready,
+    and a tuple (reader, file_size, position_callable) when it is.
 
-    @param process the process that generated the outfile or None
-    @param outfile the file to poll
-    @param ts the time to sleep while if object is not ready
+    @param process the helper process created by run_helper or None
+    @param outfile the file to poll or None to read from process stdout
+    @param ts the time to wait while if object is not ready
     @return
     """
 
+    if outfile is None:
+        reader = PcapStreamReader(process.stdout, ts)
+
+        while not reader.read_header():
+            if reader.eof:
+                process.wait()
+                raise Exception(
+                    'Helper process died unexpectly with %d as returncode '
+                    '(%s)' % (process.returncode, get_helper_error(process)))
+
+            log.debug("Helper output not ready. Waited %.2f sec" % ts)
+            yield None
+
+        log.debug("Helper output seems to be ready (linktype %d)" % \
+                  reader.linktype)
+
+        yield reader, 0.0, reader.tell
+        return
+
     if process:
         # 20 is the minimum header length for a pcap file
         while process.poll() is None and \
@@ -202,43 +379,6 @@ def bind_reader(process, outfile, ts=0.5):
 
     yield reader, outfile_size, position
 
-def get_n_packets(process):
-    """
-    @param process the process helper created with run_helper
-    @return the number of packets that the helper prints on the stderr >= 0
-            negative on errors.
-    """
-    if not WINDOWS:
-        try:
-            inp, out, err = select.select([process.stderr],
-                                          [process.stderr],
-                                          [process.stderr])
-        except:
-            # Here we could have select that hangs after a kill in stop
-            return -1
-
-        if process.stderr in inp:
-            line = process.stderr.read()
-
-            if not line:
-                return -2
-    else:
-        try:
-            # PeekNamedPipe is async here and doesn't block resulting
-            # in gui freeze. So we use directly ReadFile here
-            x = msvcrt.get_osfhandle(process.stderr.fileno())
-            errCode, line = ReadFile(x, 1024, None)
-        except:
-            return -2
-
-    # Here dumpcap use '\rPackets: %u ' while tcpdump 'Got %u\r'
-    # over stderr file. We use simple split(' ')[1]
-
-    try:
-        return int(line.split(' ')[1])
-    except:
-        return -3
-
 def get_iface_from_ip(metapacket):
     if metapacket.haslayer(IP):
         iff, a, gw = conf.route.route(metapacket.getlayer(IP).dst)
@@ -250,7 +390,11 @@ def get_iface_from_ip(metapacket):
 
     return iff
 
-def get_socket_for(metapacket, want_layer_2=False, iff=None):
+def get_socket_key(metapacket, want_layer_2=False, iff=None):
+    """
+    @return a tuple (iface, layer) describing the socket to use to send the
+            metapacket
+    """
     # We should check if the given packet has a IP layer but not an
     # Ether one so we could send it trough layer 3
 
@@ -261,54 +405,477 @@ def get_socket_for(metapacket, want_layer_2=False, iff=None):
 
     if not metapacket.haslayer(Ether) and not want_layer_2:
         log.debug("Using layer 3 socket")
-        sock = conf.L3socket(iface=iff)
-    else:
-        log.debug("Using layer 2 socket (Ether: %s Layer 2: %s)" % \
-                 (metapacket.haslayer(Ether), want_layer_2))
-        sock = conf.L2socket(iface=iff)
+        return (iff, 3)
+
+    log.debug("Using layer 2 socket (Ether: %s Layer 2: %s)" % \
+             (metapacket.haslayer(Ether), want_layer_2))
+    return (iff, 2)
+
+def create_socket(iff, layer):
+    "@return a new scapy socket working at layer (2 or 3) on iff"
+    if layer == 3:
+        return conf.L3socket(iface=iff)
+
+    return conf.L2socket(iface=iff)
+
+def get_socket_for(metapacket, want_layer_2=False, iff=None):
+    """
+    @return a new scapy socket for the metapacket. Use acquire_socket_for
+            if the socket is only needed to send packets.
+    """
+    return create_socket(*get_socket_key(metapacket, want_layer_2, iff))
+
+###############################################################################
+# Socket pool
+###############################################################################
+
+# Errors after which the socket is considered broken and recreated
+BROKEN_ERRNOS = (EBADF, ENODEV, ENXIO, ENETDOWN)
+
+class PooledSocket(object):
+    """
+    A reference to a socket of the SocketPool. It could be used in place of a
+    scapy socket to send packets. Call close() to release the reference.
+    """
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.closed = False
+
+    def send(self, packet):
+        if self.closed:
+            raise socket.error(EBADF, 'Socket already released')
+
+        return self.pool.send(self.key, packet)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pool.release(self.key)
+
+    def __repr__(self):
+        return '<PooledSocket %s L%d>' % self.key
+
+class SocketPool(object):
+    """
+    Pool of the sockets used to send packets. Sockets are indexed by
+    interface and layer and shared by every send path: a socket is created
+    the first time it is acquired and closed when the last reference is
+    released.
+
+    >>> import socket
+    >>> from errno import ENETDOWN, EPERM
+    >>> class FakeSocket(object):
+    ...     fail = None
+    ...     def __init__(self, iface=None):
+    ...         self.sock, self.peer = socket.socketpair()
+    ...         self.sent = []
+    ...     def fileno(self):
+    ...         return self.sock.fileno()
+    ...     def send(self, packet):
+    ...         if FakeSocket.fail:
+    ...             errno, FakeSocket.fail = FakeSocket.fail, None
+    ...             raise socket.error(errno, 'Fake error')
+    ...         self.sent.append(packet)
+    ...         return len(packet)
+    ...     def close(self):
+    ...         self.sock.close()
+    ...         self.peer.close()
+    >>> L3socket, conf.L3socket = conf.L3socket, FakeSocket
+
+    A socket is shared by all the references to the same interface and layer
+    and closed with the last one:
+
+    >>> first = socket_pool.acquire('lo', 3)
+    >>> second = socket_pool.acquire('lo', 3)
+    >>> len(socket_pool), socket_pool.sockets[('lo', 3)][1]
+    (1, 2)
+    >>> sock = socket_pool.sockets[('lo', 3)][0]
+    >>> first.send('first'), second.send('second'), sock.sent
+    (5, 6, ['first', 'second'])
+    >>> first.close(); first.close(); len(socket_pool)
+    1
+    >>> first.send('closed')
+    Traceback (most recent call last):
+      ...
+    error: [Errno 9] Socket already released
+    >>> second.close(); len(socket_pool)
+    0
+
+    A broken socket is recreated on acquire and after a send failing with one
+    of BROKEN_ERRNOS, sending again the packet once:
+
+    >>> first = socket_pool.acquire('lo', 3)
+    >>> sock = socket_pool.sockets[('lo', 3)][0]
+    >>> sock.sock.close()
+    >>> second = socket_pool.acquire('lo', 3)
+    >>> socket_pool.sockets[('lo', 3)][0] is sock
+    False
+    >>> sock = socket_pool.sockets[('lo', 3)][0]
+    >>> FakeSocket.fail = ENETDOWN
+    >>> first.send('retried'), sock.sent
+    (7, [])
+    >>> socket_pool.sockets[('lo', 3)][0].sent
+    ['retried']
+    >>> FakeSocket.fail = EPERM
+    >>> second.send('failed')
+    Traceback (most recent call last):
+      ...
+    error: [Errno 1] Fake error
+    >>> first.close(); second.close(); len(socket_pool)
+    0
+    >>> conf.L3socket = L3socket
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+
+        # (iface, layer) -> [socket, refcount, send lock]
+        self.sockets = {}
+
+        self.sent = metrics.counter('send.packets')
+        self.retries = metrics.counter('send.retries')
+        self.send_time = metrics.histogram('send.latency')
+
+        metrics.gauge('send.sockets', lambda: len(self.sockets))
+
+    def __create(self, key):
+        log.debug("Creating pooled L%d socket on %s" % (key[1], key[0]))
+        return create_socket(*key)
+
+    def __close(self, sock):
+        try:
+            sock.close()
+        except Exception:
+            pass
+
+    def __is_healthy(self, sock):
+        try:
+            os.fstat(sock.fileno())
+            return True
+        except Exception:
+            return False
+
+    @with_decorator
+    def acquire(self, iff, layer):
+        """
+        Get a reference to the socket used to send packets at the given layer
+        on iface. The socket is recreated if it is no more usable.
+
+        @param iff the interface name
+        @param layer 2 or 3
+        @return a PooledSocket
+        """
+        key = (iff, layer)
+        entry = self.sockets.get(key)
+
+        if entry is None:
+            entry = [self.__create(key), 0, Lock()]
+            self.sockets[key] = entry
+
+        elif not self.__is_healthy(entry[0]):
+            log.debug("Pooled L%d socket on %s is broken. Recreating" % \
+                      (layer, iff))
+
+            self.__close(entry[0])
+            entry[0] = self.__create(key)
+
+        entry[1] += 1
+        return PooledSocket(self, key)
+
+    @with_decorator
+    def release(self, key):
+        "Drop a reference to the socket and close it if it is unused"
+        entry = self.sockets.get(key)
+
+        if entry is None:
+            return
 
-    return sock
+        entry[1] -= 1
+
+        if entry[1] <= 0:
+            log.debug("Closing pooled L%d socket on %s" % (key[1], key[0]))
+
+            del self.sockets[key]
+            self.__close(entry[0])
+
+    def send(self, key, packet):
+        """
+        Send packet through the socket indexed by key. The socket is recreated
+        and the send retried once if the socket is broken.
+        """
+        entry = self.sockets.get(key)
+
+        if entry is None:
+            raise socket.error(EBADF, 'No pooled socket for %s L%d' % key)
+
+        if metrics.enabled:
+            start = time.time()
+
+            try:
+                return self.__send(entry, key, packet)
+            finally:
+                self.sent.inc()
+                self.send_time.record((time.time() - start) * 1000000)
+
+        return self.__send(entry, key, packet)
+
+    def __send(self, entry, key, packet):
+        entry[2].acquire()
+
+        try:
+            sock = entry[0]
+
+            try:
+                return sock.send(packet)
+            except socket.error, err:
+                if err.args[0] not in BROKEN_ERRNOS:
+                    raise
+
+            if metrics.enabled:
+                self.retries.inc()
+
+            self.lock.acquire()
+
+            try:
+                # Another thread could have already replaced it
+                if entry[0] is sock:
+                    log.debug("Send on pooled L%d socket on %s failed. "
+                              "Recreating" % (key[1], key[0]))
+
+                    self.__close(sock)
+                    entry[0] = self.__create(key)
+
+                sock = entry[0]
+            finally:
+                self.lock.release()
+
+            return sock.send(packet)
+        finally:
+            entry[2].release()
+
+    @with_decorator
+    def close_all(self):
+        "Close all the sockets. The references still around become invalid"
+        for key, entry in self.sockets.items():
+            self.__close(entry[0])
+
+        self.sockets.clear()
+
+    def __len__(self):
+        return len(self.sockets)
+
+socket_pool = SocketPool()
+atexit.register(socket_pool.close_all)
+
+def acquire_socket_for(metapacket, want_layer_2=False, iff=None):
+    """
+    @return a PooledSocket to send the metapacket. Remember to close() it.
+    """
+    iff, layer = get_socket_key(metapacket, want_layer_2, iff)
+    return socket_pool.acquire(iff, layer)
 
 ###############################################################################
 # Analyze functions
 ###############################################################################
 
-def analyze_connections(pktlist, strict=False):
-    # Doesn't work with strict = True :(
-    # but without strict is also more speedy so :)
+def get_flow_key(metapacket):
+    """
+    Get a key identifying the flow of the packet regardless of its direction.
+    IP packets captured on ethernet, linux cooked or raw IP links are handled
+    on the raw bytes without dissecting them. Ports (or the id of ICMP echo
+    requests and replies) are part of the key. Non first fragments have no
+    ports and are grouped by addresses and protocol.
 
-    tree = {}
+    For the other packets the key is built on hashret().
 
-    for packet in pktlist:
-        hashret = packet.root.hashret()
-        append = False
-        last = 0
+    @param metapacket a MetaPacket object
+    @return a hashable object
+    """
+    raw = metapacket.get_raw()
+    llcls = metapacket.get_llclass()
 
-        for (idx, hash, pkt) in tree:
-            last = max(last, idx)
+    try:
+        if llcls is Ether:
+            offset, l3_type = 14, raw[12:14]
+
+            if l3_type == '\x81\x00':
+                offset, l3_type = 18, raw[16:18]
+        elif llcls is CookedLinux:
+            offset, l3_type = 16, raw[14:16]
+        elif llcls is IP:
+            offset = 0
+            l3_type = (ord(raw[0]) >> 4 == 6) and '\x86\xdd' or '\x08\x00'
+        else:
+            l3_type = None
 
-            if hash == hashret:
-                lst = tree[(idx, hash, pkt)]
+        if l3_type == '\x08\x00':
+            proto = ord(raw[offset + 9])
+            src = raw[offset + 12:offset + 16]
+            dst = raw[offset + 16:offset + 20]
 
-                if strict:
-                    for child in lst:
-                        if child.root.answers(packet.root):
-                            lst.append(packet)
-                            append = True
-                            break
-                else:
-                    lst.append(packet)
-                    append = True
+            if (ord(raw[offset + 6]) & 0x1f) or ord(raw[offset + 7]):
+                l4 = None
+            else:
+                l4 = offset + (ord(raw[offset]) & 0x0f) * 4
+        elif l3_type == '\x86\xdd':
+            # Extension headers are not followed
+            proto = ord(raw[offset + 6])
+            src = raw[offset + 8:offset + 24]
+            dst = raw[offset + 24:offset + 40]
+            l4 = offset + 40
+        else:
+            return (None, metapacket.hashret())
 
-                break
+        sport = dport = ''
+
+        if l4 is None or len(raw) < l4 + 8:
+            pass
+        elif proto in (6, 17):
+            sport, dport = raw[l4:l4 + 2], raw[l4 + 2:l4 + 4]
+        elif (proto == 1 and ord(raw[l4]) in (0, 8)) or \
+             (proto == 58 and ord(raw[l4]) in (128, 129)):
+            sport = dport = raw[l4 + 4:l4 + 6]
+
+    except IndexError:
+        return (None, metapacket.hashret())
+
+    src, dst = (src, sport), (dst, dport)
+
+    if src > dst:
+        src, dst = dst, src
+
+    return (proto, src, dst)
+
+class ConnectionIndex(object):
+    """
+    Groups the packets of a list by flow (@see get_flow_key). The index is
+    incremental: update() only looks at the packets appended to the list
+    since the previous call, so it could be called every time new packets
+    are captured and the groups are ready when needed.
+
+    The groups hold the indexes of the packets in the list, not the packets,
+    so the index doesn't keep alive the packets spilled by a PacketStore.
+    Use resolve() to get the packets.
+
+    >>> from umit.pm.backend.scapy.wrapper import Ether, IP, TCP, ICMP
+    >>> def mkpkt(src, dst, l4):
+    ...     return MetaPacket(Ether() / IP(src=src, dst=dst) / l4)
+    >>> pktlist = [mkpkt('10.0.0.1', '10.0.0.2', TCP(sport=1024, dport=80)),
+    ...            mkpkt('10.0.0.2', '10.0.0.1', TCP(sport=80, dport=1024)),
+    ...            mkpkt('10.0.0.1', '10.0.0.2', TCP(sport=1025, dport=80)),
+    ...            mkpkt('10.0.0.1', '10.0.0.2', ICMP(type=8, id=7)),
+    ...            mkpkt('10.0.0.2', '10.0.0.1', ICMP(type=0, id=7))]
+    >>> index = ConnectionIndex()
+    >>> [(first, list(others)) for first, others in index.update(pktlist)]
+    [(0, [1]), (2, []), (3, [4])]
+    >>> index.resolve(pktlist)[2] == (pktlist[3], [pktlist[4]])
+    True
+
+    Only the packets appended are indexed, a truncated list is reindexed:
+
+    >>> generation = index.generation
+    >>> pktlist.append(mkpkt('10.0.0.2', '10.0.0.1', TCP(sport=80,
+    ...                                                  dport=1025)))
+    >>> list(index.update(pktlist)[1][1]), index.generation - generation
+    ([5], 1)
+    >>> index.update(pktlist) is index.groups, index.generation - generation
+    (True, 1)
+    >>> del pktlist[1:]
+    >>> [len(others) for first, others in index.update(pktlist)]
+    [0]
+
+    The packets loaded back by a PacketStore after the spill are new objects
+    but the index is not rebuilt:
+
+    >>> from umit.pm.backend.scapy.store import PacketStore
+    >>> store = PacketStore(window=4)
+    >>> index.update(store)
+    []
+    >>> for idx in xrange(20):
+    ...     store.append(mkpkt('10.0.0.1', '10.0.0.2',
+    ...                        TCP(sport=1024 + idx % 2, dport=80)))
+    ...     generation = index.generation
+    ...     groups = index.update(store)
+    ...     assert index.generation == generation + 1
+    >>> store.spilled, [len(others) for first, others in groups]
+    (16, [9, 9])
+    >>> store.close()
+    """
+
+    def __init__(self):
+        # Incremented every time the groups change
+        self.generation = 0
+
+        self.clear()
+
+    def clear(self):
+        self.pktlist = None
+        self.count = 0
+        self.generation += 1
+
+        self.keys = {}
+        self.groups = []
+
+    def add(self, packet, idx):
+        """
+        Add a packet to the index
+        @param packet a MetaPacket object
+        @param idx the index of the packet in the list
+        """
+        key = get_flow_key(packet)
+
+        try:
+            self.keys[key][1].append(idx)
+        except KeyError:
+            group = (idx, array('i'))
+            self.keys[key] = group
+            self.groups.append(group)
+
+        self.generation += 1
+
+    def update(self, pktlist):
+        """
+        Synchronize the index with the list of packets. The index is rebuilt
+        if the list is not the one indexed before or if it was truncated.
+        @param pktlist a list of MetaPacket objects (or a PacketStore)
+        @return a list of (index of the first packet, array of the indexes of
+                the other packets) tuples in order of appearance
+        """
+        count = len(pktlist)
+
+        if pktlist is not self.pktlist or count < self.count:
+            self.clear()
+            self.pktlist = pktlist
 
-        if not append:
-            tree[(last + 1, hashret, packet)] = []
+        if count > self.count:
+            for idx in xrange(self.count, count):
+                self.add(pktlist[idx], idx)
 
-    items = tree.items()
-    items.sort()
+            self.count = count
 
-    return [(packet, lst) for (idx, hash, packet), lst in tree.items()]
+        return self.groups
+
+    def resolve(self, pktlist):
+        """
+        Synchronize the index and get the packets of every group
+        @param pktlist a list of MetaPacket objects (or a PacketStore)
+        @return a list of (first packet, list of the other packets) tuples
+                in order of appearance
+        """
+        return [(pktlist[first], [pktlist[idx] for idx in others]) \
+                for first, others in self.update(pktlist)]
+
+def analyze_connections(pktlist, strict=False):
+    """
+    Group the packets by connection
+    @param pktlist a list of MetaPacket objects
+    @param strict unused. Kept for compatibility
+    @return a list of (first packet, list of the other packets) tuples
+    @see ConnectionIndex
+    """
+    return ConnectionIndex().resolve(pktlist)
 
 ###############################################################################
 # Routing related functions
@@ -483,6 +1050,10 @@ class SenderConsumer(Thread, Interruptable):
             self.callback(Exception(err), self.udata)
             return
 
+        finally:
+            # Give the socket back to the pool
+            self.socket.close()
+
         self.callback(None, self.udata)
 
     def terminate(self):
@@ -503,7 +1074,7 @@ def send_packet(metapacket, count, inter, iface, callback, udata=None):
     """
 
     try:
-        sock = get_socket_for(metapacket, iff=iface)
+        sock = acquire_socket_for(metapacket, iff=iface)
     except socket.error, (errno, err):
         raise Exception(err)
 
@@ -524,7 +1095,7 @@ class SendReceiveConsumer(Interruptable):
         Create a SendReceiveConsumer object used to send and receive packets.
 
         @param ssock the socket to use to send packets.
-        @param rsock a socket object to use to receive packets or a list
+        @param rsock a socket object to use to receive packets or the process
                      returned by the run_helper method
         @param metapacket the packet to send
         @param inter the interval to wait between 2 consecutive send
@@ -537,9 +1108,9 @@ class SendReceiveConsumer(Interruptable):
 
         self.send_sock = ssock
 
-        if isinstance(rsock, tuple):
+        if isinstance(rsock, subprocess.Popen):
             # Here we are using a helper
-            self.process, self.outfile = rsock
+            self.process = rsock
             self.recv_thread = Thread(target=self.__recv_helper_thread)
         else:
             self.recv_sock = rsock
@@ -547,6 +1118,10 @@ class SendReceiveConsumer(Interruptable):
 
         self.metapacket = metapacket
 
+        # Every reply to the packet is accepted
+        self.matcher = ReplyMatcher()
+        self.matcher.add(metapacket.root, count=None)
+
         self.count = count
         self.scount = count
         self.running = True
@@ -600,34 +1175,34 @@ class SendReceiveConsumer(Interruptable):
                 cPickle.dump(arp_cache, self.wrpipe)
 
             self.wrpipe.close()
+        finally:
+            self.send_sock.close()
 
     def __recv_helper_thread(self):
         try:
-            for reader in bind_reader(self.process, self.outfile):
+            for reader in bind_reader(self.process):
                 if not self.running:
                     break
 
                 if reader:
                     reader, outfile_size, position = reader
 
-
-            report_idx = 0
-            reported_packets = 0
-
             ans = 0
             nbrecv = 0
             notans = self.count
 
             force_exit = False
-            packet = self.metapacket.root
-            packet_hash = packet.hashret()
 
             while self.running:
-                while report_idx < reported_packets:
-                    report_idx = get_n_packets(self.process)
-
+                # This waits at most the reader timeout
                 r = reader.read_packet()
 
+                if r is None:
+                    if reader.eof:
+                        break
+
+                    continue
+
                 try:
                     # The helper capture packets at L2 so we need to drop the
                     # first protocol to make the match against the packets.
@@ -639,8 +1214,7 @@ class SendReceiveConsumer(Interruptable):
                 if not r:
                     break
 
-                if not self.strict or (r.hashret() == packet_hash and \
-                   r.answers(packet)):
+                if not self.strict or self.matcher.match(r) is not None:
 
                     ans += 1
 
@@ -684,8 +1258,6 @@ class SendReceiveConsumer(Interruptable):
         notans = self.count
 
         force_exit = False
-        packet = self.metapacket.root
-        packet_hash = packet.hashret()
 
         inmask = [self.recv_sock, self.rdpipe]
 
@@ -713,8 +1285,7 @@ class SendReceiveConsumer(Interruptable):
             if r is None:
                 continue
 
-            if not self.strict or (r.hashret() == packet_hash and \
-               r.answers(packet)):
+            if not self.strict or self.matcher.match(r) is not None:
 
                 ans += 1
 
@@ -811,10 +1382,10 @@ def send_receive_packet(metapacket, count, inter, iface, strict, capmethod, \
             # Here we need a Layer 3 socket
             sock = get_socket_for(metapacket, False, iface)
 
-        sock_send = get_socket_for(metapacket, iff=iface)
-
         if not sock:
             raise Exception('Unable to create a valid socket')
+
+        sock_send = acquire_socket_for(metapacket, iff=iface)
     except socket.error, (errno, err):
         raise Exception(err)
 
@@ -830,10 +1401,10 @@ def send_receive_packet(metapacket, count, inter, iface, strict, capmethod, \
 ###############################################################################
 
 class SequenceConsumer(Interruptable):
-    # This class most probably suffers when there's repeated sequence
-    # because we destroy and then recreate various process when the refcount
-    # associated to the sockets or process reach 0. Should be optimized to
-    # better handle this situation.
+    # Packets are sent through the sockets of the SocketPool, acquired once
+    # for the whole sequence. This class still suffers when there's repeated
+    # sequence because we destroy and then recreate the receive sockets and
+    # the helper processes when their refcount reach 0.
 
     def __init__(self, tree, count, inter, iface, strict, capmethod, \
                  scallback, rcallback, sudata, rudata, excback):
@@ -866,8 +1437,13 @@ class SequenceConsumer(Interruptable):
 
         self.procs = {}
         self.sockets = []
+        self.sockets_lock = Lock()
 
-        self.recv_list = defaultdict(list)
+        # (iface, layer) -> PooledSocket used to send the packets
+        self.send_sockets = {}
+
+        # Outstanding requests. udata is a (socket or process, node) tuple
+        self.matcher = ReplyMatcher()
         self.receiving = False
 
         self.internal = False
@@ -895,6 +1471,7 @@ class SequenceConsumer(Interruptable):
         self.internal = False
 
         self.pool.stop()
+        self.__release_sockets()
         #self.pool.join_threads()
 
     def terminate(self):
@@ -950,6 +1527,7 @@ class SequenceConsumer(Interruptable):
                 self.count -= 1
 
         self.running.release()
+        self.__release_sockets()
 
         if not self.internal:
             log.debug("Stopping the thread pool (async)")
@@ -957,9 +1535,7 @@ class SequenceConsumer(Interruptable):
 
         log.debug("Finished")
 
-    def __recv_helper_worker(self, udata):
-        (process, outfile) = udata
-
+    def __recv_helper_worker(self, process):
         self.active_helpers_lock.acquire()
 
         if self.active_helpers is not None:
@@ -970,7 +1546,7 @@ class SequenceConsumer(Interruptable):
         if self.timeout is not None:
             stoptime = time.time() + self.timeout
 
-        for reader in bind_reader(process, outfile):
+        for reader in bind_reader(process):
             if self.timeout is not None:
                 remain = stoptime - time.time()
 
@@ -985,9 +1561,6 @@ class SequenceConsumer(Interruptable):
             if reader:
                 reader, outfile_size, position = reader
 
-        report_idx = 0
-        reported_packets = 0
-
         while self.running and self.receiving:
             if self.timeout is not None:
                 remain = stoptime - time.time()
@@ -997,11 +1570,15 @@ class SequenceConsumer(Interruptable):
                     log.debug("Timeout here!")
                     break
 
-            while report_idx < reported_packets:
-                report_idx = get_n_packets(self.process)
-
+            # This waits at most the reader timeout
             r = reader.read_packet()
 
+            if r is None:
+                if reader.eof:
+                    break
+
+                continue
+
             try:
                 # The helper capture packets at L2 so we need to drop the
                 # first protocol to make the match against the packets.
@@ -1013,43 +1590,23 @@ class SequenceConsumer(Interruptable):
             if not r:
                 break
 
-            is_reply = True
-            my_node = None
-            requested_process = None
-
-            if self.strict:
-                is_reply = False
-                hashret = r.hashret()
-
-                if hashret in self.recv_list:
-                    for (idx, process, node) in self.recv_list[hashret]:
-                        packet = node.get_data().packet.root
+            # In non strict mode the oldest request is answered
+            req = self.matcher.match(r, self.strict)
 
-                        if r.answers(packet):
-                            requested_process = process
-                            my_node = node
-                            is_reply = True
-
-                            break
-
-            elif not self.strict and my_node is None:
-                # Get the first packet
-
-                list = [(v, k) for k, v in self.recv_list.items()]
-                list.sort()
-
-                requested_process = list[0][0][0][1]
-                my_node = list[0][0][0][2]
+            if req is not None:
+                requested_process, my_node = req.udata
+                is_reply = True
             else:
-                continue
+                requested_process = my_node = None
+                is_reply = False
 
             # Now cleanup the sockets
             for key in self.procs:
                 if self.procs[key][0] == requested_process:
-                    self.procs[key][2] -= 1
+                    self.procs[key][1] -= 1
 
-                    if self.procs[key][2] == 0:
-                        process, outfile, refcount = self.procs[key]
+                    if self.procs[key][1] == 0:
+                        process, refcount = self.procs[key]
 
                         log.debug("Killing helper %s cause refcount == 0" % \
                                   process)
@@ -1097,7 +1654,7 @@ class SequenceConsumer(Interruptable):
 
     def __recv_worker(self):
         # Here we should receive the packet and check against
-        # recv_list if the packet match remove from the list
+        # the matcher if the packet match remove from the matcher
         # and start another send_worker
 
         if self.timeout is not None:
@@ -1105,7 +1662,7 @@ class SequenceConsumer(Interruptable):
 
         while self.internal and self.receiving:
             r = []
-            inmask = [socket for socket, refcount in self.sockets]
+            inmask = [entry[0] for entry in self.sockets]
 
             if self.timeout is not None:
                 remain = stoptime - time.time()
@@ -1145,46 +1702,31 @@ class SequenceConsumer(Interruptable):
                 if precv is None:
                     continue
 
-                is_reply = True
-                my_node = None
-                requested_socket = None
-
-                if self.strict:
-                    is_reply = False
-                    hashret = precv.hashret()
-
-                    if hashret in self.recv_list:
-                        for (idx, sock, node) in self.recv_list[hashret]:
-                            packet = node.get_data().packet.root
-
-                            if precv.answers(packet):
-                                requested_socket = sock
-                                my_node = node
-                                is_reply = True
-
-                                break
-
-                elif not self.strict and my_node is None:
-                    # Get the first packet
-
-                    list = [(v, k) for k, v in self.recv_list.items()]
-                    list.sort()
+                # In non strict mode the oldest request is answered
+                req = self.matcher.match(precv, self.strict)
 
-                    requested_socket = list[0][0][0][1]
-                    my_node = list[0][0][0][2]
+                if req is not None:
+                    requested_socket, my_node = req.udata
+                    is_reply = True
                 else:
-                    continue
+                    requested_socket = my_node = None
+                    is_reply = False
 
                 # Now cleanup the sockets
-                for idx in xrange(len(self.sockets)):
-                    if self.sockets[idx][0] == requested_socket:
-                        self.sockets[idx][1] -= 1
+                self.sockets_lock.acquire()
 
-                        if self.sockets[idx][1] == 0:
-                            self.sockets.remove(self.sockets[idx])
+                for entry in self.sockets:
+                    if entry[0] is requested_socket:
+                        entry[1] -= 1
+
+                        if entry[1] == 0:
+                            self.sockets.remove(entry)
+                            entry[0].close()
 
                         break
 
+                self.sockets_lock.release()
+
                 if is_reply:
                     self.__notify_recv(my_node, MetaPacket(precv), is_reply)
 
@@ -1212,7 +1754,8 @@ class SequenceConsumer(Interruptable):
 
         obj = node.get_data()
 
-        sock = get_socket_for(obj.packet, iff=self.iface)
+        sockkey = get_socket_key(obj.packet, iff=self.iface)
+        sock = self.__get_send_socket(sockkey)
 
         if node.is_parent():
             # Here we should add the node to the dict
@@ -1221,18 +1764,24 @@ class SequenceConsumer(Interruptable):
             # depth.
 
             if self.capmethod == 0:
+                self.sockets_lock.acquire()
 
                 try:
-                    idx = self.sockets.index(sock)
-                    self.sockets[idx][1] += 1
-                except:
-                    self.sockets.append([sock, 1])
+                    for entry in self.sockets:
+                        if entry[2] == sockkey:
+                            entry[1] += 1
+                            rsock = entry[0]
+                            break
+                    else:
+                        rsock = create_socket(*sockkey)
+                        self.sockets.append([rsock, 1, sockkey])
+                finally:
+                    self.sockets_lock.release()
 
-                key = obj.packet.root.hashret()
-                self.recv_list[key].append((len(self.recv_list), sock, node))
+                self.matcher.add(obj.packet.root, (rsock, node))
 
                 log.debug("Adding socket to the list for receiving my packet %s"
-                          % sock)
+                          % rsock)
             else:
                 # TODO: here we could create another thread that spawns tcpdump
                 # process. We have to resize also the pool directly leaving n
@@ -1242,8 +1791,8 @@ class SequenceConsumer(Interruptable):
                 iface = get_iface_from_ip(obj.packet)
 
                 if not iface in self.procs:
-                    process, outfile = run_helper(self.capmethod - 1, iface)
-                    self.procs[iface] = [process, outfile, 1]
+                    process = run_helper(self.capmethod - 1, iface)
+                    self.procs[iface] = [process, 1]
 
                     # Just increase the size of our pool to avoid starvation
                     self.pool.resize(maxthreads=self.pool.max + 1)
@@ -1251,14 +1800,13 @@ class SequenceConsumer(Interruptable):
                     # And now start a new worker
                     self.pool.queue_work(None, self.__notify_exc,
                                          self.__recv_helper_worker,
-                                         (process, outfile))
+                                         process)
                 else:
-                    self.procs[iface][2] += 1
-                    process, outfile = self.procs[iface][0:2]
+                    self.procs[iface][1] += 1
+                    process = self.procs[iface][0]
                     log.debug("A process sniffing on %s exists." % iface)
 
-                key = obj.packet.root.hashret()
-                self.recv_list[key].append((len(self.recv_list), process, node))
+                self.matcher.add(obj.packet.root, (process, node))
 
         sock.send(obj.packet.root)
 
@@ -1284,6 +1832,31 @@ class SequenceConsumer(Interruptable):
             log.debug("Last packet sent")
             self.__notify_recv(None, None, False)
 
+    def __get_send_socket(self, key):
+        self.sockets_lock.acquire()
+
+        try:
+            sock = self.send_sockets.get(key)
+
+            if sock is None:
+                sock = socket_pool.acquire(*key)
+                self.send_sockets[key] = sock
+
+            return sock
+        finally:
+            self.sockets_lock.release()
+
+    def __release_sockets(self):
+        self.sockets_lock.acquire()
+
+        try:
+            for sock in self.send_sockets.values():
+                sock.close()
+
+            self.send_sockets.clear()
+        finally:
+            self.sockets_lock.release()
+
     def __notify_exc(self, exc):
         self.scallback = None
         self.rcallback = None
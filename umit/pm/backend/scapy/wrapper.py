@@ -20,6 +20,7 @@
 
 import os
 import sys
+import cPickle
 import select as selectmod
 
 __original_write = os.write
@@ -67,6 +68,7 @@ except ImportError:
 
 from umit.pm.core.i18n import _
 from umit.pm.core.logger import log
+from umit.pm.core.const import PM_PROTOCOLS_CACHE
 from umit.pm.manager.preferencemanager import Prefs
 
 if not 'WINDOWS' in globals():
@@ -83,7 +85,8 @@ Prefs()['backend.scapy.interface'].connect(change_interface)
 # Protocols loading
 ###############################################################################
 
-def load_scapy_protocols():
+def scan_scapy_protocols():
+    "@return a list of (global name, class) of the protocols sorted by name"
     import __builtin__
     all = __builtin__.__dict__.copy()
     all.update(globals())
@@ -91,24 +94,163 @@ def load_scapy_protocols():
                     all.items())
     objlst.sort(lambda x,y:cmp(x[0],y[0]))
 
-    ret = []
+    return objlst
+
+def load_scapy_protocols():
+    return [o for n, o in scan_scapy_protocols()]
+
+def get_static_field_size(field):
+    """
+    @return the size in bits of a field if it does not depend on the value
+            or on the other fields, None otherwise
+    """
+    if isinstance(field, Emph):
+        field = field.fld
+
+    if isinstance(field, (ConditionalField, StrField)) or \
+       getattr(field, 'islist', False) or \
+       getattr(field, 'holds_packets', False):
+        return None
+
+    if hasattr(field, 'size'):
+        return field.size
+
+    sz = getattr(field, 'sz', None)
+
+    if sz is None:
+        return None
+
+    return sz * 8
+
+def get_scapy_version():
+    "@return a tuple identifying the scapy installation in use"
+    module = sys.modules.get('scapy')
+    fname = getattr(module, '__file__', '')
+
+    try:
+        mtime = os.path.getmtime(fname)
+    except OSError:
+        mtime = None
+
+    return (getattr(conf, 'version', ''), PM_USE_NEW_SCAPY, fname, mtime)
+
+class ProtocolRegistry(object):
+    """
+    Registry of the scapy protocols indexed by name and class name, with
+    the size in bits of their fields. The class names and the field sizes
+    are saved on disk and reused while the scapy installation does not
+    change, so the globals are not scanned and the fields are not inspected
+    at every start.
+    """
+
+    VERSION = 1
+
+    def __init__(self, fname=PM_PROTOCOLS_CACHE):
+        self.fname = fname
+
+        self.keys = []       # global names of the protocols
+        self.protocols = []  # sorted by global name
+        self.names = {}      # name or class name -> class
+        self.sizes = {}      # class -> [(field name, bits or None), ...]
+        self.from_cache = False
+
+        if self.load():
+            self.from_cache = True
+        else:
+            self.build()
+            self.save()
+
+        # The first protocol matching by name or by class name wins
+        for proto in self.protocols:
+            for name in (proto.name, proto.__name__):
+                if name:
+                    self.names.setdefault(name, proto)
+
+        log.debug("%d protocols registered%s." % \
+                  (len(self.protocols), self.from_cache and ' (cached)' or ''))
+
+    def build(self):
+        objlst = scan_scapy_protocols()
+
+        self.keys = [n for n, o in objlst]
+        self.protocols = [o for n, o in objlst]
+        self.sizes = {}
+
+        for proto in self.protocols:
+            self.sizes[proto] = [(field.name, get_static_field_size(field)) \
+                                 for field in proto.fields_desc]
+
+    def load(self):
+        "@return True if the protocols are loaded from the cache"
+        try:
+            f = open(self.fname, 'rb')
+
+            try:
+                version, scapy_version, entries = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception, err:
+            log.debug('Protocols cache not loaded (%s)' % str(err))
+            return False
+
+        if version != self.VERSION or scapy_version != get_scapy_version():
+            return False
 
-    for n,o in objlst:
-        ret.append(o)
+        import __builtin__
 
-    return ret
+        scope = globals()
+        builtins = __builtin__.__dict__
+        keys, protocols, sizes = [], [], {}
 
-# We use this global variable to track protocols
-gprotos = load_scapy_protocols()
+        for name, fields in entries:
+            proto = scope.get(name, None) or builtins.get(name, None)
 
-log.debug("%d protocols registered." % len(gprotos))
+            if not isinstance(proto, type) or not issubclass(proto, Packet):
+                return False
+
+            keys.append(name)
+            protocols.append(proto)
+            sizes[proto] = fields
+
+        self.keys, self.protocols, self.sizes = keys, protocols, sizes
+        return True
+
+    def save(self):
+        entries = [(name, self.sizes[proto]) \
+                   for name, proto in zip(self.keys, self.protocols)]
+        tmp = self.fname + '.tmp'
+
+        try:
+            f = open(tmp, 'wb')
+
+            try:
+                cPickle.dump((self.VERSION, get_scapy_version(), entries), f,
+                             cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+
+            os.rename(tmp, self.fname)
+        except Exception, err:
+            log.debug('Unable to save the protocols cache (%s)' % str(err))
+
+# Built on first use
+registry = None
+
+def get_registry():
+    "@return the ProtocolRegistry creating it if needed"
+    global registry
+
+    if registry is None:
+        registry = ProtocolRegistry()
+
+    return registry
 
 ###############################################################################
 # Protocols functions
 ###############################################################################
 
 def get_protocols():
-    return gprotos
+    return get_registry().protocols
 
 def get_proto_class_name(protok):
     if not protok.name or protok.name == "":
@@ -120,14 +262,73 @@ def get_proto_name(proto_inst):
     return get_proto_class_name(proto_inst)
 
 def get_proto(proto_name):
-    for proto in gprotos:
-        if proto.name == proto_name:
-            return proto
-        if proto.__name__ == proto_name:
-            return proto
+    proto = get_registry().names.get(proto_name, None)
+
+    if proto is None:
+        print "Protocol named %s not found." % proto_name
+
+    return proto
+
+def get_proto_field_sizes(proto):
+    """
+    @param proto a protocol class or instance
+    @return a list of (field name, size in bits or None if variable)
+    """
+    if not isinstance(proto, type):
+        proto = proto.__class__
+
+    sizes = get_registry().sizes.get(proto, None)
+
+    if sizes is None:
+        sizes = [(field.name, get_static_field_size(field)) \
+                 for field in proto.fields_desc]
+
+    return sizes
+
+# class -> ({id(field): static size in bits or None}, static size or None)
+layouts = {}
+
+def get_proto_layout(proto):
+    """
+    Layout of a protocol class, computed once from the fields sizes kept
+    in the registry.
+
+    @param proto a protocol class or instance
+    @return a tuple (sizes, size) where sizes maps the id() of the fields
+            in fields_desc to their static size in bits (None if variable)
+            and size is the static size in bits of the protocol (None if
+            any field is variable)
+
+    >>> get_proto_layout(Ether)[1], get_proto_layout(UDP())[1]
+    (112, 64)
+    >>> sizes, size = get_proto_layout(IP)
+    >>> [sizes[id(field)] for field in IP.fields_desc], size
+    ([4, 4, 8, 16, 16, 3, 13, 8, 8, 16, 32, 32, None], None)
+    >>> get_proto_layout(IP) is get_proto_layout(IP())
+    True
+    """
+    if not isinstance(proto, type):
+        proto = proto.__class__
 
-    print "Protocol named %s not found." % proto_name
-    return None
+    try:
+        return layouts[proto]
+    except KeyError:
+        pass
+
+    sizes = {}
+    total = 0
+
+    for field, (name, bits) in zip(proto.fields_desc,
+                                   get_proto_field_sizes(proto)):
+        sizes[id(field)] = bits
+
+        if bits is None:
+            total = None
+        elif total is not None:
+            total += bits
+
+    layout = layouts[proto] = (sizes, total)
+    return layout
 
 def get_proto_layer(proto):
     return getattr(proto, '_pm_layer', None)
@@ -146,6 +347,11 @@ def get_proto_fields(proto_inst):
 
 def get_proto_size(proto_inst):
     """@return the size of the entire protocol in bits"""
+    size = get_proto_layout(proto_inst)[1]
+
+    if size is not None:
+        return size
+
     size = 0
 
     for field in get_proto_fields(proto_inst):
@@ -190,6 +396,10 @@ def get_field_desc(field):
     if not field:
         return _('No description')
 
+    # The documentation is parsed the first time it is shown
+    from umit.pm.backend.scapy.doc import apply_doc
+    apply_doc()
+
     if field.__doc__:
         return field.__doc__
     else:
@@ -208,6 +418,11 @@ def get_field_value_repr(proto, field):
     return field.i2repr(proto, getattr(proto, field.name))
 
 def get_field_size(proto, field):
+    size = get_proto_layout(proto)[0].get(id(field), None)
+
+    if size is not None:
+        return size
+
     if isinstance(field, StrField):
         try:
             # We have to manage in a different way the StrField
@@ -222,21 +437,14 @@ def get_field_size(proto, field):
         return field.sz * 8
 
 def get_field_offset(packet, proto, field):
-    bits = 0
-
-    child = packet.root
-
-    while not isinstance(child, NoPayload) and proto != child:
-        for f in child.fields_desc:
-            bits += get_field_size(child, f)
-
-        child = child.payload
+    # The offsets of all the fields are memoized on the MetaPacket
+    layout = packet.get_layer_layout(proto)
 
-    for f in child.fields_desc:
-        if field == f:
-            return bits
+    if layout is not None:
+        offset = layout[2].get(id(field), None)
 
-        bits += get_field_size(child, f)
+        if offset is not None:
+            return offset
 
     raise Exception('Field or protocol is not present in the packet')
 
@@ -206,6 +206,10 @@ class MetaPacket:
     def get_raw(self):
         return get_packet_raw(self)
 
+    def invalidate(self):
+        # Nothing is cached here
+        pass
+
     def complete(self):
         return False
 
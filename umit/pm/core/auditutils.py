@@ -20,6 +20,23 @@
 
 """
 General purpose functions used by various audit plugins goes here.
+
+The pure python checksum functions return the same values and types of the
+_checksum extension, also when the partial sum is a long (like the lengths
+computed from scapy fields):
+
+>>> data = '\\x45\\x00\\x00\\x3c\\x1c\\x46\\x40\\x00\\x40\\x06'
+>>> _checksum_add(data, initial=6L), type(_checksum_add(data, initial=6L))
+(57742, <type 'int'>)
+>>> checksum_add(data, 0, None, 6L) == _checksum_add(data, 0, None, 6L)
+True
+>>> type(checksum_add(data, 0, None, 6L)), type(checksum(data))
+(<type 'int'>, <type 'int'>)
+>>> pseudo = checksum_pseudo('\\x0a\\x00\\x00\\x01', '\\x0a\\x00\\x00\\x02', 6, 20L)
+>>> hex(pseudo), type(pseudo)
+('0x141d', <type 'int'>)
+>>> _checksum_batch([data, (data, 6L)]) == checksum_batch([data, (data, 6L)])
+True
 """
 
 import re
@@ -33,28 +50,103 @@ from socket import inet_ntoa, inet_aton, gethostbyname
 
 from umit.pm.core.netconst import IL_TYPE_ETH
 
-# Code ripped from scapy
+################################################################################
+# Internet checksum
+################################################################################
+
 BIG_ENDIAN= pack("H",1) == "\x00\x01"
 
-if BIG_ENDIAN:
-    def checksum(pkt):
-        if len(pkt) % 2 == 1:
-            pkt += "\0"
-        s = sum(array("H", pkt))
-        s = (s >> 16) + (s & 0xffff)
-        s += s >> 16
-        s = ~s
-        return s & 0xffff
-else:
-    def checksum(pkt):
-        if len(pkt) % 2 == 1:
-            pkt += "\0"
-        s = sum(array("H", pkt))
+# checksum_add() and checksum_batch() are provided by the _checksum extension
+# if it's available. The following are the pure python fallbacks.
+
+def _checksum_add(data, start=0, end=None, initial=0):
+    """
+    Compute the one's complement sum of the 16 bit words of data[start:end]
+    in network byte order. The sum could be chained by passing the result of
+    a previous call as initial so a checksum could be verified without
+    building a copy of the packet. Only the last chunk could have an odd
+    length.
+
+    @param data a str or a buffer
+    @param start the start offset (should be even)
+    @param end the end offset or None
+    @param initial a partial sum to add
+    @return the folded sum as int (not complemented)
+    """
+    if start or end is not None or data.__class__ is not str:
+        data = data[start:end]
+
+    if len(data) & 1:
+        data += "\0"
+
+    s = sum(array("H", data))
+    s = (s >> 16) + (s & 0xffff)
+    s += s >> 16
+
+    if BIG_ENDIAN:
+        s = (s & 0xffff) + initial
+    else:
+        s = (((s >> 8) & 0xff) | ((s & 0xff) << 8)) + initial
+
+    s = (s >> 16) + (s & 0xffff)
+
+    # initial could be a long (scapy fields) while the extension returns int
+    return int((s >> 16) + (s & 0xffff))
+
+def _checksum_batch(buffers):
+    """
+    @param buffers a sequence of str or (str, initial) tuples
+    @return a list containing the checksum of each buffer
+    """
+    ret = []
+
+    for buf in buffers:
+        if isinstance(buf, tuple):
+            ret.append(~_checksum_add(buf[0], initial=buf[1]) & 0xffff)
+        else:
+            ret.append(~_checksum_add(buf) & 0xffff)
+
+    return ret
+
+try:
+    from umit.pm.core._checksum import checksum_add, checksum_batch
+except ImportError:
+    checksum_add, checksum_batch = _checksum_add, _checksum_batch
+
+def checksum(pkt):
+    """
+    @param pkt a str
+    @return the internet checksum of pkt as int in network byte order
+    """
+    return ~checksum_add(pkt) & 0xffff
+
+def checksum_pseudo(src, dst, proto, length):
+    """
+    @param src the IPv4 source address as packed str
+    @param dst the IPv4 destination address as packed str
+    @param proto the transport protocol
+    @param length the length of the transport segment
+    @return the partial sum of the TCP/UDP pseudo header to be passed as
+            initial to checksum_add()
+    """
+    return checksum_add(src + dst, 0, None, proto + length)
+
+def checksum_update(chksum, old, new):
+    """
+    Incrementally update a checksum as described in RFC 1624 (eqn. 3) after
+    the data old has been replaced by new.
+
+    @param chksum the previous checksum
+    @param old the old data (str of even length at an even offset)
+    @param new the new data (str of the same length)
+    @return the updated checksum
+    """
+    s = (~chksum & 0xffff) + (~checksum_add(old) & 0xffff) + checksum_add(new)
+
+    while s >> 16:
         s = (s >> 16) + (s & 0xffff)
-        s += s >> 16
-        s = ~s
-        return (((s>>8)&0xff)|s<<8) & 0xffff
 
+    return ~s & 0xffff
 
 def audit_unittest(parameters, pcap=None, dl=IL_TYPE_ETH):
     cmd = 'python audittester.py -q -t%d %s %s' % (dl, parameters,
@@ -0,0 +1,181 @@
+/*
+ * Copyright (C) 2009 Adriano Monteiro Marques
+ *
+ * Author: Francesco Piccinno <stack.box@gmail.com>
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 2 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+ */
+
+/*
+ * Native implementation of the one's complement sum used by the internet
+ * checksum (RFC 1071). See umit/pm/core/auditutils.py for the pure python
+ * fallback and for the documentation of the exported functions.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+static unsigned long
+fold(unsigned long long sum)
+{
+  while (sum >> 16)
+    sum = (sum & 0xffff) + (sum >> 16);
+
+  return (unsigned long)sum;
+}
+
+/* Sum of the big endian 16 bit words of buf. An odd trailing byte is padded
+ * with a zero byte. */
+static unsigned long
+sum_buffer(const unsigned char *buf, Py_ssize_t len, unsigned long initial)
+{
+  unsigned long long sum = initial;
+
+  while (len >= 8)
+    {
+      sum += ((buf[0] << 8) | buf[1]) + ((buf[2] << 8) | buf[3]) +
+             ((buf[4] << 8) | buf[5]) + ((buf[6] << 8) | buf[7]);
+      buf += 8;
+      len -= 8;
+    }
+
+  while (len > 1)
+    {
+      sum += (buf[0] << 8) | buf[1];
+      buf += 2;
+      len -= 2;
+    }
+
+  if (len)
+    sum += buf[0] << 8;
+
+  return fold(sum);
+}
+
+static void
+clamp_range(Py_ssize_t size, Py_ssize_t *start, Py_ssize_t *end)
+{
+  if (*start < 0)
+    *start = (*start + size < 0) ? 0 : *start + size;
+  if (*end < 0)
+    *end = (*end + size < 0) ? 0 : *end + size;
+
+  if (*start > size)
+    *start = size;
+  if (*end > size)
+    *end = size;
+  if (*end < *start)
+    *end = *start;
+}
+
+static PyObject *
+pm_checksum_add(PyObject *self, PyObject *args)
+{
+  const char *data;
+  Py_ssize_t size, start = 0, end;
+  PyObject *end_obj = Py_None;
+  unsigned long initial = 0, sum;
+
+  if (!PyArg_ParseTuple(args, "s#|nOk:checksum_add", &data, &size, &start,
+                        &end_obj, &initial))
+    return NULL;
+
+  if (end_obj == Py_None)
+    end = size;
+  else
+    {
+      end = PyInt_AsSsize_t(end_obj);
+
+      if (end == -1 && PyErr_Occurred())
+        return NULL;
+    }
+
+  clamp_range(size, &start, &end);
+
+  sum = sum_buffer((const unsigned char *)data + start, end - start,
+                   fold(initial));
+
+  return PyInt_FromLong(sum);
+}
+
+static PyObject *
+pm_checksum_batch(PyObject *self, PyObject *args)
+{
+  PyObject *seq, *fast, *ret, *item, *value;
+  unsigned long initial;
+  const char *data;
+  Py_ssize_t idx, count, size;
+
+  if (!PyArg_ParseTuple(args, "O:checksum_batch", &seq))
+    return NULL;
+
+  if (!(fast = PySequence_Fast(seq, "checksum_batch() needs a sequence")))
+    return NULL;
+
+  count = PySequence_Fast_GET_SIZE(fast);
+
+  if (!(ret = PyList_New(count)))
+    {
+      Py_DECREF(fast);
+      return NULL;
+    }
+
+  for (idx = 0; idx < count; idx++)
+    {
+      item = PySequence_Fast_GET_ITEM(fast, idx);
+      initial = 0;
+
+      if (PyTuple_Check(item))
+        {
+          if (!PyArg_ParseTuple(item, "s#k:checksum_batch", &data, &size,
+                                &initial))
+            goto error;
+        }
+      else if (PyObject_AsReadBuffer(item, (const void **)&data, &size) < 0)
+        goto error;
+
+      value = PyInt_FromLong(~sum_buffer((const unsigned char *)data, size,
+                                         fold(initial)) & 0xffff);
+
+      if (!value)
+        goto error;
+
+      PyList_SET_ITEM(ret, idx, value);
+    }
+
+  Py_DECREF(fast);
+  return ret;
+
+error:
+  Py_DECREF(fast);
+  Py_DECREF(ret);
+  return NULL;
+}
+
+static PyMethodDef checksum_methods[] = {
+  {"checksum_add", pm_checksum_add, METH_VARARGS,
+   "checksum_add(data, start=0, end=None, initial=0) -> one's complement "
+   "sum of data[start:end] added to initial"},
+  {"checksum_batch", pm_checksum_batch, METH_VARARGS,
+   "checksum_batch(buffers) -> list of internet checksums"},
+  {NULL, NULL, 0, NULL}
+};
+
+PyMODINIT_FUNC
+init_checksum(void)
+{
+  Py_InitModule3("_checksum", checksum_methods,
+                 "Native internet checksum routines");
+}
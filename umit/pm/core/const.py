@@ -50,6 +50,8 @@ PM_HOME = os.path.join(HOME, '.PacketManipulator')
 PM_PLUGINS_DIR = os.path.join(PM_HOME, 'plugins')
 PM_PLUGINS_TEMP_DIR = os.path.join(PM_PLUGINS_DIR, 'plugins-temp')
 PM_PLUGINS_DOWNLOAD_DIR = os.path.join(PM_PLUGINS_DIR, 'plugins-download')
+PM_PLUGINS_CACHE = os.path.join(PM_HOME, 'plugins-cache.db')
+PM_PROTOCOLS_CACHE = os.path.join(PM_HOME, 'protocols-cache.db')
 
 main_dir = os.path.abspath(os.path.dirname(sys.argv[0]))
 main_dir = os.path.dirname(main_dir)
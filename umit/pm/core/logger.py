@@ -21,16 +21,47 @@
 """
 Logger module
 
-Use PM_LOGLEVEL to set the loglevel and
-    PM_LOGEXCLUDE to exclude certain log records
+Use PM_LOGLEVEL to set the loglevel,
+    PM_LOGCATEGORIES to set the loglevel of categories (tcp=10,ip=20),
+    PM_LOGEXCLUDE to exclude certain log records and
+    PM_LOGASYNC to write the log records from a separate thread
+
+Pass the format arguments to debug(), info() ... instead of formatting the
+message with %, so the message is formatted only if the record is emitted.
+The methods of the disabled levels are replaced by a no-op and the
+debug_enabled, info_enabled ... attributes could be checked to skip even
+the call on the packet path:
+
+    tcp_log = log.category('tcp')
+
+    if tcp_log.debug_enabled:
+        tcp_log.debug('Appending %s after %s', packet, prev)
+
+PM_LOGEXCLUDE is matched against the category, the file, the line and the
+function of the call site (like "tcp main.py:880 add_from_skb()") once for
+every call site, so messages are never formatted just to be discarded. The
+categories matching PM_LOGEXCLUDE are disabled.
 """
 
 import os
 import re
+import sys
+import atexit
+
+from Queue import Queue, Full
+from threading import Thread
 
-from logging import Logger, StreamHandler, Formatter, addLevelName
+from logging import Logger, Handler, StreamHandler, Formatter, Filter, \
+                    addLevelName, DEBUG, INFO, WARNING, ERROR, CRITICAL
 from logging import __status__ as STATUS
 
+LEVELS = (('debug', DEBUG), ('info', INFO), ('warning', WARNING),
+          ('error', ERROR), ('critical', CRITICAL))
+
+# The frames of this module and of logging are skipped by findCaller()
+_srcfiles = [os.path.normcase(os.path.splitext(fname)[0] + '.py') \
+             for fname in (__file__, sys.modules[Logger.__module__].__file__)]
+
 # Avoid coloring the terminal if PM_NOCOLORTERM is setted
 if os.name == 'posix' and not os.getenv('PM_NOCOLORTERM', ''):
     reset = "\033[1;0m"
@@ -54,45 +85,252 @@ else:
     addLevelName(40, '%sERR%s' % (red, reset))
     addLevelName(50, '%sCRI%s' % (red, reset))
 
+def _noop(*args, **kwargs):
+    pass
+
 class PMLogHandler(StreamHandler):
-    def __init__(self):
-        regex = os.getenv('PM_LOGEXCLUDE', '')
+    pass
 
-        if regex:
-            try:
-                rex = re.compile(regex)
-                print "Using %s to filter logging" % regex
-                self.rex = rex
-            except:
-                print "Error while compiling except regex %s" % regex
-                self.rex = None
-        else:
-            self.rex = None
+class CallSiteFilter(Filter):
+    """
+    Filter out the records whose call site matches a regex. The regex is
+    matched only the first time a call site logs.
+    """
+
+    def __init__(self, rex):
+        Filter.__init__(self)
+
+        self.rex = rex
+        self.sites = {}
+
+    def filter(self, record):
+        category = getattr(record, 'category', record.name)
+        key = (category, record.pathname, record.lineno)
+
+        try:
+            return self.sites[key]
+        except KeyError:
+            ret = not self.rex.search('%s %s:%d %s()' % \
+                                      (category, record.filename,
+                                       record.lineno, record.funcName))
+            self.sites[key] = ret
+            return ret
 
-        StreamHandler.__init__(self)
+class AsyncLogHandler(Handler):
+    """
+    Handler passing the records to another handler in a separate thread,
+    so the threads logging never wait for the I/O. When maxsize records are
+    pending the new ones are dropped and counted in dropped.
+    """
+
+    def __init__(self, target, maxsize=10000):
+        Handler.__init__(self)
+
+        self.target = target
+        self.queue = Queue(maxsize)
+        self.dropped = 0
+
+        self.thread = Thread(target=self.__run, name='LogHandler')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def __run(self):
+        while True:
+            record = self.queue.get()
+
+            if record is None:
+                break
+
+            self.target.handle(record)
 
     def emit(self, record):
-        if self.rex and self.rex.findall(self.format(record)):
-            return
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def close(self):
+        "Write the pending records and stop the thread"
+        if self.thread.isAlive():
+            self.queue.put(None)
+            self.thread.join()
+
+        Handler.close(self)
+
+class LogCategory(object):
+    """
+    A named category of records (a subsystem or an audit) with its own
+    level. The records are emitted through the logger.
+    """
+
+    def __init__(self, logger, name, level=None):
+        """
+        @param logger the PMLogger
+        @param name the name of the category
+        @param level the level or None to follow the one of the logger
+        """
+        self.logger = logger
+        self.name = name
+        self.level = level
+        self.extra = {'category' : name}
+        self.excluded = logger.is_excluded(name)
+
+        self.update()
+
+    def setLevel(self, level):
+        "@param level the level or None to follow the one of the logger"
+        self.level = level
+        self.update()
+
+    def get_effective_level(self):
+        if self.level is None:
+            return self.logger.level
+
+        return self.level
+
+    def isEnabledFor(self, level):
+        return not self.excluded and level >= self.get_effective_level()
+
+    def update(self):
+        "Bind the methods of the enabled levels and no-op the others"
+        for name, level in LEVELS:
+            enabled = self.isEnabledFor(level)
+
+            setattr(self, name + '_enabled', enabled)
+            setattr(self, name, enabled and self.__method(level) or _noop)
+
+        self.warn = self.warning
 
-        StreamHandler.emit(self, record)
+    def __method(self, level):
+        _log, extra = self.logger._log, self.extra
+
+        def method(msg, *args, **kwargs):
+            kwargs['extra'] = extra
+            _log(level, msg, args, **kwargs)
+
+        return method
+
+    def exception(self, msg, *args):
+        self.error(msg, exc_info=1, *args)
 
 class PMLogger(Logger, object):
     def __init__(self, name, level):
+        self.categories = {}
+        self.category_levels = {}
+
         Logger.__init__(self, name, level)
         self.formatter = self.format
 
+        self.exclude = None
+        regex = os.getenv('PM_LOGEXCLUDE', '')
+
+        if regex:
+            try:
+                self.exclude = re.compile(regex)
+                print "Using %s to filter logging" % regex
+                self.addFilter(CallSiteFilter(self.exclude))
+            except:
+                print "Error while compiling except regex %s" % regex
+
+        for spec in os.getenv('PM_LOGCATEGORIES', '').split(','):
+            if not spec:
+                continue
+
+            try:
+                name, value = spec.split('=', 1)
+                self.category_levels[name.strip()] = int(value)
+            except ValueError:
+                print "Wrong category level %s" % spec
+
         self.handler = PMLogHandler()
         self.handler.setFormatter(self.formatter)
+        self.async_handler = None
 
         self.addHandler(self.handler)
 
+        if os.getenv('PM_LOGASYNC', ''):
+            self.set_async(True)
+
+        self.update()
+
     def get_formatter(self):
         return self.__formatter
 
     def set_formatter(self, fmt):
         self.__formatter = Formatter(fmt)
 
+    def setLevel(self, level):
+        Logger.setLevel(self, level)
+        self.update()
+
+    def update(self):
+        """
+        Replace the methods of the disabled levels with a no-op and update
+        the categories following the level of the logger.
+        """
+        for name, level in LEVELS:
+            enabled = level >= self.level
+
+            setattr(self, name + '_enabled', enabled)
+
+            if enabled:
+                self.__dict__.pop(name, None)
+            else:
+                setattr(self, name, _noop)
+
+        self.__dict__.pop('warn', None)
+
+        if not self.warning_enabled:
+            self.warn = _noop
+
+        for category in self.categories.values():
+            category.update()
+
+    def is_excluded(self, name):
+        "@return True if the category name matches PM_LOGEXCLUDE"
+        return bool(self.exclude and self.exclude.search(name))
+
+    def category(self, name):
+        "@return the LogCategory named name creating it if needed"
+        try:
+            return self.categories[name]
+        except KeyError:
+            category = LogCategory(self, name,
+                                   self.category_levels.get(name, None))
+            return self.categories.setdefault(name, category)
+
+    def findCaller(self, *args):
+        "Like Logger.findCaller() but skipping also the LogCategory frames"
+        f = sys._getframe(1)
+
+        while f is not None:
+            if os.path.normcase(f.f_code.co_filename) not in _srcfiles:
+                return (f.f_code.co_filename, f.f_lineno, f.f_code.co_name)
+
+            f = f.f_back
+
+        return "(unknown file)", 0, "(unknown function)"
+
+    def set_async(self, enabled):
+        """
+        Write the records from a separate thread (enabled) or from the
+        thread logging. The pending records are written before exiting.
+        """
+        if enabled and not self.async_handler:
+            self.async_handler = AsyncLogHandler(self.handler)
+
+            self.removeHandler(self.handler)
+            self.addHandler(self.async_handler)
+
+            atexit.register(self.set_async, False)
+
+        elif not enabled and self.async_handler:
+            self.removeHandler(self.async_handler)
+            self.addHandler(self.handler)
+
+            self.async_handler.close()
+            self.async_handler = None
+
     format = "(%(levelname)s) %(threadName)s:%(msecs)dms at %(filename)s:" \
              "%(lineno)d $(): %(message)s".replace("$",
         (STATUS != "beta") and ("%(funcName)s") or ("")
@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Lightweight metrics: counters, gauges and latency histograms.
+
+The metrics are registered by name in the metrics registry of this module.
+The code on the packet path updates them only when metrics.enabled is True
+and the decoders and the hooks are wrapped with a timer only while the
+metrics are enabled, so disabled metrics cost a boolean check at most.
+Gauges are pulled: they are usually a callable reading the size of a table
+only when a snapshot is taken.
+
+Updates are not locked, so a concurrent update could be lost. That's fine
+for statistics and keeps the updates cheap.
+
+>>> reg = MetricsRegistry()
+>>> reg.enable()
+>>> pkts = reg.counter('sniff.packets')
+>>> pkts.inc(); pkts.inc(2); pkts.value
+3
+>>> table = {'a' : 1}
+>>> gauge = reg.gauge('table.size', lambda: len(table))
+>>> lat = reg.histogram('decoder.latency')
+>>> for usecs in (1, 2, 3, 100, 1000):
+...     lat.record(usecs)
+>>> lat.count, lat.min, lat.max, lat.percentile(50)
+(5, 1, 1000, 3)
+>>> lat.percentile(100) >= 1000 * 0.97
+True
+>>> snap = reg.snapshot()
+>>> snap['table.size']['value'], snap['sniff.packets']['value']
+(1, 3)
+>>> print reg.dump(snap).splitlines()[-1]
+table.size                                  1
+"""
+
+import sys
+import time
+
+from math import frexp
+from threading import Thread, Event, Lock
+
+from umit.pm.core.logger import log
+
+try:
+    import json
+except ImportError:
+    json = None
+
+__all__ = ['metrics', 'MetricsRegistry', 'MetricsDumper', 'Counter',
+           'Gauge', 'Histogram']
+
+class Counter(object):
+    "A monotonic counter"
+
+    type = 'counter'
+
+    def __init__(self, name, desc=''):
+        self.name = name
+        self.desc = desc
+        self.value = 0
+
+    def inc(self, count=1):
+        self.value += count
+
+    def reset(self):
+        self.value = 0
+
+    def snapshot(self):
+        return {'type' : self.type, 'value' : self.value}
+
+class Gauge(object):
+    "A value that could go up and down, set or read through a callable"
+
+    type = 'gauge'
+
+    def __init__(self, name, func=None, desc=''):
+        """
+        @param func a callable returning the current value or None
+        """
+        self.name = name
+        self.desc = desc
+        self.func = func
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def get_value(self):
+        if self.func is None:
+            return self._value
+
+        try:
+            return self.func()
+        except Exception, err:
+            log.debug('Unable to read gauge %s (%s)' % (self.name, str(err)))
+            return None
+
+    def reset(self):
+        self._value = 0
+
+    def snapshot(self):
+        return {'type' : self.type, 'value' : self.value}
+
+    value = property(get_value, set)
+
+class Histogram(object):
+    """
+    A histogram of integer values (microseconds for latencies) with log
+    linear buckets like HdrHistogram: every power of two is split in
+    SUB_BUCKETS buckets so the relative error is below 1 / SUB_BUCKETS.
+    """
+
+    type = 'histogram'
+
+    SUB_BITS = 5
+    SUB_BUCKETS = 1 << SUB_BITS
+
+    def __init__(self, name, desc=''):
+        self.name = name
+        self.desc = desc
+        self.reset()
+
+    def reset(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        value = int(value)
+
+        if value < 0:
+            value = 0
+
+        if value < 2 * self.SUB_BUCKETS:
+            idx = value
+        else:
+            # frexp gives the number of bits of value
+            shift = frexp(value)[1] - self.SUB_BITS - 1
+            idx = (shift + 1) * self.SUB_BUCKETS + \
+                  (value >> shift) - self.SUB_BUCKETS
+
+        self.buckets[idx] = self.buckets.get(idx, 0) + 1
+        self.count += 1
+        self.total += value
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def get_bucket_value(self, idx):
+        "@return the lowest value falling in the bucket idx"
+        shift = max(0, idx / self.SUB_BUCKETS - 1)
+        return (idx - shift * self.SUB_BUCKETS) << shift
+
+    def percentile(self, perc):
+        """
+        @param perc a percentile between 0 and 100
+        @return the value at the given percentile or None if empty
+        """
+        if not self.count:
+            return None
+
+        rank = max(1, int(round(self.count * perc / 100.0)))
+        seen = 0
+
+        for idx in sorted(self.buckets):
+            seen += self.buckets[idx]
+
+            if seen >= rank:
+                return min(max(self.get_bucket_value(idx), self.min),
+                           self.max)
+
+        return self.max
+
+    def get_mean(self):
+        if not self.count:
+            return None
+
+        return float(self.total) / self.count
+
+    def snapshot(self):
+        return {'type' : self.type, 'count' : self.count,
+                'min' : self.min, 'max' : self.max, 'mean' : self.get_mean(),
+                'p50' : self.percentile(50), 'p90' : self.percentile(90),
+                'p99' : self.percentile(99)}
+
+    mean = property(get_mean)
+
+class MetricsRegistry(object):
+    "The registry holding the metrics by name"
+
+    def __init__(self):
+        self.lock = Lock()
+        self.enabled = False
+        self.metrics = {}
+        self.listeners = []
+
+    def __get(self, klass, name, *args):
+        self.lock.acquire()
+
+        try:
+            metric = self.metrics.get(name, None)
+
+            if not isinstance(metric, klass):
+                metric = self.metrics[name] = klass(name, *args)
+
+            return metric
+        finally:
+            self.lock.release()
+
+    def counter(self, name, desc=''):
+        "@return the Counter named name creating it if needed"
+        return self.__get(Counter, name, desc)
+
+    def gauge(self, name, func=None, desc=''):
+        """
+        @param func a callable returning the value. It replaces the one of
+               an already registered gauge.
+        @return the Gauge named name creating it if needed
+        """
+        gauge = self.__get(Gauge, name, func, desc)
+
+        if func is not None:
+            gauge.func = func
+
+        return gauge
+
+    def histogram(self, name, desc=''):
+        "@return the Histogram named name creating it if needed"
+        return self.__get(Histogram, name, desc)
+
+    def get(self, name):
+        return self.metrics.get(name, None)
+
+    def names(self):
+        return sorted(self.metrics.keys())
+
+    def timed(self, name, func):
+        """
+        @return a callable recording the execution time of func in usecs in
+                the histogram named name
+        """
+        hist = self.histogram(name)
+        clock = time.time
+
+        def proxy(*args, **kwargs):
+            start = clock()
+
+            try:
+                return func(*args, **kwargs)
+            finally:
+                hist.record((clock() - start) * 1000000)
+
+        proxy.__name__ = getattr(func, '__name__', 'proxy')
+        proxy.__doc__ = func.__doc__
+        proxy.timed = func
+
+        return proxy
+
+    # Enable / disable
+
+    def connect(self, callback):
+        "callback(enabled) is called every time the metrics are toggled"
+        self.listeners.append(callback)
+
+    def disconnect(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def set_enabled(self, enabled):
+        enabled = bool(enabled)
+
+        if enabled == self.enabled:
+            return
+
+        self.enabled = enabled
+
+        log.debug('Metrics %s' % (enabled and 'enabled' or 'disabled'))
+
+        for callback in self.listeners[:]:
+            callback(enabled)
+
+    def enable(self):
+        self.set_enabled(True)
+
+    def disable(self):
+        self.set_enabled(False)
+
+    # Pull API
+
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def snapshot(self):
+        "@return a dict name -> dict with the values of the metric"
+        return dict([(name, metric.snapshot()) \
+                     for name, metric in self.metrics.items()])
+
+    def dump(self, snapshot=None, format='text', prev=None, elapsed=None):
+        """
+        @param snapshot a dict returned by snapshot() or None to take it now
+        @param format 'text' or 'json'
+        @param prev a previous snapshot used to compute the rate of counters
+        @param elapsed seconds between prev and snapshot
+        @return a str
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+
+        if prev is not None and elapsed:
+            for name, snap in snapshot.items():
+                if snap['type'] == 'counter' and name in prev:
+                    snap['rate'] = (snap['value'] - prev[name]['value']) / \
+                                   float(elapsed)
+
+        if format == 'json':
+            if json is None:
+                raise Exception('json module not available')
+
+            return json.dumps({'time' : time.time(), 'metrics' : snapshot},
+                              sort_keys=True)
+
+        lines = []
+
+        for name in sorted(snapshot):
+            snap = snapshot[name]
+
+            if snap['type'] == 'histogram':
+                if not snap['count']:
+                    continue
+
+                lines.append('%-32s %12d  mean %.1f p50 %s p90 %s p99 %s '
+                             'max %s' % (name, snap['count'], snap['mean'],
+                                         snap['p50'], snap['p90'],
+                                         snap['p99'], snap['max']))
+            elif 'rate' in snap:
+                lines.append('%-32s %12s  %.1f/s' % (name, snap['value'],
+                                                     snap['rate']))
+            else:
+                lines.append('%-32s %12s' % (name, snap['value']))
+
+        return '\n'.join(lines)
+
+class MetricsDumper(Thread):
+    "Thread dumping periodically the metrics for headless runs"
+
+    def __init__(self, registry, out=None, interval=5, format='text'):
+        """
+        @param registry a MetricsRegistry
+        @param out a file object or a path (appended) or None for stderr
+        @param interval seconds between two dumps
+        @param format 'text' or 'json' (a line per dump)
+        """
+        Thread.__init__(self, name='MetricsDumper')
+        self.setDaemon(True)
+
+        self.registry = registry
+        self.out = out
+        self.interval = interval
+        self.format = format
+        self.finished = Event()
+
+        self.prev = None
+        self.prev_time = None
+
+    def dump(self):
+        now = time.time()
+        snapshot = self.registry.snapshot()
+        elapsed = self.prev_time and now - self.prev_time or None
+
+        data = self.registry.dump(snapshot, self.format, self.prev, elapsed)
+
+        self.prev, self.prev_time = snapshot, now
+
+        if self.format == 'text':
+            data = '--- %s\n%s\n' % (time.strftime('%H:%M:%S'), data)
+        else:
+            data += '\n'
+
+        if self.out is None:
+            sys.stderr.write(data)
+        elif isinstance(self.out, basestring):
+            f = open(self.out, 'a')
+
+            try:
+                f.write(data)
+            finally:
+                f.close()
+        else:
+            self.out.write(data)
+            self.out.flush()
+
+    def run(self):
+        while not self.finished.isSet():
+            self.finished.wait(self.interval)
+
+            try:
+                self.dump()
+            except Exception, err:
+                log.warning('Unable to dump the metrics (%s)' % str(err))
+
+    def stop(self):
+        "Stop the thread. The last dump is done before returning."
+        self.finished.set()
+
+        if self.isAlive():
+            self.join()
+
+# The global registry
+metrics = MetricsRegistry()
@@ -28,10 +28,12 @@ import gobject
 
 import os
 import sys
+import time
 
 from optparse import OptionParser
 
 from umit.pm.core.i18n import _
+from umit.pm.core.logger import log
 from umit.pm.core.atoms import Singleton
 from umit.pm.core.bus import services_boot, ServiceBus
 
@@ -49,6 +51,10 @@ class PMApp(Singleton):
         """
         gobject.threads_init()
 
+        # Startup timings reported once the main window is ready
+        self.start_time = time.time()
+        self.phase_times = []
+
         self._args = args
         root = False
 
@@ -99,6 +105,7 @@ class PMApp(Singleton):
         self.splash = SplashScreen()
 
     def _idle(self):
+        start = time.time()
 
         if self.phase == 0:
             self.splash.text = _("Registering icons ...")
@@ -121,6 +128,9 @@ class PMApp(Singleton):
             self.plugin_engine = PluginEngine()
             self.plugin_engine.load_selected_plugins()
 
+            self.phase_times.append(time.time() - start)
+            self._report_startup()
+
             # Destroy the splash screen
             self.splash.hide()
             self.splash.destroy()
@@ -148,9 +158,25 @@ class PMApp(Singleton):
 
             return False
 
+        self.phase_times.append(time.time() - start)
         self.phase += 1
         return True
 
+    def _report_startup(self):
+        "Log the time spent in the startup phases"
+
+        engine = self.plugin_engine
+        kind = engine.cache_misses and 'cold' or 'warm'
+
+        log.info("Startup (%s) completed in %.3f secs" % \
+                 (kind, time.time() - self.start_time))
+        log.info("  phases: %s" % ', '.join(['%.3f' % secs \
+                                             for secs in self.phase_times]))
+        log.info("  plugins: %d available (%d cached, %d parsed) scanned in "
+                 "%.3f secs, enabled ones loaded in %.3f secs" % \
+                 (len(engine.available_plugins), engine.cache_hits,
+                  engine.cache_misses, engine.scan_time, engine.load_time))
+
     def run(self):
         self.splash.show_all()
         gobject.idle_add(self._idle)
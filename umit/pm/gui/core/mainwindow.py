@@ -62,6 +62,7 @@ from umit.pm.gui.tabs.vtetab import VteTab
 from umit.pm.gui.tabs.maintab import MainTab
 from umit.pm.gui.tabs.hacktab import HackTab
 from umit.pm.gui.tabs.statustab import StatusTab
+from umit.pm.gui.tabs.statstab import StatisticsTab
 from umit.pm.gui.tabs.consoletab import ConsoleTab
 from umit.pm.gui.tabs.propertytab import PropertyTab
 from umit.pm.gui.tabs.hostlisttab import HostListTab
@@ -596,6 +597,8 @@ class MainWindow(gtk.Window):
                           Prefs()['gui.views.console_tab'].value)
         self.register_tab(HostListTab(),
                           Prefs()['gui.views.hostlist_tab'].value)
+        self.register_tab(StatisticsTab(),
+                          Prefs()['gui.views.stats_tab'].value)
 
         self.add(self.vbox)
 
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Rows of the packet list shown by the sniff perspective. This module doesn't
+depend on gtk: the PacketListModel of the sniff page only wraps a PacketRows
+object.
+"""
+
+from collections import deque
+
+# Number of packets whose column strings are cached. It has to be greater
+# than the number of rows visible at the same time.
+ROW_CACHE_SIZE = 512
+
+class PacketRows(object):
+    """
+    The rows of a packet list (a PacketStore or a plain list). The packets
+    are not copied: a row is only the index of a packet in the list.
+
+    With a DisplayFilter only the matching packets are rows. The filter
+    is applied only to the packets added since the last grow().
+
+    The rows only grow. If the context starts again with a new list or
+    the filter changes a new object has to be created.
+
+    >>> rows = PacketRows(['first', 'second', 'third', 'fourth'])
+    >>> len(rows), rows.grow(2)
+    (0, [0, 1])
+    >>> len(rows), rows.get_packet(1), rows.get_index(1)
+    (2, 'second', 1)
+    >>> rows.grow(2), rows.scanned
+    ([2, 3], 4)
+    >>> rows.grow(0)
+    []
+
+    Only the packets passing the filter are rows:
+
+    >>> class OddFilter(object):
+    ...     def filter(self, packets, start, end):
+    ...         return [idx for idx in xrange(start, end) if idx % 2]
+    >>> rows = PacketRows(rows.packets, OddFilter())
+    >>> rows.grow(3), rows.get_packet(0), rows.get_index(0)
+    ([0], 'second', 1)
+    >>> rows.grow(1), rows.get_packet(1), rows.scanned
+    ([1], 'fourth', 4)
+    >>> len(rows)
+    2
+    """
+
+    def __init__(self, packets=None, dfilter=None):
+        if packets is None:
+            packets = []
+
+        self.packets = packets
+
+        # Number of packets of the list already looked at
+        self.scanned = 0
+        self.count = 0
+
+        # Indexes of the packets matching the filter
+        self.dfilter = dfilter
+        self.rows = None
+
+        if dfilter is not None:
+            self.rows = []
+
+    def grow(self, count):
+        """
+        Add the rows for the next count packets of the packet list
+        @param count the number of packets to look at
+        @return the range of the new rows
+        """
+        self.scanned += count
+
+        if self.rows is not None:
+            self.rows.extend(self.dfilter.filter(self.packets,
+                                                 self.scanned - count,
+                                                 self.scanned))
+            count = len(self.rows) - self.count
+
+        start = self.count
+        self.count += count
+
+        return range(start, self.count)
+
+    def get_index(self, row):
+        "@return the index in the packet list of the packet at row"
+        if self.rows is not None:
+            return self.rows[row]
+
+        return row
+
+    def get_packet(self, row):
+        "@return the packet at row"
+        return self.packets[self.get_index(row)]
+
+    def __len__(self):
+        return self.count
+
+class RowCache(object):
+    """
+    Cache of the column strings of the last rendered packets. The cell data
+    functions are called at every redraw of the visible rows, so the
+    strings are computed only once per packet.
+
+    >>> cache = RowCache(2)
+    >>> cache.get('a')['info'] = 'A'
+    >>> cache.get('b')['info'] = 'B'
+    >>> cache.get('a')
+    {'info': 'A'}
+    >>> cache.get('c')
+    {}
+    >>> cache.get('a'), cache.get('b')
+    ({}, {})
+
+    The oldest packet is dropped first also if it was used again. Changed
+    packets have to be dropped explicitly:
+
+    >>> cache.get('b')['info'] = 'B'
+    >>> cache.drop('b')
+    >>> cache.drop('z')
+    >>> cache.get('b'), len(cache)
+    ({}, 2)
+    >>> cache.clear()
+    >>> len(cache)
+    0
+    """
+
+    def __init__(self, size=ROW_CACHE_SIZE):
+        self.size = size
+        self.cache = {}
+        self.order = deque()
+
+    def get(self, packet):
+        "@return the dict caching the column strings of packet"
+        try:
+            return self.cache[packet]
+        except KeyError:
+            if len(self.order) >= self.size:
+                del self.cache[self.order.popleft()]
+
+            row = self.cache[packet] = {}
+            self.order.append(packet)
+
+            return row
+
+    def drop(self, packet):
+        "Forget the column strings of packet"
+        if packet in self.cache:
+            self.cache[packet].clear()
+
+    def clear(self):
+        self.cache.clear()
+        self.order.clear()
+
+    def __len__(self):
+        return len(self.cache)
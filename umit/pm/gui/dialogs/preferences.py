@@ -291,7 +291,10 @@ class ViewsPage(Page):
                 gtk.CheckButton(_('Payload Hack tab'))),
 
            ('gui.views.console_tab', None,
-                gtk.CheckButton(_('Python shell')))
+                gtk.CheckButton(_('Python shell'))),
+
+           ('gui.views.stats_tab', None,
+                gtk.CheckButton(_('Statistics')))
         ))
         ]
 
@@ -334,6 +337,14 @@ class BackendPage(Page):
           )
         ),
 
+        (_('Memory'),
+          (
+           ('backend.system.store.window',
+            _('Packets kept in memory (0 no limit):'),
+            gtk.SpinButton(gtk.Adjustment(50000, 0, 10000000, 1000, 10000))),
+          )
+        ),
+
         (_('Helpers'),
           (
            ('backend.tcpdump', _('tcpdump path:'), gtk.Entry()),
@@ -36,6 +36,7 @@ from umit.pm.core.bus import ServiceBus
 from umit.pm.manager.preferencemanager import Prefs
 
 from umit.pm.gui.core.app import PMApp
+from umit.pm.gui.core.packetrows import PacketRows, RowCache
 from umit.pm.gui.widgets.filterentry import FilterEntry
 from umit.pm.gui.widgets.cellrenderer import GridRenderer
 from umit.pm.higwidgets.higanimates import HIGAnimatedBar
@@ -43,6 +44,93 @@ from umit.pm.higwidgets.higanimates import HIGAnimatedBar
 from umit.pm.gui.pages.base import Perspective
 from umit.pm.backend import SniffContext, MetaPacket
 
+class PacketListModel(gtk.GenericTreeModel):
+    """
+    A list model with a single object column showing the rows of a
+    PacketRows object. The packets are read from the packet list only when
+    the view asks for them, and with the fixed height mode only the visible
+    rows are asked.
+    """
+
+    # Above this number of new rows detaching the model from the view and
+    # attaching it again is cheaper than emitting a row-inserted signal for
+    # every row.
+    BULK_ROWS = 1000
+
+    def __init__(self, packets=None, dfilter=None):
+        gtk.GenericTreeModel.__init__(self)
+
+        # The rowrefs are the int objects stored in refs so they stay alive
+        # as long as the model and the iters don't need to leak them.
+        self.props.leak_references = False
+
+        self.rows = PacketRows(packets, dfilter)
+        self.refs = []
+
+    packets = property(lambda self: self.rows.packets)
+    scanned = property(lambda self: self.rows.scanned)
+
+    def grow(self, count, notify=True):
+        """
+        Show the packets among the next count of the packet list
+        @param count the number of packets to add
+        @param notify False to not emit row-inserted. Use it only if no view
+                      is attached to the model.
+        """
+        new = self.rows.grow(count)
+        self.refs.extend(new)
+
+        if notify:
+            for idx in new:
+                self.row_inserted((idx, ), self.get_iter((idx, )))
+
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_LIST_ONLY | gtk.TREE_MODEL_ITERS_PERSIST
+
+    def on_get_n_columns(self):
+        return 1
+
+    def on_get_column_type(self, index):
+        return gobject.TYPE_PYOBJECT
+
+    def on_get_iter(self, path):
+        if path[0] < len(self.refs):
+            return self.refs[path[0]]
+
+    def on_get_path(self, rowref):
+        return (rowref, )
+
+    def get_index(self, iter):
+        "@return the index in the packet list of the packet at iter"
+        return self.rows.get_index(self.get_user_data(iter))
+
+    def on_get_value(self, rowref, column):
+        return self.rows.get_packet(rowref)
+
+    def on_iter_next(self, rowref):
+        if rowref + 1 < len(self.refs):
+            return self.refs[rowref + 1]
+
+    def on_iter_children(self, parent):
+        if parent is None and self.refs:
+            return self.refs[0]
+
+    def on_iter_has_child(self, rowref):
+        return False
+
+    def on_iter_n_children(self, rowref):
+        if rowref is None:
+            return len(self.refs)
+
+        return 0
+
+    def on_iter_nth_child(self, parent, n):
+        if parent is None and 0 <= n < len(self.refs):
+            return self.refs[n]
+
+    def on_iter_parent(self, child):
+        return None
+
 class SniffPage(Perspective):
     COL_NO     = 0
     COL_TIME   = 1
@@ -146,14 +234,22 @@ class SniffPage(Perspective):
         # reflowing without a model filter.
 
         self.tree_store = gtk.TreeStore(object)
-        self.list_store = gtk.ListStore(object)
+        self.list_store = PacketListModel()
         self.active_model = self.list_store
 
+        # Column strings of the last rendered packets
+        self.row_cache = RowCache()
+
+        # Indexes of the packets grouped by flow. The index is updated while
+        # sniffing so reflowing doesn't need to analyze the whole capture,
+        # and the tree_store is filled again only if the index changed.
+        self.conn_index = backend.ConnectionIndex()
+        self.tree_generation = None
+
         self.tree = gtk.TreeView(self.active_model)
 
         self.active_filter = None
-        self.model_filter = self.list_store.filter_new()
-        self.model_filter.set_visible_func(self.__filter_func)
+        self.model_filter = None
 
         idx = 0
         rend = GridRenderer()
@@ -202,33 +298,57 @@ class SniffPage(Perspective):
 
     def __cell_data_number(self, col, cell, model, iter):
         packet = model.get_value(iter, 0)
-        cell.set_property('text', "%s)" % ".".join(
-            [str(i + 1) \
-                for i in model.get_path(iter)]
-        ))
-        cell.set_property('cell-background-gdk', self.__get_color(packet))
+
+        if isinstance(model, PacketListModel):
+            # The number in the capture also if the list is filtered
+            cell.set_property('text', "%d)" % (model.get_index(iter) + 1))
+        else:
+            cell.set_property('text', "%s)" % ".".join(
+                [str(i + 1) \
+                    for i in model.get_path(iter)]
+            ))
+
+        cell.set_property('cell-background-gdk',
+                          self.__get_color(self.__get_row(packet), packet))
 
     def __cell_data_cfield(self, col, cell, model, iter, cfield):
         packet = model.get_value(iter, 0)
-        data = packet.cfields.get(cfield, '')
+        row = self.__get_row(packet)
+
+        try:
+            data = row[cfield]
+        except KeyError:
+            data = row[cfield] = packet.cfields.get(cfield, '')
 
         if isinstance(data, basestring):
             cell.set_property('text', data)
         else:
             cell.set_property('text', None)
 
-        cell.set_property('cell-background-gdk', self.__get_color(packet))
+        cell.set_property('cell-background-gdk', self.__get_color(row, packet))
 
     def __cell_data_func(self, col, cell, model, iter, func):
         packet = model.get_value(iter, 0)
-        data = func(packet)
+        row = self.__get_row(packet)
+
+        try:
+            data = row[func]
+        except KeyError:
+            data = row[func] = func(packet)
 
         if isinstance(data, basestring):
             cell.set_property('text', data)
         else:
             cell.set_property('text', None)
 
-        cell.set_property('cell-background-gdk', self.__get_color(packet))
+        cell.set_property('cell-background-gdk', self.__get_color(row, packet))
+
+    def __get_row(self, packet):
+        "@return the dict caching the column strings of packet"
+        return self.row_cache.get(packet)
+
+    def __clear_rows(self):
+        self.row_cache.clear()
 
     def __modify_font(self, font):
         try:
@@ -259,26 +379,73 @@ class SniffPage(Perspective):
         # Queue draw should be enough here
         self.queue_draw()
 
-    def __get_color(self, packet):
+    def __get_color(self, row, packet):
         if self.use_colors:
-            proto = packet.get_protocol_str()
+            # None is never used as key by the columns
+            try:
+                proto = row[None]
+            except KeyError:
+                proto = row[None] = packet.get_protocol_str()
+
             return self.COLORS[hash(proto) % len(self.COLORS)]
         else:
             return None
 
+    def __sync_list(self):
+        "Show in the list the packets added to the context since last call"
+        packets = self.__get_all_packets()
+
+        if packets is None:
+            return
+
+        model = self.list_store
+
+        if packets is not model.packets or len(packets) < model.scanned:
+            # The context started again with a new list
+            self.__reset_list(packets)
+            model = self.list_store
+
+        count = len(packets) - model.scanned
+
+        if count <= 0:
+            return
+
+        if self.tree.get_model() is not model:
+            # The list is not shown at the moment
+            model.grow(count, False)
+        elif count >= model.BULK_ROWS:
+            selected = self.tree.get_selection().get_selected_rows()[1]
+            visible = self.tree.get_visible_range()
+
+            self.tree.set_model(None)
+            model.grow(count, False)
+            self.tree.set_model(model)
+
+            for path in selected:
+                self.tree.get_selection().select_path(path)
+
+            if visible:
+                self.tree.scroll_to_cell(visible[0], None, True, 0, 0)
+        else:
+            model.grow(count)
+
+    def __reset_list(self, packets=None):
+        old = self.list_store
+        self.list_store = PacketListModel(packets, self.active_filter)
+
+        if self.active_model is old:
+            self._switch_model(self.list_store)
+
     def __update_tree(self):
         if isinstance(self.session.context, SniffContext):
             self.session.context.check_finished()
 
-        self.tree.freeze_child_notify()
+        self.__sync_list()
 
-        for packet in self.session.context.get_data():
-            self.list_store.append([packet])
+        packets = self.__get_all_packets()
 
-            #while gtk.events_pending():
-            #    gtk.main_iteration_do()
-
-        self.tree.thaw_child_notify()
+        if packets is not None:
+            self.conn_index.update(packets)
 
         # TODO: better handle the situation.
         if getattr(self.session.context, 'auto_scroll', True) and \
@@ -298,23 +465,26 @@ class SniffPage(Perspective):
 
     def clear(self):
         self.tree_store.clear()
-        self.list_store.clear()
+        self.__reset_list()
+        self.__clear_rows()
+        self.tree_generation = None
 
         # Maybe we have to switch back to list store mode?
 
     def redraw(self, packet=None):
         model, lst = self.tree.get_selection().get_selected_rows()
 
+        if packet is not None:
+            self.row_cache.drop(packet)
+
         for idx in lst:
             iter = model.get_iter(lst[0])
             model.row_changed(idx, iter)
 
     def reload(self):
-        for packet in self.session.context.get_data():
-            self.list_store.append([packet])
-
-            while gtk.events_pending():
-                gtk.main_iteration_do()
+        # Packets could have been modified
+        self.__clear_rows()
+        self.__sync_list()
 
         self.statusbar.label = "<b>%s</b>" % self.session.context.summary
 
@@ -425,31 +595,39 @@ class SniffPage(Perspective):
         dialog.hide()
         dialog.destroy()
 
-    def __on_reorder(self, action):
+    def __get_all_packets(self):
+        "@return the list of all the packets of the context or None"
         if isinstance(self.session.context, backend.TimedContext):
-            if self.session.context.state == self.session.context.NOT_RUNNING:
-                packets = self.session.context.get_all_data()
-            else:
-                self.statusbar.label = \
-                    _('<b>Cannot reorganize the flow while sniffing</b>')
-                self.statusbar.start_animation(True)
-                return
-
+            return self.session.context.get_all_data()
         elif isinstance(self.session.context, backend.StaticContext):
-            packets = self.session.context.get_data()
-        else:
+            return self.session.context.get_data()
+
+        return None
+
+    def __on_reorder(self, action):
+        if isinstance(self.session.context, backend.TimedContext) and \
+           self.session.context.state != self.session.context.NOT_RUNNING:
+            self.statusbar.label = \
+                _('<b>Cannot reorganize the flow while sniffing</b>')
+            self.statusbar.start_animation(True)
             return
 
-        tree = backend.analyze_connections(packets)
+        packets = self.__get_all_packets()
 
-        if tree:
-            self.tree_store.clear()
+        if packets is None:
+            return
 
-            for (root, lst) in tree:
-                iter = self.tree_store.append(None, [root])
+        if self.conn_index.update(packets):
+            if self.tree_generation != self.conn_index.generation:
+                self.tree_store.clear()
 
-                for child in lst:
-                    self.tree_store.append(iter, [child])
+                for (root, lst) in self.conn_index.resolve(packets):
+                    iter = self.tree_store.append(None, [root])
+
+                    for child in lst:
+                        self.tree_store.append(iter, [child])
+
+                self.tree_generation = self.conn_index.generation
 
             self._switch_model(self.tree_store)
 
@@ -458,20 +636,33 @@ class SniffPage(Perspective):
         Switch to the new model and reset the filter
         """
 
-        if self.active_model is not model:
-            self.active_model = model
+        self.active_model = model
+
+        # The list model applies the display filter by itself
+        if self.active_filter and model is not self.list_store:
             self.model_filter = model.filter_new()
             self.model_filter.set_visible_func(self.__filter_func)
-
-        if self.active_filter:
-            self.model_filter.refilter()
             self.tree.set_model(self.model_filter)
         elif self.tree.get_model() is not model:
             self.tree.set_model(model)
 
     def __on_apply_filter(self, entry):
-        self.active_filter = self.filter.get_text() or None
-        self._switch_model(self.active_model)
+        text = self.filter.get_text().strip()
+
+        try:
+            self.active_filter = text and backend.DisplayFilter(text) or None
+        except backend.FilterSyntaxError, err:
+            self.statusbar.image = gtk.STOCK_DIALOG_ERROR
+            self.statusbar.label = _('<b>Invalid filter: %s</b>') % \
+                                   gobject.markup_escape_text(str(err))
+            self.statusbar.start_animation(True)
+            return
+
+        if self.active_model is self.list_store:
+            self.__reset_list(self.list_store.packets)
+            self.__sync_list()
+        else:
+            self._switch_model(self.active_model)
 
     def __filter_func(self, model, iter):
         if not self.active_filter:
@@ -482,22 +673,7 @@ class SniffPage(Perspective):
         if not packet:
             return False
 
-        strs = (
-            str(model.get_path(iter)[0] + 1),
-            packet.get_time(),
-            packet.get_source(),
-            packet.get_dest(),
-            packet.get_protocol_str(),
-            packet.summary()
-        )
-
-        # TODO: implement a search engine like num: summary: ?
-
-        for pattern in strs:
-            if self.active_filter in pattern:
-                return True
-
-        return False
+        return self.active_filter.match(packet)
 
     def __on_stop(self, action):
         self.session.context.stop()
@@ -21,6 +21,7 @@
 import os
 import os.path
 import sys
+import cPickle
 
 import datetime
 
@@ -38,7 +39,7 @@ from tempfile import mktemp
 from umit.pm.gui.plugins.parser import Parser
 from umit.pm.gui.plugins.atoms import StringFile
 
-from umit.pm.core.const import PM_PLUGINS_TEMP_DIR
+from umit.pm.core.const import PM_PLUGINS_TEMP_DIR, PM_PLUGINS_CACHE
 
 from umit.pm.core.logger import log
 
@@ -70,6 +71,13 @@ SIGNATURE = "UmitPlugin"
 PASSIVE_AUDIT_TYPE = 0
 ACTIVE_AUDIT_TYPE  = 1
 
+# Fields of the manifest saved in the ManifestCache
+MANIFEST_FIELDS = ('name', 'version', 'description', 'url', 'start_file',
+                   'update', 'provide', 'need', 'conflict', 'license',
+                   'copyright', 'author', 'contributor', 'translator',
+                   'artist', 'audit_type', 'configurations', 'protocols',
+                   'vulnerabilities', 'attr_type')
+
 class ManifestObject(object):
     def __init__(self):
 
@@ -723,16 +731,28 @@ class BadPlugin(Exception):
     pass
 
 class PluginReader(ManifestLoader):
-    def __init__(self, file):
+    def __init__(self, file, manifest=None):
+        """
+        @param file the .ump file
+        @param manifest the fields returned by get_manifest() on the same
+               file. If given the zip file is opened only when needed.
+        """
         ManifestLoader.__init__(self)
 
         self.path = file
         self.enabled = False
         self.hasprefs = False
-        self.parser = None
+
+        self._file = None
+        self._parser = None
+        self._prefs_parsed = False
+
+        if manifest is not None:
+            self.set_manifest(manifest)
+            return
 
         try:
-            self.file = ZipFile(file, "r")
+            self._file = ZipFile(file, "r")
         except:
             raise BadPlugin("Not a valid umit plugin format")
 
@@ -742,8 +762,36 @@ class PluginReader(ManifestLoader):
         if not self.check_validity():
             raise BadPlugin("Validation phase not passed")
 
-        # Needs some testing
-        self.parse_preferences()
+    def get_file(self):
+        "@return the ZipFile of the plugin opening it if needed"
+        if self._file is None:
+            try:
+                self._file = ZipFile(self.path, "r")
+            except:
+                raise BadPlugin("Not a valid umit plugin format")
+
+        return self._file
+
+    def get_parser(self):
+        "@return the Parser of data/preferences.xml or None"
+        if not self._prefs_parsed:
+            self._prefs_parsed = True
+
+            # Needs some testing
+            self.parse_preferences()
+
+        return self._parser
+
+    def get_manifest(self):
+        "@return a dict with the fields of the manifest"
+        return dict([(name, getattr(self, name)) for name in MANIFEST_FIELDS])
+
+    def set_manifest(self, manifest):
+        for name in MANIFEST_FIELDS:
+            setattr(self, name, manifest[name])
+
+    file = property(get_file)
+    parser = property(get_parser)
 
     def parse_manifest(self):
         """
@@ -774,8 +822,8 @@ class PluginReader(ManifestLoader):
         try:
             data = self.file.read('data/preferences.xml')
 
-            self.parser = Parser()
-            self.parser.parse_string(data)
+            self._parser = Parser()
+            self._parser.parse_string(data)
         except Exception, err:
             return
 
@@ -966,6 +1014,102 @@ class PluginReader(ManifestLoader):
 
         return None
 
+class ManifestCache(object):
+    """
+    Persistent cache of the manifests of the plugins indexed by path and
+    checked against size and mtime of the file, so the unchanged plugins
+    are never reopened. Bad plugins are cached too.
+    """
+
+    VERSION = 1
+
+    def __init__(self, fname=PM_PLUGINS_CACHE):
+        self.fname = fname
+
+        # path -> ((size, mtime), manifest or None, error or None)
+        self.entries = {}
+        self.seen = set()
+        self.dirty = False
+
+        self.hits = 0
+        self.misses = 0
+
+        self.load()
+
+    def load(self):
+        try:
+            f = open(self.fname, 'rb')
+
+            try:
+                version, entries = cPickle.load(f)
+            finally:
+                f.close()
+
+            if version == self.VERSION:
+                self.entries = entries
+        except Exception, err:
+            log.debug('Plugins cache not loaded (%s)' % str(err))
+
+    def save(self, prune=True):
+        """
+        Save the cache if something is changed.
+        @param prune True to forget the plugins not looked up
+        """
+        if prune:
+            for path in self.entries.keys():
+                if path not in self.seen:
+                    del self.entries[path]
+                    self.dirty = True
+
+        if not self.dirty:
+            return
+
+        tmp = self.fname + '.tmp'
+
+        try:
+            f = open(tmp, 'wb')
+
+            try:
+                cPickle.dump((self.VERSION, self.entries), f,
+                             cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+
+            os.rename(tmp, self.fname)
+            self.dirty = False
+        except Exception, err:
+            log.warning('Unable to save the plugins cache (%s)' % str(err))
+
+    def get_reader(self, path):
+        """
+        @return a PluginReader for path or raise BadPlugin
+        """
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime)
+
+        self.seen.add(path)
+        entry = self.entries.get(path)
+
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+
+            if entry[1] is None:
+                raise BadPlugin(entry[2])
+
+            return PluginReader(path, entry[1])
+
+        self.misses += 1
+        self.dirty = True
+
+        try:
+            reader = PluginReader(path)
+        except BadPlugin, exc:
+            self.entries[path] = (key, None, str(exc))
+            raise
+
+        self.entries[path] = (key, reader.get_manifest(), None)
+        return reader
+
 class PluginWriter(ManifestObject):
     def __init__(self, **fields):
         ManifestObject.__init__(self)
@@ -20,6 +20,7 @@
 
 import os
 import sys
+import time
 import os.path
 
 from umit.pm.core.i18n import _
@@ -31,8 +32,9 @@ from umit.pm.core.const import PM_DEVELOPMENT, \
                           PM_PLUGINS_DOWNLOAD_DIR
 
 from umit.pm.gui.plugins.core import Core
-from umit.pm.gui.plugins.tree import PluginsTree, PluginException
-from umit.pm.gui.plugins.containers import PluginReader, BadPlugin
+from umit.pm.gui.plugins.tree import PluginsTree, PluginException, DepGraph
+from umit.pm.gui.plugins.containers import PluginReader, BadPlugin, \
+                                          ManifestCache
 
 from umit.pm.manager.auditmanager import AuditManager
 
@@ -59,13 +61,15 @@ class PluginPath(object):
     {}
     """
 
-    def __init__(self, path):
+    def __init__(self, path, cache=None):
         """
         The default constructor
 
         @param path the path to search in for plugin
+        @param cache a ManifestCache to not reopen the unchanged plugins
         """
         self.path = path
+        self.cache = cache
         self.scanned = False
         self._plugins = {} # a dict should be great ;)
 
@@ -88,7 +92,10 @@ class PluginPath(object):
                os.path.isfile(path):
 
                 try:
-                    reader = PluginReader(path)
+                    if self.cache is not None:
+                        reader = self.cache.get_reader(path)
+                    else:
+                        reader = PluginReader(path)
 
                     for conf_name, conf_dict in reader.configurations:
                         AuditManager().register_configuration(conf_name,
@@ -171,6 +178,13 @@ class PluginEngine(Singleton):
 
         self.available_plugins = None
         self.paths = None
+        self.graph = None
+
+        # Startup statistics (seconds and cache lookups)
+        self.scan_time = 0
+        self.load_time = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
 
         self.apply_updates()
         self.recache()
@@ -217,12 +231,16 @@ class PluginEngine(Singleton):
         Reinit the available_plugins and paths fields
         """
 
+        start = time.time()
+
         self.available_plugins = []
         self.paths = {}
 
+        cache = ManifestCache()
+
         idx = 0
         for path in self.plugins.paths:
-            plug_path = PluginPath(path)
+            plug_path = PluginPath(path, cache)
             self.paths[path] = (idx, plug_path)
 
             self.available_plugins.extend(
@@ -231,13 +249,28 @@ class PluginEngine(Singleton):
 
             idx += 1
 
+        cache.save()
+
+        self.graph = DepGraph(self.available_plugins)
+
+        self.scan_time = time.time() - start
+        self.cache_hits = cache.hits
+        self.cache_misses = cache.misses
+
+        log.info("%d plugins scanned in %.3f secs (%d cached, %d parsed)" % \
+                 (len(self.available_plugins), self.scan_time,
+                  cache.hits, cache.misses))
+
     def load_selected_plugins(self):
         """
         Load the selected plugins specified in config file
         """
 
-        # Load the plugins in order (specified in conf file)
-        for plugin in self.plugins.plugins:
+        start = time.time()
+
+        # Load the plugins in order (specified in conf file) but after the
+        # plugins providing their needs
+        for plugin in self.sort_plugins(self.plugins.plugins):
 
             if not plugin or plugin == "":
                 continue
@@ -247,6 +280,8 @@ class PluginEngine(Singleton):
             if not loaded:
                 log.warning(errmsg)
 
+        self.load_time = time.time() - start
+
         # Check out the global variable PM_PLUGINS if we are in
         # development enviroment.
 
@@ -259,6 +294,24 @@ class PluginEngine(Singleton):
             for plugin in plugins.split(os.pathsep):
                 self.load_from_directory(plugin)
 
+    def sort_plugins(self, plugins):
+        """
+        Sort a list of plugin paths through the dependency graph. The
+        paths not available are left at the end.
+
+        @param plugins a list of full paths
+        @return the sorted list
+        """
+        readers = {}
+
+        for reader in self.available_plugins:
+            readers[reader.get_path()] = reader
+
+        pkgs = [readers[plugin] for plugin in plugins if plugin in readers]
+        others = [plugin for plugin in plugins if plugin not in readers]
+
+        return [pkg.get_path() for pkg in self.graph.sort(pkgs)] + others
+
     def load_from_directory(self, path):
         log.debug("Loading source files from plugin directory: %s" % path)
         self.tree.load_directory(path)
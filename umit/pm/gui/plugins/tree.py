@@ -97,6 +97,99 @@ class PluginException(Exception):
         Exception.__init__(self, _("Unable to load %s") % txt)
         self.summary = summ
 
+class DepGraph(object):
+    """
+    Dependency graph of the available plugins. It is built once from the
+    needs/provides of the manifests and used to load the plugins after
+    their providers.
+
+    >>> dummy = Package('dummy', [], ['dummy-2.1'], [])
+    >>> woot = Package('woot', ['>dummy-2.0'], ['=woot-2.0.0'], [])
+    >>> other = Package('other', ['woot', 'missing'], [], [])
+    >>> graph = DepGraph([other, woot, dummy])
+    >>> graph.get_providers(woot), graph.get_providers(other)
+    ([dummy], [woot])
+    >>> graph.sort([other, woot, dummy])
+    [dummy, woot, other]
+    """
+
+    def __init__(self, pkgs):
+        """
+        @param pkgs a list of PluginReader
+        """
+        self.pkgs = list(pkgs)
+
+        # name -> [(op, ver, pkg), ...]
+        self.providers = DepDict()
+
+        # pkg -> [pkg, ...] providing its needs
+        self.edges = {}
+
+        for pkg in self.pkgs:
+            for provide in pkg.provides:
+                try:
+                    name, op, ver = Version.extract_version(provide)
+                    self.providers[name] = (op, ver, pkg)
+                except Exception, err:
+                    log.warning("Ignoring provide entry %s of %s (%s)" % \
+                                (provide, pkg, err))
+
+        for pkg in self.pkgs:
+            lst = []
+
+            for need in pkg.needs:
+                try:
+                    name, op, ver = Version.extract_version(need)
+                except Exception, err:
+                    log.warning("Ignoring need entry %s of %s (%s)" % \
+                                (need, pkg, err))
+                    continue
+
+                for p_op, p_ver, p_pkg in self.providers[name]:
+                    if p_pkg is not pkg and p_pkg not in lst and \
+                       op(p_ver, ver) is not False:
+                        lst.append(p_pkg)
+
+            self.edges[pkg] = lst
+
+    def get_providers(self, pkg):
+        "@return the list of plugins providing the needs of pkg"
+        return self.edges.get(pkg, [])
+
+    def sort(self, pkgs):
+        """
+        @param pkgs a list of plugins to load
+        @return pkgs sorted so every plugin follows its providers. The
+                original order is kept otherwise.
+        """
+        wanted = set(pkgs)
+        visited = set()
+        ret = []
+
+        def visit(pkg):
+            # Iterative DFS to not hit the recursion limit
+            stack = [(pkg, iter(self.get_providers(pkg)))]
+            visited.add(pkg)
+
+            while stack:
+                node, providers = stack[-1]
+
+                for provider in providers:
+                    if provider in wanted and provider not in visited:
+                        visited.add(provider)
+                        stack.append((provider,
+                                      iter(self.get_providers(provider))))
+                        break
+                else:
+                    stack.pop()
+                    ret.append(node)
+
+        for pkg in pkgs:
+            if pkg not in visited:
+                visit(pkg)
+
+        return ret
+
 class PluginsTree(object):
     """
     Manages and tracks the loads/unloads of plugins objects
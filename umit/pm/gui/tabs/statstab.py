@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import gtk
+import gobject
+
+from time import time
+
+from umit.pm.core.i18n import _
+from umit.pm.core.metrics import metrics
+from umit.pm.manager.preferencemanager import Prefs
+
+from umit.pm.gui.core.views import UmitView
+
+class StatisticsTab(UmitView):
+    """
+    StatisticsTab shows the metrics collected by the metrics registry. The
+    view is refreshed periodically only while the metrics are enabled.
+    """
+
+    name = 'StatisticsTab'
+    label_text = _('Statistics')
+    tab_position = gtk.POS_BOTTOM
+    icon_name = gtk.STOCK_PROPERTIES
+
+    COL_NAME, COL_VALUE, COL_RATE, COL_P50, COL_P99, COL_MAX = range(6)
+
+    def create_ui(self):
+        self.timeout_id = None
+        self.rows = {}
+
+        self.prev = None
+        self.prev_time = None
+
+        self._main_widget.set_border_width(4)
+        self._main_widget.set_spacing(2)
+
+        hbox = gtk.HBox(False, 4)
+
+        self.btn_enable = gtk.CheckButton(_('Collect metrics'))
+        self.btn_enable.connect('toggled', self.__on_enable_toggled)
+
+        self.btn_reset = gtk.Button(stock=gtk.STOCK_CLEAR)
+        self.btn_reset.connect('clicked', self.__on_reset)
+
+        hbox.pack_start(self.btn_enable, False, False)
+        hbox.pack_end(self.btn_reset, False, False)
+
+        self._main_widget.pack_start(hbox, False, False)
+
+        sw = gtk.ScrolledWindow()
+        sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        sw.set_shadow_type(gtk.SHADOW_ETCHED_IN)
+
+        self.store = gtk.ListStore(str, str, str, str, str, str)
+        self.tree = gtk.TreeView(self.store)
+
+        rend = gtk.CellRendererText()
+
+        for idx, label in enumerate((_('Metric'), _('Value'), _('Rate/s'),
+                                     _('p50 (usec)'), _('p99 (usec)'),
+                                     _('Max (usec)'))):
+            col = gtk.TreeViewColumn(label, rend, text=idx)
+            col.set_resizable(True)
+            col.set_sort_column_id(idx)
+            self.tree.append_column(col)
+
+        self.tree.set_rules_hint(True)
+        self.tree.set_search_column(self.COL_NAME)
+        self.tree.set_enable_search(True)
+
+        sw.add(self.tree)
+        self._main_widget.pack_start(sw)
+        self._main_widget.show_all()
+
+        metrics.connect(self.__on_metrics_toggled)
+
+        self.btn_enable.set_active(metrics.enabled)
+        self.__on_metrics_toggled(metrics.enabled)
+
+    def __on_enable_toggled(self, btn):
+        metrics.set_enabled(btn.get_active())
+
+    def __on_reset(self, btn):
+        metrics.reset()
+
+        self.prev = None
+        self.refresh()
+
+    def __on_metrics_toggled(self, enabled):
+        if self.btn_enable.get_active() != enabled:
+            self.btn_enable.set_active(enabled)
+
+        if enabled and not self.timeout_id:
+            self.timeout_id = gobject.timeout_add(
+                Prefs()['gui.statstab.updatetimeout'].value or 1000,
+                self.__timeout_cb)
+
+            self.refresh()
+
+    def __timeout_cb(self):
+        if not metrics.enabled:
+            self.timeout_id = None
+            return False
+
+        self.refresh()
+        return True
+
+    def refresh(self):
+        "Update the rows with a new snapshot of the metrics"
+        now = time()
+        snapshot = metrics.snapshot()
+
+        elapsed = self.prev_time and now - self.prev_time or None
+        prev = self.prev or {}
+
+        for name in sorted(snapshot):
+            snap = snapshot[name]
+
+            value, rate, p50, p99, maxv = '', '', '', '', ''
+
+            if snap['type'] == 'histogram':
+                value = str(snap['count'])
+
+                if snap['count']:
+                    p50, p99, maxv = map(str, (snap['p50'], snap['p99'],
+                                               snap['max']))
+            else:
+                value = str(snap['value'])
+
+            if snap['type'] == 'counter' and name in prev and elapsed:
+                rate = '%.1f' % ((snap['value'] - prev[name]['value']) /
+                                 elapsed)
+
+            row = (name, value, rate, p50, p99, maxv)
+
+            if name in self.rows:
+                self.store.set(self.rows[name].get_iter(), 1, value, 2, rate,
+                               3, p50, 4, p99, 5, maxv)
+            else:
+                iter = self.store.append(row)
+                self.rows[name] = gtk.TreeRowReference(self.store,
+                                  self.store.get_path(iter))
+
+        self.prev, self.prev_time = snapshot, now
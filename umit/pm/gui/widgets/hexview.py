@@ -22,7 +22,15 @@ import gtk
 import pango
 import gobject
 
+from umit.pm.gui.widgets.hexwindow import HexWindow, PRINTABLE, \
+                                          offset_lines, hex_lines, ascii_lines
+
 class BaseText(gtk.TextView):
+    """
+    A text view showing a window of the lines of the payload. The lines are
+    rendered by the subclasses with get_lines()
+    """
+
     __gtype_name__ = "BaseText"
 
     def __init__(self, parent):
@@ -33,6 +41,55 @@ class BaseText(gtk.TextView):
         self.modify_font(pango.FontDescription(parent.font))
         self.set_editable(False)
 
+        self.top_mark = self.buffer.create_mark(None,
+                                                self.buffer.get_start_iter(),
+                                                True)
+
+    def get_tag(self):
+        return None
+
+    def get_lines(self, payload, first, last):
+        """
+        @return a list of strings for the lines of the payload between first
+                and last
+        """
+        return []
+
+    def render(self, payload, first, last):
+        self.buffer.set_text('')
+
+        output = self.get_lines(payload, first, last)
+
+        if output:
+            self.buffer.insert_with_tags(
+                self.buffer.get_end_iter(),
+                "\n".join(output),
+                self.get_tag()
+            )
+
+    def update_line(self, payload, line, first):
+        """
+        Render again a single line
+        @param line the line of the payload
+        @param first the first line rendered in the buffer
+        """
+        start = self.buffer.get_iter_at_line(line - first)
+        end = start.copy()
+
+        if not end.ends_line():
+            end.forward_to_line_end()
+
+        self.buffer.delete(start, end)
+        self.buffer.insert_with_tags(start,
+                                     self.get_lines(payload, line, line + 1)[0],
+                                     self.get_tag())
+
+    def scroll_to_line(self, line):
+        "Put the line of the buffer at the top of the view"
+        self.buffer.move_mark(self.top_mark,
+                              self.buffer.get_iter_at_line(line))
+        self.scroll_to_mark(self.top_mark, 0, True, 0, 0)
+
 gobject.type_register(BaseText)
 
 class OffsetText(BaseText):
@@ -52,27 +109,11 @@ class OffsetText(BaseText):
     def __on_realize(self, widget):
         self.modify_base(gtk.STATE_NORMAL, self.style.dark[gtk.STATE_NORMAL])
 
-    def render(self, txt):
-        self.buffer.set_text('')
+    def get_tag(self):
+        return self._parent.tag_offset
 
-        bpl = self._parent.bpl
-        tot_lines = int(len(txt) / bpl)
-
-        if len(txt) % bpl != 0:
-            tot_lines += 1
-
-        self.off_len = len(str(tot_lines)) + 1
-        output = []
-
-        for i in xrange(tot_lines):
-            output.append(("%0" + str(self.off_len) + "d") % i)
-
-        if output:
-            self.buffer.insert_with_tags(
-                self.buffer.get_end_iter(),
-                "\n".join(output),
-                self._parent.tag_offset
-            )
+    def get_lines(self, payload, first, last):
+        return offset_lines(first, last, self.off_len)
 
     def __on_size_request(self, widget, alloc):
         ctx = self.get_pango_context()
@@ -86,9 +127,7 @@ class OffsetText(BaseText):
             alloc.width = w
 
 class AsciiText(BaseText):
-    _printable = \
-        "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!\"#$%" \
-        "&'()*+,-./:;<=>?@[\]^_`{|}~"
+    _printable = PRINTABLE
 
     def __init__(self, parent):
         BaseText.__init__(self, parent)
@@ -97,40 +136,11 @@ class AsciiText(BaseText):
         self.prev_start = None
         self.prev_end = None
 
-    def render(self, txt):
-        self.buffer.set_text('')
-
-        bpl = self._parent.bpl
-        tot_lines = len(txt) / bpl
-
-        if len(txt) % bpl != 0:
-            tot_lines += 1
-
-        output = []
+    def get_tag(self):
+        return self._parent.tag_ascii
 
-        convert = lambda i: "".join(
-            map(lambda x: (x in AsciiText._printable) and (x) or ('.'),
-                list(i)))
-
-        for i in xrange(tot_lines):
-            to_fill = 0
-
-            if i * bpl + bpl > len(txt):
-                to_fill = (i * bpl) + bpl - len(txt)
-                output.append(
-                    convert(txt[i * bpl:])
-                )
-            else:
-                output.append(
-                    convert(txt[i * bpl:(i * bpl) + bpl])
-                )
-
-        if output:
-            self.buffer.insert_with_tags(
-                self.buffer.get_end_iter(),
-                "\n".join(output),
-                self._parent.tag_ascii
-            )
+    def get_lines(self, payload, first, last):
+        return ascii_lines(payload, first, last, self._parent.bpl)
 
     def __on_size_request(self, widget, alloc):
         ctx = self.get_pango_context()
@@ -144,24 +154,36 @@ class AsciiText(BaseText):
             alloc.width = w
 
     def select_blocks(self, start=None, end=None):
+        """
+        Set the secondary selection
+        @param start the first byte of the payload
+        @param end the byte after the last one
+        """
 
-        if self.prev_start and self.prev_end and \
-           self.prev_start != self.prev_end:
-
-            self.buffer.remove_tag(self._parent.tag_sec_sel, self.prev_start,
-                                   self.prev_end)
+        # Offsets in the buffer since the iters don't survive to changes
+        if self.prev_start is not None and self.prev_start != self.prev_end:
+            self.buffer.remove_tag(self._parent.tag_sec_sel,
+                                   self.buffer.get_iter_at_offset(
+                                       self.prev_start),
+                                   self.buffer.get_iter_at_offset(
+                                       self.prev_end))
+            self.prev_start = self.prev_end = None
 
         if not start and not end:
             return
 
-        start_iter = self.buffer.get_iter_at_line(start / self._parent.bpl)
-        start_iter.forward_chars(start % self._parent.bpl)
+        bpl = self._parent.bpl
+        start, end = self._parent.clip_to_window(start, end)
+
+        start_iter = self.buffer.get_iter_at_line(start / bpl)
+        start_iter.forward_chars(start % bpl)
 
-        end_iter = self.buffer.get_iter_at_line(end / self._parent.bpl)
-        end_iter.forward_chars(end % self._parent.bpl)
+        end_iter = self.buffer.get_iter_at_line(end / bpl)
+        end_iter.forward_chars(end % bpl)
 
         self.buffer.apply_tag(self._parent.tag_sec_sel, start_iter, end_iter)
-        self.prev_start, self.prev_end = start_iter, end_iter
+        self.prev_start = start_iter.get_offset()
+        self.prev_end = end_iter.get_offset()
 
 
 class HexText(BaseText):
@@ -176,39 +198,11 @@ class HexText(BaseText):
     def __on_realize(self, widget):
         self.modify_base(gtk.STATE_NORMAL, self.style.mid[gtk.STATE_NORMAL])
 
-    def render(self, txt):
-        self.buffer.set_text('')
-
-        bpl = self._parent.bpl
-        tot_lines = int(len(txt) / bpl)
-
-        if len(txt) % bpl != 0:
-            tot_lines += 1
-
-        output = []
-        convert = lambda x: (len(x) == 1) and ("0%s" % x) or (x)
-
-        for i in xrange(tot_lines):
-            to_fill = 0
-
-            if i * bpl + bpl > len(txt):
-                to_fill = (i * bpl) + bpl - len(txt)
-                output.append(
-                    " ".join(map(lambda x: convert(str(hex(ord(x)))[2:]),
-                                 txt[i * bpl:]))
-                )
-            else:
-                output.append(
-                    " ".join(map(lambda x: convert(str(hex(ord(x)))[2:]),
-                                 txt[i * bpl:(i * bpl) + bpl]))
-                )
+    def get_tag(self):
+        return self._parent.tag_hex
 
-        if output:
-            self.buffer.insert_with_tags(
-                self.buffer.get_end_iter(),
-                "\n".join(output).upper(),
-                self._parent.tag_hex
-            )
+    def get_lines(self, payload, first, last):
+        return hex_lines(payload, first, last, self._parent.bpl)
 
     def __on_size_request(self, widget, alloc):
         ctx = self.get_pango_context()
@@ -223,27 +217,46 @@ class HexText(BaseText):
             alloc.width = w
 
     def select_blocks(self, start=None, end=None):
+        """
+        Set the secondary selection
+        @param start the first byte of the payload
+        @param end the byte after the last one
+        """
 
-        if self.prev_start and self.prev_end and \
-           self.prev_start != self.prev_end:
-
-            self.buffer.remove_tag(self._parent.tag_sec_sel, self.prev_start,
-                                   self.prev_end)
+        if self.prev_start is not None and self.prev_start != self.prev_end:
+            self.buffer.remove_tag(self._parent.tag_sec_sel,
+                                   self.buffer.get_iter_at_offset(
+                                       self.prev_start),
+                                   self.buffer.get_iter_at_offset(
+                                       self.prev_end))
+            self.prev_start = self.prev_end = None
 
         if not start and not end:
             return
 
-        start_iter = self.buffer.get_iter_at_line(start / self._parent.bpl)
-        start_iter.forward_chars(3 * (start % self._parent.bpl))
+        bpl = self._parent.bpl
+        start, end = self._parent.clip_to_window(start, end)
+
+        start_iter = self.buffer.get_iter_at_line(start / bpl)
+        start_iter.forward_chars(3 * (start % bpl))
 
-        end_iter = self.buffer.get_iter_at_line(end / self._parent.bpl)
-        end_iter.forward_chars(3 * (end % self._parent.bpl) - 1)
+        end_iter = self.buffer.get_iter_at_line(end / bpl)
+        end_iter.forward_chars(3 * (end % bpl) - 1)
 
         self.buffer.apply_tag(self._parent.tag_sec_sel, start_iter, end_iter)
-        self.prev_start, self.prev_end = start_iter, end_iter
+        self.prev_start = start_iter.get_offset()
+        self.prev_end = end_iter.get_offset()
 
 
 class HexView(gtk.HBox):
+    """
+    A read only hex view. Only the visible lines plus a margin are rendered
+    in the text views, so the time needed to show a payload doesn't depend
+    on its size (see HexWindow). The vertical scrollbar works on lines of
+    the payload and the text views are rendered again when the visible
+    lines go out of the rendered window.
+    """
+
     __gtype_name__ = "HexView"
 
     def __init__(self):
@@ -261,20 +274,30 @@ class HexView(gtk.HBox):
         self.table.add(self.tag_ascii)
         self.table.add(self.tag_sec_sel)
 
-        self._bpl = 16
         self._font = "Monospace 10"
-        self._payload = ""
 
-        vadj, hadj = gtk.Adjustment(), gtk.Adjustment()
-        self.vscroll = gtk.VScrollbar(vadj)
+        # Lines of the payload rendered in the text views
+        self.hexwindow = HexWindow()
+
+        # The primary selection in bytes of the payload
+        self._line_height = None
+        self._selection = None
+
+        # The scrollbar works on lines while the text views scroll inside
+        # the rendered window with their own adjustments.
+        self.vadj, hadj = gtk.Adjustment(), gtk.Adjustment()
+        self.vscroll = gtk.VScrollbar(self.vadj)
 
         self.offset_text = OffsetText(self)
         self.hex_text = HexText(self)
         self.ascii_text = AsciiText(self)
 
-        self.offset_text.set_scroll_adjustments(hadj, vadj)
-        self.hex_text.set_scroll_adjustments(hadj, vadj)
-        self.ascii_text.set_scroll_adjustments(hadj, vadj)
+        for view in (self.offset_text, self.hex_text, self.ascii_text):
+            view.set_scroll_adjustments(hadj, gtk.Adjustment())
+            view.connect('scroll-event', self.__on_scroll)
+
+        self.vadj.connect('value-changed', self.__on_value_changed)
+        self.hex_text.connect('size-allocate', self.__on_size_allocate)
 
         self.hex_text.buffer.connect('mark-set', self.__on_hex_change)
         self.ascii_text.buffer.connect('mark-set', self.__on_ascii_change)
@@ -312,6 +335,95 @@ class HexView(gtk.HBox):
             self.style.text_aa[gtk.STATE_NORMAL]
         )
 
+    ############################################################################
+    # Window handling
+    ############################################################################
+
+    def get_lines(self):
+        "@return the number of lines of the payload"
+        return self.hexwindow.get_lines()
+
+    def clip_to_window(self, start, end):
+        """
+        @param start the first byte of the payload
+        @param end the byte after the last one
+        @return start and end relative to the rendered window
+        """
+        return self.hexwindow.clip(start, end)
+
+    def __get_line_height(self):
+        if self._line_height is None:
+            ctx = self.hex_text.get_pango_context()
+            metrics = ctx.get_metrics(pango.FontDescription(self._font),
+                                      ctx.get_language())
+
+            self._line_height = max(1, pango.PIXELS(metrics.get_ascent() +
+                                                    metrics.get_descent()))
+
+        return self._line_height
+
+    def __on_size_allocate(self, widget, alloc):
+        visible = max(1, alloc.height / self.__get_line_height())
+
+        if visible != self.hexwindow.visible:
+            self.hexwindow.visible = visible
+            self.__update_adjustment()
+            self.__update_window()
+
+    def __update_adjustment(self):
+        lines = self.get_lines()
+        page = min(self.hexwindow.visible, max(lines, 1))
+
+        self.vadj.set_all(min(self.vadj.value, max(0, lines - page)), 0,
+                          max(lines, 1), 1, max(1, page - 1), page)
+
+    def __update_window(self, force=False):
+        """
+        Render the lines around the visible ones if needed and scroll the
+        text views to the first visible line
+        """
+        top = int(self.vadj.value)
+
+        if self.hexwindow.scroll(top, force):
+            off_len = self.hexwindow.get_offset_width()
+
+            if off_len != self.offset_text.off_len:
+                self.offset_text.off_len = off_len
+                self.offset_text.queue_resize()
+
+            for view in (self.offset_text, self.hex_text, self.ascii_text):
+
+                # Invalidate previous selections
+                if hasattr(view, 'prev_start'):
+                    view.prev_start = None
+                if hasattr(view, 'prev_end'):
+                    view.prev_end = None
+
+                view.render(self.hexwindow.payload, self.hexwindow.first,
+                            self.hexwindow.last)
+
+            if self._selection:
+                self.__select_window(*self._selection)
+
+        for view in (self.offset_text, self.hex_text, self.ascii_text):
+            view.scroll_to_line(top - self.hexwindow.first)
+
+    def __on_value_changed(self, adj):
+        self.__update_window()
+
+    def __on_scroll(self, widget, evt):
+        if evt.direction == gtk.gdk.SCROLL_UP:
+            delta = -3
+        elif evt.direction == gtk.gdk.SCROLL_DOWN:
+            delta = 3
+        else:
+            return False
+
+        self.vadj.set_value(max(self.vadj.lower,
+                                min(self.vadj.value + delta,
+                                    self.vadj.upper - self.vadj.page_size)))
+        return True
+
     def __on_menu_popup(self, widget, menu):
         item = gtk.SeparatorMenuItem()
         item.show()
@@ -376,6 +488,9 @@ class HexView(gtk.HBox):
 
         start, end = buffer.get_selection_bounds()
 
+        # Lines in the buffer are relative to the rendered window
+        first = self.hexwindow.first
+
         if start.get_line() == end.get_line():
             tmp = buffer.get_iter_at_line(start.get_line())
             txt = buffer.get_text(tmp, start)
@@ -385,8 +500,8 @@ class HexView(gtk.HBox):
             e_off = len(filter(lambda x: len(x) == 2, txt.split(" ")))
 
             self.ascii_text.select_blocks(
-                (self.bpl * start.get_line()) + s_off,
-                (self.bpl * start.get_line()) + s_off + e_off
+                (self.bpl * (start.get_line() + first)) + s_off,
+                (self.bpl * (start.get_line() + first)) + s_off + e_off
             )
         else:
             tmp = buffer.get_iter_at_line(start.get_line())
@@ -398,8 +513,8 @@ class HexView(gtk.HBox):
             e_off = len(filter(lambda x: len(x) == 2, txt.split(" ")))
 
             self.ascii_text.select_blocks(
-                (self.bpl * start.get_line()) + s_off,
-                (self.bpl * end.get_line()) + e_off
+                (self.bpl * (start.get_line() + first)) + s_off,
+                (self.bpl * (end.get_line() + first)) + e_off
             )
 
     def __on_ascii_change(self, buffer, iter, mark):
@@ -407,15 +522,31 @@ class HexView(gtk.HBox):
             self.hex_text.select_blocks() # Deselect
             return
 
+        first = self.hexwindow.first
         start, end = self.ascii_text.buffer.get_selection_bounds()
         self.hex_text.select_blocks(
-            (self.bpl * start.get_line()) + start.get_line_index(),
-            (self.bpl * end.get_line()) + end.get_line_index()
+            (self.bpl * (start.get_line() + first)) + start.get_line_index(),
+            (self.bpl * (end.get_line() + first)) + end.get_line_index()
         )
 
+    def __select_window(self, start, end):
+        "Set the primary selection on the part of the block rendered"
+        start, end = self.clip_to_window(start, end)
+
+        # We need to add the \n characters one for each line
+        start += start / self.hexwindow.bpl
+        end += end / self.hexwindow.bpl
+
+        buffer = self.ascii_text.get_buffer()
+        start_iter = buffer.get_iter_at_offset(start)
+        end_iter   = buffer.get_iter_at_offset(end)
+
+        buffer.select_range(end_iter, start_iter)
+
     def select_block(self, offset, len, ascii=True):
         """
-        Select a block of data in the HexView
+        Select a block of data in the HexView. If the block is not visible
+        the view is scrolled to its first line.
 
         @param offset the offset byte
         @param len the lenght of selection
@@ -425,35 +556,39 @@ class HexView(gtk.HBox):
         start = offset
         end = offset + len
 
-        # We need to add the \n characters one for each line
-        start += start / self._bpl
-        end += end / self._bpl
-
         if start > end:
             start, end = end, start
 
-        if ascii:
-            # We need to get a fucking iter!
-            buffer = self.ascii_text.get_buffer()
-            start_iter = buffer.get_iter_at_offset(start)
-            end_iter   = buffer.get_iter_at_offset(end)
+        if not ascii:
+            return
+
+        self._selection = (start, end)
+
+        line = start / self.hexwindow.bpl
+        top = int(self.vadj.value)
+
+        if line < top or line >= top + self.hexwindow.visible:
+            self.vadj.set_value(min(line,
+                                    self.vadj.upper - self.vadj.page_size))
 
-            buffer.select_range(end_iter, start_iter)
+        self.__select_window(start, end)
 
     def get_payload(self):
-        return self._payload
+        return self.hexwindow.payload
     def set_payload(self, val):
-        self._payload = val
+        old, self.hexwindow.payload = self.hexwindow.payload, val
 
-        for view in (self.offset_text, self.hex_text, self.ascii_text):
-
-            # Invalidate previous iters
-            if hasattr(view, 'prev_start'):
-                view.prev_start = None
-            if hasattr(view, 'prev_end'):
-                view.prev_end = None
+        if len(old) != len(val) or self.hexwindow.first == self.hexwindow.last:
+            self._selection = None
+            self.vadj.set_value(0)
+            self.__update_adjustment()
+            self.__update_window(True)
+            return
 
-            view.render(self._payload)
+        # Same size. Only the changed lines of the window are rendered again
+        for line in self.hexwindow.get_changed_lines(old):
+            self.hex_text.update_line(val, line, self.hexwindow.first)
+            self.ascii_text.update_line(val, line, self.hexwindow.first)
 
     def get_font(self):
         return self._font
@@ -461,6 +596,7 @@ class HexView(gtk.HBox):
         try:
             desc = pango.FontDescription(val)
             self._font = val
+            self._line_height = None
 
             for view in (self.offset_text, self.hex_text, self.ascii_text):
                 view.modify_font(desc)
@@ -468,12 +604,13 @@ class HexView(gtk.HBox):
             pass
 
     def get_bpl(self):
-        return self._bpl
+        return self.hexwindow.bpl
     def set_bpl(self, val):
-        self._bpl = val
+        self.hexwindow.bpl = val
 
         # Redraw!
-        self.payload = self.payload
+        self.__update_adjustment()
+        self.__update_window(True)
 
     payload = property(get_payload, set_payload)
     font = property(get_font, modify_font)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Adriano Monteiro Marques
+#
+# Author: Francesco Piccinno <stack.box@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Window of lines rendered by the read only HexView and the rendering of the
+lines. This module doesn't depend on gtk.
+
+>>> payload = 'GET / HTTP/1.0\\r\\n\\r\\n'
+>>> offset_lines(0, 2, 3)
+['000', '001']
+>>> hex_lines(payload, 1, 2, 16)
+['0D 0A']
+>>> ascii_lines(payload, 0, 2, 16)
+['GET./.HTTP/1.0..', '..']
+"""
+
+# Lookup tables used to render the lines
+HEX_BYTES = dict([(chr(i), '%02X' % i) for i in xrange(256)])
+
+PRINTABLE = \
+    "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!\"#$%" \
+    "&'()*+,-./:;<=>?@[\]^_`{|}~"
+
+ASCII_TABLE = ''.join([(chr(i) in PRINTABLE) and chr(i) or '.' \
+                       for i in xrange(256)])
+
+def offset_lines(first, last, width):
+    "@return the offset column for the lines between first and last"
+    fmt = "%0" + str(width) + "d"
+    return [fmt % i for i in xrange(first, last)]
+
+def hex_lines(payload, first, last, bpl):
+    "@return the hex column for the lines between first and last"
+    convert = HEX_BYTES.__getitem__
+
+    return [" ".join(map(convert, payload[i * bpl:i * bpl + bpl])) \
+            for i in xrange(first, last)]
+
+def ascii_lines(payload, first, last, bpl):
+    "@return the ascii column for the lines between first and last"
+    return [payload[i * bpl:i * bpl + bpl].translate(ASCII_TABLE) \
+            for i in xrange(first, last)]
+
+class HexWindow(object):
+    """
+    The lines of the payload rendered by a HexView. Only the visible lines
+    plus a margin are rendered, and they are rendered again only when the
+    visible lines go out of the window.
+
+    >>> window = HexWindow()
+    >>> window.payload = ''.join(map(chr, xrange(256))) * 64
+    >>> window.visible = 20
+    >>> window.get_lines(), window.get_offset_width()
+    (1024, 5)
+    >>> window.scroll(0), window.first, window.last
+    (True, 0, 84)
+    >>> window.scroll(10), window.first, window.last
+    (False, 0, 84)
+    >>> window.scroll(10, True)
+    True
+
+    Scrolling out of the window moves it around the visible lines:
+
+    >>> window.scroll(500), window.first, window.last
+    (True, 436, 584)
+    >>> window.scroll(1010), window.first, window.last
+    (True, 946, 1024)
+
+    The bytes are clipped to the window:
+
+    >>> window.scroll(0), window.first, window.last
+    (True, 0, 84)
+    >>> window.clip(16, 20), window.clip(80 * 16, 90 * 16)
+    ((16, 20), (1280, 1344))
+    >>> window.scroll(500)
+    True
+    >>> window.clip(0, 16), window.clip(437 * 16 + 2, 438 * 16)
+    ((0, 0), (18, 32))
+
+    Only the changed lines of the window are rendered again:
+
+    >>> old = window.payload
+    >>> window.payload = old[:500 * 16] + 'A' * 16 + old[501 * 16:]
+    >>> window.get_changed_lines(old)
+    [500]
+    >>> window.payload = old[:16] + 'A' + old[17:]
+    >>> window.get_changed_lines(old)
+    []
+    """
+
+    # Lines rendered above and below the visible ones
+    MARGIN = 64
+
+    def __init__(self, bpl=16):
+        self.bpl = bpl
+        self.payload = ""
+
+        # Lines of the payload rendered
+        self.first = self.last = 0
+
+        # Number of visible lines
+        self.visible = 1
+
+    def get_lines(self):
+        "@return the number of lines of the payload"
+        return (len(self.payload) + self.bpl - 1) / self.bpl
+
+    def get_offset_width(self):
+        "@return the number of digits of the offsets"
+        return len(str(self.get_lines())) + 1
+
+    def scroll(self, top, force=False):
+        """
+        Move the window if the visible lines go out of it
+        @param top the first visible line
+        @param force True to move the window anyway
+        @return True if the lines of the window have to be rendered again
+        """
+        lines = self.get_lines()
+        bottom = min(lines, top + self.visible)
+
+        if not force and top >= self.first and bottom <= self.last:
+            return False
+
+        self.first = max(0, top - self.MARGIN)
+        self.last = min(lines, bottom + self.MARGIN)
+
+        return True
+
+    def clip(self, start, end):
+        """
+        @param start the first byte of the payload
+        @param end the byte after the last one
+        @return start and end relative to the window
+        """
+        base = self.first * self.bpl
+        limit = (self.last - self.first) * self.bpl
+
+        return (max(0, min(start - base, limit)),
+                max(0, min(end - base, limit)))
+
+    def get_changed_lines(self, old):
+        """
+        @param old the previous payload with the same size
+        @return the lines of the window that differ from old
+        """
+        bpl = self.bpl
+
+        return [line for line in xrange(self.first, self.last) \
+                if old[line * bpl:line * bpl + bpl] != \
+                   self.payload[line * bpl:line * bpl + bpl]]
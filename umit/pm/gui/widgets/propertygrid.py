@@ -845,6 +845,10 @@ class PropertyGridTree(gtk.ScrolledWindow):
         packet.reset()
 
     def __on_finish_edit(self, entry, editor):
+        # The editors modify the layer directly
+        if self.packet:
+            self.packet.invalidate()
+
         self.emit('finish-edit', entry)
 
     def __property_cell_func(self, col, cell, model, iter):
@@ -25,6 +25,10 @@ Audit manager module
 import sys
 import os.path
 
+from time import time
+from Queue import Empty
+from struct import unpack
+
 from xml.sax import handler, make_parser
 from xml.sax.saxutils import XMLGenerator
 from xml.sax.xmlreader import AttributesImpl
@@ -32,8 +36,10 @@ from xml.sax.xmlreader import AttributesImpl
 from umit.pm.core.i18n import _
 from umit.pm.core.logger import log
 from umit.pm.core.bus import ServiceBus
+from umit.pm.core.metrics import metrics
 from umit.pm.core.auditutils import AuditOperation
-from umit.pm.manager.sessionmanager import ConnectionManager
+from umit.pm.manager.sessionmanager import SessionManager, \
+                                         ConnectionManager, ExpiryScheduler
 from umit.pm.core.atoms import Singleton, defaultdict, generate_traceback
 from umit.pm.core.const import PM_TYPE_STR, PM_TYPE_INT, PM_TYPE_INSTANCE,\
                                PM_HOME
@@ -201,6 +207,7 @@ class Configuration(object):
         @param odict options dictionary {'key' : [value, 'description' or None]}
         """
         self._name = name
+        self._callbacks = []
 
         if not odict:
             self._dict = {}
@@ -218,6 +225,16 @@ class Configuration(object):
         else:
             raise Exception('value has different type')
 
+        for callback in self._callbacks:
+            callback(self, x, value)
+
+    def connect(self, callback):
+        """
+        @param callback a callable called with (configuration, option, value)
+                        every time an option is set
+        """
+        self._callbacks.append(callback)
+
     def get_name(self): return self._name
     def get_option(self, x):
         """
@@ -244,6 +261,31 @@ class Configuration(object):
 # Implementation
 ###############################################################################
 
+SEVERITIES = ('emerg', 'alert', 'crit', 'err', 'warn', 'notice', 'info',
+              'debug', 'none')
+
+def format_user_msg(msg, severity=5, facility=None):
+    "@return the line shown for a message passed to AuditManager.user_msg()"
+    if facility:
+        return '%s.%s %s' % (facility, SEVERITIES[severity], msg)
+
+    return '%s %s' % (SEVERITIES[severity], msg)
+
+def _tracer(msg, *args):
+    "@return a callable logging msg % args (a step of a traced plan)"
+    def tracer(*ignored, **kwignored):
+        log.debug(msg, *args)
+
+    return tracer
+
+def _traced(msg, args, callback):
+    "@return a callable logging msg % args before calling callback"
+    def traced(*cbargs, **cbkwargs):
+        log.debug(msg, *args)
+        return callback(*cbargs, **cbkwargs)
+
+    return traced
+
 class AuditManager(Singleton):
     """
     This is a singleton classes that is used to track decoders/dissectors etc.
@@ -251,6 +293,7 @@ class AuditManager(Singleton):
     """
     def __init__(self):
         self._output = None
+        self._redirect = None
         # It seems that specifying {} * n doesn't create a new object
         # but instead only create a new pointer to the same object.
         # Here we need separated dict so we should declare them all
@@ -264,14 +307,55 @@ class AuditManager(Singleton):
             'pm::pre-forward' : [],
             'pm::dispatcher'  : [],
         }
+
+        # Dispatch plan used on the packet path. It mirrors _decoders and
+        # _hooks but with immutable tuples and without the empty entries, and
+        # it's recompiled every time a decoder, a dissector or a hook is
+        # registered or removed. While the metrics are enabled the callables
+        # in the plan are wrapped with timers, and with the trace option the
+        # plan also logs every step. The whole plan is recompiled when one of
+        # them changes so run_decoder() never looks at the configuration.
+        self._plan = ({}, {}, {}, {}, {}, {}, {}, {})
+        self._hook_plan = {}
+        self._trace = False
+
+        for name in self._hooks:
+            self.__compile_hook_point(name)
+
+        metrics.connect(self.__compile_plan)
+
         self._configurations = {}
 
         self.load_configurations()
 
         self._global_conf = self.register_configuration('global', {
             'debug' : [False, 'Turn out debugging'],
+            'trace' : [False, 'Log every decoder and hook executed. Slow down '
+                       'the dispatching a lot'],
+            'expiry_interval' : [1, 'Seconds between two runs of the sessions '
+                                 'and connections expiration'],
+            'session_timeout' : [300, 'Seconds of inactivity after which a '
+                                 'session is dropped (0 to disable)'],
+            'session_max' : [65536, 'Max number of sessions tracked (0 for no '
+                             'limit)'],
+            'conn_idle' : [5, 'Seconds of inactivity after which a connection '
+                           'is marked as idle'],
+            'conn_timeout' : [300, 'Seconds of inactivity after which a '
+                              'connection is dropped'],
+            'conn_max' : [65536, 'Max number of connections tracked (0 for no '
+                          'limit)'],
+            'metrics' : [False, 'Collect counters and latencies of the '
+                         'decoders and hooks (see the Statistics view)'],
         })
 
+        self._global_conf.connect(self.__on_global_conf_changed)
+
+        if self._global_conf['metrics']:
+            metrics.enable()
+
+        if self._global_conf['trace']:
+            self.__on_global_conf_changed(self._global_conf, 'trace', True)
+
         self._global_cfields = self.register_configuration('global.cfields', {
             'username' : [PM_TYPE_STR, 'Account username'],
             'password' : [PM_TYPE_STR, 'Account password'],
@@ -384,13 +468,11 @@ class AuditManager(Singleton):
                         8 for none
         @param facility a str representing a facility
         """
-        trans = ('emerg', 'alert', 'crit', 'err', 'warn', 'notice', 'info',
-                 'debug', 'none')
+        if self._redirect:
+            self._redirect(msg, severity, facility)
+            return
 
-        if facility:
-            out = '%s.%s %s' % (facility, trans[severity], msg)
-        else:
-            out = '%s %s' % (trans[severity], msg)
+        out = format_user_msg(msg, severity, facility)
 
         if self._global_conf['debug']:
             print out
@@ -402,6 +484,14 @@ class AuditManager(Singleton):
                 self._output = tab.status
             self._output.info(out)
 
+    def redirect_messages(self, callback):
+        """
+        Redirect the messages passed to user_msg()
+        @param callback a callable accepting (msg, severity, facility) or None
+                        to restore the default behaviour
+        """
+        self._redirect = callback
+
     ############################################################################
     # General hooks
     ############################################################################
@@ -416,11 +506,13 @@ class AuditManager(Singleton):
             return False
 
         self._hooks[name] = []
+        self.__compile_hook_point(name)
         return True
 
     def deregister_hook_point(self, name):
         try:
             del self._hooks[name]
+            self.__compile_hook_point(name)
             return True
         except:
             return False
@@ -431,6 +523,7 @@ class AuditManager(Singleton):
                 self._hooks[name].append(callback)
             else:
                 self._hooks[name].insert(to, callback)
+            self.__compile_hook_point(name)
             return True
         except:
             return False
@@ -438,18 +531,56 @@ class AuditManager(Singleton):
     def remove_from_hook_point(self, name, callback):
         try:
             self._hooks[name].remove(callback)
+            self.__compile_hook_point(name)
             return True
         except:
             return False
 
+    def __compile_hook_point(self, name):
+        if self._hooks.get(name):
+            callbacks = tuple(self._hooks[name])
+
+            if metrics.enabled:
+                callbacks = tuple([metrics.timed('hook.%s' % name, callback) \
+                                   for callback in callbacks])
+
+            if self._trace:
+                callbacks = (_tracer('Starting hook cascade for %s', name), ) +\
+                            tuple([_traced('Callback %d is %s', (idx, callback),
+                                           callback) \
+                                   for idx, callback in enumerate(callbacks)])
+
+            self._hook_plan[name] = callbacks
+        else:
+            self._hook_plan.pop(name, None)
+
+    def __compile_plan(self, *args):
+        "Recompile the whole dispatch plan (timers or trace toggled)"
+        for name in self._hooks:
+            self.__compile_hook_point(name)
+
+        for level, decoders in enumerate(self._decoders):
+            for type in decoders.keys():
+                self.__compile_decoder(level, type)
+
+    def __on_global_conf_changed(self, conf, option, value):
+        if option == 'trace' and value != self._trace:
+            self._trace = value
+            self.__compile_plan()
+        elif option == 'metrics':
+            if value:
+                metrics.enable()
+            else:
+                metrics.disable()
+
     def run_hook_point(self, name, *args, **kwargs):
-        idx = 0
-        log.debug('Starting hook cascade for %s' % name)
-        while name in self._hooks and idx < len(self._hooks[name]):
-            callback = self._hooks[name][idx]
-            log.debug('Callback %d is %s' % (idx, callback))
+        callbacks = self._hook_plan.get(name)
+
+        if not callbacks:
+            return
+
+        for callback in callbacks:
             callback(*args, **kwargs)
-            idx += 1
 
     ############################################################################
     # Injectors
@@ -498,6 +629,7 @@ class AuditManager(Singleton):
         log.debug("Registering dissector %s for level %s with type %s" % \
                   (decoder, level, type))
         self._decoders[level][type] = (decoder, [], [])
+        self.__compile_decoder(level, type)
 
     def remove_decoder(self, level, type, decoder, force=True):
         """
@@ -515,6 +647,7 @@ class AuditManager(Singleton):
                 return False
 
         del self._decoders[level][type]
+        self.__compile_decoder(level, type)
         return True
 
     def add_decoder_hook(self, level, type, decoder_hook, post=0):
@@ -522,14 +655,43 @@ class AuditManager(Singleton):
             self._decoders[level][type] = (None, [], [])
 
         self._decoders[level][type][post + 1].append(decoder_hook)
+        self.__compile_decoder(level, type)
 
     def remove_decoder_hook(self, level, type, decoder_hook, post=0):
         if type not in self._decoders[level]:
             return False
 
         self._decoders[level][type][post + 1].remove(decoder_hook)
+        self.__compile_decoder(level, type)
         return True
 
+    def __compile_decoder(self, level, type):
+        """
+        Update the entry of the dispatch plan for the given level and type.
+        Entries without decoder and hooks are dropped so run_decoder() could
+        stop with a single lookup.
+        """
+        decoder, pre, post = self._decoders[level].get(type, (None, (), ()))
+
+        if (decoder or pre or post) and metrics.enabled:
+            name = 'decoder.%d.%s' % (level, type)
+            timed = metrics.timed
+
+            if decoder:
+                decoder = timed(name, decoder)
+
+            pre = [timed(name + '.pre', hook) for hook in pre]
+            post = [timed(name + '.post', hook) for hook in post]
+
+        if (decoder or pre or post) and self._trace:
+            pre = [_tracer('Running decoder %s (pre: %s post: %s)', decoder,
+                           tuple(pre), tuple(post))] + list(pre)
+
+        if decoder or pre or post:
+            self._plan[level][type] = (decoder, tuple(pre), tuple(post))
+        else:
+            self._plan[level].pop(type, None)
+
     def get_decoder(self, level, type):
         try:
             return self._decoders[level][type]
@@ -539,16 +701,15 @@ class AuditManager(Singleton):
             return None, None, None
 
     def run_decoder(self, level, type, metapkt):
+        plan = self._plan
         ret = None
-        while level is not None and type is not None:
-            decoder, pre, post = self.get_decoder(level, type)
 
-
-            if not decoder and not pre and not post:
+        while level is not None and type is not None:
+            try:
+                decoder, pre, post = plan[level][type]
+            except (KeyError, IndexError, TypeError):
                 return
 
-            #log.debug("Running decoder %s" % decoder)
-
             for pre_hook in pre:
                 pre_hook(metapkt)
 
@@ -597,13 +758,27 @@ class AuditDispatcher(object):
         @param context an AuditContext or None
         """
 
+        conf = AuditManager().global_conf
+        sessions = SessionManager()
+        sessions.configure(conf['session_timeout'], conf['session_max'])
+
         self._datalink = datalink
         self._context = context
-        self._conn_manager = ConnectionManager()
+        self._conn_manager = ConnectionManager(conf['conn_idle'],
+                                               conf['conn_timeout'],
+                                               conf['conn_max'])
+        self._expiry = ExpiryScheduler((sessions, self._conn_manager),
+                                       conf['expiry_interval'])
         self._main_decoder = AuditManager().get_decoder(LINK_LAYER,
                                                         self._datalink)
 
-    def feed(self, mpkt, *args):
+        self._feed_packets = metrics.counter('audit.packets')
+        self._feed_time = metrics.histogram('audit.feed')
+
+        conn_manager = self._conn_manager
+        metrics.gauge('audit.connections', lambda: len(conn_manager.lru))
+
+    def dispatch(self, mpkt, *args):
         """
         General purpose procedure.
         Will be used the main_decoder created in the constructor. So if you need
@@ -615,6 +790,8 @@ class AuditDispatcher(object):
         if not mpkt:# or not self._main_decoder:
             return
 
+        self._expiry.tick(mpkt.get_rawtime())
+
         manager = AuditManager()
         manager.run_hook_point('pm::received', mpkt)
 
@@ -622,36 +799,10 @@ class AuditDispatcher(object):
             manager.run_decoder(LINK_LAYER, self.datalink, mpkt)
             return
 
-        # Same code of run_decoder.
-        # Only executed when there's a context so we can have more granularity
-        # over various callbacks
-
-        level = LINK_LAYER
-        type = self.datalink
+        # With a context we have also to track the connections and to forward
+        # the packet once the decoders chain is completed.
         mpkt.context = self._context
-
-        while level is not None and type is not None:
-            decoder, pre, post = manager.get_decoder(level, type)
-
-            if not decoder and not pre and not post:
-                break
-
-            #log.debug("Running decoder %s" % decoder)
-
-            for pre_hook in pre:
-                pre_hook(mpkt)
-
-            if decoder:
-                ret = decoder(mpkt)
-
-            for post_hook in post:
-                post_hook(mpkt)
-
-            if decoder and isinstance(ret, tuple):
-                # Infinite loop over there :)
-                level, type = ret
-            else:
-                break
+        manager.run_decoder(LINK_LAYER, self.datalink, mpkt)
 
         if not mpkt.flags & MPKT_FORWARDED:
             self._conn_manager.parse(mpkt)
@@ -663,16 +814,256 @@ class AuditDispatcher(object):
         mpkt.context = None
         mpkt.data = ''
 
+    def timed_dispatch(self, mpkt, *args):
+        "dispatch() updating the audit metrics"
+        if not mpkt:
+            return
+
+        start = time()
+        self.dispatch(mpkt)
+
+        self._feed_packets.inc()
+        self._feed_time.record((time() - start) * 1000000)
+
+    # feed() is switched to timed_dispatch() while the metrics are enabled so
+    # disabled metrics cost nothing on the packet path
+    feed = dispatch
 
     def get_main_decoder(self): return self._main_decoder
     def set_main_decoder(self, dec): self._main_decoder = dec
 
     def get_datalink(self): return self._datalink
     def get_connection_manager(self): return self._conn_manager
+    def get_expiry_scheduler(self): return self._expiry
 
     main_decoder = property(get_main_decoder, set_main_decoder)
     datalink = property(get_datalink)
 
+def _on_metrics_toggled(enabled):
+    if enabled:
+        AuditDispatcher.feed = AuditDispatcher.timed_dispatch.im_func
+    else:
+        AuditDispatcher.feed = AuditDispatcher.dispatch.im_func
+
+metrics.connect(_on_metrics_toggled)
+_on_metrics_toggled(metrics.enabled)
+
+def get_flow_shard(raw, datalink):
+    """
+    Get a shard key for the raw packet without dissecting it. The key depends
+    on the unordered pair of IP addresses so both the directions of a flow
+    have the same key. Ports are not used since only the first fragment of
+    an IP datagram carries them: this way all the fragments, the reassembled
+    datagram and the rest of its flow, the IP sessions of the hosts and the
+    ICMP errors about the flow are handled by the same shard.
+
+    @param raw the packet as str
+    @param datalink the datalink type of the packet
+    @return an int (0 for non IP packets)
+    """
+
+    if datalink == IL_TYPE_ETH:
+        offset = 14
+        l3_type = raw[12:14]
+
+        if l3_type == '\x81\x00':
+            offset = 18
+            l3_type = raw[16:18]
+
+        if len(l3_type) < 2:
+            return 0
+
+        l3_type = unpack('!H', l3_type)[0]
+    elif datalink == IL_TYPE_RAWIP:
+        offset = 0
+        l3_type = (ord(raw[:1] or '\x00') >> 4 == 6) and LL_TYPE_IP6 or \
+                  LL_TYPE_IP
+    else:
+        return 0
+
+    if l3_type == LL_TYPE_IP:
+        src = raw[offset + 12:offset + 16]
+        dst = raw[offset + 16:offset + 20]
+    elif l3_type == LL_TYPE_IP6:
+        src = raw[offset + 8:offset + 24]
+        dst = raw[offset + 24:offset + 40]
+    else:
+        return 0
+
+    if src > dst:
+        src, dst = dst, src
+
+    return hash(src + dst) & 0x7fffffff
+
+def _shard_worker(idx, datalink, inqueue, outqueue):
+    """
+    Main procedure of ShardedAuditDispatcher worker processes. Sends back
+    (idx, 'msg', (msg, severity, facility)) for the messages,
+    (idx, 'sessions', list) with the sessions at the end and (idx, 'exit',
+    None) before exiting.
+    """
+    from umit.pm.backend import MetaPacket
+
+    def forward_msg(msg, severity, facility):
+        outqueue.put((idx, 'msg', (msg, severity, facility)))
+
+    AuditManager().redirect_messages(forward_msg)
+    dispatcher = AuditDispatcher(datalink)
+
+    while True:
+        batch = inqueue.get()
+
+        if batch is None:
+            break
+
+        for raw, llcls, ts, flags in batch:
+            try:
+                dispatcher.feed(MetaPacket.new_lazy(raw, llcls, ts, flags))
+            except Exception:
+                log.error(generate_traceback())
+
+    outqueue.put((idx, 'sessions', SessionManager().export_sessions()))
+    outqueue.put((idx, 'exit', None))
+
+class ShardedAuditDispatcher(AuditDispatcher):
+    """
+    An AuditDispatcher that distributes packets over a pool of worker
+    processes. Packets are sharded with get_flow_shard() so a flow is always
+    handled by the same worker in the order of arrival.
+
+    The workers are forked by start() and so they inherit the decoders, the
+    hooks and the configurations registered at that time. Sessions and
+    connections live inside the worker owning the flow. Messages generated
+    with AuditManager().user_msg() are sent back and delivered by poll() and
+    join() in the calling process. When the workers terminate their sessions
+    are sent back and put in the SessionManager of the calling process (the
+    data that can't be pickled is lost).
+
+    Forwarding is not supported so it can't be used with an AuditContext.
+    """
+
+    def __init__(self, datalink=IL_TYPE_ETH, workers=None, batch=256):
+        """
+        @param datalink the datalink to be used
+        @param workers number of worker processes or None to use the number
+                       of CPUs
+        @param batch number of packets sent at once to a worker
+        """
+        AuditDispatcher.__init__(self, datalink)
+
+        self._nworkers = workers
+        self._batch = batch
+
+        self._workers = []
+        self._queues = []
+        self._pending = []
+        self._results = None
+        self._running = set()
+
+    def start(self):
+        import multiprocessing
+
+        if self._workers:
+            return
+
+        if not self._nworkers:
+            self._nworkers = multiprocessing.cpu_count()
+
+        log.debug('Spawning %d audit workers' % self._nworkers)
+
+        self._results = multiprocessing.Queue()
+
+        for idx in xrange(self._nworkers):
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_shard_worker,
+                                              args=(idx, self._datalink,
+                                                    queue, self._results))
+            process.daemon = True
+            process.start()
+
+            self._workers.append(process)
+            self._queues.append(queue)
+            self._pending.append([])
+
+        self._running = set(xrange(self._nworkers))
+
+    def feed(self, mpkt, *args):
+        if not mpkt:
+            return
+
+        if not self._workers:
+            self.start()
+
+        raw = mpkt.get_raw()
+        idx = get_flow_shard(raw, self._datalink) % self._nworkers
+
+        pending = self._pending[idx]
+        pending.append((raw, mpkt.get_llclass(), mpkt.get_rawtime(),
+                        mpkt.flags))
+
+        if len(pending) >= self._batch:
+            self._queues[idx].put(pending)
+            self._pending[idx] = []
+
+            self.poll()
+
+    def poll(self, block=False, timeout=None):
+        """
+        Deliver the messages produced by the workers
+        @param block if True wait for the next message
+        @param timeout the max seconds to wait if block is True
+        @return the number of workers still running
+        """
+        manager = AuditManager()
+
+        while self._running:
+            try:
+                idx, kind, data = self._results.get(block, timeout)
+            except Empty:
+                break
+
+            if kind == 'msg':
+                manager.user_msg(*data)
+            elif kind == 'sessions':
+                SessionManager().import_sessions(data)
+            else:
+                self._running.discard(idx)
+
+            block = False
+
+        return len(self._running)
+
+    def join(self):
+        """
+        Flush the pending packets and wait for the termination of the workers
+        """
+        for idx, queue in enumerate(self._queues):
+            if self._pending[idx]:
+                queue.put(self._pending[idx])
+                self._pending[idx] = []
+
+            queue.put(None)
+
+        while self.poll(True, 0.5):
+            for idx in list(self._running):
+                if self._workers[idx].is_alive():
+                    continue
+
+                # Deliver what it sent before dying
+                self.poll()
+
+                if idx in self._running:
+                    log.error('Audit worker %d died with %s as exitcode' % \
+                              (idx, self._workers[idx].exitcode))
+                    self._running.discard(idx)
+
+        for process in self._workers:
+            process.join()
+
+        self._workers = []
+        self._queues = []
+        self._pending = []
+
 ###############################################################################
 # Plugin related classes
 ###############################################################################
@@ -894,18 +1285,44 @@ class AuditTester(object):
         test.start() # Threaded
         test.join()
     """
-    def __init__(self, pcapfile, datalink=IL_TYPE_ETH):
+    def __init__(self, pcapfile, datalink=IL_TYPE_ETH, workers=0,
+                 dfilter=None):
         """
         Launch an audit manager against a pcap file using the selected backend
+
+        @param workers if > 0 use a ShardedAuditDispatcher with workers
+                       processes (POSIX only)
+        @param dfilter a display filter expression. Only the packets matching
+                       it are fed to the dispatcher.
+        @raise PMErrorException if dfilter is not valid
         """
         import umit.pm.backend
 
-        self.dispatcher = AuditDispatcher(datalink)
+        if workers > 0 and os.name != 'nt':
+            self.dispatcher = ShardedAuditDispatcher(datalink, workers)
+        else:
+            self.dispatcher = AuditDispatcher(datalink)
+
+        callback = self.dispatcher.feed
+
+        if dfilter:
+            match = umit.pm.backend.DisplayFilter(dfilter).match
+            feed = callback
+
+            def callback(mpkt, *args):
+                # None is passed at the end of the capture
+                if mpkt is None or match(mpkt):
+                    feed(mpkt, *args)
+
         self.ctx = umit.pm.backend.SniffContext(None, capfile=pcapfile, capmethod=1,
-                                                callback=self.dispatcher.feed,
+                                                callback=callback,
                                                 audits=False)
 
     def start(self):
+        if isinstance(self.dispatcher, ShardedAuditDispatcher):
+            # Fork before starting the reader thread
+            self.dispatcher.start()
+
         log.debug('Starting context for test')
         self.ctx.start()
 
@@ -913,3 +1330,281 @@ class AuditTester(object):
         log.debug('Waiting for test thread termination')
         # We have to use that for the moment since join in SniffContext is dummy
         self.ctx.thread.join()
+
+        if isinstance(self.dispatcher, ShardedAuditDispatcher):
+            self.dispatcher.join()
+
+def _load_index(fname):
+    """
+    Load the PcapIndex of fname from the sidecar file or build it. The
+    sidecar file is never written in batch mode since the captures could be
+    in a read only directory (or a test corpus).
+    """
+    import umit.pm.backend
+
+    return umit.pm.backend.PcapIndex.load(fname) or \
+           umit.pm.backend.PcapIndex.build(fname)
+
+def _batch_worker(fname, part, parts, datalink, dfilter, index, outqueue):
+    """
+    Main procedure of BatchAuditTester worker processes. The packets of the
+    flows of fname belonging to part are fed to a new AuditDispatcher and the
+    messages and the statistics are sent back. If index is None the PcapIndex
+    of fname is loaded or built by the worker.
+    """
+    import umit.pm.backend
+
+    # (timestamp of the packet being decoded, sequence, msg, severity,
+    #  facility)
+    messages = []
+    current = [0]
+
+    def store_msg(msg, severity, facility):
+        messages.append((current[0], len(messages), msg, severity, facility))
+
+    AuditManager().redirect_messages(store_msg)
+
+    stats = {'packets' : 0, 'bytes' : 0, 'errors' : 0}
+    result = {'messages' : messages, 'stats' : stats, 'error' : None}
+
+    try:
+        if index is None:
+            index = _load_index(fname)
+
+        data = umit.pm.backend.PcapPacketList(fname, index)
+
+        if datalink is None:
+            datalink = data.get_linktype()
+
+            if datalink is None:
+                datalink = IL_TYPE_ETH
+
+        match = None
+
+        if dfilter:
+            match = umit.pm.backend.DisplayFilter(dfilter).match
+
+        dispatcher = AuditDispatcher(datalink)
+
+        for mpkt in data.stream():
+            raw = mpkt.get_raw()
+
+            if parts > 1 and get_flow_shard(raw, datalink) % parts != part:
+                continue
+
+            if match and not match(mpkt):
+                continue
+
+            current[0] = mpkt.get_rawtime()
+            stats['packets'] += 1
+            stats['bytes'] += len(raw)
+
+            try:
+                dispatcher.feed(mpkt)
+            except Exception:
+                stats['errors'] += 1
+                log.error(generate_traceback())
+
+        data.close()
+    except IOError, err:
+        result['error'] = err.strerror or str(err)
+
+    sessions = SessionManager()
+    result['sessions'] = sessions.get_stats()
+    result['tables'] = sessions.get_table_sizes()
+
+    outqueue.put((fname, part, result))
+
+class BatchAuditTester(object):
+    """
+    Run the audits against many capture files using a pool of processes.
+    Every capture could also be split in parts at flow boundaries (with
+    get_flow_shard()) to use the pool with a single huge file.
+
+    Every part is analyzed by a new process forked from the calling one, so
+    the plugins loaded and started before run() are inherited without being
+    loaded again, while sessions and decoders state is not shared between
+    captures. The messages generated with AuditManager().user_msg() and the
+    statistics are collected and merged by get_report() in an order that
+    doesn't depend on the scheduling of the processes.
+
+    The state of the decoders is not shared between the parts of a capture,
+    so the sessions not keyed by the pair of hosts (like the ones of a
+    single host) are created in more than one part and the expiry of the
+    sessions depends on the packets of the part. For this reason the
+    session counters of a split capture are reported for every part and not
+    summed, and the messages about expired sessions or streams could differ
+    from an unsplit run.
+    """
+
+    def __init__(self, files, datalink=None, jobs=None, split=1,
+                 dfilter=None):
+        """
+        @param files a list of capture files
+        @param datalink the datalink to use or None to use the linktype of
+                        every capture
+        @param jobs number of processes or None to use the number of CPUs
+        @param split number of parts every capture is split into
+        @param dfilter a display filter expression. Only the packets matching
+                       it are fed to the dispatchers.
+        @raise PMErrorException if dfilter is not valid
+        """
+        import umit.pm.backend
+
+        if dfilter:
+            # Check the expression before spawning the workers
+            umit.pm.backend.DisplayFilter(dfilter)
+
+        self.files = list(files)
+        self.datalink = datalink
+        self.jobs = jobs
+        self.split = max(1, split)
+        self.dfilter = dfilter
+
+        # (fname, part) -> result dict
+        self.results = {}
+
+    def run(self):
+        "Analyze all the captures and wait for the termination of the workers"
+        import multiprocessing
+
+        jobs = self.jobs or multiprocessing.cpu_count()
+
+        # Start from the biggest captures to balance the load
+        pending = [(fname, part) for fname in self.files \
+                                 for part in xrange(self.split)]
+        pending.sort(key=lambda (fname, part): -os.path.getsize(fname))
+
+        outqueue = multiprocessing.Queue()
+        running = {}
+
+        # The index of a split capture is loaded or built once here and
+        # inherited by the workers of its parts
+        indexes = {}
+
+        log.debug('Analyzing %d parts with %d processes' % (len(pending),
+                                                              jobs))
+
+        while pending or running:
+            while pending and len(running) < jobs:
+                fname, part = pending.pop(0)
+                index = None
+
+                if self.split > 1:
+                    if fname not in indexes:
+                        try:
+                            indexes[fname] = _load_index(fname)
+                        except IOError:
+                            # The workers will report the error
+                            indexes[fname] = None
+
+                    index = indexes[fname]
+
+                    if part == self.split - 1:
+                        del indexes[fname]
+
+                process = multiprocessing.Process(
+                    target=_batch_worker,
+                    args=(fname, part, self.split, self.datalink,
+                          self.dfilter, index, outqueue))
+                process.daemon = True
+                process.start()
+
+                running[(fname, part)] = process
+
+            try:
+                fname, part, result = outqueue.get(True, 1)
+            except Empty:
+                # Check for workers died without sending their results
+                for key, process in running.items():
+                    if not process.is_alive() and outqueue.empty():
+                        process.join()
+                        del running[key]
+
+                        self.results[key] = {
+                            'messages' : [], 'stats' : {}, 'sessions' : {},
+                            'tables' : {}, 'error' : 'Worker terminated '
+                            'with exit code %s' % process.exitcode}
+                continue
+
+            running.pop((fname, part)).join()
+            self.results[(fname, part)] = result
+
+    def get_report(self):
+        """
+        Merge the results of the workers. The messages of every capture are
+        sorted by the timestamp of the packet that generated them.
+
+        @return a list of lines
+        """
+        lines = []
+        totals = defaultdict(int)
+        severities = defaultdict(int)
+
+        # Session counters by part (summed over the captures)
+        sessions = [defaultdict(int) for part in xrange(self.split)]
+        tables = [defaultdict(int) for part in xrange(self.split)]
+
+        for fname in sorted(self.files):
+            messages = []
+
+            for part in xrange(self.split):
+                result = self.results.get((fname, part), None)
+
+                if result is None:
+                    continue
+
+                if result['error']:
+                    lines.append('%s (part %d): %s' % (fname, part,
+                                                        result['error']))
+                    totals['failed'] += 1
+
+                for ts, seq, msg, severity, facility in result['messages']:
+                    messages.append((ts, part, seq, msg, severity, facility))
+
+                for stats, total in ((result['stats'], totals),
+                                     (result['sessions'], sessions[part]),
+                                     (result['tables'], tables[part])):
+                    for key, value in stats.iteritems():
+                        total[key] += value
+
+            messages.sort()
+
+            lines.append('== %s' % fname)
+
+            for ts, part, seq, msg, severity, facility in messages:
+                lines.append(format_user_msg(msg, severity, facility))
+                severities[severity] += 1
+
+        lines.append('== Summary')
+        lines.append('  %-20s %10d' % ('captures', len(self.files)))
+        lines.append('  %-20s %10d' % ('parts', len(self.files) * self.split))
+        lines.append('  %-20s %10d' % ('failed parts', totals['failed']))
+        lines.append('  %-20s %10d' % ('packets', totals['packets']))
+        lines.append('  %-20s %10d' % ('bytes', totals['bytes']))
+        lines.append('  %-20s %10d' % ('decoding errors', totals['errors']))
+
+        for severity in sorted(severities):
+            lines.append('  %-20s %10d' % ('%s messages' % \
+                                          SEVERITIES[severity],
+                                          severities[severity]))
+
+        for part in xrange(self.split):
+            if self.split > 1:
+                lines.append('== Sessions of part %d' % part)
+
+            for key, label in (('sessions', 'live sessions'),
+                               ('expired', 'expired sessions'),
+                               ('evicted', 'evicted sessions')):
+                lines.append('  %-20s %10d' % (label, sessions[part][key]))
+
+            for magic in sorted(tables[part]):
+                # Dissector sessions use the name of the dissector as magic
+                if isinstance(magic, (int, long)):
+                    label = 'table 0x%08x' % magic
+                else:
+                    label = 'table %s' % magic
+
+                lines.append('  %-20s %10d' % (label, tables[part][magic]))
+
+        return lines
@@ -203,6 +203,8 @@ class Prefs(Singleton):
         'gui.operationstab.uniqueupdate' : True,
         'gui.operationstab.updatetimeout' : 500,
 
+        'gui.statstab.updatetimeout' : 1000,
+
         'gui.views.protocol_selector_tab' : True,
 
         'gui.views.property_tab' : True,
@@ -214,6 +216,7 @@ class Prefs(Singleton):
         'gui.views.hack_tab' : False,
         'gui.views.console_tab' : False,
         'gui.views.hostlist_tab' : True,
+        'gui.views.stats_tab' : False,
 
         'backend.system' : 'scapy',
 
@@ -226,6 +229,9 @@ class Prefs(Singleton):
         'backend.system.sniff.audits' : True,
         'backend.system.static.audits' : True,
 
+        # Number of packets kept in memory by contexts (0 means no limit)
+        'backend.system.store.window' : 50000,
+
         'backend.scapy.interface' : '',
 
         'backend.tcpdump' : '/usr/sbin/tcpdump',
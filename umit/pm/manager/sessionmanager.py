@@ -24,10 +24,98 @@ Session manager module.
 
 import time
 
+from threading import Lock
+from cPickle import dumps, HIGHEST_PROTOCOL
+
 from umit.pm.core.logger import log
+from umit.pm.core.metrics import metrics
 from umit.pm.core.atoms import Singleton, defaultdict
 from umit.pm.core.netconst import *
 
+conn_log = log.category('connections')
+
+class LRUList(object):
+    """
+    Intrusive doubly linked list of objects having lru_prev and lru_next
+    attributes, ordered from the least recently used one.
+    """
+
+    __slots__ = ('oldest', 'latest', 'count')
+
+    def __init__(self):
+        self.oldest = self.latest = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def link(self, item):
+        "Put the item at the tail (most recently used) of the list"
+        item.lru_prev = self.latest
+        item.lru_next = None
+
+        if self.latest:
+            self.latest.lru_next = item
+        else:
+            self.oldest = item
+
+        self.latest = item
+        self.count += 1
+
+    def unlink(self, item):
+        if item.lru_prev:
+            item.lru_prev.lru_next = item.lru_next
+        else:
+            self.oldest = item.lru_next
+
+        if item.lru_next:
+            item.lru_next.lru_prev = item.lru_prev
+        else:
+            self.latest = item.lru_prev
+
+        item.lru_prev = item.lru_next = None
+        self.count -= 1
+
+    def touch(self, item):
+        if item is not self.latest:
+            self.unlink(item)
+            self.link(item)
+
+class ExpiryScheduler(object):
+    """
+    Periodically calls expire(now) on a set of managers (SessionManager and
+    ConnectionManager). It's driven by the timestamps of the packets passed
+    to tick() by AuditDispatcher.feed(), so it works in the same way on live
+    captures in the GUI and while replaying a pcap file with AuditTester.
+
+    Every AuditDispatcher has its own scheduler and ConnectionManager used
+    only by the thread feeding it. The SessionManager is shared by all the
+    dispatchers so it locks its tables and keeps a single clock.
+    """
+
+    def __init__(self, managers=(), interval=1):
+        """
+        @param managers a list of objects exposing an expire(now) method
+        @param interval seconds between two expiration runs
+        """
+        self.managers = list(managers)
+        self.interval = interval
+        self.next_run = 0
+        self.runs = 0
+
+    def tick(self, now):
+        """
+        @param now the timestamp of the last packet
+        """
+        if self.next_run - self.interval <= now < self.next_run:
+            return
+
+        self.next_run = now + self.interval
+        self.runs += 1
+
+        for manager in self.managers:
+            manager.expire(now)
+
 class DissectIdent(object):
     magic = None
 
@@ -111,16 +199,74 @@ class Session(object):
         self.data = None
         self.prev = None
 
+        self.last_seen = 0
+        self.lru_prev = self.lru_next = None
+
     def __str__(self):
         return "%s -> %s" % (str(self.prev), str(self.ident))
 
 class SessionManager(Singleton):
     """
     The session manager is a singleton class.
+
+    The sessions of every type (the magic of the ident) are linked in a LRU
+    list. expire() drops the sessions idle for more than the timeout of their
+    type while put_session() drops the least recently used session when
+    max_sessions is hit.
+
+    The manager is shared by all the AuditDispatchers (and their threads) so
+    the tables are protected by a lock. The sessions are stamped with a
+    single clock advanced by the timestamps of the packets of every
+    dispatcher, so a capture replayed while sniffing can't expire the
+    sessions of the other one.
     """
 
     def __init__(self):
         self._sessions = defaultdict(dict)
+        self._lru = {}
+        self._timeouts = {}
+
+        self.timeout = 300
+        self.max_sessions = 65536
+        self.count = 0
+        self.now = 0
+
+        self.lock = Lock()
+
+        self.stats = {'expired' : 0, 'evicted' : 0}
+
+        metrics.gauge('sessions.active', lambda: self.count)
+        metrics.gauge('sessions.expired', lambda: self.stats['expired'])
+        metrics.gauge('sessions.evicted', lambda: self.stats['evicted'])
+
+    def configure(self, timeout, max_sessions):
+        """
+        @param timeout default idle timeout in seconds (0 to disable)
+        @param max_sessions the max number of sessions (0 for no limit)
+        """
+        self.timeout = timeout
+        self.max_sessions = max_sessions
+
+    def set_timeout(self, magic, timeout):
+        """
+        Set the idle timeout for a type of session
+        @param magic the magic of the session ident
+        @param timeout seconds or None to use the default timeout
+        """
+        if timeout is None:
+            self._timeouts.pop(magic, None)
+        else:
+            self._timeouts[magic] = timeout
+
+    def get_stats(self):
+        "@return a dict with the statistics of the session manager"
+        ret = {'sessions' : self.count}
+        ret.update(self.stats)
+        return ret
+
+    def get_table_sizes(self):
+        "@return a dict with the number of sessions for every ident magic"
+        return dict([(magic, len(lru)) for magic, lru in self._lru.iteritems()])
 
     # Dissectors methods
 
@@ -141,7 +287,7 @@ class SessionManager(Singleton):
             ident = self.create_dissect_ident(mpkt, dissector)
 
             sess = Session(ident)
-            self.put_session(sess)
+            self.put_session(sess, mpkt.get_rawtime())
 
             return sess
 
@@ -158,11 +304,11 @@ class SessionManager(Singleton):
 
     def lookup_session(self, mpkt, ports, decoder, create_on_fail=False):
         ident = self.create_dissect_ident(mpkt, decoder)
-        sess = self.get_session(ident)
+        sess = self.get_session(ident, mpkt.get_rawtime())
 
         if create_on_fail and not sess:
             sess = Session(ident)
-            self.put_session(sess)
+            self.put_session(sess, mpkt.get_rawtime())
 
         return sess
 
@@ -170,62 +316,227 @@ class SessionManager(Singleton):
         if mpkt.l4_src in ports and \
            mpkt.l4_flags & TH_PSH != 0:
 
-            return self.get_session(self.create_dissect_ident(mpkt, decoder))
+            return self.get_session(self.create_dissect_ident(mpkt, decoder),
+                                    mpkt.get_rawtime())
 
     # Standard methods
 
-    def put_session(self, sess):
+    def update_time(self, now):
+        """
+        Advance the clock of the manager. It never goes backwards.
+        @param now a timestamp (of a packet) or None
+        """
+        if now > self.now:
+            self.now = now
+
+    def put_session(self, sess, now=None):
         """
         Put the session inside the manager
         @param sess a Session object
+        @param now the timestamp of the packet creating the session or None
         """
+        self.lock.acquire()
+
+        try:
+            self.update_time(now)
+            self.__put_session(sess)
+        finally:
+            self.lock.release()
+
+    def __put_session(self, sess):
+        if self.max_sessions and self.count >= self.max_sessions:
+            self.__evict()
+
+        magic = sess.ident.magic
         hv = sess.ident.mkhash(sess.ident)
-        sessions = self._sessions[sess.ident.magic]
+        sessions = self._sessions[magic]
 
         try:
             sessions[hv].append(sess)
         except:
             sessions[hv] = [sess]
 
+        try:
+            lru = self._lru[magic]
+        except KeyError:
+            lru = self._lru[magic] = LRUList()
+
+        sess.last_seen = self.now
+        lru.link(sess)
+        self.count += 1
+
     def delete_session(self, sess):
         """
-        Delete the session
+        Delete the session. Nothing is done if the session was already
+        deleted or expired.
         """
+        self.lock.acquire()
+
+        try:
+            self.__delete_session(sess)
+        finally:
+            self.lock.release()
+
+    def __delete_session(self, sess):
         hv = sess.ident.mkhash(sess.ident)
         sessions = self._sessions[sess.ident.magic]
 
+        if sess not in sessions.get(hv, ()):
+            return
+
         sessions[hv].remove(sess)
 
         if not sessions[hv]:
             del sessions[hv]
 
-    def get_session(self, ident):
+        self._lru[sess.ident.magic].unlink(sess)
+        self.count -= 1
+
+    def get_session(self, ident, now=None):
+        """
+        @param ident the ident of the session
+        @param now the timestamp of the packet looking for the session or None
+        @return the Session or None
+        """
         hv = ident.mkhash(ident)
 
+        self.lock.acquire()
+
         try:
+            self.update_time(now)
+
             sessions = self._sessions[ident.magic][hv]
 
             for sess in sessions:
                 if sess.ident == ident:
+                    sess.last_seen = self.now
+                    self._lru[ident.magic].touch(sess)
                     return sess
         except:
             return None
+        finally:
+            self.lock.release()
+
+    def export_sessions(self):
+        """
+        @return a picklable list of (ident, data, last_seen) tuples with the
+                sessions from the least recently used one. The data that
+                can't be pickled is replaced by None.
+        """
+        ret = []
+
+        self.lock.acquire()
+
+        try:
+            for lru in self._lru.itervalues():
+                sess = lru.oldest
+
+                while sess:
+                    data = sess.data
+
+                    try:
+                        dumps(data, HIGHEST_PROTOCOL)
+                    except Exception:
+                        log.debug('Data of session %s not exported', sess)
+                        data = None
+
+                    ret.append((sess.ident, data, sess.last_seen))
+                    sess = sess.lru_next
+        finally:
+            self.lock.release()
+
+        return ret
+
+    def import_sessions(self, sessions):
+        """
+        Put the sessions returned by export_sessions() (by another process)
+        in the manager.
+        """
+        for ident, data, last_seen in sorted(sessions, key=lambda x: x[2]):
+            sess = Session(ident)
+            sess.data = data
+
+            self.put_session(sess, last_seen)
+            sess.last_seen = last_seen
+
+    def evict(self):
+        "Delete the least recently used session"
+        self.lock.acquire()
+
+        try:
+            self.__evict()
+        finally:
+            self.lock.release()
+
+    def __evict(self):
+        oldest = None
+
+        for lru in self._lru.itervalues():
+            if lru.oldest and \
+               (oldest is None or lru.oldest.last_seen < oldest.last_seen):
+                oldest = lru.oldest
+
+        if oldest:
+            log.debug('Evicting session %s', oldest)
+
+            self.__delete_session(oldest)
+            self.stats['evicted'] += 1
+
+    def expire(self, now):
+        """
+        Delete the sessions idle for more than the timeout of their type
+        @param now the current time (the timestamp of the last packet)
+        """
+        self.lock.acquire()
+
+        try:
+            self.update_time(now)
+
+            for magic, lru in self._lru.iteritems():
+                timeout = self._timeouts.get(magic, self.timeout)
+
+                if not timeout:
+                    continue
+
+                limit = self.now - timeout
+
+                while lru.oldest and lru.oldest.last_seen <= limit:
+                    self.__delete_session(lru.oldest)
+                    self.stats['expired'] += 1
+        finally:
+            self.lock.release()
 
 class ConnectionManager(object):
     """
-    This class will track connections
+    This class will track connections.
+
+    The connections are linked in a LRU list so expire() only walks the ones
+    idle for more than conn_idle seconds, and the least recently used one is
+    dropped when conn_max is hit. conn_list keeps the connections in order of
+    creation for the GUI.
     """
-    def __init__(self, conn_idle=5, conn_timeout=300):
+    def __init__(self, conn_idle=5, conn_timeout=300, conn_max=65536):
         self.conn_list = []
         self.connections = defaultdict(list)
         self.conn_idle = conn_idle
         self.conn_timeout = conn_timeout
+        self.conn_max = conn_max
+
+        self.lru = LRUList()
+        self.serial = 0
+
+        # Connections deleted but still in conn_list
+        self.garbage = []
+
+        self.stats = {'expired' : 0, 'evicted' : 0}
 
     def parse(self, mpkt):
         if not mpkt.l4_src or not mpkt.l4_dst:
             return
 
-        log.debug("Parsing new mpkt")
+        if conn_log.debug_enabled:
+            conn_log.debug('Parsing new mpkt')
+
         hv, conn = self.search(mpkt)
 
         if conn:
@@ -247,18 +558,28 @@ class ConnectionManager(object):
         return hv, None
 
     def add(self, mpkt, hv):
+        if self.conn_max and len(self.lru) >= self.conn_max:
+            self.evict(mpkt.get_rawtime() or time.time())
+
         conn = Connection(mpkt)
 
-        log.debug("Adding new connection %s" % conn)
+        if conn_log.debug_enabled:
+            conn_log.debug('Adding new connection %s', conn)
+
+        self.serial += 1
+        conn.serial = self.serial
 
         self.connections[hv].append(conn)
+        self.lru.link(conn)
         self.update(conn, mpkt)
         self.conn_list.append(conn)
 
     def update(self, conn, mpkt):
-        log.debug("Updating connection %s" % conn)
+        if conn_log.debug_enabled:
+            conn_log.debug('Updating connection %s', conn)
 
-        conn.ts = time.time()
+        conn.ts = mpkt.get_rawtime() or time.time()
+        self.lru.touch(conn)
 
         if mpkt.l4_flags & TH_SYN:
             conn.status = CN_OPENING
@@ -284,37 +605,97 @@ class ConnectionManager(object):
         if mpkt.flags & MPKT_MODIFIED or mpkt.flags & MPKT_DROPPED:
             conn.flags |= CN_MODIFIED
 
+    def get_new_connections(self, serial):
+        """
+        @param serial the serial of the last connection already seen or 0
+        @return a list of the connections added after it
+        """
+        idx = len(self.conn_list)
+
+        while idx > 0 and self.conn_list[idx - 1].serial > serial:
+            idx -= 1
+
+        return self.conn_list[idx:]
+
+    def get_stats(self):
+        "@return a dict with the statistics of the connection manager"
+        ret = {'connections' : len(self.lru)}
+        ret.update(self.stats)
+        return ret
+
     def cleaner(self):
         """
-        Start this function in a external thread every tot sec
-        to collect garbage.
+        Expire the connections using the current time. Usually expire() is
+        called by the ExpiryScheduler of the AuditDispatcher.
+        """
+        self.expire(time.time())
+
+    def expire(self, now):
+        """
+        Mark as idle the active connections without traffic for conn_idle
+        seconds and delete the ones without traffic for conn_timeout seconds.
+        The connections being viewed are kept alive.
+        @param now the current time
         """
+        conn = self.lru.oldest
 
-        ts = time.time()
+        # The connections being viewed are moved to the tail: stop when the
+        # first one moved is reached again (conn_idle could be 0)
+        first_touched = None
 
-        idx = 0
-        while idx < len(self.conn_list):
-            conn = self.conn_list[idx]
+        while conn and conn is not first_touched and \
+              now - conn.ts >= self.conn_idle:
+            following = conn.lru_next
 
             if conn.flags & CN_VIEWING:
-                continue
+                conn.ts = now
+                self.lru.touch(conn)
 
-            diff = ts - conn.ts
+                if first_touched is None:
+                    first_touched = conn
+            elif now - conn.ts >= self.conn_timeout:
+                self.delete(conn)
+                self.stats['expired'] += 1
+            elif conn.status == CN_ACTIVE:
+                conn.status = CN_IDLE
 
-            if conn.status == CN_ACTIVE and \
-               diff >= self.conn_idle:
+            conn = following
 
-                conn.status = CN_IDLE
+        if self.garbage:
+            garbage = set(self.garbage)
+            self.conn_list = [item for item in self.conn_list \
+                              if item not in garbage]
+            self.garbage = []
+
+    def evict(self, now):
+        "Delete the least recently used connection not being viewed"
+        for idx in xrange(len(self.lru)):
+            conn = self.lru.oldest
+
+            if not conn.flags & CN_VIEWING:
+                conn_log.debug('Evicting connection %s', conn)
 
-            if diff >= self.conn_timeout:
                 self.delete(conn)
-                continue
+                self.stats['evicted'] += 1
+                return
 
-            idx += 1
+            conn.ts = now
+            self.lru.touch(conn)
 
     def delete(self, conn):
-        self.conn_list.remove(conn)
-        self.connections[Connection.mkhash(conn)].remove(conn)
+        """
+        Delete the connection. It's removed from conn_list by the next run
+        of expire().
+        """
+        hv = Connection.mkhash(conn)
+
+        self.connections[hv].remove(conn)
+
+        if not self.connections[hv]:
+            del self.connections[hv]
+
+        self.lru.unlink(conn)
+        self.garbage.append(conn)
 
 class Connection(object):
     def __init__(self, mpkt):
@@ -334,6 +715,9 @@ class Connection(object):
         self.status = 0
         self.ts = 0
 
+        self.serial = 0
+        self.lru_prev = self.lru_next = None
+
     @classmethod
     def mkhash(cls, obj):
         return hash(obj.l3_addr1) ^ hash(obj.l3_addr2) ^ \
@@ -363,7 +747,7 @@ class Connection(object):
             self.xferred += len(mpkt.data)
 
             if len(self.buffers) > 40:
-                log.debug('Removing old buffers')
+                conn_log.debug('Removing old buffers')
                 self.buffers = []
 
             if mpkt.l4_dst == self.l4_addr2: